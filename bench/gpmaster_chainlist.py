@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+"""
+Measure the chainList modifies of gpmaster commands.
+
+Runs add, move and delete of one chain against an in-memory master entry
+holding N chains and prints, for each, the bytes of values sent in the
+modify and the time spent planning it, next to the bytes of replacing the
+whole chainList as the commands did before. No server is needed: the
+modify is recorded instead of sent.
+
+    python3 bench/gpmaster_chainlist.py [N ...]
+"""
+import sys
+import time
+from contextlib import contextmanager
+
+import ldap as _ldap
+
+from ipapython.dn import DN
+from ipaserver.plugins.gpmaster import gpmaster
+
+BASE = 'dc=example,dc=test'
+MASTER_DN = DN('cn=Group Policy Master,cn=System,' + BASE)
+REPEAT = 20
+
+
+def chain_dn(number):
+    return DN('cn=chain{:06d},cn=System,{}'.format(number, BASE))
+
+
+class Entry(dict):
+    def __init__(self, dn, **attrs):
+        super().__init__(attrs)
+        self.dn = dn
+
+
+class Directory:
+    """Master entry served by get_entry, modifies applied and measured."""
+
+    MOD_ATTRS = {_ldap.MOD_ADD: 'add', _ldap.MOD_DELETE: 'delete',
+                 _ldap.MOD_REPLACE: 'replace'}
+
+    def __init__(self, chain_dns):
+        self.conn = self
+        self.entry = Entry(MASTER_DN, chainList=[], chainListOrder=[],
+                           entryUSN=[1])
+        self.sent = 0
+        Master().add_chains(self, chain_dns)
+
+    def get_entry(self, dn, attrs_list):
+        return Entry(dn, **{attr: list(self.entry[attr])
+                            for attr in attrs_list})
+
+    @staticmethod
+    def encode(value):
+        return str(value).encode('utf-8')
+
+    @contextmanager
+    def error_handler(self):
+        yield
+
+    def modify_ext_s(self, dn, modlist, serverctrls=None):
+        for op, attr, values in modlist:
+            self.sent += sum(len(value) for value in values)
+            values = [value.decode('utf-8') for value in values]
+            if op == _ldap.MOD_ADD:
+                self.entry[attr].extend(values)
+            elif op == _ldap.MOD_DELETE:
+                for value in values:
+                    self.entry[attr].remove(value)
+            else:
+                self.entry[attr] = values
+        self.entry['entryUSN'] = [self.entry['entryUSN'][0] + 1]
+
+
+class Master:
+    """The chain list methods of the gpmaster object, without the API."""
+
+    get_dn = staticmethod(lambda: MASTER_DN)
+    read_chain_list = gpmaster.read_chain_list
+    edit_chain_list = gpmaster.edit_chain_list
+    add_chains = gpmaster.add_chains
+    remove_chains = gpmaster.remove_chains
+    move_chain = gpmaster.move_chain
+    change_chain = gpmaster.change_chain
+
+
+def measure(count):
+    dns = [chain_dn(number) for number in range(count)]
+    directory = Directory(dns)
+    master = Master()
+    middle = dns[count // 2]
+    full = sum(len(directory.encode(dn)) for dn in directory.entry['chainList'])
+    rows = []
+    for change, dn in (('add', chain_dn(count)), ('moveup', middle),
+                       ('movedown', middle), ('del', dns[-1])):
+        sent = directory.sent
+        start = time.perf_counter()
+        for _attempt in range(REPEAT):
+            master.change_chain(directory, dn, change)
+            # Undo, so that every round starts from the same list
+            master.change_chain(directory, dn, {
+                'add': 'del', 'del': 'add', 'moveup': 'movedown',
+                'movedown': 'moveup'}[change])
+        elapsed = (time.perf_counter() - start) / (2 * REPEAT)
+        rows.append((change, (directory.sent - sent) / (2 * REPEAT),
+                     elapsed * 1000))
+    return full, rows
+
+
+def main(counts):
+    for count in counts:
+        full, rows = measure(count)
+        print('{} chains, whole chainList {} bytes'.format(count, full))
+        for change, sent, elapsed in rows:
+            print('  {:<9} {:>8.0f} bytes sent  {:>8.2f} ms'.format(
+                change, sent, elapsed))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 5000])
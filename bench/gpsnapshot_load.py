@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+"""
+Measure loading the Group Policy snapshot against parsing the same data.
+
+Writes a snapshot of POLICIES policies and CHAINS chains of LINKS links
+each, and the same data as JSON, then measures in separate processes:
+the JSON load into dicts and its resident memory, and the snapshot open,
+lookups and resident memory after decoding every chain. The snapshot
+pages are file-backed and shared by every process mapping the file,
+while the dicts are private to each process.
+
+    python3 bench/gpsnapshot_load.py [DIRECTORY]
+"""
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from ipaserver.plugins.gpsnapshot import Snapshot, SnapshotWriter
+
+BASE = 'dc=example,dc=test'
+POLICIES = 100000
+CHAINS = 20000
+LINKS = 10
+LOOKUPS = 20000
+
+
+def policy(number):
+    guid = '{{G-{:08d}}}'.format(number)
+    return ('cn={},cn=Policies,cn=System,{}'.format(guid, BASE), guid,
+            'Policy number {}'.format(number),
+            '\\\\example.test\\SysVol\\example.test\\Policies\\' + guid)
+
+
+def chain(number):
+    return ('cn=chain{},cn=System,{}'.format(number, BASE),
+            'chain{}'.format(number),
+            'cn=ug{},cn=groups,cn=accounts,{}'.format(number % 500, BASE),
+            'cn=hg{},cn=hostgroups,cn=accounts,{}'.format(number % 300, BASE),
+            [policy((number * LINKS + link) % POLICIES)[0]
+             for link in range(LINKS)])
+
+
+def rss():
+    """Return private and file-backed resident memory in MiB."""
+    found = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            name, _sep, value = line.partition(':')
+            if name in ('RssAnon', 'RssFile'):
+                found[name] = int(value.split()[0]) / 1024
+    return found['RssAnon'], found['RssFile']
+
+
+def write(directory):
+    writer = SnapshotWriter(1)
+    data = {'policies': {}, 'chains': {}}
+    start = time.perf_counter()
+    for number in range(POLICIES):
+        dn, guid, name, path = policy(number)
+        writer.add_policy(dn, guid, name, path, 3, 0)
+        data['policies'][dn] = {'guid': guid, 'name': name, 'path': path,
+                                'version': 3, 'flags': 0}
+    for number in range(CHAINS):
+        dn, name, usergroup, computergroup, links = chain(number)
+        writer.add_chain(dn, name, usergroup, computergroup, links)
+        data['chains'][dn] = {'name': name, 'usergroup': usergroup,
+                              'computergroup': computergroup,
+                              'gplink': links}
+    writer.set_chain_order(list(data['chains']))
+    size = writer.write(os.path.join(directory, 'gp.snap'))
+    print('snapshot: written in {:.2f} s, {:.1f} MiB'.format(
+        time.perf_counter() - start, size / 2 ** 20))
+
+    with open(os.path.join(directory, 'gp.json'), 'w') as f:
+        json.dump(data, f)
+    print('json: {:.1f} MiB'.format(
+        os.path.getsize(os.path.join(directory, 'gp.json')) / 2 ** 20))
+
+
+def load_json(directory):
+    base = rss()[0]
+    start = time.perf_counter()
+    with open(os.path.join(directory, 'gp.json')) as f:
+        data = json.load(f)
+    by_name = {value['name'].lower(): dn
+               for dn, value in data['policies'].items()}
+    print('json: loaded in {:.3f} s, +{:.0f} MiB private, {} names'.format(
+        time.perf_counter() - start, rss()[0] - base, len(by_name)))
+
+
+def load_snapshot(directory):
+    base = rss()
+    start = time.perf_counter()
+    snapshot = Snapshot(os.path.join(directory, 'gp.snap'))
+    opened = time.perf_counter() - start
+
+    names = ['Policy number {}'.format(random.randrange(POLICIES))
+             for _lookup in range(LOOKUPS)]
+    start = time.perf_counter()
+    for name in names:
+        snapshot.policy(snapshot.find_policy(name=name))
+    lookup = (time.perf_counter() - start) / LOOKUPS
+
+    start = time.perf_counter()
+    for index in range(snapshot.chain_count):
+        snapshot.chain(index)
+    decode = (time.perf_counter() - start) / snapshot.chain_count
+
+    private, shared = rss()
+    print('snapshot: opened in {:.0f} us, name lookup and decode {:.1f} us, '
+          'chain decode {:.1f} us; after every chain +{:.0f} MiB private, '
+          '+{:.0f} MiB file-backed'.format(
+              opened * 1e6, lookup * 1e6, decode * 1e6,
+              private - base[0], shared - base[1]))
+
+
+def main(argv):
+    if len(argv) == 3:
+        {'json': load_json, 'snapshot': load_snapshot}[argv[1]](argv[2])
+        return
+    directory = argv[1] if len(argv) > 1 else tempfile.mkdtemp()
+    write(directory)
+    for mode in ('json', 'snapshot'):
+        subprocess.run([sys.executable, argv[0], mode, directory],
+                       check=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+"""
+Measure the full check run of ipa-gpo-install before and after the
+in-process system queries.
+
+Runs the critical and configuration checks of the installer REPEAT times
+as they are now, and REPEAT times with the service and share checks
+done the way they were before ipa_gpo_install.system: one
+`systemctl is-active` per IPA service and `net conf list` searched for
+"sysvol". The LDAP checks are the same in both runs. Prints the median
+and fastest run of each, and the time of the two changed checks.
+
+Run as root on an IPA server with an admin Kerberos ticket:
+
+    python3 bench/install_checks.py [REPEAT]
+"""
+import logging
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+from ipalib import api
+from ipaplatform.paths import paths
+
+from ipa_gpo_install import checks
+from ipa_gpo_install.cli import (
+    check_critical_requirements,
+    perform_configuration_checks,
+)
+from ipa_gpo_install.checks import IPAChecker
+
+REPEAT = 10
+
+
+def forked_unit_states(units):
+    """State of each unit from its own systemctl, as the checks did."""
+    return {unit: subprocess.run(['systemctl', 'is-active', unit],
+                                 capture_output=True,
+                                 text=True).stdout.strip()
+            for unit in units}
+
+
+class ForkedSambaConfig:
+    """Share check over net conf list, as the checks did."""
+
+    def share_exists(self, name):
+        result = subprocess.run(['net', 'conf', 'list'],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr)
+        return name in result.stdout
+
+
+@contextmanager
+def forked_queries():
+    saved = checks.unit_states, checks.SambaConfig
+    checks.unit_states, checks.SambaConfig = \
+        forked_unit_states, ForkedSambaConfig
+    try:
+        yield
+    finally:
+        checks.unit_states, checks.SambaConfig = saved
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def measure(checker, repeat):
+    runs, changed = [], []
+    for _run in range(repeat):
+        start = time.perf_counter()
+        if not check_critical_requirements(checker):
+            sys.exit('critical requirements are not met, see the log')
+        perform_configuration_checks(checker)
+        runs.append(time.perf_counter() - start)
+        changed.append(timed(checker.check_ipa_services) +
+                       timed(checker.check_sysvol_share))
+    return runs, changed
+
+
+def report(name, runs, changed):
+    print('{}: median {:.0f} ms, fastest {:.0f} ms; services and share '
+          'checks {:.1f} ms'.format(
+              name, statistics.median(runs) * 1000, min(runs) * 1000,
+              statistics.median(changed) * 1000))
+
+
+def main(argv):
+    repeat = int(argv[1]) if len(argv) > 1 else REPEAT
+    logging.basicConfig(level=logging.CRITICAL)
+    api.bootstrap(in_server=True, debug=False, context='installer',
+                  confdir=paths.ETC_IPA)
+    api.finalize()
+    api.Backend.ldap2.connect()
+
+    checker = IPAChecker(logging.getLogger('bench'), api)
+    # Warm up the connection and the schema caches of both runs
+    measure(checker, 1)
+    with forked_queries():
+        before = measure(checker, repeat)
+    after = measure(checker, repeat)
+    report('before', *before)
+    report('after', *after)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -37,8 +37,17 @@ mkdir -p %buildroot%_datadir/locale/ru/LC_MESSAGES
 mkdir -p %buildroot%_mandir/man8
 mkdir -p %buildroot%_mandir/ru/man8
 mkdir -p %buildroot%_datadir/bash-completion/completions
+mkdir -p %buildroot%_unitdir
 
 install -m 755 bin/ipa-gpo-install %buildroot%_bindir/
+install -m 755 bin/ipa-gpo-resolverd %buildroot%_bindir/
+install -m 755 bin/ipa-gpo-sysvol-gc %buildroot%_bindir/
+install -m 755 bin/ipa-gpo-sysvol-watch %buildroot%_bindir/
+install -m 644 data/ipa-gpo-resolverd.service %buildroot%_unitdir/
+install -m 644 data/ipa-gpo-provision.service %buildroot%_unitdir/
+install -m 644 data/ipa-gpo-provision.timer %buildroot%_unitdir/
+install -m 644 data/ipa-gpo-health.service %buildroot%_unitdir/
+install -m 644 data/ipa-gpo-sysvol-watch.service %buildroot%_unitdir/
 cp -a ipa_gpo_install/* %buildroot%python3_sitelibdir/ipa_gpo_install/
 install -m 644 data/74alt-group-policy.ldif %buildroot%_datadir/%name/data/
 install -m 644 locale/ru/LC_MESSAGES/ipa-gpo-install.mo %buildroot%_datadir/locale/ru/LC_MESSAGES/
@@ -49,6 +58,14 @@ install -m 644 completions/ipa-gpo-install %buildroot%_datadir/bash-completion/c
 %files
 %doc README.md
 %_bindir/ipa-gpo-install
+%_bindir/ipa-gpo-resolverd
+%_bindir/ipa-gpo-sysvol-gc
+%_bindir/ipa-gpo-sysvol-watch
+%_unitdir/ipa-gpo-resolverd.service
+%_unitdir/ipa-gpo-provision.service
+%_unitdir/ipa-gpo-provision.timer
+%_unitdir/ipa-gpo-health.service
+%_unitdir/ipa-gpo-sysvol-watch.service
 %python3_sitelibdir/ipa_gpo_install
 %_datadir/%name
 %_datadir/locale/ru/LC_MESSAGES/%name.mo
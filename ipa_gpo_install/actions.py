@@ -1,17 +1,28 @@
 #!/usr/bin/env python3
 
 import os
+import grp
 import logging
-import subprocess
 import gettext
 import locale
 from pathlib import Path
 from os.path import dirname, join, abspath
 
-from ipalib import api
+from ipalib import api, errors
 from ipapython import ipautil
+from ipapython.dn import DN
+from ipaplatform.constants import constants
 from ipaplatform.paths import paths
 
+from ipa_gpo_install.checks import (
+    NAME_CACHE_PATH, ORDERED_ATTRIBUTES, PROVISIONING_QUEUE_PATH,
+    TARGET_GROUP_FILTER, TARGET_OBJECTCLASS,
+)
+from ipa_gpo_install.schema import apply_schema, diff_schema
+from ipa_gpo_install.sysvol_acl import SysvolPermissions
+from ipa_gpo_install.system import SambaConfig, set_default_acl
+from ipa_gpo_install.sysvol_gc import SysvolCollector
+
 
 LOCALE_DIR = '/usr/share/locale'
 
@@ -43,36 +54,35 @@ class IPAActions:
         self.logger = logger or logging.getLogger('ipa-gpo-install')
         self.api = api_instance or api
 
-    def add_ldif_schema(self, ldif_file):
+    def update_schema(self, ldif_files):
         """
-        Add LDIF schema to LDAP using ipa-ldap-updater
+        Add missing and changed schema definitions of LDIF files to LDAP
+
+        The files are compared with the server schema and the difference is
+        applied with a single modify over the existing LDAP connection.
 
         Args:
-            ldif_file: Path to LDIF file
+            ldif_files: Paths to LDIF files; missing files are skipped
 
         Returns:
-            True if successfully added, False otherwise
+            True if the schema is up to date, False otherwise
         """
         try:
-            if not os.path.exists(ldif_file):
-                self.logger.error(_("LDIF file not found: {}").format(ldif_file))
-                return False
-
-            self.logger.info(_("Adding LDIF schema from file: {}").format(ldif_file))
-            cmd = ['/usr/sbin/ipa-ldap-updater', '-S', ldif_file]
-            self.logger.debug(_("Running: {}").format(' '.join(cmd)))
-            result = ipautil.run(cmd, raiseonerr=False)
+            conn = self.api.Backend.ldap2.conn
+            diff = diff_schema(conn, ldif_files)
+            for line in diff.lines():
+                self.logger.info(_("Schema difference: {}").format(line))
 
-            if result.returncode == 0:
-                self.logger.info(_("Successfully added schema from {}").format(ldif_file))
+            if diff.current:
+                self.logger.info(_("LDAP schema is up to date"))
                 return True
-            else:
-                error_msg = result.error_output or _("Unknown error")
-                self.logger.error(_("Failed to add schema from {}: {}").format(ldif_file, error_msg))
-                return False
+
+            count = apply_schema(conn, diff)
+            self.logger.info(_("Updated {} schema definitions").format(count))
+            return True
 
         except Exception as e:
-            self.logger.error(_("Error adding LDIF schema: {}").format(e))
+            self.logger.error(_("Error updating LDAP schema: {}").format(e))
             return False
 
     def install_adtrust(self):
@@ -136,20 +146,56 @@ class IPAActions:
         Tries to set default ACLs on the given path.
         Returns True if successful, False otherwise.
         """
-        if ipautil.run(["which", "setfacl"], raiseonerr=False).returncode != 0:
-            return False
-
         self.logger.info(_("Setting default ACLs on {}").format(path))
-        cmd = ["setfacl", "-d", "-m", "g:admins:rwx,o::r-x", str(path)]
-        result = ipautil.run(cmd, raiseonerr=False)
-
-        if result.returncode != 0:
-            self.logger.warning(_("Failed to set ACLs on {}: {}").format(path, result.error_output))
+        try:
+            set_default_acl(str(path), grp.getgrnam("admins").gr_gid)
+        except (KeyError, OSError, ipautil.CalledProcessError) as e:
+            self.logger.warning(_("Failed to set ACLs on {}: {}").format(path, e))
             return False
 
         self.logger.info(_("Successfully set default ACLs on {}").format(path))
         return True
 
+    def create_provisioning_queue(self):
+        """
+        Create the directory queuing SYSVOL policy directories to create.
+
+        The web server adds jobs to it, the oddjob helper running as root
+        processes them.
+
+        Returns:
+            True if creation was successful, False otherwise
+        """
+        try:
+            os.makedirs(PROVISIONING_QUEUE_PATH, mode=0o770, exist_ok=True)
+            os.chown(PROVISIONING_QUEUE_PATH, 0, constants.HTTPD_GROUP.gid)
+            os.chmod(PROVISIONING_QUEUE_PATH, 0o770)
+            self.logger.info(_("Provisioning queue directory created: {}").format(PROVISIONING_QUEUE_PATH))
+            return True
+
+        except Exception as e:
+            self.logger.error(_("Error creating provisioning queue directory: {}").format(e))
+            return False
+
+    def create_name_cache(self):
+        """
+        Create the directory of the name cache shared by the web server
+        processes.
+
+        Returns:
+            True if creation was successful, False otherwise
+        """
+        try:
+            os.makedirs(NAME_CACHE_PATH, mode=0o770, exist_ok=True)
+            os.chown(NAME_CACHE_PATH, 0, constants.HTTPD_GROUP.gid)
+            os.chmod(NAME_CACHE_PATH, 0o770)
+            self.logger.info(_("Name cache directory created: {}").format(NAME_CACHE_PATH))
+            return True
+
+        except Exception as e:
+            self.logger.error(_("Error creating name cache directory: {}").format(e))
+            return False
+
     def create_sysvol_share(self):
         """
         Create SYSVOL Samba share
@@ -165,12 +211,10 @@ class IPAActions:
                 self.logger.error(_("Cannot create share: directory {} does not exist").format(sysvol_path))
                 return False
 
-            cmd = ["net", "conf", "addshare", "sysvol", sysvol_path, "writeable=y", "guest_ok=N"]
-            self.logger.debug(_("Running: {}").format(' '.join(cmd)))
-            result = ipautil.run(cmd, raiseonerr=False)
-
-            if result.returncode != 0:
-                self.logger.error(_("Failed to create SYSVOL share: {}").format(result.error_output))
+            try:
+                SambaConfig().add_share("sysvol", sysvol_path, writeable=True)
+            except Exception as e:
+                self.logger.error(_("Failed to create SYSVOL share: {}").format(e))
                 return False
 
             self.logger.info(_("SYSVOL share created successfully"))
@@ -178,4 +222,125 @@ class IPAActions:
 
         except Exception as e:
             self.logger.error(_("Error creating SYSVOL share: {}").format(e))
-            return False
\ No newline at end of file
+            return False
+
+    def migrate_ordering(self):
+        """
+        Add position keys to chains and the master that lack them.
+
+        The current value order of gpLink and chainList is kept. Entries are
+        found with one search per list attribute.
+
+        Returns:
+            True if migration was successful, False otherwise
+        """
+        try:
+            from ipaserver.plugins.gporder import RankedList
+        except ImportError:
+            self.logger.warning(_("Group Policy server plugins are not installed, skipping list migration"))
+            return True
+
+        try:
+            ldap2 = self.api.Backend.ldap2
+            migrated = 0
+            for object_class, list_attr, order_attr in ORDERED_ATTRIBUTES:
+                search_filter = '(&(objectClass={})({}=*)(!({}=*)))'.format(
+                    object_class, list_attr, order_attr)
+                try:
+                    entries = ldap2.get_entries(
+                        DN(self.api.env.basedn), ldap2.SCOPE_SUBTREE,
+                        search_filter, [list_attr], paged_search=True)
+                except errors.NotFound:
+                    continue
+
+                for entry in entries:
+                    ranked = RankedList(entry.get(list_attr, []), key=DN)
+                    entry[order_attr] = ranked.migrate()[0]
+                    ldap2.update_entry(entry)
+                    migrated += 1
+
+            self.logger.info(_("Added position keys to {} entries").format(migrated))
+            return True
+
+        except Exception as e:
+            self.logger.error(_("Error migrating Group Policy list ordering: {}").format(e))
+            return False
+
+    def add_group_targets(self):
+        """
+        Add the Group Policy object class to user and host groups
+
+        Chain commands keep the chain lists of groups, but may only write
+        those lists: the class is added here for existing groups, and by
+        group-add and hostgroup-add for new ones.
+
+        Returns:
+            True if all groups were updated, False otherwise
+        """
+        try:
+            ldap2 = self.api.Backend.ldap2
+            try:
+                entries = ldap2.get_entries(
+                    DN(self.api.env.basedn), ldap2.SCOPE_SUBTREE,
+                    TARGET_GROUP_FILTER, ['objectClass'], paged_search=True)
+            except errors.NotFound:
+                entries = []
+
+            for entry in entries:
+                entry['objectClass'].append(TARGET_OBJECTCLASS)
+                ldap2.update_entry(entry)
+
+            self.logger.info(_("Added the Group Policy object class to {} groups").format(len(entries)))
+            return True
+
+        except Exception as e:
+            self.logger.error(_("Error adding the Group Policy object class to groups: {}").format(e))
+            return False
+
+    def repair_sysvol_permissions(self, dry_run=False):
+        """
+        Set the expected ACLs on every directory and file of SYSVOL
+
+        Args:
+            dry_run: Only report the paths with wrong permissions
+
+        Returns:
+            True if the tree was walked, False otherwise
+        """
+        try:
+            checker = SysvolPermissions(dry_run=dry_run, log=self.logger)
+            stats = checker.repair()
+            if dry_run:
+                message = _("Checked {} SYSVOL paths, {} with wrong permissions, {} errors")
+            else:
+                message = _("Checked {} SYSVOL paths, repaired {}, {} errors")
+            self.logger.info(message.format(stats['checked'], stats['repaired'], stats['errors']))
+            if stats['fallback']:
+                self.logger.warning(_("ACLs are not supported, modes were checked on {} paths").format(stats['fallback']))
+            return stats['errors'] == 0
+
+        except Exception as e:
+            self.logger.error(_("Error repairing SYSVOL permissions: {}").format(e))
+            return False
+
+    def collect_sysvol_garbage(self, dry_run=False):
+        """
+        Quarantine SYSVOL policy directories without a Group Policy entry
+
+        Args:
+            dry_run: Only report the orphaned directories
+
+        Returns:
+            True if collection was successful, False otherwise
+        """
+        try:
+            collector = SysvolCollector(self.api, dry_run=dry_run,
+                                        log=self.logger)
+            stats = collector.collect()
+            self.logger.info(_("Orphaned policy directories: {}, quarantined: {}, left for the next run: {}").format(
+                stats['orphans'], stats['quarantined'], stats['remaining']))
+            return True
+
+        except Exception as e:
+            self.logger.error(_("Error collecting SYSVOL directories: {}").format(e))
+            return False
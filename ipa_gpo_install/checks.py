@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
 import logging
 import ldap
 import gettext
 import locale
 from os.path import dirname, join, abspath
 
-from ipalib import api
+from ipalib import api, errors
 from ipalib import krb_utils
-from ipapython import ipautil
+from ipapython.dn import DN
+from ipaplatform.constants import constants
+
+from ipa_gpo_install.schema import diff_schema
+from ipa_gpo_install.system import SambaConfig, unit_states
 
 LOCALE_DIR = '/usr/share/locale'
 
@@ -28,6 +31,24 @@ except Exception as e:
     def _(text):
         return text
 
+# Queue of SYSVOL policy directories created by the oddjob helper
+PROVISIONING_QUEUE_PATH = '/var/lib/ipa-gpo/provision'
+
+# Name cache shared by the web server processes
+NAME_CACHE_PATH = '/var/cache/ipa-gpo/names'
+
+# Ordered list attributes and the companion attributes holding their ranks
+ORDERED_ATTRIBUTES = (
+    ('groupPolicyChain', 'gpLink', 'gpLinkOrder'),
+    ('groupPolicyMaster', 'chainList', 'chainListOrder'),
+)
+
+# Auxiliary class of the groups chains apply to, and the group classes
+TARGET_OBJECTCLASS = 'groupPolicyTarget'
+TARGET_GROUP_FILTER = ('(&(|(objectClass=ipaUserGroup)(objectClass=ipaHostGroup))'
+                       '(!(objectClass={})))'.format(TARGET_OBJECTCLASS))
+
+
 class IPAChecker:
     """Class for performing various checks in IPA environment"""
 
@@ -115,13 +136,9 @@ class IPAChecker:
             ]
             self.logger.debug(_("Checking IPA services"))
 
+            states = unit_states(services)
             for service in services:
-                cmd = ['systemctl', 'is-active', service]
-                self.logger.debug(_("Running: {}").format(' '.join(cmd)))
-
-                result = ipautil.run(cmd, raiseonerr=False)
-
-                if result.returncode != 0:
+                if states[service] != 'active':
                     self.logger.error(_("Service {} is not active").format(service))
                     return False
                 self.logger.debug(_("Service {} is active").format(service))
@@ -167,6 +184,28 @@ class IPAChecker:
             self.logger.error(_("Error checking schema object classes: {}").format(e))
             return False
 
+    def check_schema_current(self, ldif_files):
+        """
+        Check if the server schema holds the definitions of LDIF files
+
+        Args:
+            ldif_files: Paths to LDIF files; missing files are skipped
+
+        Returns:
+            True if no definition is missing or different, False otherwise
+        """
+        try:
+            diff = diff_schema(self.api.Backend.ldap2.conn, ldif_files)
+            for line in diff.lines():
+                self.logger.info(_("Schema difference: {}").format(line))
+            if diff.current:
+                self.logger.debug(_("{} schema definitions are up to date").format(diff.unchanged))
+            return diff.current
+
+        except Exception as e:
+            self.logger.error(_("Error comparing LDAP schema: {}").format(e))
+            return False
+
     def check_adtrust_installed(self):
         """
         Check if AD Trust support is enabled in FreeIPA
@@ -223,6 +262,52 @@ class IPAChecker:
             self.logger.error(_("Error checking SYSVOL directory: {}").format(e))
             return False
 
+    def check_provisioning_queue(self):
+        """
+        Check if the provisioning queue directory is writable by the web server
+
+        Returns:
+            True if the directory exists with the expected group, False otherwise
+        """
+        try:
+            if not os.path.isdir(PROVISIONING_QUEUE_PATH):
+                self.logger.warning(_("Provisioning queue directory does not exist: {}").format(PROVISIONING_QUEUE_PATH))
+                return False
+
+            if os.stat(PROVISIONING_QUEUE_PATH).st_gid != constants.HTTPD_GROUP.gid:
+                self.logger.warning(_("Provisioning queue directory is not writable by the web server"))
+                return False
+
+            self.logger.info(_("Provisioning queue directory exists"))
+            return True
+
+        except Exception as e:
+            self.logger.error(_("Error checking provisioning queue directory: {}").format(e))
+            return False
+
+    def check_name_cache(self):
+        """
+        Check if the shared name cache directory is writable by the web server
+
+        Returns:
+            True if the directory exists with the expected group, False otherwise
+        """
+        try:
+            if not os.path.isdir(NAME_CACHE_PATH):
+                self.logger.warning(_("Name cache directory does not exist: {}").format(NAME_CACHE_PATH))
+                return False
+
+            if os.stat(NAME_CACHE_PATH).st_gid != constants.HTTPD_GROUP.gid:
+                self.logger.warning(_("Name cache directory is not writable by the web server"))
+                return False
+
+            self.logger.info(_("Name cache directory exists"))
+            return True
+
+        except Exception as e:
+            self.logger.error(_("Error checking name cache directory: {}").format(e))
+            return False
+
     def check_sysvol_share(self):
         """
         Check if SYSVOL share exists
@@ -232,13 +317,7 @@ class IPAChecker:
         """
         try:
             self.logger.debug(_("Checking if SYSVOL share exists"))
-            cmd = ["net", "conf", "list"]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                self.logger.error(_("Error listing Samba shares: {}").format(result.stderr))
-                return False
-
-            has_share = "sysvol" in result.stdout
+            has_share = SambaConfig().share_exists("sysvol")
             if has_share:
                 self.logger.info(_("SYSVOL share exists"))
             else:
@@ -248,4 +327,63 @@ class IPAChecker:
 
         except Exception as e:
             self.logger.error(_("Error checking SYSVOL share: {}").format(e))
-            return False
\ No newline at end of file
+            return False
+
+    def check_ordering_migrated(self):
+        """
+        Check if ordered Group Policy lists carry explicit position keys
+
+        Returns:
+            True if no chain or master entry needs migration, False otherwise
+        """
+        try:
+            ldap2 = self.api.Backend.ldap2
+            for object_class, list_attr, order_attr in ORDERED_ATTRIBUTES:
+                if ldap2.schema.get_obj(ldap.schema.AttributeType, order_attr) is None:
+                    self.logger.debug(_("Attribute '{}' does not exist in schema").format(order_attr))
+                    continue
+                search_filter = '(&(objectClass={})({}=*)(!({}=*)))'.format(
+                    object_class, list_attr, order_attr)
+                try:
+                    ldap2.find_entries(search_filter, ['dn'],
+                                       DN(self.api.env.basedn), size_limit=1)
+                except errors.NotFound:
+                    continue
+                self.logger.info(_("Entries with {} need position keys").format(list_attr))
+                return False
+
+            self.logger.debug(_("Group Policy lists have position keys"))
+            return True
+
+        except errors.LimitsExceeded:
+            return False
+        except Exception as e:
+            self.logger.error(_("Error checking Group Policy list ordering: {}").format(e))
+            return False
+
+    def check_group_targets(self):
+        """
+        Check if all user and host groups have the Group Policy object class
+
+        Returns:
+            True if no group lacks the class, False otherwise
+        """
+        try:
+            ldap2 = self.api.Backend.ldap2
+            if ldap2.schema.get_obj(ldap.schema.ObjectClass, TARGET_OBJECTCLASS) is None:
+                self.logger.debug(_("Object class '{}' does not exist in schema").format(TARGET_OBJECTCLASS))
+                return True
+            try:
+                ldap2.find_entries(TARGET_GROUP_FILTER, ['dn'],
+                                   DN(self.api.env.basedn), size_limit=1)
+            except errors.NotFound:
+                self.logger.debug(_("All groups have the Group Policy object class"))
+                return True
+            self.logger.info(_("Groups need the Group Policy object class"))
+            return False
+
+        except errors.LimitsExceeded:
+            return False
+        except Exception as e:
+            self.logger.error(_("Error checking the object class of groups: {}").format(e))
+            return False
@@ -5,6 +5,7 @@ import sys
 import logging
 import gettext
 import locale
+import time
 from typing import Dict, Tuple, List, Any, Callable
 from os.path import dirname, join, abspath
 
@@ -18,6 +19,8 @@ from ipaserver.install.installutils import run_script
 
 from ipa_gpo_install.checks import IPAChecker
 from ipa_gpo_install.actions import IPAActions
+from ipa_gpo_install.health import STATUS_PATH, run_daemon
+from ipa_gpo_install.schema import SCHEMA_FILES
 
 LOCALE_DIR = '/usr/share/locale'
 
@@ -38,8 +41,6 @@ except Exception as e:
 
 
 LOG_FILE_PATH = '/var/log/freeipa/ipa-gpo-install.log'
-SCHEMA_LDIF_PATH = '/usr/share/ipa-gpo-install/data/74alt-group-policy.ldif'
-REQUIRED_SCHEMA_CLASSES = ['altOrganizationalUnit', 'groupPolicyContainer']
 
 logger = logging.getLogger(os.path.basename(__file__))
 
@@ -51,6 +52,14 @@ def parse_options() -> Tuple[Dict, Any]:
                       help=_("Debug level: 0=errors, 1=warnings, 2=debug"))
     parser.add_option("--check-only", dest="check_only", action="store_true",
                       default=False, help=_("Only perform checks without making changes"))
+    parser.add_option("--sysvol-gc", dest="sysvol_gc", action="store_true",
+                      default=False, help=_("Quarantine SYSVOL policy directories without a Group Policy Object"))
+    parser.add_option("--repair-sysvol-acl", dest="repair_sysvol_acl", action="store_true",
+                      default=False, help=_("Repair ACLs of all SYSVOL directories and files"))
+    parser.add_option("--daemon", dest="daemon", action="store_true",
+                      default=False, help=_("Keep running and repeat the checks on a schedule"))
+    parser.add_option("--status-file", dest="status_file", default=STATUS_PATH,
+                      metavar="PATH", help=_("File the daemon writes check results to"))
 
     options, _args = parser.parse_args()
     safe_options = parser.get_safe_opts(options)
@@ -117,7 +126,7 @@ def perform_configuration_checks(checker: IPAChecker) -> Dict[str, Any]:
     results = {}
 
     logger.info(_("Checking LDAP schema for required object classes"))
-    results['schema_complete'] = checker.check_schema_complete(REQUIRED_SCHEMA_CLASSES)
+    results['schema_complete'] = checker.check_schema_current(SCHEMA_FILES)
 
     logger.info(_("Checking if AD Trust is enabled"))
     results['adtrust_enabled'] = checker.check_adtrust_installed()
@@ -125,6 +134,14 @@ def perform_configuration_checks(checker: IPAChecker) -> Dict[str, Any]:
     logger.info(_("Checking SYSVOL directory and share"))
     results['sysvol_directory'] = checker.check_sysvol_directory()
     results['sysvol_share'] = checker.check_sysvol_share()
+    results['provisioning_queue'] = checker.check_provisioning_queue()
+    results['name_cache'] = checker.check_name_cache()
+
+    logger.info(_("Checking ordering of Group Policy lists"))
+    results['ordering_migrated'] = checker.check_ordering_migrated()
+
+    logger.info(_("Checking Group Policy object class of groups"))
+    results['group_targets'] = checker.check_group_targets()
 
     return results
 
@@ -149,7 +166,7 @@ def execute_required_actions(actions: IPAActions, check_results: Dict[str, Any])
     tasks = []
 
     if not check_results['schema_complete']:
-        tasks.append((_("Extend LDAP schema"), actions.add_ldif_schema, SCHEMA_LDIF_PATH))
+        tasks.append((_("Extend LDAP schema"), actions.update_schema, SCHEMA_FILES))
 
     if not check_results['adtrust_enabled']:
         tasks.append((_("Install AD Trust"), actions.install_adtrust))
@@ -160,6 +177,18 @@ def execute_required_actions(actions: IPAActions, check_results: Dict[str, Any])
     if not check_results['sysvol_share']:
         tasks.append((_("Create SYSVOL share"), actions.create_sysvol_share))
 
+    if not check_results['provisioning_queue']:
+        tasks.append((_("Create provisioning queue directory"), actions.create_provisioning_queue))
+
+    if not check_results['name_cache']:
+        tasks.append((_("Create name cache directory"), actions.create_name_cache))
+
+    if not check_results['ordering_migrated']:
+        tasks.append((_("Migrate Group Policy list ordering"), actions.migrate_ordering))
+
+    if not check_results['group_targets']:
+        tasks.append((_("Add Group Policy object class to groups"), actions.add_group_targets))
+
     for task in tasks:
         if not run_task(*task):
             return False
@@ -174,22 +203,39 @@ def main():
     if not setup_environment(options):
         return 1
     try:
+        if options.daemon:
+            return run_daemon(api, options.status_file)
+
         checker = IPAChecker(logger, api)
+        started = time.perf_counter()
         logger.info(_("Checking critical requirements"))
         if not check_critical_requirements(checker):
             return 1
 
         logger.info(_("Performing configuration environment checks"))
         check_results = perform_configuration_checks(checker)
+        logger.info(_("Checks completed in {:.2f} s").format(time.perf_counter() - started))
  
+        actions = IPAActions(logger, api)
         if options.check_only:
+            if options.sysvol_gc:
+                actions.collect_sysvol_garbage(dry_run=True)
+            if options.repair_sysvol_acl:
+                actions.repair_sysvol_permissions(dry_run=True)
             print(_("Check-only mode: all checks completed"))
             return 0
 
-        actions = IPAActions(logger, api)
         if not execute_required_actions(actions, check_results):
             return 1
 
+        if options.sysvol_gc and not run_task(_("Collect orphaned SYSVOL directories"),
+                                              actions.collect_sysvol_garbage):
+            return 1
+
+        if options.repair_sysvol_acl and not run_task(_("Repair SYSVOL permissions"),
+                                                      actions.repair_sysvol_permissions):
+            return 1
+
         print(_("""
 =============================================================================
 Setup complete
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Health monitoring mode of the installer.
+
+ipa-gpo-install --daemon keeps the IPA API and its LDAP connection open
+and runs the IPAChecker checks on a schedule instead of paying for a new
+process, API bootstrap and connection on every run. Each check has a base
+interval; a slow check is run less often, so that none spends more than
+1/COST_RATIO of the time. A cycle runs only the checks which are due,
+which are usually a few cheap ones.
+
+Results are written to a JSON status file, replaced atomically, so a
+reader sees either the previous or the new state. The LDAP connection is
+probed before each cycle and opened again when it was lost or its
+credentials were rejected, and when the Kerberos ticket check changes
+result, that is when the ticket expired or was renewed.
+"""
+
+import json
+import logging
+import os
+import signal
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from ipalib import errors
+
+from ipa_gpo_install.checks import IPAChecker
+from ipa_gpo_install.schema import SCHEMA_FILES
+
+logger = logging.getLogger('ipa-gpo-install')
+
+STATUS_PATH = '/run/ipa-gpo/health.json'
+
+# A check is run at most once per its duration times this
+COST_RATIO = 100
+
+# Reconnect delays in seconds after the LDAP connection is lost
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 60.0
+
+CONNECTION_ERRORS = (errors.NetworkError, errors.DatabaseError,
+                     errors.ACIError, errors.KerberosError)
+
+HealthCheck = namedtuple('HealthCheck', 'name method args interval')
+
+# Names are the keys of the installer check results
+CHECKS = (
+    HealthCheck('kerberos_ticket', 'check_kerberos_ticket', (), 60),
+    HealthCheck('admin_privileges', 'check_admin_privileges', (), 300),
+    HealthCheck('ipa_services', 'check_ipa_services', (), 30),
+    HealthCheck('schema_complete', 'check_schema_current', (SCHEMA_FILES,),
+                3600),
+    HealthCheck('adtrust_enabled', 'check_adtrust_installed', (), 600),
+    HealthCheck('sysvol_directory', 'check_sysvol_directory', (), 60),
+    HealthCheck('sysvol_share', 'check_sysvol_share', (), 300),
+    HealthCheck('provisioning_queue', 'check_provisioning_queue', (), 60),
+    HealthCheck('name_cache', 'check_name_cache', (), 60),
+    HealthCheck('ordering_migrated', 'check_ordering_migrated', (), 3600),
+    HealthCheck('group_targets', 'check_group_targets', (), 3600),
+)
+
+
+class HealthMonitor:
+    """Runs the checks which are due and publishes their results."""
+
+    def __init__(self, checker, api, checks=CHECKS, status_path=STATUS_PATH):
+        self.checker = checker
+        self.api = api
+        self.checks = checks
+        self.status_path = status_path
+        self.connected = False
+        self.cycles = 0
+        # name -> {'ok', 'checked', 'duration', 'next'}
+        self.results = {}
+        # name -> monotonic time the check is due
+        self.next_run = {check.name: 0 for check in checks}
+
+    def reconnect(self):
+        ldap = self.api.Backend.ldap2
+        if ldap.isconnected():
+            ldap.disconnect()
+        try:
+            ldap.connect()
+        except errors.PublicError as e:
+            logger.error("Cannot connect to the LDAP server: %s", e)
+            self.connected = False
+            return False
+        logger.info("Connected to the LDAP server")
+        self.connected = True
+        return True
+
+    def ensure_connected(self):
+        """Probe the connection with a base read; reconnect if it fails."""
+        ldap = self.api.Backend.ldap2
+        if ldap.isconnected():
+            try:
+                ldap.get_entry(self.api.env.basedn, ['1.1'])
+                self.connected = True
+                return True
+            except CONNECTION_ERRORS as e:
+                logger.warning("LDAP connection lost, reconnecting: %s", e)
+        return self.reconnect()
+
+    def due(self, now):
+        return [check for check in self.checks
+                if self.next_run[check.name] <= now]
+
+    def run_cycle(self, now=None):
+        """
+        Run the checks which are due.
+
+        Returns the names of the checks run, or None if the LDAP server
+        cannot be reached.
+        """
+        now = time.monotonic() if now is None else now
+        due = self.due(now)
+        if not due:
+            return []
+        if not self.ensure_connected():
+            return None
+
+        wall = time.time()
+        for check in due:
+            started = time.perf_counter()
+            ok = bool(getattr(self.checker, check.method)(*check.args))
+            duration = time.perf_counter() - started
+            interval = max(check.interval, duration * COST_RATIO)
+            self.next_run[check.name] = now + interval
+
+            previous = self.results.get(check.name)
+            if previous is None or previous['ok'] != ok:
+                logger.log(logging.INFO if ok else logging.WARNING,
+                           "Check %s %s", check.name,
+                           'passed' if ok else 'failed')
+                if check.name == 'kerberos_ticket' and previous is not None:
+                    # Credentials changed: bind again with the new ones
+                    self.reconnect()
+            self.results[check.name] = {
+                'ok': ok,
+                'checked': wall,
+                'duration': round(duration, 6),
+                'next': wall + interval,
+            }
+        self.cycles += 1
+        return [check.name for check in due]
+
+    def status(self):
+        return {
+            'updated': time.time(),
+            'connected': self.connected,
+            'healthy': (self.connected and
+                        len(self.results) == len(self.checks) and
+                        all(result['ok'] for result in self.results.values())),
+            'cycles': self.cycles,
+            'checks': self.results,
+        }
+
+    def publish(self):
+        """Replace the status file with the current results."""
+        directory = os.path.dirname(self.status_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.health-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.status(), f, sort_keys=True)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.status_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def run(self, stop_event):
+        """Run cycles until stop_event is set."""
+        delay = RECONNECT_MIN
+        while not stop_event.is_set():
+            started = time.perf_counter()
+            ran = self.run_cycle()
+            if ran is None:
+                self.publish()
+                logger.error("LDAP server unreachable, retrying in %.0f s",
+                             delay)
+                stop_event.wait(delay)
+                delay = min(delay * 2, RECONNECT_MAX)
+                continue
+
+            delay = RECONNECT_MIN
+            if ran:
+                self.publish()
+                logger.debug("Checked %s in %.3f s", ', '.join(ran),
+                             time.perf_counter() - started)
+            stop_event.wait(max(0, min(self.next_run.values()) -
+                                time.monotonic()))
+
+
+def run_daemon(api, status_path=STATUS_PATH):
+    """Monitor the server until SIGTERM; the API must be finalized."""
+    # Check results are logged by the monitor when they change
+    checker_logger = logger.getChild('checks')
+    checker_logger.setLevel(logging.WARNING)
+
+    monitor = HealthMonitor(IPAChecker(checker_logger, api), api,
+                            status_path=status_path)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    logger.info("Publishing health checks to %s", status_path)
+    try:
+        monitor.run(stop_event)
+    except KeyboardInterrupt:
+        pass
+    return 0
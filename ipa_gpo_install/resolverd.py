@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Resident Group Policy resolution service.
+
+Keeps the policy graph (see ipaserver.plugins.gpresolve) in memory and
+answers "which policies apply to user U on host H" over a local Unix
+socket. The graph is loaded once and then kept current from 389-ds
+persistent searches on the Group Policy containers and the user and host
+containers.
+
+The protocol is one JSON object per line in each direction:
+
+    {"user": "john", "host": "ws001.example.test"}
+    {"policies": [{"guid": "{...}", "name": "...", ...}], "generation": 42}
+
+    {"op": "status"}
+    {"ready": true, "policies": 10, "chains": 3, ...}
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+import ldap
+from ldap.controls.psearch import (
+    EntryChangeNotificationControl,
+    PersistentSearchControl,
+)
+
+from ipalib import api
+from ipapython import ipaldap, version
+from ipapython.config import IPAOptionParser
+from ipapython.ipa_log_manager import standard_logging_setup
+from ipapython.dn import DN
+from ipaplatform.paths import paths
+
+try:
+    from ipaserver.plugins.chain import PLUGIN_CONFIG as CHAIN_CONFIG
+    from ipaserver.plugins.gpc import PLUGIN_CONFIG as GPC_CONFIG
+    from ipaserver.plugins.gpmaster import PLUGIN_CONFIG as GPMASTER_CONFIG
+    from ipaserver.plugins.gpresolve import KIND_ATTRIBUTES, PolicyGraph
+except ImportError as e:
+    # The server plugins are installed with FreeIPA, not with this package
+    plugins_error = e
+else:
+    plugins_error = None
+
+logger = logging.getLogger('ipa-gpo-resolverd')
+
+SOCKET_PATH = '/run/ipa-gpo/resolver.sock'
+SOCKET_MODE = 0o660
+
+# Seconds between checks for shutdown while waiting for LDAP changes
+POLL_TIMEOUT = 1.0
+
+# Reconnect delays in seconds after the LDAP connection is lost
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 60.0
+
+# Values of the changeType field of the entry change notification control
+CHANGE_DELETE = 2
+CHANGE_MODDN = 8
+
+RESPONSE_CONTROLS = {
+    EntryChangeNotificationControl.controlType: EntryChangeNotificationControl,
+}
+
+
+def watched_searches(env):
+    """
+    Return (base, scope, filter, attributes) of the searches to watch.
+
+    Group Policy containers come from the PLUGIN_CONFIG of the chain,
+    grouppolicy and gpmaster plugins.
+    """
+    chain_config = dict(CHAIN_CONFIG)
+    gpc_config = dict(GPC_CONFIG)
+    gpmaster_config = dict(GPMASTER_CONFIG)
+    return [
+        (DN(gpc_config['container_grouppolicy'], env.basedn),
+         ldap.SCOPE_ONELEVEL, '(objectClass=groupPolicyContainer)',
+         KIND_ATTRIBUTES['grouppolicy']),
+        (DN(chain_config['container_grouppolicychain'], env.basedn),
+         ldap.SCOPE_ONELEVEL, '(objectClass=groupPolicyChain)',
+         KIND_ATTRIBUTES['chain']),
+        (DN(gpmaster_config['container_grouppolicymaster'], env.basedn),
+         ldap.SCOPE_ONELEVEL, '(objectClass=groupPolicyMaster)',
+         KIND_ATTRIBUTES['gpmaster']),
+        (DN(env.container_user, env.basedn),
+         ldap.SCOPE_ONELEVEL, '(objectClass=posixAccount)',
+         KIND_ATTRIBUTES['user']),
+        (DN(env.container_host, env.basedn),
+         ldap.SCOPE_ONELEVEL, '(objectClass=ipaHost)',
+         KIND_ATTRIBUTES['host']),
+    ]
+
+
+class ResolverService:
+    """Holds the current graph and answers requests against it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.graph = PolicyGraph()
+        self.ready = False
+
+    def set_graph(self, graph):
+        with self.lock:
+            self.graph = graph
+            self.ready = True
+
+    def apply(self, change):
+        """Apply a change notification to the current graph."""
+        with self.lock:
+            change(self.graph)
+
+    def handle_request(self, request):
+        if not isinstance(request, dict):
+            raise ValueError('request must be a JSON object')
+        op = request.get('op', 'resolve')
+        with self.lock:
+            if op == 'status':
+                response = self.graph.stats()
+                response['ready'] = self.ready
+                return response
+            if op != 'resolve':
+                raise ValueError('unknown op: {}'.format(op))
+            if not self.ready:
+                return {'error': 'not ready'}
+            return {
+                'policies': self.graph.resolve(request.get('user'),
+                                               request.get('host')),
+                'generation': self.graph.generation,
+            }
+
+
+class GraphWatcher:
+    """
+    Loads the policy graph and follows changes with persistent searches.
+
+    The persistent searches are started with changesOnly before the
+    initial searches, so no change is lost between the two; changes are
+    read only after the initial load, and since applying an entry is an
+    upsert, seeing one twice is harmless.
+    """
+
+    def __init__(self, service, searches, connect):
+        self.service = service
+        self.searches = searches
+        self.connect = connect
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        delay = RECONNECT_MIN
+        while not self.stop_event.is_set():
+            conn = None
+            try:
+                conn = self.connect()
+                self.watch(conn)
+                delay = RECONNECT_MIN
+            except ldap.LDAPError as e:
+                logger.error("LDAP connection failed, reconnecting in "
+                             "%.0f s: %s", delay, e)
+                self.stop_event.wait(delay)
+                delay = min(delay * 2, RECONNECT_MAX)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.unbind_s()
+                    except ldap.LDAPError:
+                        pass
+
+    def watch(self, conn):
+        psearch = PersistentSearchControl(criticality=True, changesOnly=True,
+                                          returnECs=True)
+        msgids = set()
+        for base, scope, search_filter, attrs in self.searches:
+            msgids.add(conn.search_ext(str(base), scope, search_filter,
+                                       attrs, serverctrls=[psearch]))
+
+        graph = PolicyGraph()
+        start = time.monotonic()
+        for base, scope, search_filter, attrs in self.searches:
+            try:
+                entries = conn.search_s(str(base), scope, search_filter, attrs)
+            except ldap.NO_SUCH_OBJECT:
+                continue
+            for dn, entry_attrs in entries:
+                if dn is not None:
+                    graph.update(dn, entry_attrs)
+        self.service.set_graph(graph)
+        logger.info("Loaded policy graph in %.3f s: %s",
+                    time.monotonic() - start, graph.stats())
+
+        while not self.stop_event.is_set():
+            try:
+                result = conn.result4(ldap.RES_ANY, all=0,
+                                      timeout=POLL_TIMEOUT, add_ctrls=1,
+                                      resp_ctrl_classes=RESPONSE_CONTROLS)
+            except ldap.TIMEOUT:
+                continue
+            rtype, rdata, rmsgid = result[:3]
+            if rmsgid not in msgids:
+                continue
+            if rtype == ldap.RES_SEARCH_RESULT:
+                raise ldap.SERVER_DOWN(
+                    {'desc': 'persistent search ended by the server'})
+            for dn, entry_attrs, controls in rdata or ():
+                self.service.apply(self.make_change(dn, entry_attrs,
+                                                    controls))
+
+    @staticmethod
+    def make_change(dn, entry_attrs, controls):
+        """Turn a persistent search result into a graph update."""
+        change_type = None
+        previous_dn = None
+        for control in controls:
+            if isinstance(control, EntryChangeNotificationControl):
+                change_type = control.changeType
+                previous_dn = control.previousDN
+
+        if change_type == CHANGE_DELETE:
+            return lambda graph: graph.remove(dn)
+        if change_type == CHANGE_MODDN and previous_dn:
+            return lambda graph: graph.rename(previous_dn, dn, entry_attrs)
+        return lambda graph: graph.update(dn, entry_attrs)
+
+
+class ResolverRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.service.handle_request(
+                    json.loads(line))
+            except (ValueError, TypeError) as e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class ResolverServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        self.service = service
+        if os.path.exists(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        super(ResolverServer, self).__init__(path, ResolverRequestHandler)
+        os.chmod(path, SOCKET_MODE)
+
+
+def ldapi_connect():
+    """Connect to the local directory over LDAPI with autobind."""
+    conn = ldap.initialize(ipaldap.realm_to_ldapi_uri(api.env.realm))
+    conn.sasl_non_interactive_bind_s('EXTERNAL')
+    return conn
+
+
+def query(request, path=SOCKET_PATH, timeout=5.0):
+    """Send one request to a running resolver and return the response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        stream = sock.makefile('rwb')
+        stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+def run(socket_path=SOCKET_PATH):
+    """Run the resolver until it is stopped."""
+    api.bootstrap(in_server=True, context='gpo-resolver',
+                  confdir=paths.ETC_IPA)
+
+    service = ResolverService()
+    watcher = GraphWatcher(service, watched_searches(api.env), ldapi_connect)
+    thread = threading.Thread(target=watcher.run, name='ldap-watcher',
+                              daemon=True)
+    thread.start()
+
+    server = ResolverServer(socket_path, service)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+        target=server.shutdown).start())
+    logger.info("Serving policy resolution on %s", socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        watcher.stop()
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+    return 0
+
+
+def main():
+    parser = IPAOptionParser(version=version.VERSION)
+    parser.add_option("--socket", dest="socket", default=SOCKET_PATH,
+                      metavar="PATH", help="Unix socket to listen on")
+    parser.add_option("--debug", dest="debug", action="store_true",
+                      default=False, help="Log debugging information")
+    options, _args = parser.parse_args()
+
+    standard_logging_setup(verbose=True, debug=options.debug)
+    if plugins_error is not None:
+        logger.error("Group Policy server plugins are not installed: %s",
+                     plugins_error)
+        return 1
+    try:
+        return run(options.socket)
+    except KeyboardInterrupt:
+        return 0
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+LDAP schema comparison and update.
+
+The attributeTypes and objectClasses of the Group Policy LDIF files are
+compared with cn=schema of the server, read with one base search over the
+existing connection. Only missing or changed definitions are written,
+all in a single modify, so running the installer on a configured server
+costs one search.
+
+Definitions are matched by OID, then by first NAME. A definition whose
+name exists under another OID is reported as a conflict and left alone:
+replacing it would orphan entries using the old one. When several files
+define the same name, the last one wins, so the plugin schema.d files
+override data/. X-ORIGIN, which the server adds, is ignored when
+comparing.
+"""
+
+import base64
+import copy
+import os
+import re
+from collections import OrderedDict
+
+import ldap
+from ldap.schema.models import AttributeType, ObjectClass
+from ipaplatform.paths import paths
+
+SCHEMA_DN = 'cn=schema'
+SUBSCHEMA_DN = 'cn=subschema'
+
+DATA_DIR = '/usr/share/ipa-gpo-install/data'
+SCHEMA_D_DIR = os.path.join(paths.USR_SHARE_IPA_DIR, 'schema.d')
+
+SCHEMA_FILES = (
+    os.path.join(DATA_DIR, '74alt-group-policy.ldif'),
+    os.path.join(SCHEMA_D_DIR, '75-gpc.ldif'),
+    os.path.join(SCHEMA_D_DIR, '75-chain.ldif'),
+    os.path.join(SCHEMA_D_DIR, '75-gpmaster.ldif'),
+)
+
+# Attribute types first: object classes of the same modify refer to them
+ELEMENT_CLASSES = OrderedDict((
+    ('attributetypes', AttributeType),
+    ('objectclasses', ObjectClass),
+))
+
+HEAD_RE = re.compile(r"\(\s*([\w.-]+)(?:\s+NAME\s+\(?\s*'([^']+)')?")
+
+
+def read_ldif(path):
+    """Return (attribute, value) of the schema definitions of an LDIF file."""
+    lines = []
+    comment = False
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.startswith(' '):
+                if not comment and lines:
+                    lines[-1] += line[1:]
+                continue
+            comment = line.startswith('#')
+            if not comment:
+                lines.append(line)
+
+    definitions = []
+    for line in lines:
+        name, separator, value = line.partition(':')
+        name = name.lower()
+        if not separator or name not in ELEMENT_CLASSES:
+            continue
+        if value.startswith(':'):
+            value = base64.b64decode(value[1:].strip()).decode('utf-8')
+        definitions.append((name, value.strip()))
+    return definitions
+
+
+def _head(value):
+    """Return the OID and the lower-cased first name of a definition."""
+    match = HEAD_RE.match(value)
+    if match is None:
+        return None, None
+    return match.group(1), (match.group(2) or '').lower() or None
+
+
+def _canonical(element):
+    element = copy.copy(element)
+    element.x_origin = ()
+    return str(element)
+
+
+def load_definitions(files):
+    """
+    Parse the schema definitions of LDIF files.
+
+    Returns {(attribute, name): element}, in file order; missing files are
+    skipped.
+    """
+    definitions = OrderedDict()
+    for path in files:
+        if not os.path.exists(path):
+            continue
+        for attr, value in read_ldif(path):
+            element = ELEMENT_CLASSES[attr](value)
+            name = (element.names[0] if element.names else element.oid).lower()
+            definitions.pop((attr, name), None)
+            definitions[(attr, name)] = element
+    return definitions
+
+
+def read_server_schema(conn):
+    """Return {attribute: [values]} of the server schema entry."""
+    attrlist = list(ELEMENT_CLASSES)
+    try:
+        entry = conn.search_s(SCHEMA_DN, ldap.SCOPE_BASE, attrlist=attrlist)[0]
+    except ldap.NO_SUCH_OBJECT:
+        entry = conn.search_s(SUBSCHEMA_DN, ldap.SCOPE_BASE,
+                              attrlist=attrlist)[0]
+    values = {attr.lower(): values for attr, values in entry[1].items()}
+    return {attr: values.get(attr, []) for attr in ELEMENT_CLASSES}
+
+
+class SchemaDiff:
+    """Definitions to add or change, and the ones left alone."""
+
+    def __init__(self):
+        # (attribute, name, new element)
+        self.added = []
+        # (attribute, name, current raw value, new element)
+        self.changed = []
+        # (attribute, name, OID on the server, OID in the file)
+        self.conflicts = []
+        self.unchanged = 0
+
+    @property
+    def current(self):
+        return not (self.added or self.changed)
+
+    def modlist(self):
+        mods = []
+        for attr in ELEMENT_CLASSES:
+            for changed_attr, _name, old, new in self.changed:
+                if changed_attr == attr:
+                    mods.append((ldap.MOD_DELETE, attr, [old]))
+                    mods.append((ldap.MOD_ADD, attr,
+                                 [str(new).encode('utf-8')]))
+            values = [str(new).encode('utf-8')
+                      for added_attr, _name, new in self.added
+                      if added_attr == attr]
+            if values:
+                mods.append((ldap.MOD_ADD, attr, values))
+        return mods
+
+    def lines(self):
+        """Describe the difference, one line per definition."""
+        result = ['add {} {}'.format(attr, name)
+                  for attr, name, _new in self.added]
+        result += ['change {} {}'.format(attr, name)
+                   for attr, name, _old, _new in self.changed]
+        result += ['conflict {} {}: OID {} on the server, {} in the file'
+                   .format(*conflict) for conflict in self.conflicts]
+        return result
+
+
+def diff_schema(conn, files):
+    """Compare the definitions of LDIF files with the server schema."""
+    diff = SchemaDiff()
+    definitions = load_definitions(files)
+    server = read_server_schema(conn)
+
+    for attr, element_class in ELEMENT_CLASSES.items():
+        wanted = [(name, element)
+                  for (kind, name), element in definitions.items()
+                  if kind == attr]
+        oids = {element.oid for _name, element in wanted}
+        names = {name for name, _element in wanted}
+
+        by_oid = {}
+        by_name = {}
+        for raw in server[attr]:
+            value = raw.decode('utf-8')
+            oid, name = _head(value)
+            if oid in oids:
+                by_oid[oid] = raw
+            if name in names:
+                by_name[name] = (oid, raw)
+
+        for name, element in wanted:
+            raw = by_oid.get(element.oid)
+            if raw is None:
+                if name in by_name:
+                    diff.conflicts.append(
+                        (attr, name, by_name[name][0], element.oid))
+                else:
+                    diff.added.append((attr, name, element))
+                continue
+
+            current = element_class(raw.decode('utf-8'))
+            if _canonical(current) == _canonical(element):
+                diff.unchanged += 1
+            else:
+                diff.changed.append((attr, name, raw, element))
+    return diff
+
+
+def apply_schema(conn, diff):
+    """Write the added and changed definitions in one modify."""
+    mods = diff.modlist()
+    if mods:
+        conn.modify_s(SCHEMA_DN, mods)
+    return len(diff.added) + len(diff.changed)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+In-process access to the system services the installer checks.
+
+systemd unit states are read with one ListUnitsByNames D-Bus call, the
+Samba registry configuration through the samba Python bindings and POSIX
+ACLs as extended attributes. Each operation falls back to the command
+the installer used to run when its API is not available, so results do
+not depend on which path was taken.
+"""
+
+import errno
+import logging
+import os
+import shutil
+
+from ipapython import ipautil
+
+from ipa_gpo_install.sysvol_acl import (
+    DEFAULT_ACL, DIRECTORY_PERMISSIONS, encode_acl,
+)
+
+logger = logging.getLogger('ipa-gpo-install')
+
+SYSTEMD_BUS_NAME = 'org.freedesktop.systemd1'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+SYSTEMD_MANAGER = 'org.freedesktop.systemd1.Manager'
+
+UNIT_SUFFIXES = ('.service', '.socket', '.target', '.timer', '.mount',
+                 '.path')
+
+
+def _unit_name(unit):
+    return unit if unit.endswith(UNIT_SUFFIXES) else unit + '.service'
+
+
+def _dbus_unit_states(names):
+    import dbus
+
+    bus = dbus.SystemBus()
+    manager = dbus.Interface(bus.get_object(SYSTEMD_BUS_NAME, SYSTEMD_PATH),
+                             SYSTEMD_MANAGER)
+    return {str(unit[0]): str(unit[3])
+            for unit in manager.ListUnitsByNames(names)}
+
+
+def _systemctl_unit_states(names):
+    result = ipautil.run(['systemctl', 'is-active'] + names,
+                         raiseonerr=False, capture_output=True)
+    return dict(zip(names, result.output.split()))
+
+
+def unit_states(units):
+    """Return {unit: ActiveState} of systemd units, in one query."""
+    names = [_unit_name(unit) for unit in units]
+    try:
+        states = _dbus_unit_states(names)
+    except Exception as e:
+        logger.debug("Cannot query systemd over D-Bus, using systemctl: %s",
+                     e)
+        states = _systemctl_unit_states(names)
+    return {unit: states.get(name, 'inactive')
+            for unit, name in zip(units, names)}
+
+
+class SambaConfig:
+    """Shares of the Samba registry configuration."""
+
+    def __init__(self):
+        try:
+            from samba.samba3 import smbconf
+            self.conf = smbconf.init_reg(None)
+        except Exception as e:
+            logger.debug("Samba registry bindings are not available, "
+                         "using net conf: %s", e)
+            self.conf = None
+
+    def share_exists(self, name):
+        if self.conf is not None:
+            return self.conf.share_exists(name)
+
+        result = ipautil.run(['net', 'conf', 'listshares'],
+                             raiseonerr=False, capture_output=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.error_output)
+        return name.lower() in (
+            share.strip().lower() for share in result.output.splitlines())
+
+    def add_share(self, name, path, writeable=False, guest_ok=False):
+        if self.conf is not None and hasattr(self.conf, 'create_share'):
+            self.conf.transaction_start()
+            try:
+                self.conf.create_share(name)
+                self.conf.set_parameter(name, 'path', path)
+                self.conf.set_parameter(name, 'read only',
+                                        'no' if writeable else 'yes')
+                self.conf.set_parameter(name, 'guest ok',
+                                        'yes' if guest_ok else 'no')
+            except Exception:
+                self.conf.transaction_cancel()
+                raise
+            self.conf.transaction_commit()
+            return
+
+        result = ipautil.run(['net', 'conf', 'addshare', name, path,
+                              'writeable=' + ('y' if writeable else 'N'),
+                              'guest_ok=' + ('y' if guest_ok else 'N')],
+                             raiseonerr=False)
+        if result.returncode != 0:
+            raise RuntimeError(result.error_output)
+
+
+def set_default_acl(path, gid):
+    """Set the SYSVOL default ACL on a directory."""
+    try:
+        os.setxattr(path, DEFAULT_ACL, encode_acl(DIRECTORY_PERMISSIONS, gid))
+        return
+    except OSError as e:
+        if e.errno == errno.EOPNOTSUPP or shutil.which('setfacl') is None:
+            raise
+        logger.debug("Cannot set ACL of %s as an attribute, using setfacl: "
+                     "%s", path, e)
+
+    ipautil.run(['setfacl', '-d', '-m', 'g:{}:rwx,o::r-x'.format(gid), path])
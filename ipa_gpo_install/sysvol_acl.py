@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Audit and repair of SYSVOL permissions.
+
+Every directory of the SYSVOL tree gets an access and a default POSIX ACL
+giving its owner full access, the admins group read and write access and
+everyone else read access; every file gets the matching access ACL. This
+is the ACL `setfacl -d -m g:admins:rwx,o::r-x` makes new entries inherit.
+
+ACLs are read and written as the system.posix_acl_* extended attributes,
+in the binary form the kernel uses, so no process is started per path and
+an entry already carrying the expected ACL costs one getxattr call.
+Directories are listed with os.scandir by a pool of threads, each listing
+handing the subdirectories it finds back to the pool. Symbolic links are
+never followed.
+"""
+
+import errno
+import grp
+import logging
+import os
+import stat
+import struct
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger('ipa-gpo-install')
+
+SYSVOL_ROOT = '/var/lib/freeipa/sysvol'
+ADMINS_GROUP = 'admins'
+
+DEFAULT_WORKERS = 16
+
+ACCESS_ACL = 'system.posix_acl_access'
+DEFAULT_ACL = 'system.posix_acl_default'
+
+ACL_VERSION = 2
+ACL_HEADER = struct.Struct('<I')
+ACL_ENTRY = struct.Struct('<HHI')
+ACL_UNDEFINED_ID = 0xFFFFFFFF
+
+# Entry tags, in the order the kernel keeps them
+ACL_USER_OBJ = 0x01
+ACL_GROUP_OBJ = 0x04
+ACL_GROUP = 0x08
+ACL_MASK = 0x10
+ACL_OTHER = 0x20
+
+READ, WRITE, EXECUTE = 4, 2, 1
+
+# Permissions of owner, owning group, admins and others
+DIRECTORY_PERMISSIONS = (READ | WRITE | EXECUTE, READ | EXECUTE,
+                         READ | WRITE | EXECUTE, READ | EXECUTE)
+FILE_PERMISSIONS = (READ | WRITE, READ, READ | WRITE, READ)
+
+# Modes used where the file system does not support ACLs
+DIRECTORY_MODE = 0o755
+FILE_MODE = 0o644
+
+
+def encode_acl(permissions, gid):
+    """Return the extended attribute value of an ACL."""
+    owner, group, admins, other = permissions
+    entries = (
+        (ACL_USER_OBJ, owner, ACL_UNDEFINED_ID),
+        (ACL_GROUP_OBJ, group, ACL_UNDEFINED_ID),
+        (ACL_GROUP, admins, gid),
+        (ACL_MASK, group | admins, ACL_UNDEFINED_ID),
+        (ACL_OTHER, other, ACL_UNDEFINED_ID),
+    )
+    return ACL_HEADER.pack(ACL_VERSION) + b''.join(
+        ACL_ENTRY.pack(*entry) for entry in entries)
+
+
+def _getxattr(path, name):
+    try:
+        return os.getxattr(path, name, follow_symlinks=False)
+    except OSError as e:
+        if e.errno == errno.ENODATA:
+            return None
+        raise
+
+
+class SysvolPermissions:
+    """Checks the permissions of a SYSVOL tree and repairs them."""
+
+    def __init__(self, root=SYSVOL_ROOT, gid=None, dry_run=False,
+                 workers=DEFAULT_WORKERS, log=None):
+        if gid is None:
+            gid = grp.getgrnam(ADMINS_GROUP).gr_gid
+        self.root = root
+        self.dry_run = dry_run
+        self.workers = workers
+        self.log = log or logger
+        self.directory_acl = encode_acl(DIRECTORY_PERMISSIONS, gid)
+        self.file_acl = encode_acl(FILE_PERMISSIONS, gid)
+        self.lock = threading.Lock()
+        self.stats = {'checked': 0, 'repaired': 0, 'fallback': 0,
+                      'errors': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def _expected(self, is_dir):
+        if is_dir:
+            return ((ACCESS_ACL, self.directory_acl),
+                    (DEFAULT_ACL, self.directory_acl))
+        return ((ACCESS_ACL, self.file_acl),)
+
+    def _fallback(self, path, is_dir):
+        mode = DIRECTORY_MODE if is_dir else FILE_MODE
+        if stat.S_IMODE(os.lstat(path).st_mode) == mode:
+            return False
+        if not self.dry_run:
+            os.chmod(path, mode)
+        return True
+
+    def check(self, path, is_dir):
+        """Repair one path; returns the names of the wrong attributes."""
+        wrong = []
+        try:
+            for name, value in self._expected(is_dir):
+                if _getxattr(path, name) == value:
+                    continue
+                wrong.append(name)
+                if not self.dry_run:
+                    os.setxattr(path, name, value, follow_symlinks=False)
+        except OSError as e:
+            if e.errno != errno.EOPNOTSUPP:
+                self.log.error("Cannot repair permissions of %s: %s",
+                               path, e)
+                self._count('errors')
+                return wrong
+            try:
+                wrong = ['mode'] if self._fallback(path, is_dir) else []
+            except OSError as e:
+                self.log.error("Cannot repair mode of %s: %s", path, e)
+                self._count('errors')
+                return wrong
+            self._count('fallback')
+
+        self._count('checked')
+        if wrong:
+            self._count('repaired')
+            if self.dry_run:
+                self.log.info("Wrong %s: %s", ', '.join(wrong), path)
+            else:
+                self.log.debug("Repaired %s: %s", ', '.join(wrong), path)
+        return wrong
+
+    def scan(self, directory):
+        """Check the entries of a directory and return its subdirectories."""
+        subdirectories = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        self.check(entry.path, True)
+                        subdirectories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        self.check(entry.path, False)
+        except OSError as e:
+            self.log.error("Cannot list %s: %s", directory, e)
+            self._count('errors')
+        return subdirectories
+
+    def repair(self):
+        """Walk the tree; returns the counters of checked and wrong paths."""
+        if not os.path.isdir(self.root):
+            self.log.warning("SYSVOL directory does not exist: %s",
+                             self.root)
+            return self.stats
+
+        self.check(self.root, True)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {pool.submit(self.scan, self.root)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for directory in future.result():
+                        pending.add(pool.submit(self.scan, directory))
+        return self.stats
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Garbage collection of orphaned SYSVOL policy directories.
+
+A directory under Policies/ is an orphan when no groupPolicyContainer
+entry has its GUID as cn: grouppolicy-del leaves the directory behind
+and a failed grouppolicy-add can create one without an entry.
+
+The GUIDs of all entries are read with one paged search and Policies/ is
+listed with os.scandir. Orphans are moved to a quarantine directory
+outside the share (or deleted) at a limited rate and in limited batches,
+so the collector can run on a live server and pick up where it stopped
+on the next run. Directories younger than the minimal age are left alone,
+as is any GUID an entry appeared for since the search.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import re
+import shutil
+import time
+
+from ipalib import api, errors
+from ipapython import version
+from ipapython.config import IPAOptionParser
+from ipapython.dn import DN
+from ipapython.ipa_log_manager import standard_logging_setup
+from ipaplatform.paths import paths
+
+logger = logging.getLogger('ipa-gpo-sysvol-gc')
+
+SYSVOL_ROOT = '/var/lib/freeipa/sysvol'
+QUARANTINE_ROOT = '/var/lib/freeipa/sysvol-quarantine'
+GPC_CONTAINER = DN(('cn', 'Policies'), ('cn', 'System'))
+
+GUID_RE = re.compile(
+    r'^\{[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\}$',
+    re.IGNORECASE)
+
+# Directories modified less than this many seconds ago are never collected
+DEFAULT_MIN_AGE = 3600
+
+# Directories moved or deleted per second and per run
+DEFAULT_RATE = 10.0
+DEFAULT_LIMIT = 1000
+
+# Days quarantined directories are kept before they are deleted
+DEFAULT_PURGE_AFTER = 30
+
+
+class RateLimiter:
+    """Spaces calls to wait() at least 1/rate seconds apart."""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self.next = None
+
+    def wait(self):
+        now = self.clock()
+        if self.next is not None and now < self.next:
+            self.sleep(self.next - now)
+            now = self.next
+        self.next = now + self.interval
+
+
+def find_orphans(policies_path, guids, min_age, now=None):
+    """
+    Yield (name, path) of policy directories whose GUID is not in guids.
+
+    guids holds lower-cased GUIDs. Entries which are not GUID named
+    directories are skipped, as are directories modified less than
+    min_age seconds ago.
+    """
+    now = time.time() if now is None else now
+    with os.scandir(policies_path) as it:
+        for entry in it:
+            if not GUID_RE.match(entry.name):
+                continue
+            if entry.name.lower() in guids:
+                continue
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                continue
+            if now - mtime < min_age:
+                logger.debug("Skipping recent directory %s", entry.path)
+                continue
+            yield entry.name, entry.path
+
+
+class SysvolCollector:
+    """Moves or deletes orphaned policy directories of one domain."""
+
+    def __init__(self, api_instance, delete=False, dry_run=False,
+                 limit=DEFAULT_LIMIT, rate=DEFAULT_RATE,
+                 min_age=DEFAULT_MIN_AGE, purge_after=DEFAULT_PURGE_AFTER,
+                 log=None):
+        self.api = api_instance
+        self.delete = delete
+        self.dry_run = dry_run
+        self.limit = limit
+        self.min_age = min_age
+        self.purge_after = purge_after
+        self.logger = log or logger
+        self.limiter = RateLimiter(rate)
+
+        domain = self.api.env.domain
+        self.policies_path = os.path.join(SYSVOL_ROOT, domain, 'Policies')
+        self.quarantine_path = os.path.join(QUARANTINE_ROOT, domain)
+        self.container = DN(GPC_CONTAINER, self.api.env.basedn)
+
+    def policy_guids(self):
+        """Return the lower-cased cn of every Group Policy Container."""
+        ldap = self.api.Backend.ldap2
+        try:
+            entries = ldap.get_entries(
+                self.container, ldap.SCOPE_ONELEVEL,
+                '(objectClass=groupPolicyContainer)', ['cn'],
+                paged_search=True)
+        except errors.NotFound:
+            return set()
+        return {str(value).lower()
+                for entry in entries for value in entry.get('cn', [])}
+
+    def policy_exists(self, guid):
+        ldap = self.api.Backend.ldap2
+        try:
+            ldap.get_entry(DN(('cn', guid), self.container), ['cn'])
+        except errors.NotFound:
+            return False
+        return True
+
+    def _lock(self):
+        os.makedirs(self.quarantine_path, mode=0o700, exist_ok=True)
+        lock_file = open(os.path.join(self.quarantine_path, '.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(
+                "Another SYSVOL garbage collection is running")
+        return lock_file
+
+    def _quarantine(self, name, path):
+        target = os.path.join(self.quarantine_path,
+                              '{}.{}'.format(name, int(time.time())))
+        try:
+            os.rename(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(path, target)
+
+    def collect(self):
+        """Collect orphans and purge old quarantined directories."""
+        stats = {'orphans': 0, 'quarantined': 0, 'deleted': 0,
+                 'skipped': 0, 'purged': 0, 'remaining': 0}
+        if not os.path.isdir(self.policies_path):
+            self.logger.info("No SYSVOL policies directory at %s",
+                             self.policies_path)
+            return stats
+
+        lock_file = None if self.dry_run else self._lock()
+        try:
+            self._collect_orphans(stats)
+            if not self.dry_run:
+                self._purge(stats)
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+        return stats
+
+    def _collect_orphans(self, stats):
+        guids = self.policy_guids()
+        done = 0
+        for name, path in find_orphans(self.policies_path, guids,
+                                       self.min_age):
+            stats['orphans'] += 1
+            if done >= self.limit:
+                stats['remaining'] += 1
+                continue
+            # The entry may have been added after the bulk search
+            if self.policy_exists(name):
+                stats['skipped'] += 1
+                continue
+
+            done += 1
+            if self.dry_run:
+                self.logger.info("Orphaned policy directory: %s", path)
+                continue
+
+            self.limiter.wait()
+            try:
+                if self.delete:
+                    shutil.rmtree(path)
+                    stats['deleted'] += 1
+                    self.logger.info("Deleted %s", path)
+                else:
+                    self._quarantine(name, path)
+                    stats['quarantined'] += 1
+                    self.logger.info("Quarantined %s", path)
+            except OSError as e:
+                self.logger.error("Failed to collect %s: %s", path, e)
+
+    def _purge(self, stats):
+        cutoff = time.time() - self.purge_after * 86400
+        with os.scandir(self.quarantine_path) as it:
+            expired = []
+            for entry in it:
+                name, _sep, stamp = entry.name.rpartition('.')
+                if GUID_RE.match(name) and stamp.isdigit() and \
+                        int(stamp) < cutoff:
+                    expired.append(entry.path)
+
+        for path in expired[:self.limit]:
+            self.limiter.wait()
+            try:
+                shutil.rmtree(path)
+                stats['purged'] += 1
+            except OSError as e:
+                self.logger.error("Failed to purge %s: %s", path, e)
+
+
+def parse_options():
+    parser = IPAOptionParser(version=version.VERSION)
+    parser.add_option("--delete", dest="delete", action="store_true",
+                      default=False,
+                      help="Delete orphans instead of quarantining them")
+    parser.add_option("--dry-run", dest="dry_run", action="store_true",
+                      default=False,
+                      help="Only list orphaned policy directories")
+    parser.add_option("--limit", dest="limit", type="int",
+                      default=DEFAULT_LIMIT, metavar="COUNT",
+                      help="Directories to collect per run")
+    parser.add_option("--rate", dest="rate", type="float",
+                      default=DEFAULT_RATE, metavar="COUNT",
+                      help="Directories to collect per second")
+    parser.add_option("--min-age", dest="min_age", type="int",
+                      default=DEFAULT_MIN_AGE, metavar="SECONDS",
+                      help="Skip directories modified more recently")
+    parser.add_option("--purge-after", dest="purge_after", type="int",
+                      default=DEFAULT_PURGE_AFTER, metavar="DAYS",
+                      help="Delete quarantined directories after DAYS")
+    parser.add_option("--debug", dest="debug", action="store_true",
+                      default=False, help="Log debugging information")
+    options, _args = parser.parse_args()
+    return options
+
+
+def main():
+    options = parse_options()
+    standard_logging_setup(verbose=True, debug=options.debug)
+    if os.geteuid() != 0:
+        logger.error("Must be root to collect SYSVOL directories")
+        return 1
+
+    api.bootstrap(in_server=True, context='gpo-sysvol-gc',
+                  confdir=paths.ETC_IPA)
+    api.finalize()
+    api.Backend.ldap2.connect()
+    try:
+        collector = SysvolCollector(
+            api, delete=options.delete, dry_run=options.dry_run,
+            limit=options.limit, rate=options.rate,
+            min_age=options.min_age, purge_after=options.purge_after)
+        stats = collector.collect()
+    except RuntimeError as e:
+        logger.error("%s", e)
+        return 1
+    finally:
+        api.Backend.ldap2.disconnect()
+
+    logger.info("Orphans: %(orphans)d, quarantined: %(quarantined)d, "
+                "deleted: %(deleted)d, skipped: %(skipped)d, "
+                "purged: %(purged)d, left for the next run: "
+                "%(remaining)d", stats)
+    return 0
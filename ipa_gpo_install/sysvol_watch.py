@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+Version bumps for policy files edited directly in SYSVOL.
+
+Clients apply a GPO again only when its version changes: ALT clients
+compare versionNumber of the groupPolicyContainer entry, Windows clients
+the Version line of GPT.INI. Both are set by the tools which edit a
+policy, but a file copied or edited in Policies/{GUID} over SMB or on
+the server changes neither, so the edit is never applied.
+
+The watcher follows the Policies/ tree with inotify and records, per
+GUID, which parts changed: a path under Machine/ or User/ bumps the
+version of that part, any other path both. Editors write a file in
+bursts, so a GUID is flushed only after DEFAULT_DEBOUNCE seconds without
+events, or DEFAULT_MAX_DELAY seconds after its first event under
+continuous writes. The GUIDs due together are read with one search, and
+each versionNumber is replaced under an entryUSN assertion, so a
+concurrent grouppolicy-mod makes the bump collide and be retried instead
+of being lost. GPT.INI is written after the entry, atomically, which is
+ignored by the watcher like the temporary files of the write.
+
+A new GUID directory is written by grouppolicy-add or grouppolicy-copy
+with its content and version, and is only watched: files appearing in
+new directories below a GUID are changes, except while the provisioning
+job of the GUID is still queued. When the kernel event queue overflows,
+files modified since the last scan are looked up instead.
+"""
+
+import ctypes
+import logging
+import os
+import select
+import signal
+import struct
+import threading
+import time
+
+from ipalib import api, errors
+from ipapython import version
+from ipapython.config import IPAOptionParser
+from ipapython.dn import DN
+from ipapython.ipa_log_manager import standard_logging_setup
+from ipaplatform.paths import paths
+
+from ipa_gpo_install.sysvol_gc import GPC_CONTAINER, GUID_RE, SYSVOL_ROOT
+
+try:
+    from ipaserver.plugins.gporder import entry_usn, modify_values
+    from ipaserver.plugins.gpprovision import (
+        GPT_INI_NAME, GPT_INI_PREFIX, ProvisioningQueue, set_gpt_version,
+    )
+    from ipaserver.plugins.gprsop import SIDES, bump_version
+except ImportError as e:
+    # The server plugins are installed with FreeIPA, not with this package
+    plugins_error = e
+else:
+    plugins_error = None
+
+logger = logging.getLogger('ipa-gpo-sysvol-watch')
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+# struct inotify_event without its name
+EVENT = struct.Struct('iIII')
+
+# Seconds without events after which a GUID is flushed
+DEFAULT_DEBOUNCE = 2.0
+
+# Seconds after its first event a GUID is flushed under continuous writes
+DEFAULT_MAX_DELAY = 30.0
+
+# GUIDs read with one search
+BATCH_SIZE = 100
+
+# Longest wait for events, so that a stop request is seen
+STOP_CHECK = 1.0
+
+CONNECTION_ERRORS = (errors.NetworkError, errors.DatabaseError)
+
+
+class Inotify:
+    """Minimal inotify instance through the C library."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise self._error()
+        self.poll = select.poll()
+        self.poll.register(self.fd, select.POLLIN)
+
+    @staticmethod
+    def _error(path=None):
+        err = ctypes.get_errno()
+        return OSError(err, os.strerror(err), path)
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise self._error(path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """
+        Return the pending events as (wd, mask, name).
+
+        Waits up to timeout seconds for the first one, forever if timeout
+        is None.
+        """
+        if not self.poll.poll(None if timeout is None
+                              else max(0, int(timeout * 1000))):
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def classify(path):
+    """
+    Return (GUID, sides) a change of path bumps, or None.
+
+    path is relative to Policies/. GPT.INI of a GPO and the temporary
+    files it is written through are ignored, as is anything outside a
+    GUID named directory.
+    """
+    parts = path.split(os.sep)
+    if len(parts) < 2 or not GUID_RE.match(parts[0]):
+        return None
+    if len(parts) == 2 and (parts[1].upper() == GPT_INI_NAME or
+                            parts[1].startswith(GPT_INI_PREFIX)):
+        return None
+    for side in SIDES:
+        if parts[1].lower() == side.lower():
+            return parts[0], (side,)
+    return parts[0], SIDES
+
+
+class SysvolWatcher:
+    """Collects the changed parts of each GPO from inotify events."""
+
+    def __init__(self, policies_path, inotify=None,
+                 debounce=DEFAULT_DEBOUNCE, max_delay=DEFAULT_MAX_DELAY,
+                 queue=None):
+        self.policies_path = policies_path
+        self.inotify = inotify or Inotify()
+        # Provisioning queue of the GPOs being created, if any
+        self.queue = queue
+        self.debounce = debounce
+        self.max_delay = max_delay
+        # wd -> directory relative to policies_path, '' for Policies/
+        self.watches = {}
+        # GUID -> [sides, monotonic time of the first and last event]
+        self.pending = {}
+        # Files modified since this time are found again after an overflow
+        self.scanned = time.time()
+
+    def watch(self, relative, now, since=None):
+        """
+        Watch a directory and the ones below it.
+
+        With since, files modified at or after that time are recorded
+        as changed, for directories which appeared or events which were
+        lost before the watches were in place.
+        """
+        top = os.path.join(self.policies_path, relative)
+        for dirpath, dirnames, filenames in os.walk(top):
+            current = os.path.relpath(dirpath, self.policies_path)
+            current = '' if current == os.curdir else current
+            if not current:
+                dirnames[:] = [name for name in dirnames
+                               if GUID_RE.match(name)]
+            try:
+                wd = self.inotify.add_watch(dirpath, WATCH_MASK)
+            except OSError as e:
+                logger.warning("Cannot watch %s: %s", dirpath, e)
+                dirnames[:] = []
+                continue
+            self.watches[wd] = current
+            if since is None or not current:
+                continue
+            for name in filenames:
+                try:
+                    mtime = os.lstat(os.path.join(dirpath, name)).st_mtime
+                except OSError:
+                    continue
+                if mtime >= since:
+                    self.record(os.path.join(current, name), now)
+
+    def unwatch(self, relative):
+        """Stop watching a directory moved away and the ones below it."""
+        prefix = relative + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == relative or path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def record(self, path, now):
+        found = classify(path)
+        if found is None:
+            return
+        guid, sides = found
+        if self.queue is not None and self.queue.load(guid) is not None:
+            logger.debug("Ignoring %s, %s is being provisioned", path, guid)
+            return
+        change = self.pending.get(guid)
+        if change is None:
+            self.pending[guid] = [set(sides), now, now]
+        else:
+            change[0].update(sides)
+            change[2] = now
+
+    def overflow(self, now):
+        logger.warning("Lost file system events, looking for files "
+                       "modified since the last scan")
+        since, self.scanned = self.scanned, time.time()
+        self.watch('', now, since=since)
+
+    def handle(self, wd, mask, name, now):
+        """Record one event."""
+        if mask & IN_Q_OVERFLOW:
+            self.overflow(now)
+            return
+        relative = self.watches.get(wd)
+        if relative is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+
+        path = os.path.join(relative, name) if name else relative
+        if mask & IN_ISDIR:
+            if mask & IN_MOVED_FROM:
+                self.unwatch(path)
+            if mask & (IN_CREATE | IN_MOVED_TO) and relative:
+                # Files created before the watch was added are changes too
+                self.watch(path, now, since=0)
+            elif mask & (IN_CREATE | IN_MOVED_TO) and GUID_RE.match(name):
+                # A new policy comes with its version
+                self.watch(path, now)
+            if relative and mask & (IN_DELETE | IN_MOVED_FROM):
+                self.record(path, now)
+            return
+        self.record(path, now)
+
+    def timeout(self, now):
+        """Return the seconds until the next GUID is due, None if none."""
+        if not self.pending:
+            return None
+        return max(0, min(min(last + self.debounce, first + self.max_delay)
+                          for _sides, first, last in self.pending.values())
+                   - now)
+
+    def due(self, now):
+        """Remove and return {GUID: sides} of the GUIDs to flush."""
+        ready = {guid: sides
+                 for guid, (sides, first, last) in self.pending.items()
+                 if now - last >= self.debounce or
+                 now - first >= self.max_delay}
+        for guid in ready:
+            del self.pending[guid]
+        return ready
+
+    def requeue(self, changes, now):
+        """Flush changes again after the debounce period."""
+        for guid, sides in changes.items():
+            change = self.pending.setdefault(guid, [set(), now, now])
+            change[0].update(sides)
+            change[2] = now
+
+    def run(self, updater, stop_event):
+        """Watch and flush until stop_event is set."""
+        self.watch('', time.monotonic())
+        logger.info("Watching %d directories under %s", len(self.watches),
+                    self.policies_path)
+        while not stop_event.is_set():
+            timeout = self.timeout(time.monotonic())
+            timeout = STOP_CHECK if timeout is None \
+                else min(timeout, STOP_CHECK)
+            for wd, mask, name in self.inotify.read(timeout):
+                self.handle(wd, mask, name, time.monotonic())
+
+            changes = self.due(time.monotonic())
+            if not changes:
+                continue
+            try:
+                retry = updater.apply(changes)
+            except CONNECTION_ERRORS as e:
+                logger.error("Cannot update policy versions: %s", e)
+                updater.reconnect()
+                retry = changes
+            if retry:
+                self.requeue(retry, time.monotonic())
+
+        # Do not lose the edits of the last debounce period
+        if self.pending:
+            try:
+                updater.apply(self.due(float('inf')))
+            except CONNECTION_ERRORS as e:
+                logger.error("Cannot update policy versions: %s", e)
+
+
+class VersionUpdater:
+    """Bumps versionNumber and GPT.INI of batches of policies."""
+
+    def __init__(self, api_instance, policies_path):
+        self.api = api_instance
+        self.policies_path = policies_path
+        self.container = DN(GPC_CONTAINER, self.api.env.basedn)
+
+    def reconnect(self):
+        ldap = self.api.Backend.ldap2
+        if ldap.isconnected():
+            ldap.disconnect()
+        try:
+            ldap.connect()
+        except errors.PublicError as e:
+            logger.error("Cannot connect to the LDAP server: %s", e)
+
+    def read_entries(self, guids):
+        """Return {lower-cased GUID: entry} of the policies in guids."""
+        ldap = self.api.Backend.ldap2
+        search_filter = ldap.combine_filters(
+            ['(objectClass=groupPolicyContainer)',
+             ldap.make_filter_from_attr('cn', guids, rules=ldap.MATCH_ANY)],
+            rules=ldap.MATCH_ALL)
+        try:
+            entries = ldap.get_entries(
+                self.container, ldap.SCOPE_ONELEVEL, search_filter,
+                ['cn', 'versionNumber', 'entryUSN'])
+        except errors.NotFound:
+            return {}
+        return {str(entry['cn'][0]).lower(): entry for entry in entries}
+
+    def apply(self, changes):
+        """
+        Bump the versions of changes, {GUID: sides}.
+
+        Returns the changes which collided with another writer, to be
+        applied again.
+        """
+        ldap = self.api.Backend.ldap2
+        guids = sorted(changes)
+        retry = {}
+        for start in range(0, len(guids), BATCH_SIZE):
+            batch = guids[start:start + BATCH_SIZE]
+            entries = self.read_entries(batch)
+            for guid in batch:
+                entry = entries.get(guid.lower())
+                if entry is None:
+                    logger.debug("No policy entry for %s", guid)
+                    continue
+                old = int(entry.get('versionNumber', [0])[0])
+                new = bump_version(old, changes[guid])
+                try:
+                    modify_values(ldap, entry.dn,
+                                  [('replace', 'versionNumber', [new])],
+                                  usn=entry_usn(entry))
+                except errors.MidairCollision:
+                    logger.debug("Policy %s changed concurrently", guid)
+                    retry[guid] = changes[guid]
+                    continue
+                try:
+                    set_gpt_version(os.path.join(self.policies_path, guid),
+                                    new)
+                except OSError as e:
+                    logger.error("Cannot update GPT.INI of %s: %s", guid, e)
+                logger.info("Policy %s changed, version %d -> %d", guid,
+                            old, new)
+        return retry
+
+
+def parse_options():
+    parser = IPAOptionParser(version=version.VERSION)
+    parser.add_option("--debounce", dest="debounce", type="float",
+                      default=DEFAULT_DEBOUNCE, metavar="SECONDS",
+                      help="Wait for SECONDS without writes to a policy")
+    parser.add_option("--max-delay", dest="max_delay", type="float",
+                      default=DEFAULT_MAX_DELAY, metavar="SECONDS",
+                      help="Bump a policy written to continuously after "
+                           "SECONDS")
+    parser.add_option("--debug", dest="debug", action="store_true",
+                      default=False, help="Log debugging information")
+    options, _args = parser.parse_args()
+    return options
+
+
+def main():
+    options = parse_options()
+    standard_logging_setup(verbose=True, debug=options.debug)
+    if plugins_error is not None:
+        logger.error("Group Policy server plugins are not installed: %s",
+                     plugins_error)
+        return 1
+    if os.geteuid() != 0:
+        logger.error("Must be root to watch SYSVOL")
+        return 1
+
+    api.bootstrap(in_server=True, context='gpo-sysvol-watch',
+                  confdir=paths.ETC_IPA)
+    api.finalize()
+    policies_path = os.path.join(SYSVOL_ROOT, api.env.domain, 'Policies')
+    if not os.path.isdir(policies_path):
+        logger.error("No SYSVOL policies directory at %s", policies_path)
+        return 1
+
+    api.Backend.ldap2.connect()
+    watcher = SysvolWatcher(policies_path, debounce=options.debounce,
+                            max_delay=options.max_delay,
+                            queue=ProvisioningQueue())
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    try:
+        watcher.run(VersionUpdater(api, policies_path), stop_event)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.inotify.close()
+        api.Backend.ldap2.disconnect()
+    return 0
@@ -0,0 +1,329 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+from ipaclient.frontend import CommandOverride
+from ipalib import errors, output, util
+from ipalib import Flag, Str
+from ipalib.constants import USER_CACHE_PATH
+from ipalib.frontend import Local
+from ipalib.plugable import Registry
+from ipalib import _
+from ipapython.dn import DN
+
+logger = logging.getLogger(__name__)
+
+register = Registry()
+
+# Seconds the name cache is used for display without asking the server for
+# its generation. Writes are checked by the server whatever the cache age.
+CACHE_TTL = 60
+
+# chain_mod options taking Group Policy Object names
+GPLINK_OPTIONS = ('gplink', 'add_gpc', 'remove_gpc', 'moveup_gpc',
+                  'movedown_gpc')
+
+# chain_mod options changing names held by the cache
+RENAME_OPTIONS = ('rename', 'displayname')
+
+
+def _is_dn(value):
+    return str(value).startswith(('cn=', 'CN='))
+
+
+class GPNameCache:
+    """
+    On-disk cache of Group Policy Object and chain names.
+
+    The cache is filled by gpmaster_cache and tagged with the generation
+    of the master, which the server bumps whenever a policy or a chain is
+    added, deleted or renamed. Names resolved from the cache are sent
+    along with that generation so the server can reject them if stale.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.path = os.path.join(USER_CACHE_PATH, 'ipa', 'gpc',
+                                 '{}.json'.format(api.env.realm))
+        self.data = None
+        self.dn_by_name = {}
+        self.name_by_dn = {}
+
+    @property
+    def supported(self):
+        return 'gpmaster_cache' in self.api.Command
+
+    @property
+    def generation(self):
+        return self.data['generation'] if self.data else None
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or 'generation' not in data:
+            return None
+        return data
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.gpc-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.data, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError) as e:
+            logger.debug("Failed to save Group Policy name cache: %s", e)
+
+    def _index(self):
+        self.dn_by_name = {}
+        self.name_by_dn = {}
+        for dn, _guid, name in self.data.get('grouppolicy', []):
+            self.dn_by_name[name.lower()] = dn
+            self.name_by_dn[DN(dn)] = name
+
+    def _fetch(self):
+        kwargs = {}
+        if self.data is not None:
+            kwargs['generation'] = self.data['generation']
+        result = self.api.Command.gpmaster_cache(**kwargs)['result']
+        if result['changed']:
+            self.data = {
+                'generation': result['generation'],
+                'grouppolicy': result['grouppolicy'],
+                'chain': result['chain'],
+            }
+        self.data['checked'] = time.time()
+        self._index()
+        self._save()
+
+    def load(self):
+        """
+        Load the cache for resolving names of a write.
+
+        A stale cache is fine here: the server compares the generation.
+        """
+        if self.data is None and self.supported:
+            self.data = self._load()
+            if self.data is None:
+                self._fetch()
+            else:
+                self._index()
+        return self.data is not None
+
+    def refresh(self, force=False):
+        """Load the cache for display, revalidating it after CACHE_TTL."""
+        if not self.load():
+            return False
+        if force or time.time() - self.data.get('checked', 0) >= CACHE_TTL:
+            self._fetch()
+        return True
+
+    def expire(self):
+        """Make the next use of the cache ask the server for changes."""
+        if self.data is not None:
+            self.data['checked'] = 0
+            self._save()
+
+    def gp_dn(self, name):
+        return self.dn_by_name.get(str(name).lower())
+
+    def gp_name(self, dn):
+        try:
+            return self.name_by_dn.get(DN(dn))
+        except ValueError:
+            return None
+
+    def gp_names(self):
+        return [name for _dn, _guid, name in self.data.get('grouppolicy', [])]
+
+    def chain_names(self):
+        return [cn for cn, _displayname in self.data.get('chain', [])]
+
+
+_caches = {}
+
+
+def get_cache(api):
+    if id(api) not in _caches:
+        _caches[id(api)] = GPNameCache(api)
+    return _caches[id(api)]
+
+
+def format_chain_entry(cache, entry):
+    """Replace DNs of a chain returned with no_resolve by names."""
+    for attr in ('usergroup', 'computergroup'):
+        if entry.get(attr):
+            entry[attr] = [str(DN(value)[0].value) for value in entry[attr]]
+
+    if entry.get('gplink'):
+        names = [cache.gp_name(value) for value in entry['gplink']]
+        if None in names and cache.refresh(force=True):
+            names = [cache.gp_name(value) for value in entry['gplink']]
+        entry['gplink'] = [
+            name or str(value) for name, value in zip(names, entry['gplink'])
+        ]
+
+
+class ChainResolveOverride(CommandOverride):
+    """Base of chain commands formatting names from the local cache."""
+
+    def use_cache(self, options):
+        cache = get_cache(self.api)
+        return (not options.get('raw', False) and
+                'no_resolve' in self.params and cache.refresh())
+
+    def format_result(self, result):
+        format_chain_entry(get_cache(self.api), result['result'])
+
+
+@register(override=True, no_fail=True)
+class chain_show(ChainResolveOverride):
+    def forward(self, *keys, **options):
+        if self.use_cache(options):
+            options['no_resolve'] = True
+        result = super(chain_show, self).forward(*keys, **options)
+        if options.get('no_resolve'):
+            self.format_result(result)
+        return result
+
+
+@register(override=True, no_fail=True)
+class chain_find(ChainResolveOverride):
+    def forward(self, *keys, **options):
+        if self.use_cache(options):
+            options['no_resolve'] = True
+        result = super(chain_find, self).forward(*keys, **options)
+        if options.get('no_resolve'):
+            for entry in result['result']:
+                format_chain_entry(get_cache(self.api), entry)
+        return result
+
+
+@register(override=True, no_fail=True)
+class chain_mod(ChainResolveOverride):
+    def resolve_options(self, options):
+        """Return options with policy names replaced by cached DNs."""
+        cache = get_cache(self.api)
+        if 'gp_generation' not in self.params or not cache.load():
+            return None
+
+        resolved = dict(options)
+        translated = False
+        for name in GPLINK_OPTIONS:
+            values = options.get(name)
+            if not values:
+                continue
+            if isinstance(values, str):
+                values = (values,)
+            dns = []
+            for value in values:
+                dn = None if _is_dn(value) else cache.gp_dn(value)
+                translated = translated or dn is not None
+                dns.append(dn or value)
+            resolved[name] = tuple(dns)
+
+        if not translated:
+            return None
+        resolved['gp_generation'] = cache.generation
+        return resolved
+
+    def forward(self, *keys, **options):
+        if self.use_cache(options):
+            options['no_resolve'] = True
+
+        resolved = self.resolve_options(options)
+        if resolved is None:
+            result = super(chain_mod, self).forward(*keys, **options)
+        else:
+            try:
+                result = super(chain_mod, self).forward(*keys, **resolved)
+            except errors.MidairCollision:
+                # Names changed since the cache was filled: let the
+                # server resolve them and refresh the cache for later.
+                logger.debug("Group Policy name cache is out of date")
+                get_cache(self.api).expire()
+                result = super(chain_mod, self).forward(*keys, **options)
+
+        if any(options.get(name) for name in RENAME_OPTIONS):
+            get_cache(self.api).expire()
+        if options.get('no_resolve'):
+            self.format_result(result)
+        return result
+
+
+@register()
+class grouppolicy_complete(Local):
+    __doc__ = _('Complete Group Policy Object or chain names from the local '
+                'cache.')
+
+    takes_args = (
+        Str('prefix?',
+            label=_('Prefix'),
+            doc=_('Beginning of the name to complete'),
+        ),
+    )
+
+    takes_options = (
+        Flag('chain',
+             label=_('Chains'),
+             doc=_('Complete Group Policy Chain names'),
+             default=False,
+        ),
+    )
+
+    has_output = (
+        output.Output('result', (list, tuple), _('Matching names')),
+    )
+
+    def execute(self, prefix=None, **options):
+        cache = get_cache(self.api)
+        if not cache.refresh():
+            raise errors.ExecutionError(
+                message=_('The server does not provide Group Policy names')
+            )
+        if options.get('chain'):
+            names = cache.chain_names()
+        else:
+            names = cache.gp_names()
+        prefix = (prefix or '').lower()
+        return dict(result=sorted(
+            name for name in names if name.lower().startswith(prefix)
+        ))
+
+    def output_for_cli(self, textui, output, *args, **options):
+        for name in output['result']:
+            textui.print_plain(name)
+
+
+@register(override=True, no_fail=True)
+class gpconfig_export(CommandOverride):
+    def forward(self, *keys, **options):
+        filename = options.pop('out', None)
+        if filename:
+            try:
+                util.check_writable_file(filename)
+            except errors.FileError as e:
+                raise errors.ValidationError(name='out', error=str(e))
+
+        result = super(gpconfig_export, self).forward(*keys, **options)
+
+        if filename:
+            with open(filename, 'w') as f:
+                for record in result['result']:
+                    f.write(json.dumps(record, sort_keys=True))
+                    f.write('\n')
+            result['summary'] = _('Configuration saved to %(file)s') % {
+                'file': filename}
+            result['result'] = []
+
+        return result
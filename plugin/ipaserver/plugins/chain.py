@@ -1,5 +1,5 @@
-from ipalib import api, errors
-from ipalib import Str
+from ipalib import api, errors, output
+from ipalib import Command, File, Str, StrEnum
 from ipalib.plugable import Registry
 from .baseldap import (
     LDAPObject,
@@ -13,6 +13,30 @@ from .baseldap import (
 from ipalib import _, ngettext
 from ipapython.dn import DN
 from ipalib import Int, Str, Flag
+from .baseldap import entry_to_dict
+from .gporder import (
+    RankedList,
+    edit_backoff,
+    entry_usn,
+    modify_values,
+    net_changes,
+    order_changes,
+)
+from .gpclosure import GROUP_FILTER, DirectoryGroupClosure
+from .gpnames import current_snapshot, get_name_cache
+from .gpregistry import RegistryPolError, decode_value
+from .gpresolve import dn_key
+from .gprsop import SIDES, RSoPEngine
+from .gptargets import (
+    EFFECTIVE_ATTR,
+    check_targets,
+    get_chain_list,
+    refresh_targets,
+)
+import csv
+import io
+import itertools
+import json
 import logging
 
 logger = logging.getLogger(__name__)
@@ -31,6 +55,68 @@ OBJECT_TYPE_MAPPING = {
 
 GP_LOOKUP_ATTRIBUTES = ['displayName', 'cn']
 
+# chain_mod options editing gpLink value by value
+GPLINK_OPTIONS = ('add_gpc', 'remove_gpc', 'moveup_gpc', 'movedown_gpc')
+
+# chain_mod options handled by the regular LDAPUpdate modification
+UPDATE_OPTIONS = (
+    'displayname', 'usergroup', 'computergroup', 'gplink',
+    'add_usergroup', 'remove_usergroup',
+    'add_computergroup', 'remove_computergroup',
+    'rename', 'setattr', 'addattr', 'delattr',
+)
+
+# chain_mod options which may change the groups the chain applies to
+TARGET_OPTIONS = (
+    'usergroup', 'computergroup',
+    'add_usergroup', 'remove_usergroup',
+    'add_computergroup', 'remove_computergroup',
+    'rename', 'setattr', 'addattr', 'delattr',
+)
+
+# Hidden option of chain_show, chain_find and chain_mod: return DNs and leave
+# name resolution to the client, which does it from its cache
+NO_RESOLVE_OPTION = Flag('no_resolve',
+    label=_('Do not resolve names'),
+    doc=_('Return DNs instead of names'),
+    flags={'no_option'},
+    default=False,
+)
+
+# Number of times a gpLink edit is retried when the chain changed concurrently
+EDIT_RETRIES = 5
+
+# Maximum number of values combined into one OR filter by bulk lookups
+BULK_FILTER_CHUNK = 500
+
+# Column aliases accepted by chain-import, mapped to chain attributes
+IMPORT_COLUMNS = {
+    'cn': 'cn',
+    'name': 'cn',
+    'displayname': 'displayname',
+    'display_name': 'displayname',
+    'usergroup': 'usergroup',
+    'user_group': 'usergroup',
+    'computergroup': 'computergroup',
+    'computer_group': 'computergroup',
+    'gplink': 'gplink',
+    'gp_link': 'gplink',
+}
+
+# Separator of policy names inside a single CSV cell
+IMPORT_GPLINK_SEPARATOR = ';'
+
+# Resultant set of policy engines by API instance, see get_rsop_engine()
+_rsop_engines = {}
+
+# Problem kinds reported by chain-fsck
+FSCK_PROBLEMS = ('dangling', 'invalid', 'duplicate', 'not_in_master',
+                 'effective_chain')
+
+# Nesting closures of user groups and host groups, per chain attribute,
+# kept for the life of the server process
+_group_closures = {}
+
 
 @register()
 class chain(LDAPObject):
@@ -43,7 +129,8 @@ class chain(LDAPObject):
     object_class = ['groupPolicyChain']
     permission_filter_objectclasses = ['groupPolicyChain']
     default_attributes = [
-        'cn', 'displayName', 'userGroup', 'computerGroup', 'gpLink'
+        'cn', 'displayName', 'userGroup', 'computerGroup', 'gpLink',
+        'gpLinkOrder',
     ]
     allow_rename = True
 
@@ -57,7 +144,7 @@ class chain(LDAPObject):
             'ipapermright': {'read', 'search', 'compare'},
             'ipapermdefaultattr': {
                 'cn', 'objectclass', 'displayname', 'usergroup',
-                'computergroup', 'gplink'
+                'computergroup', 'gplink', 'gplinkorder'
             },
         },
         'System: Add Group Policy Chains': {
@@ -71,7 +158,8 @@ class chain(LDAPObject):
         'System: Modify Group Policy Chains': {
             'ipapermright': {'write'},
             'ipapermdefaultattr': {
-                'cn', 'displayname', 'usergroup', 'computergroup', 'gplink'
+                'cn', 'displayname', 'usergroup', 'computergroup', 'gplink',
+                'gplinkorder'
             },
             'default_privileges': {'Group Policy Administrators'},
         },
@@ -112,10 +200,16 @@ class chain(LDAPObject):
         self.container_dn = self.env.container_grouppolicychain
         super(chain, self)._on_finalize()
 
-    def find_gp_by_displayname(self, displayname):
+    def find_gp_by_displayname(self, displayname, snapshot=None):
         """Find Group Policy Container by displayName."""
+        ldap = self.api.Backend.ldap2
+        if snapshot is None:
+            snapshot = current_snapshot(self.api, ldap)
+        if snapshot is not None:
+            dn = get_name_cache().policy_dn(snapshot, displayname)
+            if dn is not None:
+                return DN(dn)
         try:
-            ldap = self.api.Backend.ldap2
             entry = ldap.find_entry_by_attr(
                 'displayName',
                 displayname,
@@ -180,12 +274,14 @@ class chain(LDAPObject):
 
     def _convert_gp_names_to_dns(self, gp_names, strict=False):
         """Convert GP displayNames to DNs."""
+        snapshot = current_snapshot(self.api, self.api.Backend.ldap2)
+
         def resolve_gp(name):
             name = str(name)
             if name.startswith(('cn=', 'CN=')):
                 return name
             try:
-                return str(self.find_gp_by_displayname(name))
+                return str(self.find_gp_by_displayname(name, snapshot))
             except errors.NotFound:
                 if strict:
                     raise
@@ -200,12 +296,20 @@ class chain(LDAPObject):
         else:
             return list(map(resolve_gp, gp_names))
 
-    def convert_dns_to_names(self, ldap, entry_attrs):
+    def convert_dns_to_names(self, ldap, entry_attrs, snapshot=None):
         """Convert DNs to readable names in entry attributes."""
+        if snapshot is None:
+            snapshot = current_snapshot(self.api, ldap, stale=True)
+        names = get_name_cache()
 
         for attr_name, (_, name_attr) in OBJECT_TYPE_MAPPING.items():
             if attr_name in entry_attrs and entry_attrs[attr_name]:
                 dn_str = entry_attrs[attr_name][0]
+                if snapshot is not None:
+                    name = names.group_name(snapshot, dn_str)
+                    if name is not None:
+                        entry_attrs[attr_name] = [name]
+                        continue
                 try:
                     dn_obj = DN(dn_str)
                     entry = ldap.get_entry(dn_obj, attrs_list=[name_attr])
@@ -218,6 +322,11 @@ class chain(LDAPObject):
         if 'gplink' in entry_attrs and entry_attrs['gplink']:
             gplink_display_names = []
             for gp_dn in entry_attrs['gplink']:
+                if snapshot is not None:
+                    display_name = names.policy_name(snapshot, gp_dn)
+                    if display_name is not None:
+                        gplink_display_names.append(display_name)
+                        continue
                 try:
                     gp_dn_obj = DN(gp_dn)
                     gp_entry = ldap.get_entry(gp_dn_obj, attrs_list=GP_LOOKUP_ATTRIBUTES)
@@ -237,25 +346,306 @@ class chain(LDAPObject):
 
             entry_attrs['gplink'] = gplink_display_names
 
+    def get_all_entries(self, ldap, attrs_list=None):
+        """Fetch all Group Policy Chains with a single paged search."""
+        try:
+            return ldap.get_entries(
+                DN(self.container_dn, self.api.env.basedn),
+                ldap.SCOPE_ONELEVEL,
+                ldap.make_filter_from_attr('objectclass', 'groupPolicyChain'),
+                attrs_list or self.default_attributes,
+                paged_search=True,
+            )
+        except errors.NotFound:
+            return []
+
+    def find_dns_by_attr(self, ldap, attr, values, object_class, base_dn):
+        """
+        Map values of a naming attribute to entry DNs.
+
+        Values are looked up with chunked OR searches instead of one read
+        per value. Keys of the returned dict are lower-cased values.
+        """
+        found = {}
+        values = sorted({str(value) for value in values})
+
+        for start in range(0, len(values), BULK_FILTER_CHUNK):
+            chunk = values[start:start + BULK_FILTER_CHUNK]
+            search_filter = ldap.combine_filters(
+                [
+                    ldap.make_filter_from_attr('objectclass', object_class),
+                    ldap.make_filter_from_attr(attr, chunk,
+                                               rules=ldap.MATCH_ANY),
+                ],
+                rules=ldap.MATCH_ALL
+            )
+            try:
+                entries = ldap.get_entries(
+                    base_dn, ldap.SCOPE_SUBTREE, search_filter, [attr],
+                    paged_search=True,
+                )
+            except errors.NotFound:
+                continue
+
+            for entry in entries:
+                for value in entry.get(attr, []):
+                    found[str(value).lower()] = entry.dn
+
+        return found
+
+    def resolve_names_bulk(self, ldap, usergroups=(), computergroups=(),
+                           gp_names=()):
+        """
+        Resolve user group, host group and GP names to DNs in bulk.
+
+        Returns a dict keyed by chain attribute name ('usergroup',
+        'computergroup', 'gplink') whose values map lower-cased names to DNs.
+        Names which do not exist are simply absent from the maps.
+        """
+        resolved = {}
+        requested = {
+            'usergroup': usergroups,
+            'computergroup': computergroups,
+        }
+
+        for attr_name, (obj_type, name_attr) in OBJECT_TYPE_MAPPING.items():
+            obj = self.api.Object[obj_type]
+            resolved[attr_name] = self.find_dns_by_attr(
+                ldap, name_attr, requested[attr_name],
+                obj.permission_filter_objectclasses[0],
+                DN(obj.container_dn, self.api.env.basedn)
+            )
+
+        resolved['gplink'] = self.find_dns_by_attr(
+            ldap, 'displayName', gp_names, 'groupPolicyContainer',
+            DN(self.api.env.container_grouppolicy, self.api.env.basedn)
+        )
+
+        return resolved
+
+    def get_group_closure(self, ldap, attr_name):
+        """Return the current nesting closure of user or host groups."""
+        closure = _group_closures.get(attr_name)
+        if closure is None:
+            obj = self.api.Object[OBJECT_TYPE_MAPPING[attr_name][0]]
+            closure = _group_closures.setdefault(
+                attr_name,
+                DirectoryGroupClosure(DN(obj.container_dn,
+                                         self.api.env.basedn)),
+            )
+        closure.refresh(ldap)
+        return closure
+
+    def member_groups(self, ldap, attr_name, obj_name, name):
+        """Return keys of all groups of a user or host, nested included."""
+        if not name:
+            return set()
+        obj = self.api.Object[obj_name]
+        dn = obj.get_dn(name)
+        try:
+            ldap.get_entry(dn, ['1.1'])
+        except errors.NotFound:
+            obj.handle_not_found(name)
+        closure = self.get_group_closure(ldap, attr_name)
+        return closure.member_of(ldap, dn)
+
+    def get_policy_entries(self, ldap):
+        """Return Group Policy Objects keyed by normalized DN."""
+        return {
+            dn_key(entry.dn): entry
+            for entry in self.api.Object.grouppolicy.get_all_entries(
+                ldap, ['cn', 'displayName', 'versionNumber'])
+        }
+
+    def resolve_policies(self, ldap, user=None, host=None):
+        """
+        Return the chains and policies applying to a user on a host.
+
+        The result is (chain names in master order, policy entries in
+        application order).
+        """
+        user_groups = self.member_groups(ldap, 'usergroup', 'user', user)
+        host_groups = self.member_groups(ldap, 'computergroup', 'host',
+                                         host)
+
+        entries = self.get_all_entries(ldap)
+        matching = self.match_chains(entries, user_groups, host_groups)
+        chains = {dn_key(entry.dn): entry for entry in entries
+                  if dn_key(entry.dn) in matching}
+
+        try:
+            chain_list = self.api.Object.gpmaster.get_chain_list(ldap)
+        except errors.NotFound:
+            chain_list = []
+
+        policy_entries = self.get_policy_entries(ldap)
+        chain_names, policies = [], []
+        for chain_dn in chain_list:
+            entry = chains.get(dn_key(chain_dn))
+            if entry is None:
+                continue
+            chain_names.append(str(entry['cn'][0]))
+            for gp_dn in RankedList(entry.get('gpLink', []),
+                                    entry.get('gpLinkOrder', []), key=DN):
+                policy = policy_entries.get(dn_key(gp_dn))
+                if policy is not None:
+                    policies.append(policy)
+        return chain_names, policies
+
+    def match_chains(self, entries, user_groups, host_groups):
+        """
+        Return keys of the chains applying to members of the given groups.
+
+        user_groups and host_groups are keys of all groups of the user and
+        the host, nested ones included. A chain without userGroup or
+        computerGroup does not restrict on it.
+        """
+        by_group = {'usergroup': {}, 'computergroup': {}}
+        for entry in entries:
+            key = dn_key(entry.dn)
+            for attr_name, index in by_group.items():
+                values = entry.get(attr_name, [])
+                group = dn_key(values[0]) if values else None
+                index.setdefault(group, set()).add(key)
+
+        matching = []
+        for attr_name, groups in (('usergroup', user_groups),
+                                  ('computergroup', host_groups)):
+            index = by_group[attr_name]
+            chains = set(index.get(None, ()))
+            for group in groups & index.keys():
+                chains |= index[group]
+            matching.append(chains)
+        return matching[0] & matching[1]
+
+    def initial_gp_link_order(self, gp_dns):
+        """Return gpLinkOrder values for a newly written gpLink list."""
+        return RankedList([]).replace([DN(dn) for dn in gp_dns])[0]
+
+    def apply_gp_link_order(self, entry_attrs):
+        """Sort gpLink by gpLinkOrder and drop the companion attribute."""
+        order_values = entry_attrs.pop('gplinkorder', [])
+        if entry_attrs.get('gplink'):
+            entry_attrs['gplink'] = list(RankedList(
+                entry_attrs['gplink'], order_values, key=DN))
+
+    def get_gp_links(self, ldap, dn):
+        """Return the gpLink list of a chain as a RankedList of DNs."""
+        return self.read_gp_links(ldap, dn)[0]
+
+    def read_gp_links(self, ldap, dn):
+        """Return the gpLink list of a chain and the entryUSN it was read at."""
+        entry = ldap.get_entry(dn, ['gpLink', 'gpLinkOrder', 'entryUSN'])
+        return (RankedList(entry.get('gpLink', []),
+                           entry.get('gpLinkOrder', []), key=DN),
+                entry_usn(entry))
+
+    def edit_gp_links(self, ldap, dn, operations):
+        """
+        Apply add_gpc, remove_gpc, moveup_gpc and movedown_gpc operations.
+
+        Policy names are resolved with one search and a single modify sends
+        only the gpLink values added or removed and the ranks that changed,
+        asserting the entryUSN the links were read at. When the chain
+        changed in between, the operations are planned again on a fresh
+        read.
+        """
+        names = [name for values in operations.values() for name in values
+                 if not name.startswith(('cn=', 'CN='))]
+        resolved = self.resolve_names_bulk(ldap, gp_names=names)['gplink']
+
+        def to_dn(name):
+            if name.startswith(('cn=', 'CN=')):
+                return DN(name)
+            try:
+                return resolved[name.lower()]
+            except KeyError:
+                raise errors.NotFound(
+                    reason=_("Group Policy '{}' not found").format(name)
+                )
+
+        for attempt in range(EDIT_RETRIES):
+            if attempt:
+                edit_backoff(attempt)
+            ranked, usn = self.read_gp_links(ldap, dn)
+            current = {DN(value) for value in ranked}
+            links_added, links_deleted = [], []
+            added, deleted = [], []
+
+            for name in operations.get('add_gpc', []):
+                gp_dn = to_dn(name)
+                if gp_dn in current:
+                    logger.warning("GP '%s' already exists in chain", name)
+                    continue
+                planned = ranked.append([gp_dn])
+                added.extend(planned[0])
+                deleted.extend(planned[1])
+                links_added.append(gp_dn)
+                current.add(gp_dn)
+
+            if operations.get('remove_gpc') and not current:
+                raise errors.ValidationError(
+                    name='remove_gpc',
+                    error=_("No Group Policies assigned to this chain")
+                )
+            for name in operations.get('remove_gpc', []):
+                gp_dn = to_dn(name)
+                if gp_dn not in current:
+                    raise errors.NotFound(
+                        reason=_("Group Policy '{}' not found in "
+                                 "chain").format(name)
+                    )
+                planned = ranked.remove([gp_dn])
+                added.extend(planned[0])
+                deleted.extend(planned[1])
+                links_deleted.append(gp_dn)
+                current.discard(gp_dn)
+
+            for option, offset in (('moveup_gpc', -1), ('movedown_gpc', 1)):
+                # A name repeated N times in a row moves N positions at once
+                for name, repeats in itertools.groupby(
+                        operations.get(option, [])):
+                    gp_dn = to_dn(name)
+                    if gp_dn not in current:
+                        continue
+                    planned = ranked.move(gp_dn, offset * len(list(repeats)))
+                    added.extend(planned[0])
+                    deleted.extend(planned[1])
+
+            links_added, links_deleted = net_changes(links_added,
+                                                     links_deleted)
+            added, deleted = net_changes(added, deleted)
+            changes = [('add', 'gpLink', links_added),
+                       ('delete', 'gpLink', links_deleted)]
+            changes.extend(order_changes('gpLinkOrder', ranked,
+                                         added, deleted))
+            try:
+                modify_values(ldap, dn, changes, usn)
+                return
+            except errors.MidairCollision:
+                logger.debug("Chain changed concurrently, retrying "
+                             "(attempt %d)", attempt + 1)
+
+        raise errors.MidairCollision(
+            message=_('Group Policy links were modified concurrently, '
+                      'try again')
+        )
+
+    def add_chains_to_gpmaster(self, ldap, chain_dns):
+        """Append chains to the GPMaster chain list with a single modify."""
+        self.api.Object.gpmaster.add_chains(ldap, chain_dns)
+
     def add_chain_to_gpmaster(self, chain_dn):
         """Add chain to GPMaster chain list."""
+        ldap = self.api.Backend.ldap2
         try:
-            ldap = self.api.Backend.ldap2
-            gpmaster_dn = DN(('cn', 'grouppolicymaster'),
-                           ('cn', 'etc'),
-                           self.api.env.basedn)
-            gpmaster_entry = ldap.get_entry(gpmaster_dn)
-            current_chain_list = list(gpmaster_entry.get('chainList', []))
-            chain_dn_str = str(chain_dn)
-
-            if chain_dn_str not in current_chain_list:
-                current_chain_list.append(chain_dn_str)
-                gpmaster_entry['chainList'] = current_chain_list
-                ldap.update_entry(gpmaster_entry)
-                logger.info("Successfully added chain '%s' to GPMaster", chain_dn_str)
-        except Exception as e:
+            self.add_chains_to_gpmaster(ldap, [chain_dn])
+        except errors.DuplicateEntry:
+            logger.debug("Chain '%s' is already in GPMaster", chain_dn)
+        except errors.PublicError as e:
             logger.error("Failed to add chain '%s' to GPMaster: %s",
-                        chain_dn, str(e))
+                         chain_dn, e)
+            raise
 
 
 @register()
@@ -267,14 +657,101 @@ class chain_add(LDAPCreate):
         """Convert names to DNs with strict validation."""
         converted = self.obj.convert_names_to_dns(options, strict=True)
         entry_attrs.update(converted)
+        if converted.get('gplink'):
+            entry_attrs['gplinkorder'] = self.obj.initial_gp_link_order(
+                converted['gplink'])
         return dn
 
     def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
         """Add chain to GPMaster after successful creation."""
         self.obj.add_chain_to_gpmaster(dn)
+        self.api.Object.gpmaster.bump_generation(ldap)
+        refresh_targets(self.api, ldap, [dn])
+        self.obj.apply_gp_link_order(entry_attrs)
         return dn
 
 
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+
+def _parse_dn(value):
+    """Return value as a DN, or None if it is not one."""
+    try:
+        dn = DN(value)
+    except ValueError:
+        return None
+    return dn if len(dn) else None
+
+
+def _reference_key(value):
+    dn = _parse_dn(value)
+    return dn_key(dn) if dn is not None else value.lower()
+
+
+def get_rsop_engine(api):
+    """Return the RSoP engine of the process, creating it on first use."""
+    engine = _rsop_engines.get(id(api))
+    if engine is None:
+        engine = _rsop_engines.setdefault(id(api),
+                                          RSoPEngine(api.env.domain))
+    return engine
+
+
+def _count(problems):
+    return sum(len(found) for found in problems.values())
+
+
+def _parse_import_data(data, data_format=None):
+    """Parse chain-import input into a list of chain dicts."""
+    if not data_format:
+        data_format = 'json' if data.lstrip()[:1] in ('[', '{') else 'csv'
+
+    try:
+        if data_format == 'json':
+            rows = json.loads(data)
+            if isinstance(rows, dict):
+                rows = [rows]
+        else:
+            rows = list(csv.DictReader(io.StringIO(data)))
+    except (ValueError, csv.Error) as e:
+        raise errors.ValidationError(name='data', error=str(e))
+
+    chains = []
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            raise errors.ValidationError(
+                name='data', error=_("Record {}: not an object").format(number)
+            )
+        chain = {}
+        for key, value in row.items():
+            attr = IMPORT_COLUMNS.get(str(key).strip().lower())
+            if attr is None or value in (None, '', []):
+                continue
+            if attr == 'gplink':
+                if isinstance(value, str):
+                    value = value.split(IMPORT_GPLINK_SEPARATOR)
+                # A repeated policy is linked once, at its first position
+                names = {}
+                for name in (str(v).strip() for v in value):
+                    if name:
+                        names.setdefault(name.lower(), name)
+                value = list(names.values())
+            else:
+                value = str(value).strip()
+            chain[attr] = value
+        if not chain.get('cn'):
+            raise errors.ValidationError(
+                name='data',
+                error=_("Record {}: chain name is required").format(number)
+            )
+        chains.append(chain)
+
+    return chains
+
+
 def _normalize_to_list(value):
     """Normalize value to list."""
     if isinstance(value, str):
@@ -333,104 +810,72 @@ class chain_mod(LDAPUpdate):
             label=_('Move GPC down'),
             doc=_('Move GPC lower in chain priority'),
         ),
+        Int('gp_generation?',
+            label=_('Name generation'),
+            doc=_('Generation of the names the client resolved to DNs'),
+            flags={'no_option'},
+        ),
+        NO_RESOLVE_OPTION,
     )
 
     def execute(self, *keys, **options):
-        """Handle move operations separately, everything else normally."""
-
-        if ('moveup_gpc' in options and options['moveup_gpc']) or \
-           ('movedown_gpc' in options and options['movedown_gpc']):
-
-            ldap = self.api.Backend.ldap2
-            dn = self.obj.get_dn(*keys)
-
-            self._do_move_operation(ldap, dn, keys, options)
-
-            entry_attrs = ldap.get_entry(dn, self.obj.default_attributes)
-            if not options.get('raw', False):
-                self.obj.convert_dns_to_names(ldap, entry_attrs)
-
-            result_dict = {}
-            for attr_name in entry_attrs:
-                attr_value = entry_attrs[attr_name]
-                if isinstance(attr_value, list) and len(attr_value) == 1 and attr_name not in ['gplink']:
-                    result_dict[attr_name] = attr_value[0]
-                else:
-                    result_dict[attr_name] = attr_value
-
-            return {
-                'result': result_dict,
-                'value': keys[0],
-                'summary': self.msg_summary % {'value': keys[0]}
-            }
-
-        return super(chain_mod, self).execute(*keys, **options)
-
-    def _do_move_operation(self, ldap, dn, keys, options):
-        """Simple move operation - just the essentials."""
-
-        entry = ldap.get_entry(dn, attrs_list=['gplink'])
-        current_gplinks = [str(gp_dn) for gp_dn in entry.get('gplink', [])]
-
-        if len(current_gplinks) < 2:
-            return
-
-        gp_names = options.get('moveup_gpc') or options.get('movedown_gpc')
-        direction = 'up' if 'moveup_gpc' in options else 'down'
-
-        if isinstance(gp_names, str):
-            gp_names = [gp_names]
-        elif isinstance(gp_names, tuple):
-            gp_names = list(gp_names)
-
-        for gp_name in gp_names:
-            gp_dn = None
-            for existing_dn in current_gplinks:
-                try:
-                    gp_entry = ldap.get_entry(DN(existing_dn), attrs_list=GP_LOOKUP_ATTRIBUTES)
-                    display_name = (
-                        gp_entry.get('displayName', [None])[0] or
-                        gp_entry.get('cn', [None])[0]
-                    )
-                    if display_name == gp_name:
-                        gp_dn = existing_dn
-                        break
-                except:
-                    continue
-            if not gp_dn:
-                continue
-
-            current_index = current_gplinks.index(gp_dn)
-            if direction == 'up' and current_index > 0:
-                new_index = current_index - 1
-            elif direction == 'down' and current_index < len(current_gplinks) - 1:
-                new_index = current_index + 1
-            else:
-                continue
-            gp_to_move = current_gplinks.pop(current_index)
-            current_gplinks.insert(new_index, gp_to_move)
-
-        entry['gplink'] = []
-        ldap.update_entry(entry)
+        """Apply gpLink edits value by value, everything else normally."""
+        generation = options.pop('gp_generation', None)
+        if generation is not None:
+            self.api.Object.gpmaster.check_generation(
+                self.obj.backend, generation)
+
+        gplink_operations = {
+            name: [str(value) for value in _normalize_to_list(options.pop(name))]
+            for name in GPLINK_OPTIONS if options.get(name)
+        }
+        if not gplink_operations:
+            return super(chain_mod, self).execute(*keys, **options)
+
+        ldap = self.obj.backend
+        dn = self.obj.get_dn(*keys)
+        self.obj.edit_gp_links(ldap, dn, gplink_operations)
+
+        if any(options.get(name) for name in UPDATE_OPTIONS):
+            return super(chain_mod, self).execute(*keys, **options)
+
+        entry_attrs = ldap.get_entry(dn, self.obj.default_attributes)
+        self.obj.apply_gp_link_order(entry_attrs)
+        if not options.get('raw', False) and not options.get('no_resolve'):
+            self.obj.convert_dns_to_names(ldap, entry_attrs)
 
-        entry = ldap.get_entry(dn)
-        entry['gplink'] = current_gplinks
-        ldap.update_entry(entry)
+        return dict(
+            result=entry_to_dict(entry_attrs, **options),
+            value=keys[0],
+            summary=self.msg_summary % {'value': keys[0]},
+        )
 
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
-        """Standard operations only - move operations handled in execute."""
+        """Standard operations only - gpLink edits are handled in execute."""
 
-        current_entry = ldap.get_entry(dn, attrs_list=['usergroup', 'computergroup', 'gplink'])
+        current_entry = ldap.get_entry(dn, attrs_list=['usergroup', 'computergroup'])
 
-        self._handle_add_operations(entry_attrs, options, keys)
+        self._handle_add_operations(entry_attrs, options)
 
-        self._handle_remove_operations(ldap, current_entry, entry_attrs, options)
+        self._handle_remove_operations(current_entry, entry_attrs, options)
 
         self._handle_standard_modifications(entry_attrs, options)
 
         return dn
 
-    def _handle_add_operations(self, entry_attrs, options, keys):
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        """Keep the master position of a renamed chain."""
+        if options.get('rename'):
+            self.api.Object.gpmaster.rename_chain(
+                ldap, self.obj.get_dn(*keys), dn)
+        if options.get('rename') or options.get('displayname'):
+            self.api.Object.gpmaster.bump_generation(ldap)
+        if any(options.get(name) for name in TARGET_OPTIONS):
+            refresh_targets(self.api, ldap, {self.obj.get_dn(*keys), dn})
+        self.obj.apply_gp_link_order(entry_attrs)
+        return dn
+
+    def _handle_add_operations(self, entry_attrs, options):
         """Handle add operations."""
 
         if 'add_usergroup' in options and options['add_usergroup']:
@@ -443,35 +888,7 @@ class chain_mod(LDAPUpdate):
             validated = self.obj.convert_names_to_dns({'computergroup': hostgroup_name}, strict=True)
             entry_attrs['computergroup'] = validated['computergroup']
 
-        if 'add_gpc' in options and options['add_gpc']:
-            self._add_gp_links(entry_attrs, options, keys[0])
-
-    def _add_gp_links(self, entry_attrs, options, chain_name):
-        """Add GP links to chain."""
-        gp_names = _normalize_to_list(options['add_gpc'])
-        ldap = self.api.Backend.ldap2
-        chain_dn = self.obj.get_dn(chain_name)
-        current_entry = ldap.get_entry(chain_dn, attrs_list=['gplink'])
-        current_gplinks = [str(dn) for dn in current_entry.get('gplink', [])]
-
-        for gp_name in gp_names:
-            try:
-                gp_dn = str(self.obj.find_gp_by_displayname(gp_name))
-                if gp_dn not in current_gplinks:
-                    current_gplinks.append(gp_dn)
-                    logger.debug("Added GP '%s' to chain", gp_name)
-                else:
-                    logger.warning("GP '%s' already exists in chain", gp_name)
-
-            except errors.NotFound:
-                raise errors.NotFound(
-                    reason=_("Group Policy '{}' not found").format(gp_name)
-                )
-
-        if current_gplinks:
-            entry_attrs['gplink'] = current_gplinks
-
-    def _handle_remove_operations(self, ldap, current_entry, entry_attrs, options):
+    def _handle_remove_operations(self, current_entry, entry_attrs, options):
         """Handle remove operations."""
 
         if 'remove_usergroup' in options and options['remove_usergroup']:
@@ -490,50 +907,6 @@ class chain_mod(LDAPUpdate):
                 )
             entry_attrs['computergroup'] = None
 
-        if 'remove_gpc' in options and options['remove_gpc']:
-            self._remove_gp_links(ldap, current_entry, entry_attrs, options)
-
-    def _remove_gp_links(self, ldap, current_entry, entry_attrs, options):
-        """Remove GP links from chain."""
-        gp_names = _normalize_to_list(options['remove_gpc'])
-        current_gplinks = [str(dn) for dn in current_entry.get('gplink', [])]
-
-        if not current_gplinks:
-            raise errors.ValidationError(
-                name='remove_gpc',
-                error=_("No Group Policies assigned to this chain")
-            )
-
-        for gp_name in gp_names:
-            removed = False
-            try:
-                gp_dn = str(self.obj.find_gp_by_displayname(gp_name))
-                if gp_dn in current_gplinks:
-                    current_gplinks.remove(gp_dn)
-                    removed = True
-                    logger.debug("Removed GP '%s' from chain", gp_name)
-
-            except errors.NotFound:
-                for existing_dn in current_gplinks[:]:
-                    try:
-                        gp_entry = ldap.get_entry(DN(existing_dn), attrs_list=GP_LOOKUP_ATTRIBUTES)
-                        existing_name = (
-                            gp_entry.get('displayName', [None])[0] or
-                            gp_entry.get('cn', [None])[0]
-                        )
-                        if existing_name == gp_name:
-                            current_gplinks.remove(existing_dn)
-                            removed = True
-                            break
-                    except errors.NotFound:
-                        continue
-            if not removed:
-                raise errors.NotFound(
-                    reason=_("Group Policy '{}' not found in chain").format(gp_name)
-                )
-
-        entry_attrs['gplink'] = current_gplinks if current_gplinks else None
-
     def _handle_standard_modifications(self, entry_attrs, options):
         """Handle standard modification operations."""
         standard_options = {k: v for k, v in options.items()
@@ -542,6 +915,9 @@ class chain_mod(LDAPUpdate):
         if standard_options:
             converted = self.obj.convert_names_to_dns(standard_options, strict=True)
             entry_attrs.update(converted)
+            if 'gplink' in converted:
+                entry_attrs['gplinkorder'] = self.obj.initial_gp_link_order(
+                    converted['gplink'])
 
 
 @register()
@@ -549,16 +925,24 @@ class chain_del(LDAPDelete):
     __doc__ = _('Delete a Group Policy Chain.')
     msg_summary = _('Deleted Group Policy Chain "%(value)s"')
 
+    def post_callback(self, ldap, dn, *keys, **options):
+        self.api.Object.gpmaster.bump_generation(ldap)
+        refresh_targets(self.api, ldap, [dn])
+        return True
+
 
 @register()
 class chain_show(LDAPRetrieve):
     __doc__ = _('Display information about a Group Policy Chain.')
 
+    takes_options = LDAPRetrieve.takes_options + (NO_RESOLVE_OPTION,)
+
     def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
         """Convert DNs to readable names unless raw mode is enabled."""
         assert isinstance(dn, DN)
 
-        if not options.get('raw', False):
+        self.obj.apply_gp_link_order(entry_attrs)
+        if not options.get('raw', False) and not options.get('no_resolve'):
             self.obj.convert_dns_to_names(ldap, entry_attrs)
 
         return dn
@@ -573,6 +957,8 @@ class chain_find(LDAPSearch):
         '%(count)d Group Policy Chains matched', 0
     )
 
+    takes_options = LDAPSearch.takes_options + (NO_RESOLVE_OPTION,)
+
     def args_options_2_entry(self, *args, **options):
         """Convert search options to LDAP entry attributes for filtering."""
         converted = self.obj.convert_names_to_dns(options, strict=False)
@@ -582,9 +968,437 @@ class chain_find(LDAPSearch):
 
     def post_callback(self, ldap, entries, truncated, *args, **options):
         """Convert DNs to readable names for all found entries unless raw mode."""
+        resolve = not options.get('raw', False) and not options.get('no_resolve')
+        snapshot = current_snapshot(self.api, ldap, stale=True) \
+            if resolve else None
+
+        for entry_attrs in entries:
+            self.obj.apply_gp_link_order(entry_attrs)
+            if resolve:
+                self.obj.convert_dns_to_names(ldap, entry_attrs, snapshot)
+
+        return truncated
+
+
+@register()
+class chain_import(Command):
+    __doc__ = _('Create Group Policy Chains in bulk from a CSV or JSON file.')
+
+    takes_args = (
+        File('data',
+             label=_('Chains'),
+             doc=_('CSV or JSON file describing the chains to create'),
+             cli_metavar='FILE',
+        ),
+    )
 
-        if not options.get('raw', False):
-            for entry_attrs in entries:
-                self.obj.convert_dns_to_names(ldap, entry_attrs)
+    takes_options = (
+        StrEnum('format?',
+            cli_name='format',
+            label=_('Input format'),
+            doc=_('Input format, detected from the content if not set'),
+            values=(u'csv', u'json'),
+        ),
+    )
 
-        return truncated
\ No newline at end of file
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Import results')),
+    )
+
+    def execute(self, data, **options):
+        ldap = self.api.Backend.ldap2
+        chains = _parse_import_data(data, options.get('format'))
+
+        existing = {
+            str(entry['cn'][0]).lower()
+            for entry in self.obj.get_all_entries(ldap, ['cn'])
+        }
+        seen = set()
+        new_chains, skipped = [], []
+        for chain in chains:
+            key = chain['cn'].lower()
+            if key in existing or key in seen:
+                skipped.append(chain['cn'])
+                continue
+            seen.add(key)
+            new_chains.append(chain)
+
+        resolved = self.obj.resolve_names_bulk(
+            ldap,
+            usergroups=[c['usergroup'] for c in new_chains
+                        if 'usergroup' in c],
+            computergroups=[c['computergroup'] for c in new_chains
+                            if 'computergroup' in c],
+            gp_names=[name for c in new_chains
+                      for name in c.get('gplink', [])],
+        )
+
+        missing = set()
+        for chain in new_chains:
+            for attr in ('usergroup', 'computergroup'):
+                if attr in chain and chain[attr].lower() not in resolved[attr]:
+                    missing.add(chain[attr])
+            for name in chain.get('gplink', []):
+                if name.lower() not in resolved['gplink']:
+                    missing.add(name)
+        if missing:
+            raise errors.NotFound(
+                reason=_("Referenced objects not found: {}").format(
+                    ', '.join(sorted(missing)))
+            )
+
+        added = []
+        for chain in new_chains:
+            dn = self.obj.get_dn(chain['cn'])
+            attrs = {
+                'objectclass': ['top'] + self.obj.object_class,
+                'cn': chain['cn'],
+            }
+            if 'displayname' in chain:
+                attrs['displayname'] = chain['displayname']
+            for attr in ('usergroup', 'computergroup'):
+                if attr in chain:
+                    attrs[attr] = resolved[attr][chain[attr].lower()]
+            if chain.get('gplink'):
+                attrs['gplink'] = [resolved['gplink'][name.lower()]
+                                   for name in chain['gplink']]
+                attrs['gplinkorder'] = self.obj.initial_gp_link_order(
+                    attrs['gplink'])
+            ldap.add_entry(ldap.make_entry(dn, attrs))
+            added.append(dn)
+
+        self.obj.add_chains_to_gpmaster(ldap, added)
+        if added:
+            self.api.Object.gpmaster.bump_generation(ldap)
+            refresh_targets(self.api, ldap, added)
+
+        return dict(
+            result={
+                'added': [str(dn[0].value) for dn in added],
+                'skipped': skipped,
+            },
+            summary=_('Added %(count)d Group Policy Chains') % {
+                'count': len(added)},
+        )
+
+
+USER_HOST_OPTIONS = (
+    Str('user?',
+        cli_name='user',
+        label=_('User'),
+        doc=_('User login'),
+    ),
+    Str('host?',
+        cli_name='host',
+        label=_('Host'),
+        doc=_('Host name'),
+    ),
+)
+
+
+@register()
+class chain_resolve(Command):
+    __doc__ = _('Show Group Policy Chains and Objects applying to a user '
+                'on a host.')
+
+    takes_options = USER_HOST_OPTIONS
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Applying chains and policies')),
+    )
+
+    def execute(self, **options):
+        ldap = self.api.Backend.ldap2
+        chain_names, policies = self.obj.resolve_policies(
+            ldap, options.get('user'), options.get('host'))
+        gplink = [str(entry.get('displayName', entry['cn'])[0])
+                  for entry in policies]
+
+        return dict(
+            result={'chain': chain_names, 'gplink': gplink},
+            summary=ngettext(
+                '%(count)d Group Policy Object applies',
+                '%(count)d Group Policy Objects apply', len(gplink)
+            ) % {'count': len(gplink)},
+        )
+
+
+@register()
+class chain_rsop(Command):
+    __doc__ = _('Show the resultant registry settings of a Group Policy '
+                'Chain or of a user on a host.')
+
+    takes_args = (
+        Str('cn?',
+            cli_name='name',
+            label=_('Chain name'),
+            doc=_('Group Policy Chain to merge the policies of'),
+        ),
+    )
+
+    takes_options = USER_HOST_OPTIONS
+
+    has_output = (
+        output.summary,
+        output.Output('result', (list, tuple), _('Resultant settings')),
+    )
+
+    def get_policies(self, ldap, cn, options):
+        if cn is None:
+            return self.obj.resolve_policies(
+                ldap, options.get('user'), options.get('host'))[1]
+
+        dn = self.obj.get_dn(cn)
+        try:
+            links = self.obj.get_gp_links(ldap, dn)
+        except errors.NotFound:
+            self.obj.handle_not_found(cn)
+        policies = self.obj.get_policy_entries(ldap)
+        return [policies[dn_key(gp_dn)] for gp_dn in links
+                if dn_key(gp_dn) in policies]
+
+    def execute(self, cn=None, **options):
+        ldap = self.api.Backend.ldap2
+        policies = self.get_policies(ldap, cn, options)
+        names = {
+            str(entry['cn'][0]).lower():
+                str(entry.get('displayName', entry['cn'])[0])
+            for entry in policies
+        }
+
+        merged = get_rsop_engine(self.api).resolve([
+            (str(entry['cn'][0]), entry.get('versionNumber', [0])[0])
+            for entry in policies
+        ])
+
+        result = []
+        for side in SIDES:
+            for value in merged[side]:
+                try:
+                    data = decode_value(value.type, value.data)
+                except RegistryPolError:
+                    data = bytes(value.data)
+                if isinstance(data, bytes):
+                    data = data.hex()
+                elif isinstance(data, list):
+                    data = '; '.join(data)
+                result.append({
+                    'side': side,
+                    'key': value.key,
+                    'name': value.name,
+                    'type': value.type,
+                    'value': str(data),
+                    'grouppolicy': names.get(value.guid.lower(), value.guid),
+                })
+
+        return dict(
+            result=result,
+            summary=ngettext(
+                '%(count)d setting from %(policies)d Group Policy Objects',
+                '%(count)d settings from %(policies)d Group Policy Objects',
+                len(result)
+            ) % {'count': len(result), 'policies': len(policies)},
+        )
+
+
+@register()
+class chain_fsck(Command):
+    __doc__ = _('Check references of Group Policy Chains and the master.')
+
+    takes_options = (
+        Flag('fix',
+             label=_('Fix'),
+             doc=_('Remove or repair the broken references found'),
+             default=False,
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Problems found')),
+    )
+
+    def load_targets(self, ldap):
+        """
+        Return the existing targets of each reference attribute.
+
+        Values are (keys, by_name): the normalized DNs of the entries and
+        a map of lower-cased names to DNs used to repair plain names.
+        """
+        targets = {}
+        for attr_name, (obj_type, name_attr) in OBJECT_TYPE_MAPPING.items():
+            obj = self.api.Object[obj_type]
+            try:
+                entries = ldap.get_entries(
+                    DN(obj.container_dn, self.api.env.basedn),
+                    ldap.SCOPE_ONELEVEL, GROUP_FILTER, [name_attr],
+                    paged_search=True,
+                )
+            except errors.NotFound:
+                entries = []
+            targets[attr_name] = self._index(entries, [name_attr])
+
+        targets['gplink'] = self._index(
+            self.api.Object.grouppolicy.get_all_entries(
+                ldap, ['cn', 'displayName']),
+            ['displayName', 'cn'])
+        return targets
+
+    @staticmethod
+    def _index(entries, name_attrs):
+        keys, by_name = set(), {}
+        for entry in entries:
+            keys.add(dn_key(entry.dn))
+            for attr in name_attrs:
+                for value in entry.get(attr, []):
+                    by_name.setdefault(str(value).lower(), entry.dn)
+        return keys, by_name
+
+    def check_values(self, owner, attr_name, values, targets, problems):
+        """
+        Return the DNs of values which reference existing entries.
+
+        Plain names are replaced by the DN of the entry with that name if
+        there is one. Every value dropped or replaced is reported.
+        """
+        keys, by_name = targets
+        result, seen = [], set()
+        for value in values:
+            label = '{}: {}: {}'.format(owner, attr_name, value)
+            dn = _parse_dn(value)
+            if dn is None:
+                problems['invalid'].append(label)
+                dn = by_name.get(value.lower())
+                if dn is None:
+                    continue
+            key = dn_key(dn)
+            if key not in keys:
+                problems['dangling'].append(label)
+            elif key in seen:
+                problems['duplicate'].append(label)
+            else:
+                seen.add(key)
+                result.append(dn)
+        return result
+
+    def check_list(self, owner, attr_name, entry, targets, problems):
+        """Check an ordered list attribute; return its repaired DNs."""
+        values = [_decode(v) for v in entry.raw.get(attr_name, [])]
+        order_values = [_decode(v)
+                        for v in entry.raw.get(attr_name + 'Order', [])]
+        ordered = list(RankedList(values, order_values, key=_reference_key))
+
+        # RankedList keeps one of equal values, report the others here
+        seen = set()
+        for value in values:
+            key = _reference_key(value)
+            if key in seen:
+                problems['duplicate'].append(
+                    '{}: {}: {}'.format(owner, attr_name, value))
+            seen.add(key)
+
+        return self.check_values(owner, attr_name, ordered, targets,
+                                 problems)
+
+    def execute(self, **options):
+        ldap = self.api.Backend.ldap2
+        fix = options.get('fix', False)
+        problems = {kind: [] for kind in FSCK_PROBLEMS}
+        targets = self.load_targets(ldap)
+        repairs = []
+
+        chains = self.obj.get_all_entries(ldap, [
+            'cn', 'userGroup', 'computerGroup', 'gpLink', 'gpLinkOrder',
+            'entryUSN'])
+        for entry in chains:
+            owner = str(entry.dn[0].value)
+            found = _count(problems)
+            changes = []
+            for attr_name in ('userGroup', 'computerGroup'):
+                values = [_decode(v) for v in entry.raw.get(attr_name, [])]
+                valid = self.check_values(owner, attr_name, values,
+                                          targets[attr_name.lower()],
+                                          problems)
+                changes.append(('replace', attr_name, valid[:1]))
+
+            gplink = self.check_list(owner, 'gpLink', entry,
+                                     targets['gplink'], problems)
+            changes.append(('replace', 'gpLink', gplink))
+            changes.append(('replace', 'gpLinkOrder',
+                            self.obj.initial_gp_link_order(gplink)))
+
+            if _count(problems) > found:
+                repairs.append((entry.dn, changes, entry_usn(entry)))
+
+        gpmaster = self.api.Object.gpmaster
+        try:
+            master = ldap.get_entry(gpmaster.get_dn(),
+                                    ['chainList', 'chainListOrder',
+                                     'entryUSN'])
+        except errors.NotFound:
+            master = None
+            logger.warning("Group Policy Master not found")
+
+        if master is not None:
+            found = _count(problems)
+            chain_list = self.check_list(
+                'gpmaster', 'chainList', master,
+                self._index(chains, ['cn']), problems)
+
+            listed = {dn_key(dn) for dn in chain_list}
+            missing = sorted((entry for entry in chains
+                              if dn_key(entry.dn) not in listed),
+                             key=lambda entry: str(entry.dn))
+            for entry in missing:
+                problems['not_in_master'].append(str(entry.dn[0].value))
+                chain_list.append(entry.dn)
+
+            if _count(problems) > found:
+                repairs.append((master.dn, [
+                    ('replace', 'chainList', chain_list),
+                    ('replace', 'chainListOrder',
+                     self.obj.initial_gp_link_order(chain_list)),
+                ], entry_usn(master)))
+
+        fixed = []
+        if fix:
+            for dn, changes, usn in repairs:
+                # Repairs replace whole lists: skip entries edited since
+                # they were checked instead of undoing the edit
+                try:
+                    modify_values(ldap, dn, changes, usn)
+                except errors.MidairCollision:
+                    logger.warning("%s changed during the check, not "
+                                   "fixed", dn)
+                    continue
+                fixed.append(str(dn[0].value))
+
+        # Chain lists of groups are derived from the repaired chains
+        if fixed:
+            chains = self.obj.get_all_entries(ldap, [
+                'cn', 'userGroup', 'computerGroup'])
+        for entry, changes in check_targets(self.api, ldap, chains,
+                                            get_chain_list(self.api, ldap)):
+            problems['effective_chain'].append('{}: {}'.format(
+                entry.dn[0].value, EFFECTIVE_ATTR))
+            if not fix:
+                continue
+            try:
+                modify_values(ldap, entry.dn, changes, entry_usn(entry))
+            except errors.MidairCollision:
+                logger.warning("%s changed during the check, not fixed",
+                               entry.dn)
+                continue
+            fixed.append(str(entry.dn[0].value))
+
+        count = _count(problems)
+        result = {kind: found for kind, found in problems.items() if found}
+        if fixed:
+            result['fixed'] = fixed
+        return dict(
+            result=result,
+            summary=_('%(count)d problems found, %(fixed)d entries '
+                      'fixed') % {'count': count, 'fixed': len(fixed)},
+        )
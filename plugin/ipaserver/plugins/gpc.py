@@ -1,6 +1,7 @@
-from ipalib import api, errors
+from ipalib import api, errors, output
 from ipalib import Str, Int, Command
 from ipalib.plugable import Registry
+from ipalib.request import context
 from .baseldap import (
     LDAPObject,
     LDAPCreate,
@@ -16,6 +17,9 @@ import dbus
 import dbus.mainloop.glib
 import logging
 from ipapython.ipautil import run
+from .gpcontent import get_content_cache
+from .gpnames import current_snapshot, get_name_cache
+from .gpprovision import ProvisioningQueue
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +30,10 @@ PLUGIN_CONFIG = (
     ('container_grouppolicy', DN(('cn', 'Policies'), ('cn', 'System'))),
 )
 
+# Attributes grouppolicy-copy takes from the source GPO
+COPY_ATTRIBUTES = ['flags', 'versionNumber', 'gPCMachineExtensionNames',
+                   'gPCUserExtensionNames']
+
 
 @register()
 class grouppolicy(LDAPObject):
@@ -117,6 +125,18 @@ class grouppolicy(LDAPObject):
             default=0,
             minvalue=0,
         ),
+        Str('provisioningstate?',
+            label=_('Provisioning state'),
+            doc=_('State of the policy directory in SYSVOL'),
+            flags={'virtual_attribute', 'no_create', 'no_update',
+                   'no_search'},
+        ),
+        Str('provisioningerror?',
+            label=_('Provisioning error'),
+            doc=_('Last error creating the policy directory in SYSVOL'),
+            flags={'virtual_attribute', 'no_create', 'no_update',
+                   'no_search'},
+        ),
     )
 
     def _on_finalize(self):
@@ -138,47 +158,108 @@ class grouppolicy(LDAPObject):
                 reason=_('%(pkey)s: Group Policy Object not found') % {'pkey': displayname}
             )
 
-
-@register()
-class grouppolicy_add(LDAPCreate):
-    __doc__ = _('Create a new Group Policy Object.')
-    msg_summary = _('Added Group Policy Object "%(value)s"')
-
-    def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
-        displayname = keys[-1]
+    def find_gpo_dn(self, ldap, displayname):
+        """Return the DN of a GPO, from the shared name cache if current."""
+        snapshot = current_snapshot(self.api, ldap)
+        if snapshot is not None:
+            dn = get_name_cache().policy_dn(snapshot, displayname)
+            if dn is not None:
+                return DN(dn)
+        return self.find_gpo_by_displayname(ldap, displayname).dn
+
+    def get_all_entries(self, ldap, attrs_list=None):
+        """Fetch all Group Policy Objects with a single paged search."""
         try:
-            self.obj.find_gpo_by_displayname(ldap, displayname)
-            raise errors.InvocationError(
-                message=_('A Group Policy Object with displayName "%s" already exists.') % displayname
+            return ldap.get_entries(
+                DN(self.env.container_grouppolicy, self.env.basedn),
+                ldap.SCOPE_ONELEVEL,
+                ldap.make_filter_from_attr('objectclass', 'groupPolicyContainer'),
+                attrs_list or self.default_attributes,
+                paged_search=True,
             )
         except errors.NotFound:
-            pass
+            return []
 
+    def _get_server_interface(self):
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        bus = dbus.SystemBus()
+        obj = bus.get_object('org.freeipa.server', '/',
+                             follow_name_owner_changes=True)
+        return dbus.Interface(obj, 'org.freeipa.server')
+
+    def new_gpo_entry(self, entry_attrs):
+        """Fill the attributes of a new GPO with a fresh GUID, return its DN."""
         guid = '{' + str(uuid.uuid4()).upper() + '}'
-        dn = DN(('cn', guid), api.env.container_grouppolicy, api.env.basedn)
+        dn = DN(('cn', guid), self.env.container_grouppolicy, self.env.basedn)
         entry_attrs['cn'] = guid
         entry_attrs['distinguishedname'] = str(dn)
-        entry_attrs['gpcfilesyspath'] = f"\\\\{api.env.domain}\\SysVol\\{api.env.domain}\\Policies\\{guid}"
+        entry_attrs['gpcfilesyspath'] = f"\\\\{self.env.domain}\\SysVol\\{self.env.domain}\\Policies\\{guid}"
         entry_attrs['flags'] = 0
         entry_attrs['versionnumber'] = 0
-
         return dn
 
-    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
-        guid = str(dn[0].value)
-        domain = api.env.domain.lower()
+    def check_unique_displayname(self, ldap, displayname):
+        try:
+            self.find_gpo_by_displayname(ldap, displayname)
+            raise errors.InvocationError(
+                message=_('A Group Policy Object with displayName "%s" already exists.') % displayname
+            )
+        except errors.NotFound:
+            pass
 
-        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-        params = [guid, domain]
-        while len(params) < 2:
-            params.append('')
+    def queue_gpo_structure(self, guid, source=None):
+        """
+        Queue the creation of the SYSVOL structure of a GPO.
+
+        With source, the GUID of another GPO, the structure is a copy of
+        the directory of that GPO. The oddjob helper processing the queue
+        is started without waiting for it; if it cannot be started,
+        ipa-gpo-provision.timer picks the job up. Without a queue directory
+        the structure is created synchronously.
+        """
+        queue = ProvisioningQueue()
+        if not queue.available:
+            logger.warning("Provisioning queue %s is not writable, creating "
+                           "the structure of %s synchronously",
+                           queue.directory, guid)
+            if source:
+                self.copy_gpo_structure(guid, source)
+            else:
+                self.create_gpo_structure(guid)
+            return
+
+        queue.enqueue(guid, self.env.domain, source=source)
+        try:
+            self._get_server_interface().process_gpo_queue(ignore_reply=True)
+        except dbus.DBusException as e:
+            logger.warning("Failed to start the provisioning of %s, left "
+                           "for the retry timer: %s", guid, e)
 
+    def rebuild_name_cache(self):
+        """Ask the oddjob helper to rebuild the shared name cache."""
         try:
-            bus = dbus.SystemBus()
-            obj = bus.get_object('org.freeipa.server', '/',
-                                follow_name_owner_changes=True)
-            server = dbus.Interface(obj, 'org.freeipa.server')
-            ret, stdout, stderr = server.create_gpo_structure(*params)
+            self._get_server_interface().rebuild_gpo_names(ignore_reply=True)
+        except dbus.DBusException as e:
+            logger.warning("Failed to start the rebuild of the name cache, "
+                           "names are read from LDAP: %s", e)
+
+    def get_provisioning_state(self, guid):
+        return ProvisioningQueue().state(guid, self.env.domain)
+
+    def create_gpo_structure(self, guid):
+        """Create the SYSVOL directory structure of a GPO through oddjob."""
+        self._call_structure_helper('create_gpo_structure',
+                                    guid, self.env.domain.lower())
+
+    def copy_gpo_structure(self, guid, source):
+        """Copy the SYSVOL directory of GPO source to guid through oddjob."""
+        self._call_structure_helper('copy_gpo_structure',
+                                    guid, self.env.domain.lower(), source)
+
+    def _call_structure_helper(self, method, *params):
+        try:
+            server = self._get_server_interface()
+            ret, stdout, stderr = getattr(server, method)(*params)
 
             if ret != 0:
                 logger.error("Failed to create GPO structure: %s", stderr)
@@ -193,6 +274,58 @@ class grouppolicy_add(LDAPCreate):
                 message=_('Failed to communicate with DBus service')
             )
 
+
+@register()
+class grouppolicy_add(LDAPCreate):
+    __doc__ = _('Create a new Group Policy Object.')
+    msg_summary = _('Added Group Policy Object "%(value)s"')
+
+    def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
+        self.obj.check_unique_displayname(ldap, keys[-1])
+        return self.obj.new_gpo_entry(entry_attrs)
+
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        self.api.Object.gpmaster.bump_generation(ldap)
+        guid = str(dn[0].value)
+        self.obj.queue_gpo_structure(guid)
+        entry_attrs['provisioningstate'] = [
+            self.obj.get_provisioning_state(guid)[0]]
+        return dn
+
+
+@register()
+class grouppolicy_copy(LDAPCreate):
+    __doc__ = _('Create a Group Policy Object as a copy of another one.')
+    msg_summary = _('Copied Group Policy Object "%(value)s"')
+
+    takes_options = LDAPCreate.takes_options + (
+        Str('source',
+            cli_name='source',
+            label=_('Source policy'),
+            doc=_('Display name of the Group Policy Object to copy'),
+        ),
+    )
+
+    def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
+        self.obj.check_unique_displayname(ldap, keys[-1])
+        source = ldap.get_entry(
+            self.obj.find_gpo_dn(ldap, options['source']), COPY_ATTRIBUTES)
+        # The directory of this GPO is copied, whatever the name now names
+        setattr(context, 'gpo_copy_source', str(source.dn[0].value))
+
+        dn = self.obj.new_gpo_entry(entry_attrs)
+        for attr in COPY_ATTRIBUTES:
+            if source.get(attr):
+                entry_attrs[attr] = source[attr]
+        return dn
+
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        self.api.Object.gpmaster.bump_generation(ldap)
+        guid = str(dn[0].value)
+        self.obj.queue_gpo_structure(
+            guid, source=getattr(context, 'gpo_copy_source'))
+        entry_attrs['provisioningstate'] = [
+            self.obj.get_provisioning_state(guid)[0]]
         return dn
 
 
@@ -202,8 +335,14 @@ class grouppolicy_del(LDAPDelete):
     msg_summary = _('Deleted Group Policy Object "%(value)s"')
 
     def pre_callback(self, ldap, dn, *keys, **options):
-        entry = self.obj.find_gpo_by_displayname(ldap, keys[0])
-        return entry.dn
+        return self.obj.find_gpo_dn(ldap, keys[0])
+
+    def post_callback(self, ldap, dn, *keys, **options):
+        self.api.Object.gpmaster.bump_generation(ldap)
+        guid = str(dn[0].value)
+        get_content_cache().invalidate(guid)
+        ProvisioningQueue().discard(guid)
+        return True
 
 
 @register()
@@ -212,8 +351,14 @@ class grouppolicy_show(LDAPRetrieve):
     msg_summary = _('Found Group Policy Object "%(value)s"')
 
     def pre_callback(self, ldap, dn, attrs_list, *keys, **options):
-        entry = self.obj.find_gpo_by_displayname(ldap, keys[0])
-        return entry.dn
+        return self.obj.find_gpo_dn(ldap, keys[0])
+
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        state, error = self.obj.get_provisioning_state(str(dn[0].value))
+        entry_attrs['provisioningstate'] = [state]
+        if error:
+            entry_attrs['provisioningerror'] = [error]
+        return dn
 
 
 @register()
@@ -233,8 +378,7 @@ class grouppolicy_mod(LDAPUpdate):
     def pre_callback(self, ldap, dn, entry_attrs, attrs_list, *keys, **options):
         assert isinstance(dn, DN)
 
-        old_entry = self.obj.find_gpo_by_displayname(ldap, keys[0])
-        old_dn = old_entry.dn
+        old_dn = self.obj.find_gpo_dn(ldap, keys[0])
 
         if 'rename' in options and options['rename']:
             new_name = options['rename']
@@ -251,4 +395,25 @@ class grouppolicy_mod(LDAPUpdate):
             except errors.NotFound:
                 pass
 
-        return old_dn
\ No newline at end of file
+        return old_dn
+
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        if options.get('rename'):
+            self.api.Object.gpmaster.bump_generation(ldap)
+        return dn
+
+
+@register()
+class grouppolicy_stats(Command):
+    __doc__ = _('Show counters of the policy content and name caches of '
+                'the server process.')
+
+    has_output = (
+        output.Output('result', dict, _('Policy content and name caches')),
+    )
+
+    def execute(self, **options):
+        stats = get_content_cache().stats()
+        stats.update(('names_' + name, value)
+                     for name, value in get_name_cache().stats().items())
+        return dict(result=stats)
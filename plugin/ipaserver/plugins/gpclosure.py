@@ -0,0 +1,148 @@
+"""
+Transitive closure of group nesting.
+
+GroupClosure maps every group to the set of groups containing it
+directly or through nesting (the group itself included), so matching a
+user or a host against chains is a set intersection instead of a walk
+over nested groups.
+
+The closure is updated incrementally: replacing the direct member groups
+of one group recomputes only that group's descendants. A directory
+backed closure is loaded with one search and refreshed with searches for
+entries whose entryUSN grew since the previous refresh.
+
+Deleted and renamed groups are left in the closure under their old DN:
+the referential integrity plugin removes them from the member lists of
+their parents and from chains, so they can no longer match anything.
+A periodic full reload drops them.
+"""
+import threading
+import time
+
+from ipalib import errors
+from ipapython.dn import DN
+from .gpresolve import dn_key
+
+# Seconds after which a directory backed closure is reloaded from scratch
+RELOAD_INTERVAL = 3600
+
+GROUP_FILTER = '(objectClass=groupOfNames)'
+
+
+class GroupClosure:
+    """Group to ancestor groups map with incremental maintenance."""
+
+    def __init__(self):
+        self.parents = {}
+        self.children = {}
+        self.closure = {}
+
+    def set_members(self, group, member_groups):
+        """Replace the direct member groups of a group."""
+        old = self.children.get(group, set())
+        new = set(member_groups)
+        self.parents.setdefault(group, set())
+        self.children[group] = new
+
+        for child in old - new:
+            self.parents[child].discard(group)
+        for child in new - old:
+            self.parents.setdefault(child, set()).add(group)
+
+        self._refresh({group} | (old ^ new))
+
+    def _descendants(self, roots):
+        result = set(roots)
+        stack = list(roots)
+        while stack:
+            for child in self.children.get(stack.pop(), ()):
+                if child not in result:
+                    result.add(child)
+                    stack.append(child)
+        return result
+
+    def _refresh(self, roots):
+        affected = self._descendants(roots)
+        for group in affected:
+            self.closure.pop(group, None)
+        for group in affected:
+            self.closure[group] = self._compute(group)
+
+    def _compute(self, group):
+        # Walk up until groups with a valid cached closure are reached;
+        # this also terminates on nesting cycles.
+        result = {group}
+        stack = [group]
+        while stack:
+            for parent in self.parents.get(stack.pop(), ()):
+                if parent in result:
+                    continue
+                cached = self.closure.get(parent)
+                if cached is not None:
+                    result |= cached
+                else:
+                    result.add(parent)
+                    stack.append(parent)
+        return frozenset(result)
+
+    def ancestors(self, groups):
+        """Return the groups containing any of groups, groups included."""
+        result = set()
+        for group in groups:
+            result |= self.closure.get(group, frozenset((group,)))
+        return result
+
+
+class DirectoryGroupClosure(GroupClosure):
+    """GroupClosure of the groups in one container of the directory."""
+
+    def __init__(self, base_dn):
+        super(DirectoryGroupClosure, self).__init__()
+        self.base_dn = DN(base_dn)
+        self.base_key = dn_key(base_dn)
+        self.usn = 0
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def _apply(self, entries):
+        for entry in entries:
+            self.set_members(dn_key(entry.dn), [
+                key for key in (dn_key(value)
+                                for value in entry.get('member', []))
+                if key.endswith(',' + self.base_key)
+            ])
+            for usn in entry.get('entryUSN', []):
+                self.usn = max(self.usn, int(usn))
+
+    def _search(self, ldap, search_filter):
+        try:
+            return ldap.get_entries(
+                self.base_dn, ldap.SCOPE_ONELEVEL, search_filter,
+                ['member', 'entryUSN'], paged_search=True,
+            )
+        except errors.NotFound:
+            return []
+
+    def refresh(self, ldap):
+        """Bring the closure up to date with the directory."""
+        with self.lock:
+            if time.monotonic() - self.loaded > RELOAD_INTERVAL or \
+                    not self.loaded:
+                self.parents, self.children, self.closure = {}, {}, {}
+                self.usn = 0
+                self._apply(self._search(ldap, GROUP_FILTER))
+                self.loaded = time.monotonic()
+                return
+
+            changed = self._search(ldap, ldap.combine_filters(
+                [GROUP_FILTER, '(entryUSN>={})'.format(self.usn + 1)],
+                rules=ldap.MATCH_ALL))
+            self._apply(changed)
+
+    def member_of(self, ldap, member_dn):
+        """Return keys of all groups containing member_dn, nested or not."""
+        direct = self._search(ldap, ldap.combine_filters(
+            [GROUP_FILTER, ldap.make_filter_from_attr('member', member_dn)],
+            rules=ldap.MATCH_ALL))
+        with self.lock:
+            return self.ancestors(dn_key(entry.dn) for entry in direct)
@@ -0,0 +1,418 @@
+from ipalib import api, errors, output
+from ipalib import Command, File, Flag, Str
+from ipalib.plugable import Registry
+from ipalib import _
+from ipapython.dn import DN
+from .gporder import RankedList
+from .gpprovision import GUID_RE
+from .gptargets import refresh_targets
+import json
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+register = Registry()
+
+EXPORT_FORMAT = 'ipa-gpo'
+EXPORT_VERSION = 1
+
+GPMASTER_RDN = ('cn', 'grouppolicymaster')
+
+GP_EXPORT_ATTRIBUTES = [
+    'cn', 'displayName', 'flags', 'versionNumber',
+    'gPCMachineExtensionNames', 'gPCUserExtensionNames',
+]
+
+# Fields of each record type: (name, type, required)
+RECORD_FIELDS = {
+    'grouppolicy': (
+        ('displayname', str, True), ('cn', str, False),
+        ('flags', int, False), ('versionnumber', int, False),
+        ('gpcmachineextensionnames', str, False),
+        ('gpcuserextensionnames', str, False),
+    ),
+    'chain': (
+        ('cn', str, True), ('displayname', str, False),
+        ('usergroup', str, False), ('computergroup', str, False),
+        ('gplink', list, False),
+    ),
+    'gpmaster': (
+        ('chainlist', list, False),
+    ),
+}
+
+
+def _first(entry, attr, default=None):
+    """Return the first value of an attribute or the default."""
+    values = entry.get(attr, [])
+    return values[0] if values else default
+
+
+def _rdn_value(dn):
+    """Return the value of the leftmost RDN of a DN."""
+    return str(DN(dn)[0].value)
+
+
+def get_gpmaster_dn(env):
+    """Return the DN of the Group Policy Master entry."""
+    return DN(GPMASTER_RDN, ('cn', 'etc'), env.basedn)
+
+
+def record_error(record):
+    """Return what is wrong with a parsed record, or None."""
+    for name, value_type, required in RECORD_FIELDS[record['type']]:
+        value = record.get(name)
+        if value is None or value == '':
+            if required:
+                return _('missing {}').format(name)
+            continue
+        if isinstance(value, bool) or not isinstance(value, value_type):
+            return _('invalid {}').format(name)
+        if value_type is list and not all(
+                isinstance(item, str) and item for item in value):
+            return _('invalid {}').format(name)
+    if record['type'] == 'grouppolicy' and record.get('cn') and \
+            not GUID_RE.match(record['cn']):
+        return _('invalid cn')
+    return None
+
+
+def parse_records(data):
+    """
+    Parse an exported configuration.
+
+    The format is JSON Lines: a header line followed by one record per
+    line. Returns a dict of record lists keyed by record type; every
+    record is checked before anything is returned.
+    """
+    records = {'grouppolicy': [], 'chain': [], 'gpmaster': []}
+    lines = (line.strip() for line in data.splitlines())
+    lines = [line for line in lines if line]
+
+    if not lines:
+        raise errors.ValidationError(name='data', error=_('Empty input'))
+
+    try:
+        header = json.loads(lines[0])
+    except ValueError as e:
+        raise errors.ValidationError(name='data', error=str(e))
+    if header.get('format') != EXPORT_FORMAT:
+        raise errors.ValidationError(
+            name='data', error=_('Not a Group Policy configuration export')
+        )
+    if header.get('version') != EXPORT_VERSION:
+        raise errors.ValidationError(
+            name='data',
+            error=_('Unsupported export version: {}').format(
+                header.get('version'))
+        )
+
+    for lineno, line in enumerate(lines[1:], start=2):
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise errors.ValidationError(
+                name='data', error=_('Line {}: {}').format(lineno, e)
+            )
+        if not isinstance(record, dict) or \
+                record.get('type') not in records:
+            raise errors.ValidationError(
+                name='data',
+                error=_('Line {}: unknown record type').format(lineno)
+            )
+        error = record_error(record)
+        if error:
+            raise errors.ValidationError(
+                name='data', error=_('Line {}: {}').format(lineno, error)
+            )
+        records[record['type']].append(record)
+
+    return records
+
+
+@register()
+class gpconfig_export(Command):
+    __doc__ = _('Export the whole Group Policy configuration.')
+
+    takes_options = (
+        Str('out?',
+            label=_('Output file'),
+            doc=_('File to store the exported configuration in'),
+            include='cli',
+            cli_metavar='FILE',
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', list, _('Exported records')),
+    )
+
+    def execute(self, **options):
+        ldap = self.api.Backend.ldap2
+        gp_entries = self.api.Object.grouppolicy.get_all_entries(
+            ldap, GP_EXPORT_ATTRIBUTES)
+        chain_entries = self.api.Object.chain.get_all_entries(ldap)
+
+        gp_names = {}
+        records = [{'format': EXPORT_FORMAT, 'version': EXPORT_VERSION}]
+
+        for entry in gp_entries:
+            name = _first(entry, 'displayName') or _first(entry, 'cn')
+            gp_names[entry.dn] = name
+            record = {'type': 'grouppolicy', 'cn': _first(entry, 'cn'),
+                      'displayname': name}
+            for attr in GP_EXPORT_ATTRIBUTES[2:]:
+                value = _first(entry, attr)
+                if value is not None:
+                    record[attr.lower()] = value
+            records.append(record)
+
+        for entry in chain_entries:
+            record = {'type': 'chain', 'cn': _first(entry, 'cn')}
+            displayname = _first(entry, 'displayName')
+            if displayname:
+                record['displayname'] = displayname
+            for attr in ('userGroup', 'computerGroup'):
+                value = _first(entry, attr)
+                if value:
+                    record[attr.lower()] = _rdn_value(value)
+            links = RankedList(entry.get('gpLink', []),
+                               entry.get('gpLinkOrder', []), key=DN)
+            record['gplink'] = [
+                gp_names.get(DN(value), str(value)) for value in links
+            ]
+            records.append(record)
+
+        try:
+            master = ldap.get_entry(get_gpmaster_dn(self.api.env),
+                                    ['chainList', 'chainListOrder'])
+        except errors.NotFound:
+            master = None
+        if master is not None:
+            chain_list = RankedList(master.get('chainList', []),
+                                    master.get('chainListOrder', []), key=DN)
+            records.append({
+                'type': 'gpmaster',
+                'chainlist': [_rdn_value(value) for value in chain_list],
+            })
+
+        return dict(
+            result=records,
+            summary=_('Exported %(gpc)d Group Policy Objects and '
+                      '%(chain)d Group Policy Chains') % {
+                          'gpc': len(gp_entries),
+                          'chain': len(chain_entries)},
+        )
+
+
+@register()
+class gpconfig_import(Command):
+    __doc__ = _('Import a Group Policy configuration export.')
+
+    takes_args = (
+        File('data',
+             label=_('Configuration'),
+             doc=_('Exported Group Policy configuration (JSON Lines)'),
+             cli_metavar='FILE',
+        ),
+    )
+
+    takes_options = (
+        Flag('no_sysvol',
+             label=_('Skip SYSVOL'),
+             doc=_('Do not create SYSVOL structure for imported policies'),
+             default=False,
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        output.Output('result', dict, _('Import results')),
+    )
+
+    def execute(self, data, **options):
+        ldap = self.api.Backend.ldap2
+        gp_obj = self.api.Object.grouppolicy
+        chain_obj = self.api.Object.chain
+        records = parse_records(data)
+
+        # Resolve everything first so that nothing is written when a
+        # reference cannot be satisfied.
+        existing_gps = gp_obj.get_all_entries(ldap, ['cn', 'displayName'])
+        gp_by_name = {
+            str(_first(e, 'displayName', '')).lower(): e.dn
+            for e in existing_gps
+        }
+        used_guids = {str(_first(e, 'cn', '')).upper() for e in existing_gps}
+
+        new_gps = []
+        for record in records['grouppolicy']:
+            name = record['displayname']
+            if name.lower() in gp_by_name:
+                continue
+            guid = str(record.get('cn') or '').upper()
+            if not guid or guid in used_guids:
+                guid = '{' + str(uuid.uuid4()).upper() + '}'
+            used_guids.add(guid)
+            dn = DN(('cn', guid), self.api.env.container_grouppolicy,
+                    self.api.env.basedn)
+            gp_by_name[name.lower()] = dn
+            new_gps.append((guid, dn, record))
+
+        existing_chains = {
+            str(_first(e, 'cn', '')).lower(): e.dn
+            for e in chain_obj.get_all_entries(ldap, ['cn'])
+        }
+        # The first record of a repeated chain wins, as for policies
+        chain_records = []
+        seen_chains = set(existing_chains)
+        for record in records['chain']:
+            if record['cn'].lower() in seen_chains:
+                continue
+            seen_chains.add(record['cn'].lower())
+            links = {}
+            for name in record.get('gplink', []):
+                links.setdefault(name.lower(), name)
+            chain_records.append(dict(record, gplink=list(links.values())))
+
+        resolved = chain_obj.resolve_names_bulk(
+            ldap,
+            usergroups=[r['usergroup'] for r in chain_records
+                        if r.get('usergroup')],
+            computergroups=[r['computergroup'] for r in chain_records
+                            if r.get('computergroup')],
+        )
+        resolved['gplink'] = gp_by_name
+
+        missing = []
+        for record in chain_records:
+            for attr in ('usergroup', 'computergroup'):
+                name = record.get(attr)
+                if name and name.lower() not in resolved[attr]:
+                    missing.append(name)
+            for name in record.get('gplink', []):
+                if (not name.startswith(('cn=', 'CN=')) and
+                        name.lower() not in resolved['gplink']):
+                    missing.append(name)
+        if missing:
+            raise errors.NotFound(
+                reason=_('Referenced objects not found: {}').format(
+                    ', '.join(sorted(set(missing))))
+            )
+
+        # Write in dependency order: policies, chains, master.
+        created_gps, created_chains = [], []
+        try:
+            for guid, dn, record in new_gps:
+                attrs = {
+                    'objectclass': ['top', 'groupPolicyContainer'],
+                    'cn': guid,
+                    'displayName': record['displayname'],
+                    'distinguishedName': str(dn),
+                    'gPCFileSysPath':
+                        "\\\\{0}\\SysVol\\{0}\\Policies\\{1}".format(
+                            self.api.env.domain, guid),
+                    'flags': record.get('flags', 0),
+                    'versionNumber': record.get('versionnumber', 0),
+                }
+                for attr in ('gPCMachineExtensionNames',
+                             'gPCUserExtensionNames'):
+                    if record.get(attr.lower()):
+                        attrs[attr] = record[attr.lower()]
+                ldap.add_entry(ldap.make_entry(dn, attrs))
+                created_gps.append(record['displayname'])
+
+            for record in chain_records:
+                dn = chain_obj.get_dn(record['cn'])
+                attrs = {
+                    'objectclass': ['top', 'groupPolicyChain'],
+                    'cn': record['cn'],
+                }
+                if record.get('displayname'):
+                    attrs['displayName'] = record['displayname']
+                for attr in ('usergroup', 'computergroup'):
+                    if record.get(attr):
+                        attrs[attr] = resolved[attr][record[attr].lower()]
+                gplinks = [
+                    name if name.startswith(('cn=', 'CN='))
+                    else resolved['gplink'][name.lower()]
+                    for name in record.get('gplink', [])
+                ]
+                if gplinks:
+                    attrs['gpLink'] = gplinks
+                    attrs['gpLinkOrder'] = \
+                        chain_obj.initial_gp_link_order(gplinks)
+                ldap.add_entry(ldap.make_entry(dn, attrs))
+                existing_chains[record['cn'].lower()] = dn
+                created_chains.append(record['cn'])
+
+            chain_order = []
+            for record in records['gpmaster']:
+                chain_order.extend(record.get('chainlist', []))
+            chain_order.extend(r['cn'] for r in chain_records)
+            added_to_master = self._update_chain_list(ldap, [
+                existing_chains[name.lower()] for name in chain_order
+                if name.lower() in existing_chains
+            ])
+        except errors.PublicError as e:
+            if not created_gps and not created_chains:
+                raise
+            raise errors.ExecutionError(
+                message=_('Import stopped: %(error)s. Already created '
+                          'Group Policy Objects: %(gpc)s; Group Policy '
+                          'Chains: %(chain)s') % {
+                              'error': e,
+                              'gpc': ', '.join(created_gps) or '-',
+                              'chain': ', '.join(created_chains) or '-'}
+            )
+        finally:
+            # Names were added even when a later add failed
+            if created_gps or created_chains:
+                self.api.Object.gpmaster.bump_generation(ldap)
+
+        # Imported chains are all appended, and only chains in the master
+        # apply to their groups
+        refresh_targets(self.api, ldap, added_to_master)
+
+        sysvol_failed = []
+        if not options.get('no_sysvol'):
+            for guid, dn, record in new_gps:
+                try:
+                    gp_obj.create_gpo_structure(guid)
+                except errors.ExecutionError as e:
+                    logger.error("Failed to create SYSVOL structure for "
+                                 "%s: %s", guid, e)
+                    sysvol_failed.append(record['displayname'])
+
+        result = {
+            'grouppolicy': [r['displayname'] for _guid, _dn, r in new_gps],
+            'chain': [r['cn'] for r in chain_records],
+            'sysvol_failed': sysvol_failed,
+        }
+        return dict(
+            result=result,
+            summary=_('Imported %(gpc)d Group Policy Objects and '
+                      '%(chain)d Group Policy Chains') % {
+                          'gpc': len(new_gps),
+                          'chain': len(chain_records)},
+        )
+
+    def _update_chain_list(self, ldap, chain_dns):
+        """
+        Append imported chains missing from the GPMaster chain list.
+
+        Returns the DNs of the chains appended.
+        """
+        if not chain_dns:
+            return []
+        master = ldap.get_entry(get_gpmaster_dn(self.api.env), ['chainList'])
+        chain_list = {DN(value) for value in master.get('chainList', [])}
+        missing = []
+        for dn in chain_dns:
+            if dn not in chain_list:
+                chain_list.add(dn)
+                missing.append(dn)
+        self.api.Object.chain.add_chains_to_gpmaster(ldap, missing)
+        return missing
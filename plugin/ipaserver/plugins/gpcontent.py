@@ -0,0 +1,180 @@
+"""
+Cache of parsed SYSVOL policy content.
+
+Parsed files are cached under (GUID, part, versionNumber, mtime), part
+being the file path inside the policy directory. versionNumber comes from
+LDAP, so a GPO edited through the usual tools misses the cache as soon as
+its entry is updated; the modification time catches files changed
+without a version bump.
+
+Parsed content is kept in memory in LRU order within a byte budget, and,
+when the cache directory exists and is writable, in a disk tier holding
+the last version of every part so other server processes and restarts
+do not parse again. Only the current version of a part is kept: storing a
+new version drops the previous one from both tiers.
+
+Content types are described by a codec with size(value), dump(value)
+returning a JSON-serializable object, and load(obj).
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Bytes of parsed content kept in memory by each server process
+MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Disk tier, used if the directory exists and is writable
+CACHE_DIRECTORY = '/var/cache/ipa-gpo/content'
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+class PolicyContentCache:
+    """Two-tier cache of parsed policy files."""
+
+    def __init__(self, budget=MEMORY_BUDGET, directory=CACHE_DIRECTORY):
+        self.budget = budget
+        self.directory = directory
+        self.lock = threading.Lock()
+        # key -> (value, size)
+        self.entries = OrderedDict()
+        # (guid, part) -> key of the cached version
+        self.current = {}
+        self.size = 0
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0,
+                         'evictions': 0, 'disk_errors': 0}
+
+    @property
+    def disk_enabled(self):
+        return (self.directory is not None and
+                os.access(self.directory, os.W_OK | os.X_OK))
+
+    def _disk_path(self, guid, part):
+        name = '{}.{}.json'.format(guid, part).replace(os.sep, '.')
+        return os.path.join(self.directory, name)
+
+    def _drop(self, key):
+        value, size = self.entries.pop(key)
+        self.size -= size
+        if self.current.get(key[:2]) == key:
+            del self.current[key[:2]]
+
+    def _put(self, key, value, size):
+        previous = self.current.get(key[:2])
+        if previous is not None and previous in self.entries:
+            self._drop(previous)
+        if size > self.budget:
+            return
+        self.entries[key] = (value, size)
+        self.current[key[:2]] = key
+        self.size += size
+        while self.size > self.budget:
+            self._drop(next(iter(self.entries)))
+            self.counters['evictions'] += 1
+
+    def _load_disk(self, key, codec):
+        try:
+            with open(self._disk_path(*key[:2])) as f:
+                data = json.load(f)
+            if data.get('key') != list(key):
+                return None
+            return codec.load(data['value'])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.counters['disk_errors'] += 1
+            logger.debug("Ignoring cached content of %s: %s", key[0], e)
+            return None
+
+    def _store_disk(self, key, value, codec):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            prefix='.content-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'key': list(key),
+                               'value': codec.dump(value)}, f)
+                os.replace(tmp_path, self._disk_path(*key[:2]))
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except (OSError, ValueError, TypeError) as e:
+            self.counters['disk_errors'] += 1
+            logger.debug("Failed to cache content of %s: %s", key[0], e)
+
+    def get(self, guid, part, version, path, parse, codec):
+        """
+        Return the parsed content of a policy file.
+
+        parse(path) is called on a miss of both tiers.
+        """
+        key = (guid.lower(), part, int(version or 0), _mtime(path))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return entry[0]
+
+        disk = self.disk_enabled
+        value = self._load_disk(key, codec) if disk else None
+        if value is not None:
+            counter = 'disk_hits'
+        else:
+            counter = 'misses'
+            value = parse(path)
+            if disk:
+                self._store_disk(key, value, codec)
+
+        with self.lock:
+            self.counters[counter] += 1
+            self._put(key, value, codec.size(value))
+        return value
+
+    def invalidate(self, guid):
+        """Forget all content of a GPO, in memory and on disk."""
+        guid = guid.lower()
+        with self.lock:
+            parts = [part for g, part in self.current if g == guid]
+            for part in parts:
+                self._drop(self.current[(guid, part)])
+        if self.disk_enabled:
+            prefix = guid + '.'
+            try:
+                with os.scandir(self.directory) as it:
+                    names = [e.name for e in it if e.name.startswith(prefix)]
+                for name in names:
+                    os.unlink(os.path.join(self.directory, name))
+            except OSError as e:
+                logger.debug("Failed to drop cached content of %s: %s",
+                             guid, e)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self.entries), bytes=self.size,
+                         budget=self.budget, disk=self.disk_enabled)
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_content_cache():
+    """Return the content cache of the process."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PolicyContentCache()
+        return _cache
@@ -0,0 +1,435 @@
+from ipalib import api, errors, output
+from ipalib import Command, Int, Str
+from ipalib.plugable import Registry
+from .baseldap import (
+    LDAPObject,
+    LDAPRetrieve,
+    LDAPQuery,
+    entry_to_dict,
+)
+from ipalib import _
+from ipapython.dn import DN
+from .gporder import (
+    RankedList,
+    decode_value,
+    edit_backoff,
+    encode_value,
+    entry_usn,
+    modify_values,
+    order_changes,
+)
+from .gptargets import refresh_targets
+import logging
+
+logger = logging.getLogger(__name__)
+
+register = Registry()
+
+PLUGIN_CONFIG = (
+    ('container_grouppolicymaster', DN(('cn', 'etc'))),
+)
+
+GPMASTER_CN = 'grouppolicymaster'
+
+# Number of times an edit is retried when the master changed concurrently
+EDIT_RETRIES = 5
+
+
+@register()
+class gpmaster(LDAPObject):
+    """
+    Group Policy Master object.
+    """
+    container_dn = None
+    object_name = _('Group Policy Master')
+    object_name_plural = _('Group Policy Masters')
+    object_class = ['groupPolicyMaster']
+    permission_filter_objectclasses = ['groupPolicyMaster']
+    default_attributes = ['cn', 'pdcEmulator', 'chainList', 'chainListOrder']
+
+    label = _('Group Policy Master')
+    label_singular = _('Group Policy Master')
+
+    managed_permissions = {
+        'System: Read Group Policy Master': {
+            'ipapermbindruletype': 'all',
+            'ipapermright': {'read', 'search', 'compare'},
+            'ipapermdefaultattr': {
+                'cn', 'objectclass', 'pdcemulator', 'chainlist',
+                'chainlistorder', 'gpgeneration',
+            },
+        },
+        'System: Modify Group Policy Master': {
+            'ipapermright': {'write'},
+            'ipapermdefaultattr': {
+                'chainlist', 'chainlistorder', 'gpgeneration',
+            },
+            'default_privileges': {'Group Policy Administrators'},
+        },
+    }
+
+    takes_params = (
+        Str('cn?',
+            label=_('Name'),
+            flags={'no_create', 'no_update', 'no_search'},
+        ),
+        Str('pdcemulator?',
+            cli_name='pdc_emulator',
+            label=_('PDC emulator'),
+            flags={'no_create', 'no_update', 'no_search'},
+        ),
+        Str('chainlist*',
+            cli_name='chain_list',
+            label=_('Chains'),
+            doc=_('Ordered list of Group Policy Chains'),
+            flags={'no_create', 'no_update', 'no_search'},
+        ),
+    )
+
+    def _on_finalize(self):
+        self.env._merge(**dict(PLUGIN_CONFIG))
+        self.container_dn = self.env.container_grouppolicymaster
+        super(gpmaster, self)._on_finalize()
+
+    def get_dn(self, *keys, **kwargs):
+        return DN(('cn', GPMASTER_CN), self.container_dn, self.api.env.basedn)
+
+    def get_chain_list(self, ldap):
+        """Return the chain list of the master as a RankedList of DNs."""
+        return self.read_chain_list(ldap)[0]
+
+    def read_chain_list(self, ldap):
+        """Return the chain list and the entryUSN it was read at."""
+        entry = ldap.get_entry(self.get_dn(),
+                               ['chainList', 'chainListOrder', 'entryUSN'])
+        return (RankedList(entry.get('chainList', []),
+                           entry.get('chainListOrder', []), key=DN),
+                entry_usn(entry))
+
+    def get_chain_dn(self, ldap, name):
+        """Resolve a chain name to its DN, making sure the chain exists."""
+        chain_dn = self.api.Object.chain.get_dn(name)
+        try:
+            ldap.get_entry(chain_dn, ['cn'])
+        except errors.NotFound:
+            raise errors.NotFound(
+                reason=_("Group Policy Chain '{}' not found").format(name)
+            )
+        return chain_dn
+
+    def edit_chain_list(self, ldap, plan):
+        """
+        Apply an edit of the chain list.
+
+        plan(ranked) updates the RankedList and returns a tuple
+        (changes, added, deleted): chainList (op, values) changes and the
+        companion values to add and delete. Only the touched values are
+        sent, asserting the entryUSN of the read; when another writer
+        changed the master in between, the edit is planned again from a
+        fresh read.
+        """
+        for attempt in range(EDIT_RETRIES):
+            if attempt:
+                edit_backoff(attempt)
+            ranked, usn = self.read_chain_list(ldap)
+            planned = plan(ranked)
+            if planned is None:
+                return False
+            list_changes, added, deleted = planned
+            changes = [(op, 'chainList', values)
+                       for op, values in list_changes]
+            changes.extend(order_changes('chainListOrder', ranked,
+                                         added, deleted))
+            try:
+                modify_values(ldap, self.get_dn(), changes, usn)
+                return True
+            except errors.MidairCollision:
+                logger.debug("Master changed concurrently, retrying "
+                             "(attempt %d)", attempt + 1)
+
+        raise errors.MidairCollision(
+            message=_('Chain list was modified concurrently, try again')
+        )
+
+    def add_chains(self, ldap, chain_dns):
+        """Append chains to the end of the chain list."""
+        if not chain_dns:
+            return
+
+        def plan(ranked):
+            present = {DN(dn) for dn in ranked}
+            new_dns = [DN(dn) for dn in chain_dns]
+            if any(dn in present for dn in new_dns):
+                raise errors.DuplicateEntry(
+                    message=_('Group Policy Chain is already in the master')
+                )
+            added, deleted = ranked.append(new_dns)
+            return [('add', new_dns)], added, deleted
+
+        self.edit_chain_list(ldap, plan)
+        logger.info("Added %d chains to GPMaster", len(chain_dns))
+
+    def remove_chains(self, ldap, chain_dns):
+        """Remove chains from the chain list."""
+        if not chain_dns:
+            return
+
+        def plan(ranked):
+            present = {DN(dn) for dn in ranked}
+            old_dns = [DN(dn) for dn in chain_dns]
+            if any(dn not in present for dn in old_dns):
+                raise errors.NotFound(
+                    reason=_('Group Policy Chain is not in the master')
+                )
+            added, deleted = ranked.remove(old_dns)
+            return [('delete', old_dns)], added, deleted
+
+        self.edit_chain_list(ldap, plan)
+        logger.info("Removed %d chains from GPMaster", len(chain_dns))
+
+    def move_chain(self, ldap, chain_dn, offset):
+        """
+        Move a chain by offset positions in the chain list.
+
+        chainList itself is not touched: only the rank of the moved chain
+        is replaced in chainListOrder.
+        """
+        def plan(ranked):
+            if chain_dn not in {DN(dn) for dn in ranked}:
+                raise errors.NotFound(
+                    reason=_("Group Policy Chain '{}' is not in the "
+                             "master").format(chain_dn[0].value)
+                )
+            added, deleted = ranked.move(chain_dn, offset)
+            if not added and not deleted and not ranked.rebalanced:
+                return None
+            return [], added, deleted
+
+        return self.edit_chain_list(ldap, plan)
+
+    def change_chain(self, ldap, chain_dn, change, count=1):
+        """
+        Apply a chain command: 'add', 'del', 'moveup' or 'movedown'.
+
+        A move goes count positions at once, with a single modify.
+        """
+        if change == 'add':
+            self.add_chains(ldap, [chain_dn])
+        elif change == 'del':
+            self.remove_chains(ldap, [chain_dn])
+        elif change == 'moveup':
+            self.move_chain(ldap, chain_dn, -count)
+        elif change == 'movedown':
+            self.move_chain(ldap, chain_dn, count)
+        else:
+            raise ValueError(change)
+
+    def rename_chain(self, ldap, old_dn, new_dn):
+        """Carry the position of a renamed chain over to its new DN."""
+        def plan(ranked):
+            # The referential integrity plugin has already replaced the
+            # chainList value, so the old rank shows up as stale.
+            for order_value in ranked.stale:
+                rank, value = decode_value(order_value)
+                if DN(value) == old_dn:
+                    return [], [encode_value(rank, new_dn)], [order_value]
+            return None
+
+        self.edit_chain_list(ldap, plan)
+
+    def get_generation(self, ldap):
+        """Return the current naming generation of the master."""
+        try:
+            entry = ldap.get_entry(self.get_dn(), ['gpGeneration'])
+        except errors.NotFound:
+            return 0
+        return int(entry.get('gpGeneration', [0])[0])
+
+    def check_generation(self, ldap, generation):
+        """
+        Make sure names resolved by a client are still current.
+
+        Clients resolve names to DNs from their cache and send the
+        generation the cache was filled at; a different value means a
+        policy or chain was added, deleted or renamed since then.
+        """
+        if int(generation) != self.get_generation(ldap):
+            raise errors.MidairCollision(
+                message=_('Group Policy name cache is out of date')
+            )
+
+    def bump_generation(self, ldap):
+        """
+        Increment gpGeneration after policy or chain names changed.
+
+        A failure only makes client caches refresh later, so it is
+        logged and not raised.
+        """
+        dn = self.get_dn()
+        try:
+            for attempt in range(EDIT_RETRIES):
+                try:
+                    modify_values(ldap, dn,
+                                  [('increment', 'gpGeneration', [1])])
+                    return
+                except errors.MidairCollision:
+                    # gpGeneration is not set yet
+                    pass
+                try:
+                    modify_values(ldap, dn, [('add', 'gpGeneration', [1])])
+                    return
+                except errors.DuplicateEntry:
+                    logger.debug("gpGeneration added concurrently, retrying "
+                                 "(attempt %d)", attempt + 1)
+        except errors.PublicError as e:
+            logger.warning("Failed to bump gpGeneration: %s", e)
+
+    def format_entry(self, ldap, entry_attrs, options):
+        """
+        Order chainList by its ranks and show chain names instead of DNs
+        unless raw mode is enabled.
+        """
+        ranked = RankedList(entry_attrs.get('chainlist', []),
+                            entry_attrs.pop('chainlistorder', []), key=DN)
+        if 'chainlist' in entry_attrs:
+            entry_attrs['chainlist'] = list(ranked)
+        if options.get('raw', False):
+            return
+        if 'chainlist' in entry_attrs:
+            entry_attrs['chainlist'] = [
+                str(DN(value)[0].value) for value in entry_attrs['chainlist']
+            ]
+
+
+@register()
+class gpmaster_show(LDAPRetrieve):
+    __doc__ = _('Display the Group Policy Master.')
+
+    def post_callback(self, ldap, dn, entry_attrs, *keys, **options):
+        assert isinstance(dn, DN)
+        self.obj.format_entry(ldap, entry_attrs, options)
+        return dn
+
+
+MOVE_COUNT_OPTION = Int(
+    'count?',
+    cli_name='count',
+    label=_('Positions'),
+    doc=_('Number of positions to move the chain by'),
+    minvalue=1,
+    default=1,
+)
+
+
+class gpmaster_chain_command(LDAPQuery):
+    """
+    Base class of commands changing the master chain list.
+
+    Subclasses set change to the gpmaster.change_chain() argument.
+    """
+
+    has_output = output.standard_entry
+
+    takes_args = (
+        Str('chain',
+            cli_name='chain',
+            label=_('Chain name'),
+            doc=_('Group Policy Chain name'),
+        ),
+    )
+
+    change = None
+
+    def execute(self, chain, **options):
+        ldap = self.obj.backend
+        chain_dn = self.obj.get_chain_dn(ldap, chain)
+        self.obj.change_chain(ldap, chain_dn, self.change,
+                              options.get('count') or 1)
+        refresh_targets(self.api, ldap, [chain_dn])
+
+        entry_attrs = ldap.get_entry(self.obj.get_dn(),
+                                     self.obj.default_attributes)
+        self.obj.format_entry(ldap, entry_attrs, options)
+
+        return dict(
+            result=entry_to_dict(entry_attrs, **options),
+            value=chain,
+            summary=self.msg_summary % {'value': chain},
+        )
+
+
+@register()
+class gpmaster_add_chain(gpmaster_chain_command):
+    __doc__ = _('Add a Group Policy Chain to the end of the master list.')
+    msg_summary = _('Added Group Policy Chain "%(value)s" to the master')
+    change = 'add'
+
+
+@register()
+class gpmaster_del_chain(gpmaster_chain_command):
+    __doc__ = _('Remove a Group Policy Chain from the master list.')
+    msg_summary = _('Removed Group Policy Chain "%(value)s" from the master')
+    change = 'del'
+
+
+@register()
+class gpmaster_moveup_chain(gpmaster_chain_command):
+    __doc__ = _('Move a Group Policy Chain higher in the master list.')
+    msg_summary = _('Moved Group Policy Chain "%(value)s" up')
+    change = 'moveup'
+
+    takes_options = (MOVE_COUNT_OPTION,)
+
+
+@register()
+class gpmaster_movedown_chain(gpmaster_chain_command):
+    __doc__ = _('Move a Group Policy Chain lower in the master list.')
+    msg_summary = _('Moved Group Policy Chain "%(value)s" down')
+    change = 'movedown'
+
+    takes_options = (MOVE_COUNT_OPTION,)
+
+
+@register()
+class gpmaster_cache(Command):
+    __doc__ = _('Return policy and chain names for client side caches.')
+    NO_CLI = True
+
+    takes_options = (
+        Int('generation?',
+            label=_('Generation'),
+            doc=_('Generation of the names cached by the client'),
+        ),
+    )
+
+    has_output = (
+        output.Output('result', dict, _('Cached names')),
+    )
+
+    def execute(self, **options):
+        ldap = self.api.Backend.ldap2
+        # Read the generation first: a change made while the names are
+        # read leaves the client one generation behind, never ahead.
+        generation = self.api.Object.gpmaster.get_generation(ldap)
+        if options.get('generation') == generation:
+            return dict(result={'generation': generation, 'changed': False})
+
+        grouppolicies = [
+            [str(entry.dn), str(entry.get('cn', [''])[0]),
+             str(entry.get('displayName', [''])[0])]
+            for entry in self.api.Object.grouppolicy.get_all_entries(
+                ldap, ['cn', 'displayName'])
+        ]
+        chains = [
+            [str(entry.get('cn', [''])[0]),
+             str(entry.get('displayName', [''])[0])]
+            for entry in self.api.Object.chain.get_all_entries(
+                ldap, ['cn', 'displayName'])
+        ]
+
+        return dict(result={
+            'generation': generation,
+            'changed': True,
+            'grouppolicy': grouppolicies,
+            'chain': chains,
+        })
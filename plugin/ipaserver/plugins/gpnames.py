@@ -0,0 +1,238 @@
+"""
+Host-wide cache of Group Policy name to DN mappings.
+
+The server runs as several mod_wsgi worker processes which all resolve
+policy, chain and group names. Instead of a cache per process, the
+mappings live in one snapshot file (see gpsnapshot) which every worker
+maps read-only: the pages are held once per host and a lookup is a hash
+probe into shared memory, taking no lock.
+
+The snapshot carries the gpGeneration of the master, which is bumped
+whenever a policy or chain is added, deleted or renamed. A worker reads
+gpGeneration once per operation; when it differs from the mapped
+snapshot, the worker maps the file again, and if the file is stale too,
+it asks the rebuild-gpo-names oddjob helper over D-Bus to rebuild it and
+does not wait for the reply. No request waits for the rebuild: until
+the new file appears, name lookups use LDAP, while DN to name display
+may keep using the previous snapshot.
+
+The helper runs as root and binds over LDAPI, so the file does not
+depend on the credentials of the request which asked for it. It holds
+only names, DNs and chain lists, which every authenticated user may
+read; a name missing from it is looked up in LDAP as the caller, so the
+ACIs of the caller still decide what it finds.
+
+Group changes do not bump gpGeneration, so the snapshot is also rebuilt
+once it is older than MAX_AGE, and group names are only used to display
+DNs: a group missing from the snapshot is read from LDAP, and a deleted
+group may show under its name until the next rebuild, as in gpclosure.
+"""
+import errno
+import fcntl
+import logging
+import os
+import stat
+import threading
+import time
+
+from .gpsnapshot import Snapshot, SnapshotError
+
+logger = logging.getLogger(__name__)
+
+# Writable by the server process, see ipa-gpo-install
+CACHE_DIRECTORY = '/var/cache/ipa-gpo/names'
+
+SNAPSHOT_FILE = 'names.snap'
+LOCK_FILE = '.lock'
+
+# Seconds after which the snapshot is rebuilt to pick up group changes
+MAX_AGE = 300
+
+# Seconds after which a rebuild that did not happen is asked for again
+REBUILD_RETRY = 30
+
+
+class SharedNameCache:
+    """Snapshot file shared by the server processes of a host."""
+
+    def __init__(self, directory=CACHE_DIRECTORY, max_age=MAX_AGE):
+        self.directory = directory
+        self.path = os.path.join(directory, SNAPSHOT_FILE)
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # (snapshot, (st_ino, st_mtime_ns), st_mtime) of the mapped file
+        self.current = (None, None, 0)
+        # (generation, time) of the last rebuild asked for by this process
+        self.requested = (None, 0)
+        self.counters = {'hits': 0, 'misses': 0, 'reloads': 0,
+                         'requests': 0, 'rebuilds': 0, 'busy': 0,
+                         'errors': 0}
+
+    @property
+    def enabled(self):
+        return os.path.isdir(self.directory)
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _reload(self):
+        """Map the file again if it was replaced since it was mapped."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return self.current
+        identity = (st.st_ino, st.st_mtime_ns)
+        if self.current[1] == identity:
+            return self.current
+        try:
+            snapshot = Snapshot(self.path)
+        except (OSError, SnapshotError) as e:
+            logger.warning("Cannot read the name cache %s: %s", self.path, e)
+            self._count('errors')
+            return self.current
+        # The previous mapping is closed once no thread refers to it
+        self.current = (snapshot, identity, st.st_mtime)
+        self._count('reloads')
+        return self.current
+
+    def _state(self, current, generation, now):
+        """Return 'fresh', 'aged' or None for a mapped snapshot."""
+        snapshot, _identity, mtime = current
+        if snapshot is None or snapshot.generation != generation:
+            return None
+        return 'fresh' if now - mtime < self.max_age else 'aged'
+
+    def get(self, generation, rebuild, now=None, stale=False):
+        """
+        Return the snapshot at a generation, or None to use LDAP.
+
+        When the file is stale, rebuild() is called to have it rebuilt
+        elsewhere and must not wait for it; it is called again for the
+        same generation only after REBUILD_RETRY seconds. Meanwhile an
+        aged snapshot is returned, and with stale=True so is the
+        snapshot of an older generation.
+        """
+        now = time.time() if now is None else now
+        current = self.current
+        state = self._state(current, generation, now)
+        if state != 'fresh':
+            current = self._reload()
+            state = self._state(current, generation, now)
+        if state == 'fresh':
+            return current[0]
+
+        self._request_rebuild(generation, rebuild, now)
+        if state == 'aged' or stale:
+            return current[0]
+        return None
+
+    def _request_rebuild(self, generation, rebuild, now):
+        with self.lock:
+            last_generation, last_time = self.requested
+            if last_generation == generation and \
+                    0 <= now - last_time < REBUILD_RETRY:
+                return
+            self.requested = (generation, now)
+            self.counters['requests'] += 1
+        rebuild()
+
+    def _open_lock(self):
+        """Open the lock file, which must be a regular file of the cache."""
+        path = os.path.join(self.directory, LOCK_FILE)
+        fd = os.open(path, os.O_RDONLY | os.O_CREAT | os.O_NOFOLLOW |
+                     os.O_NONBLOCK | os.O_CLOEXEC, 0o644)
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            os.close(fd)
+            raise OSError(errno.EINVAL, 'lock is not a regular file', path)
+        return os.fdopen(fd, 'rb')
+
+    def rebuild(self, generation, build, now=None):
+        """
+        Write the snapshot at a generation unless it is current.
+
+        build() returns a SnapshotWriter filled from the directory. One
+        process at a time rebuilds; returns the size written, or None
+        when another process holds the lock or the file is current.
+        """
+        now = time.time() if now is None else now
+        with self._open_lock() as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._count('busy')
+                return None
+
+            # Another process may have replaced the file meanwhile
+            current = self._reload()
+            if self._state(current, generation, now) == 'fresh':
+                return None
+            size = build().write(self.path)
+            self._count('rebuilds')
+            logger.debug("Rebuilt the name cache, %d bytes", size)
+        self._reload()
+        return size
+
+    def policy_dn(self, snapshot, name):
+        """Return the DN of a policy by displayName, None if it is absent."""
+        index = snapshot.find_policy(name=name)
+        if index is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return snapshot.policy(index).dn
+
+    def policy_name(self, snapshot, dn):
+        """Return the displayName of a policy by DN, None if it is absent."""
+        self._count('hits')
+        index = snapshot.find_policy(dn=dn)
+        return None if index is None else snapshot.policy(index).name
+
+    def group_name(self, snapshot, dn):
+        """Return the name of a group by DN, None if it is not cached."""
+        index = snapshot.find_group(dn=dn)
+        if index is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return snapshot.group(index).name
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        snapshot = self.current[0]
+        stats['generation'] = None if snapshot is None else snapshot.generation
+        return stats
+
+
+_name_cache = None
+_name_cache_lock = threading.Lock()
+
+
+def get_name_cache():
+    """Return the name cache of this process."""
+    global _name_cache
+    with _name_cache_lock:
+        if _name_cache is None:
+            _name_cache = SharedNameCache()
+        return _name_cache
+
+
+def current_snapshot(api, ldap, stale=False):
+    """
+    Return the shared snapshot matching the directory, or None.
+
+    Costs one read of gpGeneration when the cache directory exists and
+    nothing otherwise. With stale=True, the previous snapshot is
+    returned while a new one is built. A name missing from a snapshot
+    must be read from LDAP.
+    """
+    cache = get_name_cache()
+    if not cache.enabled:
+        return None
+    snapshot = cache.get(api.Object.gpmaster.get_generation(ldap),
+                         api.Object.grouppolicy.rebuild_name_cache,
+                         stale=stale)
+    if snapshot is None:
+        cache._count('misses')
+    return snapshot
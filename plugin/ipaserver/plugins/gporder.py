@@ -0,0 +1,328 @@
+"""
+Explicit ordering of multi-valued DN attributes.
+
+gpLink and chainList stay plain DN attributes so that the referential
+integrity plugin keeps maintaining them. Their order is stored in a
+companion attribute (gpLinkOrder, chainListOrder) whose values are
+"<rank>:<dn>". Ranks are fractional keys compared as plain strings, so a
+new rank can always be generated between two neighbours: moving an item
+replaces one companion value and never rewrites the list.
+
+Values missing a rank are ordered after ranked ones in the order the
+directory returned them; this is how entries written before the
+companion attributes existed are read, and they are migrated by adding
+ranks for the missing values only.
+
+Edits are optimistic: a list is read along with the entryUSN of its
+entry, and the modify asserts that entryUSN is unchanged, so any other
+write to the entry in between makes it fail. The edit is then planned
+again from a fresh read after a short random delay. Nothing is locked,
+so edits of different entries never wait for each other.
+"""
+import random
+import time
+
+from ipalib import errors
+from ipalib import _
+import ldap as _ldap
+from ldap.controls.libldap import AssertionControl
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+SEPARATOR = ':'
+
+# Ranks longer than this trigger a rebalance of the whole list
+MAX_RANK_LENGTH = 24
+
+# Appended ranks are APPEND_WIDTH digits apart by APPEND_STEP, which leaves
+# room for tens of thousands of appends and for inserts between them
+APPEND_WIDTH = 6
+APPEND_STEP = len(DIGITS) ** 3
+
+# Delay in seconds before retrying a conflicting edit, doubled for each
+# attempt up to EDIT_BACKOFF_MAX; the actual delay is drawn below it
+EDIT_BACKOFF = 0.05
+EDIT_BACKOFF_MAX = 1.0
+
+MOD_OPS = {
+    'add': _ldap.MOD_ADD,
+    'delete': _ldap.MOD_DELETE,
+    'replace': _ldap.MOD_REPLACE,
+    'increment': _ldap.MOD_INCREMENT,
+}
+
+
+def rank_between(lower, upper):
+    """
+    Return a rank sorting strictly between lower and upper.
+
+    Either bound may be None for an open end. Generated ranks never end
+    with the lowest digit, so there is always room below them.
+    """
+    lower = lower or ''
+    rank = ''
+    position = 0
+    while True:
+        low = DIGITS.index(lower[position]) if position < len(lower) else 0
+        if upper is not None and position < len(upper):
+            high = DIGITS.index(upper[position])
+        else:
+            high = len(DIGITS)
+
+        if low == high:
+            rank += DIGITS[low]
+            position += 1
+            continue
+
+        middle = (low + high) // 2
+        if middle > low:
+            return rank + DIGITS[middle]
+
+        # Neighbouring digits: keep the lower one and look for room in
+        # the remaining digits of the lower bound.
+        rank += DIGITS[low]
+        position += 1
+        upper = None
+
+
+def _to_digits(number, width):
+    digits = ''
+    for _position in range(width):
+        number, digit = divmod(number, len(DIGITS))
+        digits = DIGITS[digit] + digits
+    return digits.rstrip(DIGITS[0])
+
+
+def rank_after(last):
+    """Return a rank sorting after last, keeping ranks short on appends."""
+    if last is None:
+        return _to_digits(APPEND_STEP, APPEND_WIDTH)
+    number = int(last[:APPEND_WIDTH].ljust(APPEND_WIDTH, DIGITS[0]),
+                 len(DIGITS)) + APPEND_STEP
+    if number >= len(DIGITS) ** APPEND_WIDTH:
+        return rank_between(last, None)
+    return _to_digits(number, APPEND_WIDTH)
+
+
+def spread_ranks(count):
+    """Return count evenly spaced increasing ranks."""
+    width = 1
+    while len(DIGITS) ** width <= count + 1:
+        width += 1
+    step = len(DIGITS) ** width // (count + 1)
+
+    return [_to_digits(index * step, width) for index in range(1, count + 1)]
+
+
+def encode_value(rank, value):
+    """Build a companion attribute value."""
+    return '{}{}{}'.format(rank, SEPARATOR, value)
+
+
+def decode_value(order_value):
+    """Split a companion attribute value into (rank, value)."""
+    rank, _sep, value = str(order_value).partition(SEPARATOR)
+    return rank, value
+
+
+class RankedList:
+    """
+    Ordered view of a multi-valued attribute and its companion ranks.
+
+    Editing methods do not change the directory: they return the
+    companion values to add and to delete, and update the view so that
+    several edits can be planned one after another.
+    """
+
+    def __init__(self, values, order_values=(), key=str):
+        self.key = key
+        self.ranks = {}
+        self.stale = []
+        self.unranked = []
+        self.rebalanced = False
+
+        current = {key(value): value for value in values}
+        for order_value in order_values:
+            rank, value = decode_value(order_value)
+            value_key = key(value)
+            if value_key not in current or value_key in self.ranks:
+                self.stale.append(str(order_value))
+                continue
+            self.ranks[value_key] = (rank, str(order_value))
+
+        ranked = sorted(
+            (v for k, v in current.items() if k in self.ranks),
+            key=lambda v: (self.ranks[key(v)][0], str(v))
+        )
+        self.unranked = [v for k, v in current.items() if k not in self.ranks]
+        self.items = ranked + self.unranked
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _last_rank(self):
+        ranked = [self.ranks[self.key(v)][0] for v in self.items
+                  if self.key(v) in self.ranks]
+        return ranked[-1] if ranked else None
+
+    def _assign(self, value, rank):
+        order_value = encode_value(rank, value)
+        self.ranks[self.key(value)] = (rank, order_value)
+        return order_value
+
+    def migrate(self):
+        """Rank values that have none, keeping their current position."""
+        added = []
+        last = self._last_rank()
+        for value in self.unranked:
+            last = rank_after(last)
+            added.append(self._assign(value, last))
+        self.unranked = []
+        stale, self.stale = self.stale, []
+        return added, stale
+
+    def append(self, values):
+        """Append values to the end of the list."""
+        added, deleted = self.migrate()
+        last = self._last_rank()
+        for value in values:
+            if self.key(value) in self.ranks:
+                continue
+            last = rank_after(last)
+            added.append(self._assign(value, last))
+            self.items.append(value)
+        return added, deleted
+
+    def remove(self, values):
+        """Remove values from the list."""
+        added, deleted = self.migrate()
+        keys = {self.key(value) for value in values}
+        for value_key in keys:
+            if value_key in self.ranks:
+                deleted.append(self.ranks.pop(value_key)[1])
+        self.items = [v for v in self.items if self.key(v) not in keys]
+        return added, deleted
+
+    def move(self, value, offset):
+        """
+        Move a value by offset positions.
+
+        Only the companion value of the moved item changes, unless its
+        new rank grows past MAX_RANK_LENGTH and the list is rebalanced.
+        """
+        added, deleted = self.migrate()
+        keys = [self.key(v) for v in self.items]
+        index = keys.index(self.key(value))
+        new_index = min(max(index + offset, 0), len(self.items) - 1)
+        if new_index == index:
+            return added, deleted
+
+        item = self.items.pop(index)
+        self.items.insert(new_index, item)
+        lower = (self.ranks[self.key(self.items[new_index - 1])][0]
+                 if new_index > 0 else None)
+        upper = (self.ranks[self.key(self.items[new_index + 1])][0]
+                 if new_index + 1 < len(self.items) else None)
+        rank = rank_between(lower, upper)
+
+        if len(rank) > MAX_RANK_LENGTH:
+            return self.replace(self.items)
+
+        old_value = self.ranks[self.key(item)][1]
+        if old_value in added:
+            added.remove(old_value)
+        else:
+            deleted.append(old_value)
+        added.append(self._assign(item, rank))
+        return added, deleted
+
+    def replace(self, values):
+        """
+        Replace the whole list, spreading ranks evenly.
+
+        After a replace the caller should write order_values() as a
+        whole instead of applying the returned differences.
+        """
+        self.rebalanced = True
+        deleted = [order_value for _rank, order_value in self.ranks.values()]
+        deleted.extend(self.stale)
+        self.ranks = {}
+        self.stale = []
+        self.unranked = []
+        self.items = list(values)
+        added = [self._assign(value, rank)
+                 for value, rank in zip(self.items, spread_ranks(len(values)))]
+        return added, deleted
+
+    def order_values(self):
+        """Return all companion values of the current view."""
+        return [self.ranks[self.key(v)][1] for v in self.items
+                if self.key(v) in self.ranks]
+
+
+def net_changes(added, deleted):
+    """Drop values which are both added and deleted by a series of edits."""
+    both = set(added) & set(deleted)
+    return ([value for value in added if value not in both],
+            [value for value in deleted if value not in both])
+
+
+def order_changes(order_attr, ranked, added, deleted):
+    """Turn planned companion value edits into (op, attr, values) tuples."""
+    if ranked.rebalanced:
+        return [('replace', order_attr, ranked.order_values())]
+    return [('delete', order_attr, deleted), ('add', order_attr, added)]
+
+
+def entry_usn(entry):
+    """Return the entryUSN an entry was read at, or None."""
+    values = entry.get('entryUSN')
+    return int(values[0]) if values else None
+
+
+def edit_backoff(attempt):
+    """Wait before retrying an edit which collided with another writer."""
+    time.sleep(random.uniform(
+        0, min(EDIT_BACKOFF * 2 ** attempt, EDIT_BACKOFF_MAX)))
+
+
+def modify_values(ldap, dn, changes, usn=None):
+    """
+    Apply value level changes to an entry with a single modify.
+
+    changes is a list of (op, attr, values) with op one of 'add',
+    'delete', 'replace' or 'increment'. Adding a value which already exists or
+    deleting one which is gone makes the whole modify fail, which is how
+    conflicting writers are detected. With usn, the modify also fails if
+    the entryUSN of the entry is no longer usn, whatever changed.
+    """
+    modlist = [
+        (MOD_OPS[op], attr, [ldap.encode(value) for value in values])
+        for op, attr, values in changes
+        if values or op == 'replace'
+    ]
+    if not modlist:
+        return
+
+    serverctrls = None
+    if usn is not None:
+        serverctrls = [AssertionControl(
+            criticality=True, filterstr='(entryUSN={})'.format(usn))]
+
+    with ldap.error_handler():
+        try:
+            ldap.conn.modify_ext_s(str(dn), modlist, serverctrls=serverctrls)
+        except _ldap.ASSERTION_FAILED:
+            raise errors.MidairCollision(
+                message=_('The entry was modified concurrently')
+            )
+        except _ldap.TYPE_OR_VALUE_EXISTS:
+            raise errors.DuplicateEntry(
+                message=_('Value is already present in the list')
+            )
+        except _ldap.NO_SUCH_ATTRIBUTE:
+            raise errors.MidairCollision(
+                message=_('The list was modified concurrently')
+            )
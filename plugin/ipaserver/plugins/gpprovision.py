@@ -0,0 +1,474 @@
+"""
+Queue of SYSVOL policy directories to create.
+
+grouppolicy-add stores a job for the new GPO in the queue directory and
+returns as soon as the LDAP entry exists. The jobs are processed by the
+process-gpo-queue oddjob helper, started through D-Bus after each add and
+by ipa-gpo-provision.timer, so a job whose D-Bus call was lost or whose
+directory could not be created is retried later.
+
+A job of grouppolicy-copy also names the GPO whose directory is copied.
+The copy is made in a temporary directory renamed into place, and the
+data of each file is shared with the source (FICLONE) where the file
+system supports it, copied inside the kernel (copy_file_range) where it
+does not, and streamed as a last resort.
+
+A job is a JSON file named after the GPO GUID, replaced atomically on
+every change, so the queue survives restarts of the server and of the
+helper. A failed job keeps its last error and is retried with
+exponential backoff; after MAX_ATTEMPTS failures it is reported as
+failed but still retried every MAX_RETRY_DELAY seconds.
+
+Only the standard library is used here: the helper runs as root without
+the IPA API.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import stat
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Writable by the server process, see ipa-gpo-install
+QUEUE_DIRECTORY = '/var/lib/ipa-gpo/provision'
+SYSVOL_ROOT = '/var/lib/freeipa/sysvol'
+
+JOB_SUFFIX = '.json'
+LOCK_FILE = '.lock'
+
+# Largest job file read, a job is well below it
+MAX_JOB_SIZE = 64 * 1024
+
+# Keys every job has, with their types
+JOB_KEYS = {
+    'guid': str,
+    'domain': str,
+    'attempts': int,
+    'next_attempt': (int, float),
+    'error': (str, type(None)),
+}
+
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+MAX_ATTEMPTS = 5
+
+# Provisioning states of a GPO
+STATE_PENDING = 'pending'
+STATE_RETRYING = 'retrying'
+STATE_FAILED = 'failed'
+STATE_PROVISIONED = 'provisioned'
+STATE_MISSING = 'missing'
+
+GPT_INI = '[General]\nVersion=0\n'
+GPT_INI_NAME = 'GPT.INI'
+GPT_INI_PREFIX = '.GPT.INI-'
+
+VERSION_RE = re.compile(r'^(Version\s*=\s*)\d*', re.IGNORECASE | re.MULTILINE)
+
+GUID_RE = re.compile(
+    r'^\{[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\}$',
+    re.IGNORECASE)
+
+# Prefix of the temporary directory a copy is made in
+COPY_PREFIX = '.copy-'
+
+# ioctl sharing the data of a file with another one, from linux/fs.h
+FICLONE = 0x40049409
+
+# Errors of FICLONE and copy_file_range meaning the file system or the
+# kernel cannot do it, which fall back to the next method
+COPY_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                    errno.EINVAL, errno.ENOSYS)
+
+# Bytes read at a time by a streaming copy
+COPY_CHUNK = 1024 * 1024
+
+# Ways a file was copied, see copy_file()
+COPY_CLONE = 'cloned'
+COPY_RANGE = 'kernel'
+COPY_STREAM = 'streamed'
+
+
+def valid_domain(domain):
+    """Return True if domain can name a directory of SYSVOL_ROOT."""
+    return (isinstance(domain, str) and bool(domain) and
+            os.sep not in domain and '\0' not in domain and
+            not domain.startswith('.'))
+
+
+def job_problem(guid, job):
+    """
+    Return why a job read from the queue must not be run, or None.
+
+    The queue is writable by the web server and jobs are run by root, so
+    nothing in a job may name a path outside the Policies directory.
+    """
+    if not isinstance(job, dict):
+        return 'not an object'
+    for key, types in JOB_KEYS.items():
+        if key not in job:
+            return 'no {}'.format(key)
+        if not isinstance(job[key], types) or isinstance(job[key], bool):
+            return 'invalid {}'.format(key)
+    if not GUID_RE.match(job['guid']) or job['guid'].upper() != guid.upper():
+        return 'invalid guid'
+    if not valid_domain(job['domain']):
+        return 'invalid domain'
+    # Copy jobs name the GPO whose directory is copied
+    source = job.get('source')
+    if source is not None and (not isinstance(source, str) or
+                               not GUID_RE.match(source)):
+        return 'invalid source'
+    return None
+
+
+def policy_path(root, domain, guid):
+    return os.path.join(root, domain.lower(), 'Policies', guid)
+
+
+def create_policy_structure(path):
+    """
+    Create the directories and GPT.INI of a GPO.
+
+    Safe to repeat: an existing GPT.INI is kept.
+    """
+    for name in ('Machine', 'User'):
+        os.makedirs(os.path.join(path, name), mode=0o755, exist_ok=True)
+    for directory in (os.path.dirname(path), path,
+                      os.path.join(path, 'Machine'),
+                      os.path.join(path, 'User')):
+        os.chmod(directory, 0o755)
+
+    gpt_ini = os.path.join(path, GPT_INI_NAME)
+    if not os.path.exists(gpt_ini):
+        _write_gpt_ini(path, GPT_INI)
+
+
+def _write_gpt_ini(path, content):
+    fd, tmp_path = tempfile.mkstemp(dir=path, prefix=GPT_INI_PREFIX)
+    try:
+        with os.fdopen(fd, 'w', newline='') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, os.path.join(path, GPT_INI_NAME))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def set_gpt_version(path, version):
+    """
+    Set the Version of the GPT.INI of a GPO, keeping its other lines.
+
+    The file is replaced atomically; a missing one is created.
+    """
+    try:
+        with open(os.path.join(path, GPT_INI_NAME), newline='') as f:
+            content = f.read()
+    except FileNotFoundError:
+        content = GPT_INI
+
+    content, count = VERSION_RE.subn(
+        lambda match: match.group(1) + str(version), content, count=1)
+    if not count:
+        newline = '\r\n' if '\r\n' in content else '\n'
+        if '[general]' not in content.lower():
+            content = '[General]' + newline + content
+        head, separator, tail = content.partition(']')
+        content = '{}]{}Version={}{}'.format(
+            head, newline, version, tail if tail.startswith(newline)
+            else newline + tail)
+    _write_gpt_ini(path, content)
+
+
+def _copy_data(src, dst, size):
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+        return COPY_CLONE
+    except OSError as e:
+        if e.errno not in COPY_UNSUPPORTED:
+            raise
+
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                count = os.copy_file_range(src, dst, size - copied)
+                if not count:
+                    break
+                copied += count
+            else:
+                return COPY_RANGE
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED:
+                raise
+
+    os.lseek(src, copied, os.SEEK_SET)
+    os.lseek(dst, copied, os.SEEK_SET)
+    while True:
+        data = memoryview(os.read(src, COPY_CHUNK))
+        if not data:
+            return COPY_STREAM
+        while data:
+            data = data[os.write(dst, data):]
+
+
+def copy_file(source, target):
+    """
+    Copy a file to a new file, keeping its mode and times.
+
+    Returns how the data was copied: COPY_CLONE when target shares it
+    with source, COPY_RANGE when the kernel (or the file server) copied
+    it, COPY_STREAM when it was read and written here.
+    """
+    src = os.open(source, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK |
+                  os.O_CLOEXEC)
+    try:
+        st = os.fstat(src)
+        if not stat.S_ISREG(st.st_mode):
+            raise OSError(errno.EINVAL, 'Not a regular file', source)
+        dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                      os.O_CLOEXEC, 0o600)
+        try:
+            method = _copy_data(src, dst, st.st_size)
+            os.fchmod(dst, stat.S_IMODE(st.st_mode))
+            os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+    return method
+
+
+def copy_policy_tree(source, target):
+    """
+    Copy the directory of a GPO to target, which must not exist.
+
+    The copy is made next to target and renamed into place, so target
+    appears complete or not at all. Source must be a directory, not a
+    link to one; inside it only regular files are copied, and temporary
+    files of GPT.INI are skipped. Returns counters of files by copy
+    method and of bytes.
+    """
+    if os.path.lexists(target):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                              target)
+    st = os.lstat(source)
+    if stat.S_ISLNK(st.st_mode):
+        raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), source)
+    if not stat.S_ISDIR(st.st_mode):
+        raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR),
+                                 source)
+
+    stats = {COPY_CLONE: 0, COPY_RANGE: 0, COPY_STREAM: 0, 'bytes': 0}
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(target),
+                                prefix=COPY_PREFIX)
+    try:
+        for dirpath, dirnames, filenames in os.walk(source):
+            relative = os.path.relpath(dirpath, source)
+            directory = os.path.normpath(os.path.join(tmp_path, relative))
+            if directory != tmp_path:
+                os.mkdir(directory)
+            os.chmod(directory, 0o755)
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                if (name.startswith(GPT_INI_PREFIX) or
+                        not stat.S_ISREG(st.st_mode)):
+                    logger.debug("Not copying %s", path)
+                    continue
+                stats[copy_file(path, os.path.join(directory, name))] += 1
+                stats['bytes'] += st.st_size
+        os.rename(tmp_path, target)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return stats
+
+
+def retry_delay(attempts):
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+class ProvisioningQueue:
+    """Directory of GPOs whose SYSVOL structure is to be created."""
+
+    def __init__(self, directory=QUEUE_DIRECTORY, root=SYSVOL_ROOT):
+        self.directory = directory
+        self.root = root
+
+    @property
+    def available(self):
+        return os.access(self.directory, os.W_OK | os.X_OK)
+
+    def _path(self, guid):
+        return os.path.join(self.directory, guid.upper() + JOB_SUFFIX)
+
+    def _write(self, job):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.job-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(job, f)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self._path(job['guid']))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def enqueue(self, guid, domain, source=None):
+        """Queue a GPO; with source, its directory is a copy of that GPO."""
+        self._write({
+            'guid': guid.upper(),
+            'domain': domain.lower(),
+            'source': source.upper() if source else None,
+            'queued': time.time(),
+            'attempts': 0,
+            'next_attempt': 0,
+            'error': None,
+        })
+
+    def _read(self, path, guid):
+        """
+        Return (job, None), or (None, why the job is unusable).
+
+        The queue is writable by the web server and read by root: a job
+        which is a symbolic link, a FIFO or a device is not opened or
+        read, and no more than MAX_JOB_SIZE bytes are read.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK |
+                         os.O_CLOEXEC)
+        except OSError as e:
+            if e.errno == errno.ELOOP:
+                return None, 'symbolic link'
+            raise
+        with os.fdopen(fd, 'rb') as f:
+            if not stat.S_ISREG(os.fstat(fd).st_mode):
+                return None, 'not a regular file'
+            data = f.read(MAX_JOB_SIZE + 1)
+        if len(data) > MAX_JOB_SIZE:
+            return None, 'larger than {} bytes'.format(MAX_JOB_SIZE)
+        try:
+            job = json.loads(data.decode('utf-8'))
+        except ValueError as e:
+            return None, str(e)
+        problem = job_problem(guid, job)
+        if problem is not None:
+            return None, problem
+        return job, None
+
+    def load(self, guid):
+        """Return the job of a GPO, or None if it is not queued."""
+        try:
+            job, problem = self._read(self._path(guid), guid)
+        except FileNotFoundError:
+            return None
+        if problem is not None:
+            logger.warning("Ignoring invalid provisioning job of %s: %s",
+                           guid, problem)
+        return job
+
+    def discard(self, guid):
+        try:
+            os.unlink(self._path(guid))
+        except FileNotFoundError:
+            pass
+
+    def jobs(self):
+        with os.scandir(self.directory) as it:
+            names = [entry.name for entry in it
+                     if entry.name.endswith(JOB_SUFFIX)]
+        for name in sorted(names):
+            path = os.path.join(self.directory, name)
+            try:
+                job, problem = self._read(path, name[:-len(JOB_SUFFIX)])
+            except FileNotFoundError:
+                continue
+            if problem is not None:
+                # Left in place, it would be skipped on every drain
+                logger.warning("Discarding invalid provisioning job %s: %s",
+                               name, problem)
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            yield job
+
+    def state(self, guid, domain):
+        """Return the provisioning state of a GPO and the last error."""
+        job = self.load(guid)
+        if job is None:
+            if os.path.isdir(policy_path(self.root, domain, guid)):
+                return STATE_PROVISIONED, None
+            return STATE_MISSING, None
+        if not job['attempts']:
+            return STATE_PENDING, None
+        if job['attempts'] >= MAX_ATTEMPTS:
+            return STATE_FAILED, job['error']
+        return STATE_RETRYING, job['error']
+
+    def process(self, job, now):
+        """Create the structure of one job; True if it is done."""
+        path = policy_path(self.root, job['domain'], job['guid'])
+        try:
+            # A copy renamed into place is complete: do not copy it again
+            if job.get('source') and not os.path.isdir(path):
+                stats = copy_policy_tree(
+                    policy_path(self.root, job['domain'], job['source']),
+                    path)
+                logger.info("Copied %s to %s: %d files cloned, %d copied "
+                            "by the kernel, %d streamed, %d bytes",
+                            job['source'], job['guid'], stats[COPY_CLONE],
+                            stats[COPY_RANGE], stats[COPY_STREAM],
+                            stats['bytes'])
+            create_policy_structure(path)
+        except OSError as e:
+            job['attempts'] += 1
+            job['error'] = str(e)
+            job['next_attempt'] = now + retry_delay(job['attempts'])
+            logger.error("Failed to create the structure of %s "
+                         "(attempt %d): %s", job['guid'], job['attempts'], e)
+            self._write(job)
+            return False
+        self.discard(job['guid'])
+        logger.info("Created the structure of %s", job['guid'])
+        return True
+
+    def _open_lock(self):
+        """Open the lock file, which must be a regular file of the queue."""
+        fd = os.open(os.path.join(self.directory, LOCK_FILE),
+                     os.O_RDONLY | os.O_CREAT | os.O_NOFOLLOW | os.O_NONBLOCK |
+                     os.O_CLOEXEC, 0o600)
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            os.close(fd)
+            raise OSError(errno.EINVAL, 'lock is not a regular file',
+                          os.path.join(self.directory, LOCK_FILE))
+        return os.fdopen(fd, 'rb')
+
+    def drain(self, now=None):
+        """
+        Process the jobs which are due.
+
+        Concurrent calls are serialized, so a job queued while another
+        call runs is handled by the call waiting for the lock.
+        Returns counters of provisioned, failed and deferred jobs.
+        """
+        stats = {'provisioned': 0, 'failed': 0, 'deferred': 0}
+        with self._open_lock() as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            now = time.time() if now is None else now
+            for job in self.jobs():
+                if job['next_attempt'] > now:
+                    stats['deferred'] += 1
+                elif self.process(job, now):
+                    stats['provisioned'] += 1
+                else:
+                    stats['failed'] += 1
+        return stats
@@ -0,0 +1,238 @@
+"""
+Registry.pol reading and writing.
+
+A Registry.pol file is the "PReg" signature and version 1 followed by
+records
+
+    [key;value name;type;size;data]
+
+where the brackets and semicolons are UTF-16LE characters, key and value
+name are NUL terminated UTF-16LE strings, type and size are little-endian
+uint32 and data is size raw bytes.
+
+RegistryPolReader maps the file and yields records whose data is a
+memoryview into the mapping: nothing is copied until a value is decoded,
+and the pages of a large file are read in and dropped by the kernel as
+the parser moves on, so memory use does not depend on the file size.
+The records are only valid while the reader is open.
+"""
+import mmap
+import os
+import struct
+import tempfile
+from collections import namedtuple
+
+SIGNATURE = b'PReg'
+VERSION = 1
+
+HEADER = struct.Struct('<4sI')
+UINT32 = struct.Struct('<I')
+# type ; size ; following the value name
+FIELDS = struct.Struct('<I2sI2s')
+
+OPEN = '['.encode('utf-16-le')
+CLOSE = ']'.encode('utf-16-le')
+SEPARATOR = ';'.encode('utf-16-le')
+NUL = '\x00'.encode('utf-16-le')
+TERMINATOR = NUL + SEPARATOR
+
+# Value types
+REG_NONE = 0
+REG_SZ = 1
+REG_EXPAND_SZ = 2
+REG_BINARY = 3
+REG_DWORD = 4
+REG_DWORD_BIG_ENDIAN = 5
+REG_LINK = 6
+REG_MULTI_SZ = 7
+REG_QWORD = 11
+
+STRING_TYPES = (REG_SZ, REG_EXPAND_SZ, REG_LINK)
+INTEGER_FORMATS = {
+    REG_DWORD: struct.Struct('<I'),
+    REG_DWORD_BIG_ENDIAN: struct.Struct('>I'),
+    REG_QWORD: struct.Struct('<Q'),
+}
+
+
+class RegistryPolError(ValueError):
+    pass
+
+
+class RegistryRecord(namedtuple('RegistryRecord', 'key name type data')):
+    """One value of a Registry.pol file; data is the raw bytes."""
+    __slots__ = ()
+
+    @property
+    def value(self):
+        return decode_value(self.type, self.data)
+
+
+def _text(data):
+    return str(data[:len(data) & ~1], 'utf-16-le')
+
+
+def decode_value(value_type, data):
+    """Return data of a value as str, list of str, int or bytes."""
+    if value_type in STRING_TYPES:
+        return _text(data).split('\x00', 1)[0]
+    if value_type == REG_MULTI_SZ:
+        return [s for s in _text(data).split('\x00') if s]
+    if value_type in INTEGER_FORMATS:
+        integer = INTEGER_FORMATS[value_type]
+        if len(data) < integer.size:
+            raise RegistryPolError(
+                'value of type {} is {} bytes long'.format(value_type,
+                                                           len(data)))
+        return integer.unpack_from(data)[0]
+    return bytes(data)
+
+
+def encode_value(value_type, value):
+    """Return the raw data of a value for the given type."""
+    if value_type in STRING_TYPES:
+        return (value + '\x00').encode('utf-16-le')
+    if value_type == REG_MULTI_SZ:
+        return ''.join(s + '\x00' for s in value).encode('utf-16-le') + NUL
+    if value_type in INTEGER_FORMATS:
+        return INTEGER_FORMATS[value_type].pack(value)
+    return bytes(value)
+
+
+def _find_terminator(buffer, start):
+    """Return the offset of the NUL and ';' ending a string at start."""
+    end = buffer.find(TERMINATOR, start)
+    while end != -1 and (end - start) % 2:
+        end = buffer.find(TERMINATOR, end + 1)
+    if end == -1:
+        raise RegistryPolError('unterminated string at {}'.format(start))
+    return end
+
+
+def iter_records(buffer):
+    """
+    Yield the records of a Registry.pol image.
+
+    buffer is anything supporting the buffer protocol, slicing and find(),
+    such as bytes or an mmap. Record data are memoryview slices of it.
+    """
+    view = memoryview(buffer)
+    try:
+        if len(view) < HEADER.size:
+            raise RegistryPolError('file is too short')
+        signature, version = HEADER.unpack_from(view)
+        if signature != SIGNATURE or version != VERSION:
+            raise RegistryPolError('not a Registry.pol file')
+
+        pos = HEADER.size
+        end = len(view)
+        while pos < end:
+            start = pos
+            if buffer[pos:pos + 2] != OPEN:
+                raise RegistryPolError('no record at {}'.format(pos))
+
+            pos += 2
+            nul = _find_terminator(buffer, pos)
+            key = str(view[pos:nul], 'utf-16-le')
+            pos = nul + 4
+            nul = _find_terminator(buffer, pos)
+            name = str(view[pos:nul], 'utf-16-le')
+            pos = nul + 4
+
+            if pos + FIELDS.size > end:
+                raise RegistryPolError('truncated record at {}'.format(start))
+            value_type, separator1, size, separator2 = \
+                FIELDS.unpack_from(view, pos)
+            if separator1 != SEPARATOR or separator2 != SEPARATOR:
+                raise RegistryPolError('malformed record at {}'.format(start))
+            pos += FIELDS.size
+
+            data = view[pos:pos + size]
+            pos += size
+            if len(data) != size or buffer[pos:pos + 2] != CLOSE:
+                raise RegistryPolError('truncated record at {}'.format(start))
+            pos += 2
+            yield RegistryRecord(key, name, value_type, data)
+    finally:
+        view.release()
+
+
+class RegistryPolReader:
+    """
+    Memory mapped Registry.pol file.
+
+    Iterating over the reader yields RegistryRecord items; their data
+    must not be used after the reader is closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise RegistryPolError('{}: file is too short'.format(path))
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def __iter__(self):
+        return iter_records(self._map)
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                raise RegistryPolError(
+                    '{}: records are still in use'.format(self.path))
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_records(path):
+    """Return all records of a file with their data copied."""
+    with RegistryPolReader(path) as reader:
+        return [record._replace(data=bytes(record.data))
+                for record in reader]
+
+
+class RegistryPolWriter:
+    """Writes records to a binary stream, data without copying."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        stream.write(HEADER.pack(SIGNATURE, VERSION))
+
+    def write(self, key, name, value_type, data):
+        self.stream.write(b''.join((
+            OPEN, key.encode('utf-16-le'), NUL, SEPARATOR,
+            name.encode('utf-16-le'), NUL, SEPARATOR,
+            UINT32.pack(value_type), SEPARATOR,
+            UINT32.pack(len(data)), SEPARATOR,
+        )))
+        self.stream.write(data)
+        self.stream.write(CLOSE)
+
+    def write_value(self, key, name, value_type, value):
+        self.write(key, name, value_type, encode_value(value_type, value))
+
+
+def write_file(path, records):
+    """Atomically replace path with a file holding records."""
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.Registry.pol-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer = RegistryPolWriter(f)
+            for key, name, value_type, data in records:
+                writer.write(key, name, value_type, data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,259 @@
+"""
+In-memory Group Policy topology.
+
+PolicyGraph holds the master chain list, the chains, the Group Policy
+Objects and the group memberships of users and hosts, and answers which
+policies apply to a user on a host without reading LDAP. Entries are fed
+in the form they come from the directory, one at a time, so the graph can
+be kept current from a persistent search.
+
+A chain applies when the user is a member of its userGroup and the host
+is a member of its computerGroup; a chain without one of them does not
+restrict on it. Policies are returned chain by chain in chainList order,
+each chain contributing its gpLink list in order, so the last policy has
+the highest precedence.
+
+Users and hosts with the same memberships get the same policies, so
+resolutions are memoized under the groups of the user and of the host
+that some chain refers to. The memo is cleared when a policy, a chain or
+the master changes; a membership change only moves a user or host to
+another memo entry.
+"""
+from collections import OrderedDict
+
+from ipapython.dn import DN
+from .gporder import RankedList
+
+# Entry kinds by structural object class (lower case)
+KINDS = {
+    'grouppolicycontainer': 'grouppolicy',
+    'grouppolicychain': 'chain',
+    'grouppolicymaster': 'gpmaster',
+    'ipahost': 'host',
+    'posixaccount': 'user',
+}
+
+# Attributes PolicyGraph reads, per entry kind
+KIND_ATTRIBUTES = {
+    'grouppolicy': ['objectClass', 'cn', 'displayName', 'gPCFileSysPath',
+                    'versionNumber', 'flags'],
+    'chain': ['objectClass', 'cn', 'userGroup', 'computerGroup', 'gpLink',
+              'gpLinkOrder'],
+    'gpmaster': ['objectClass', 'chainList', 'chainListOrder'],
+    'host': ['objectClass', 'fqdn', 'memberOf'],
+    'user': ['objectClass', 'uid', 'memberOf'],
+}
+
+EMPTY = frozenset()
+
+# Number of distinct membership patterns whose resolution is kept
+RESOLUTION_CACHE_SIZE = 4096
+
+
+def dn_key(dn):
+    """Return the normalized form of a DN used as a dictionary key."""
+    return str(DN(dn)).lower()
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+
+def normalize_attrs(attrs):
+    """Lower-case attribute names and decode values of a raw entry."""
+    return {
+        name.lower(): [_text(value) for value in values]
+        for name, values in attrs.items()
+    }
+
+
+def entry_kind(attrs):
+    """Return the kind of an entry with normalized attributes or None."""
+    for objectclass in attrs.get('objectclass', []):
+        kind = KINDS.get(objectclass.lower())
+        if kind is not None:
+            return kind
+    return None
+
+
+class PolicyGraph:
+    """
+    Policies, chains, master order and memberships kept in memory.
+
+    update() and remove() take entries as returned by LDAP; resolve() only
+    does dictionary and set lookups. The chain plan (groups and policy
+    keys of each chain in master order) is rebuilt lazily after a chain or
+    the master changed; policy and membership changes do not touch it.
+    Resolutions are kept in LRU order under their membership fingerprint.
+    """
+
+    def __init__(self, cache_size=RESOLUTION_CACHE_SIZE):
+        self.policies = {}
+        self.chains = {}
+        self.chain_list = []
+        self.users = {}
+        self.hosts = {}
+        self.names = {}
+        self.generation = 0
+        self._plan = None
+        self._plan_groups = (EMPTY, EMPTY)
+        self.cache_size = cache_size
+        self._resolutions = OrderedDict()
+        self.resolution_hits = 0
+        self.resolution_misses = 0
+
+    def _invalidate_plan(self):
+        self._plan = None
+        self._resolutions.clear()
+
+    def update(self, dn, attrs):
+        """Add or replace an entry; entries of other kinds are ignored."""
+        attrs = normalize_attrs(attrs)
+        kind = entry_kind(attrs)
+        if kind is None:
+            return False
+
+        key = dn_key(dn)
+        getattr(self, '_update_' + kind)(key, attrs)
+        self.generation += 1
+        return True
+
+    def remove(self, dn):
+        """Forget an entry; unknown entries are ignored."""
+        key = dn_key(dn)
+        removed = False
+        if self.policies.pop(key, None) is not None:
+            self._resolutions.clear()
+            removed = True
+        if self.chains.pop(key, None) is not None:
+            self._invalidate_plan()
+            removed = True
+        member = self.names.pop(key, None)
+        if member is not None:
+            mapping, name = member
+            mapping.pop(name, None)
+            removed = True
+        if removed:
+            self.generation += 1
+        return removed
+
+    def rename(self, old_dn, new_dn, attrs):
+        """Move an entry to a new DN."""
+        self.remove(old_dn)
+        return self.update(new_dn, attrs)
+
+    def _update_grouppolicy(self, key, attrs):
+        guid = attrs.get('cn', [''])[0]
+        self.policies[key] = {
+            'guid': guid,
+            'name': attrs.get('displayname', [guid])[0],
+            'path': attrs.get('gpcfilesyspath', [''])[0],
+            'version': int(attrs.get('versionnumber', ['0'])[0]),
+            'flags': int(attrs.get('flags', ['0'])[0]),
+        }
+        self._resolutions.clear()
+
+    def _update_chain(self, key, attrs):
+        links = RankedList(attrs.get('gplink', []),
+                           attrs.get('gplinkorder', []), key=DN)
+        usergroup = attrs.get('usergroup')
+        computergroup = attrs.get('computergroup')
+        self.chains[key] = {
+            'name': attrs.get('cn', [''])[0],
+            'usergroup': dn_key(usergroup[0]) if usergroup else None,
+            'computergroup': (dn_key(computergroup[0])
+                              if computergroup else None),
+            'gplink': [dn_key(value) for value in links],
+        }
+        self._invalidate_plan()
+
+    def _update_gpmaster(self, key, attrs):
+        chain_list = RankedList(attrs.get('chainlist', []),
+                                attrs.get('chainlistorder', []), key=DN)
+        self.chain_list = [dn_key(value) for value in chain_list]
+        self._invalidate_plan()
+
+    def _update_member(self, mapping, name_attr, key, attrs):
+        member = self.names.get(key)
+        if member is not None:
+            member[0].pop(member[1], None)
+        name = attrs.get(name_attr, [''])[0].lower()
+        self.names[key] = (mapping, name)
+        mapping[name] = frozenset(
+            dn_key(value) for value in attrs.get('memberof', []))
+
+    def _update_user(self, key, attrs):
+        self._update_member(self.users, 'uid', key, attrs)
+
+    def _update_host(self, key, attrs):
+        self._update_member(self.hosts, 'fqdn', key, attrs)
+
+    def plan(self):
+        """Return (usergroup, computergroup, policy keys) in master order."""
+        if self._plan is None:
+            self._plan = [
+                (chain['usergroup'], chain['computergroup'],
+                 tuple(chain['gplink']))
+                for chain in (self.chains.get(key) for key in self.chain_list)
+                if chain is not None
+            ]
+            self._plan_groups = (
+                frozenset(usergroup for usergroup, _c, _l in self._plan
+                          if usergroup is not None),
+                frozenset(computergroup for _u, computergroup, _l
+                          in self._plan if computergroup is not None),
+            )
+        return self._plan
+
+    def fingerprint(self, user=None, host=None):
+        """
+        Return the memo key of a user on a host.
+
+        Only groups some chain refers to are part of it, so users and
+        hosts differing in other groups share it.
+        """
+        self.plan()
+        user_groups, host_groups = self._plan_groups
+        return (self.users.get((user or '').lower(), EMPTY) & user_groups,
+                self.hosts.get((host or '').lower(), EMPTY) & host_groups)
+
+    def resolve(self, user=None, host=None):
+        """Return the policies applying to a user on a host, in order."""
+        key = self.fingerprint(user, host)
+        result = self._resolutions.get(key)
+        if result is not None:
+            self._resolutions.move_to_end(key)
+            self.resolution_hits += 1
+            return list(result)
+
+        self.resolution_misses += 1
+        user_groups, host_groups = key
+        policies = self.policies
+        result = []
+        for usergroup, computergroup, links in self.plan():
+            if usergroup is not None and usergroup not in user_groups:
+                continue
+            if computergroup is not None and computergroup not in host_groups:
+                continue
+            result.extend(policies[link] for link in links
+                          if link in policies)
+
+        self._resolutions[key] = tuple(result)
+        if len(self._resolutions) > self.cache_size:
+            self._resolutions.popitem(last=False)
+        return result
+
+    def stats(self):
+        return {
+            'policies': len(self.policies),
+            'chains': len(self.chains),
+            'chain_list': len(self.chain_list),
+            'users': len(self.users),
+            'hosts': len(self.hosts),
+            'generation': self.generation,
+            'resolutions': len(self._resolutions),
+            'resolution_hits': self.resolution_hits,
+            'resolution_misses': self.resolution_misses,
+        }
@@ -0,0 +1,290 @@
+"""
+Resultant set of policy.
+
+The registry settings of an ordered list of Group Policy Objects are
+merged last-wins, and every resulting value remembers the GPO it came
+from. Settings are read from the Registry.pol files of the Machine and
+User parts of each GPO in SYSVOL.
+
+Each GPO is parsed into a Contribution tagged with the version of its
+part, taken from versionNumber (user version in the high 16 bits,
+machine version in the low 16 bits), and kept in the policy content
+cache (see gpcontent). When a version changes only that contribution is
+parsed again, and ResultantSet recomputes only the
+values that contribution sets or set before, folding the contributions
+of the other GPOs for those values alone.
+
+Special value names are interpreted as Windows does:
+
+    **del.<name>       delete the value
+    **soft.<name>      set the value only if nothing set it before
+    **delvals.         delete all values of the key
+    **DeleteValues     delete the values listed in the data
+    **DeleteKeys       delete all values of the keys listed in the data
+"""
+import base64
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+from .gpcontent import get_content_cache
+from .gpregistry import REG_SZ, RegistryPolReader, decode_value
+
+SYSVOL_ROOT = '/var/lib/freeipa/sysvol'
+SIDES = ('Machine', 'User')
+REGISTRY_FILE = 'Registry.pol'
+
+DELETE_PREFIX = '**del.'
+SOFT_PREFIX = '**soft.'
+DELETE_ALL_VALUES = '**delvals.'
+DELETE_VALUES = '**deletevalues'
+DELETE_KEYS = '**deletekeys'
+
+OP_SET = 'set'
+OP_SOFT = 'soft'
+OP_DELETE = 'delete'
+
+# Number of merged sets kept by an engine
+MAX_SETS = 64
+
+# Estimated memory used by a value besides its strings and data
+VALUE_OVERHEAD = 200
+
+ResultantValue = namedtuple('ResultantValue', 'key name type data guid')
+
+
+def side_version(version, side):
+    """Return the version of one part of a GPO from its versionNumber."""
+    version = int(version or 0)
+    if side == 'User':
+        return (version >> 16) & 0xFFFF
+    return version & 0xFFFF
+
+
+def bump_version(version, sides):
+    """
+    Return versionNumber with the version of each of sides incremented.
+
+    A part version wraps from 0xFFFF to 1, never to 0, which clients read
+    as a part without settings.
+    """
+    version = int(version or 0)
+    user, machine = (version >> 16) & 0xFFFF, version & 0xFFFF
+    if 'User' in sides:
+        user = user % 0xFFFF + 1
+    if 'Machine' in sides:
+        machine = machine % 0xFFFF + 1
+    return (user << 16) | machine
+
+
+def _names(data):
+    return [name for name in decode_value(REG_SZ, data).split(';') if name]
+
+
+class Contribution:
+    """Registry operations of one part of one GPO."""
+
+    __slots__ = ('guid', 'version', 'values', 'clears')
+
+    def __init__(self, guid, version):
+        self.guid = guid
+        self.version = version
+        # (key, name) lower-cased -> (op, key, name, type, data)
+        self.values = {}
+        # lower-cased keys whose values are all deleted
+        self.clears = set()
+
+    def _set(self, op, key, name, value_type=None, data=None):
+        self.values[(key.lower(), name.lower())] = (op, key, name,
+                                                    value_type, data)
+
+    def add(self, record):
+        key, name = record.key, record.name
+        lower = name.lower()
+        if lower == DELETE_ALL_VALUES:
+            self.clears.add(key.lower())
+        elif lower.startswith(DELETE_PREFIX):
+            self._set(OP_DELETE, key, name[len(DELETE_PREFIX):])
+        elif lower.startswith(SOFT_PREFIX):
+            self._set(OP_SOFT, key, name[len(SOFT_PREFIX):], record.type,
+                      bytes(record.data))
+        elif lower == DELETE_VALUES:
+            for value_name in _names(record.data):
+                self._set(OP_DELETE, key, value_name)
+        elif lower == DELETE_KEYS:
+            self.clears.update(k.lower() for k in _names(record.data))
+        elif not lower.startswith('**'):
+            self._set(OP_SET, key, name, record.type, bytes(record.data))
+
+    @classmethod
+    def load(cls, path, guid, version):
+        """Parse a Registry.pol file; a missing file contributes nothing."""
+        contribution = cls(guid, version)
+        if not os.path.exists(path):
+            return contribution
+        with RegistryPolReader(path) as reader:
+            for record in reader:
+                contribution.add(record)
+            record = None
+        return contribution
+
+
+class ContributionCodec:
+    """Describes Contribution objects to the policy content cache."""
+
+    @staticmethod
+    def size(contribution):
+        return sum(
+            VALUE_OVERHEAD + 2 * (len(key) + len(name)) + len(data or b'')
+            for _op, key, name, _type, data in contribution.values.values()
+        ) + VALUE_OVERHEAD * (1 + len(contribution.clears))
+
+    @staticmethod
+    def dump(contribution):
+        return {
+            'guid': contribution.guid,
+            'version': contribution.version,
+            'values': [
+                [op, key, name, value_type,
+                 None if data is None else
+                 base64.b64encode(data).decode('ascii')]
+                for op, key, name, value_type, data
+                in contribution.values.values()
+            ],
+            'clears': sorted(contribution.clears),
+        }
+
+    @staticmethod
+    def load(obj):
+        contribution = Contribution(obj['guid'], obj['version'])
+        for op, key, name, value_type, data in obj['values']:
+            contribution._set(op, key, name, value_type,
+                              None if data is None else base64.b64decode(data))
+        contribution.clears.update(obj['clears'])
+        return contribution
+
+
+class ResultantSet:
+    """Last-wins merge of the contributions of an ordered list of GPOs."""
+
+    def __init__(self):
+        self.order = []
+        self.contributions = {}
+        self.result = {}
+        self.names = {}
+
+    def _index(self, contribution):
+        for key, name in contribution.values:
+            self.names.setdefault(key, set()).add(name)
+
+    def _pairs(self, contribution):
+        pairs = set(contribution.values)
+        for key in contribution.clears:
+            pairs.update((key, name) for name in self.names.get(key, ()))
+        return pairs
+
+    def _fold(self, pair):
+        current = None
+        for guid in self.order:
+            contribution = self.contributions[guid]
+            if pair[0] in contribution.clears:
+                current = None
+            operation = contribution.values.get(pair)
+            if operation is None:
+                continue
+            op, key, name, value_type, data = operation
+            if op == OP_DELETE:
+                current = None
+            elif op == OP_SET or current is None:
+                current = ResultantValue(key, name, value_type, data, guid)
+
+        if current is None:
+            self.result.pop(pair, None)
+        else:
+            self.result[pair] = current
+
+    def update(self, contributions):
+        """
+        Merge an ordered list of contributions.
+
+        A GPO listed more than once, linked from several chains, is
+        applied at its last position only, the one which wins. Only
+        values touched by contributions which differ from the previous
+        call are recomputed, unless the order of the GPOs changed.
+        Returns the (key, name) pairs recomputed.
+        """
+        last = {contribution.guid: position
+                for position, contribution in enumerate(contributions)}
+        contributions = [contribution
+                         for position, contribution in enumerate(contributions)
+                         if last[contribution.guid] == position]
+        order = [contribution.guid for contribution in contributions]
+        if order != self.order:
+            self.order = order
+            self.contributions = {c.guid: c for c in contributions}
+            self.result = {}
+            self.names = {}
+            for contribution in contributions:
+                self._index(contribution)
+            touched = set()
+            for contribution in contributions:
+                touched |= self._pairs(contribution)
+        else:
+            touched = set()
+            for contribution in contributions:
+                old = self.contributions[contribution.guid]
+                if old is contribution:
+                    continue
+                self.contributions[contribution.guid] = contribution
+                self._index(contribution)
+                touched |= self._pairs(old) | self._pairs(contribution)
+
+        for pair in touched:
+            self._fold(pair)
+        return touched
+
+    def values(self):
+        """Return the resulting values sorted by key and name."""
+        return [self.result[pair] for pair in sorted(self.result)]
+
+
+class RSoPEngine:
+    """Computes resultant sets from SYSVOL, reusing unchanged parts."""
+
+    def __init__(self, domain, root=SYSVOL_ROOT, content=None):
+        self.policies_path = os.path.join(root, domain, 'Policies')
+        self.content = content or get_content_cache()
+        self.sets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def contribution(self, guid, side, version):
+        part = '{}/{}'.format(side, REGISTRY_FILE)
+        return self.content.get(
+            guid, part, version, os.path.join(self.policies_path, guid, part),
+            lambda path: Contribution.load(path, guid, version),
+            ContributionCodec)
+
+    def resolve(self, policies):
+        """
+        Merge the settings of policies, a list of (guid, versionNumber).
+
+        Returns a dict mapping each side to its ResultantValue list.
+        """
+        with self.lock:
+            return {side: self._resolve_side(policies, side)
+                    for side in SIDES}
+
+    def _resolve_side(self, policies, side):
+        contributions = [
+            self.contribution(guid, side, side_version(version, side))
+            for guid, version in policies
+        ]
+        set_key = (side, tuple(c.guid.lower() for c in contributions))
+        resultant = self.sets.get(set_key)
+        if resultant is None:
+            resultant = self.sets[set_key] = ResultantSet()
+            if len(self.sets) > MAX_SETS:
+                self.sets.popitem(last=False)
+        self.sets.move_to_end(set_key)
+        resultant.update(contributions)
+        return resultant.values()
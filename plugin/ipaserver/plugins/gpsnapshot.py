@@ -0,0 +1,465 @@
+"""
+Memory-mappable snapshot of the Group Policy topology.
+
+The snapshot stores the Group Policy Objects, the chains, the master
+chain order and the user and host group names in one read-only file
+which many processes can mmap and share without parsing it. Every string
+(DNs, names, GUIDs, paths) is stored once and referenced by its integer
+ID; chains reference their policies by record index through a flat link
+array. A hash index maps normalized policy DNs, GUIDs and names, chain
+DNs and names and group DNs and names to record indexes, so lookups are
+O(1) and touch only a few pages.
+
+Layout, all integers little-endian:
+
+    header      magic, format version, flags, gpGeneration
+    sections    (offset, length) of each section below, in this order
+    strings     uint32 offsets of each string, plus the end offset
+    data        UTF-8 string bytes
+    policies    (dn, guid, name, path, version, flags) uint32 records
+    chains      (dn, name, usergroup, computergroup, link start,
+                 link count) uint32 records
+    links       uint32 policy indexes
+    order       uint32 chain indexes in chainList order
+    index       (hash uint64, key string, kind << 28 | record) slots
+    groups      (dn, name, group kind) uint32 records
+
+Snapshots are replaced atomically by rename, so a reader keeps a
+consistent view until it reopens the file.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from collections import namedtuple
+
+from ipalib import errors
+from ipapython.dn import DN
+from .gporder import RankedList
+from .gpresolve import dn_key
+
+MAGIC = b'IPAGPSN\x00'
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct('<8sIIQ')
+SECTION = struct.Struct('<QQ')
+OFFSET = struct.Struct('<I')
+POLICY = struct.Struct('<IIIIII')
+CHAIN = struct.Struct('<IIIIII')
+INDEX = struct.Struct('<QII')
+GROUP = struct.Struct('<III')
+
+SECTIONS = ('strings', 'data', 'policies', 'chains', 'links', 'order',
+            'index', 'groups')
+
+# String ID or index of a missing value
+NONE = 0xFFFFFFFF
+
+# Kinds of keys in the hash index
+KEY_POLICY_DN = 1
+KEY_POLICY_GUID = 2
+KEY_POLICY_NAME = 3
+KEY_CHAIN_DN = 4
+KEY_CHAIN_NAME = 5
+KEY_GROUP_DN = 6
+KEY_USERGROUP_NAME = 7
+KEY_HOSTGROUP_NAME = 8
+
+# Kinds of groups
+GROUP_USER = 1
+GROUP_HOST = 2
+
+GROUP_NAME_KEYS = {
+    GROUP_USER: KEY_USERGROUP_NAME,
+    GROUP_HOST: KEY_HOSTGROUP_NAME,
+}
+
+KIND_SHIFT = 28
+RECORD_MASK = (1 << KIND_SHIFT) - 1
+
+# Highest fill ratio of the hash index, as (numerator, denominator)
+MAX_LOAD = (7, 10)
+
+# Sections start at multiples of this
+ALIGNMENT = 8
+
+Policy = namedtuple('Policy', 'dn guid name path version flags')
+Chain = namedtuple('Chain', 'dn name usergroup computergroup links')
+Group = namedtuple('Group', 'dn name kind')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _key_hash(kind, data):
+    digest = hashlib.blake2b(data, digest_size=8, person=bytes([kind]))
+    return int.from_bytes(digest.digest(), 'little')
+
+
+def _pack(record_struct, records):
+    buf = bytearray(record_struct.size * len(records))
+    for position, record in enumerate(records):
+        record_struct.pack_into(buf, position * record_struct.size, *record)
+    return bytes(buf)
+
+
+def _pack_uint32(values):
+    return struct.pack('<{}I'.format(len(values)), *values)
+
+
+class SnapshotWriter:
+    """Collects policies, chains and groups and writes a snapshot file."""
+
+    def __init__(self, generation=0):
+        self.generation = generation
+        self.strings = {}
+        self.policies = []
+        self.policy_keys = {}
+        self.chains = []
+        self.chain_keys = {}
+        self.chain_links = []
+        self.order_dns = []
+        self.groups = []
+
+    def intern(self, value):
+        """Return the string ID of a value; None maps to NONE."""
+        if value is None:
+            return NONE
+        value = str(value)
+        sid = self.strings.get(value)
+        if sid is None:
+            sid = self.strings[value] = len(self.strings)
+        return sid
+
+    def add_policy(self, dn, guid, name, path='', version=0, flags=0):
+        key = dn_key(dn)
+        self.policy_keys[key] = len(self.policies)
+        self.policies.append((self.intern(dn), self.intern(guid),
+                              self.intern(name), self.intern(path),
+                              int(version), int(flags)))
+
+    def add_chain(self, dn, name, usergroup=None, computergroup=None,
+                  links=()):
+        self.chain_keys[dn_key(dn)] = len(self.chains)
+        self.chains.append((self.intern(dn), self.intern(name),
+                            self.intern(usergroup),
+                            self.intern(computergroup)))
+        self.chain_links.append([dn_key(link) for link in links])
+
+    def add_group(self, dn, name, kind):
+        self.groups.append((self.intern(dn), self.intern(name), kind))
+
+    def set_chain_order(self, chain_dns):
+        self.order_dns = [dn_key(dn) for dn in chain_dns]
+
+    def _index(self):
+        values = list(self.strings)
+        keys = []
+        for index, record in enumerate(self.policies):
+            dn, guid, name = (values[sid] for sid in record[:3])
+            keys.append((KEY_POLICY_DN, dn_key(dn), index))
+            keys.append((KEY_POLICY_GUID, guid.lower(), index))
+            keys.append((KEY_POLICY_NAME, name.lower(), index))
+        for index, record in enumerate(self.chains):
+            dn, name = (values[sid] for sid in record[:2])
+            keys.append((KEY_CHAIN_DN, dn_key(dn), index))
+            keys.append((KEY_CHAIN_NAME, name.lower(), index))
+        for index, (dn, name, kind) in enumerate(self.groups):
+            keys.append((KEY_GROUP_DN, dn_key(values[dn]), index))
+            keys.append((GROUP_NAME_KEYS[kind], values[name].lower(), index))
+
+        size = 1
+        while size * MAX_LOAD[0] <= len(keys) * MAX_LOAD[1]:
+            size *= 2
+        slots = [(0, NONE, 0)] * size
+        for kind, key, index in keys:
+            key_hash = _key_hash(kind, key.encode('utf-8'))
+            slot = key_hash & (size - 1)
+            while slots[slot][1] != NONE:
+                slot = (slot + 1) & (size - 1)
+            slots[slot] = (key_hash, self.intern(key),
+                           kind << KIND_SHIFT | index)
+        return slots
+
+    def build(self):
+        """Return the snapshot as bytes."""
+        links, chains = [], []
+        for record, chain_links in zip(self.chains, self.chain_links):
+            start = len(links)
+            links.extend(self.policy_keys[key] for key in chain_links
+                         if key in self.policy_keys)
+            chains.append(record + (start, len(links) - start))
+        order = [self.chain_keys[key] for key in self.order_dns
+                 if key in self.chain_keys]
+
+        # Interning the index keys adds strings, so build it first
+        index = self._index()
+
+        data = bytearray()
+        offsets = []
+        for value in self.strings:
+            offsets.append(len(data))
+            data += value.encode('utf-8')
+        offsets.append(len(data))
+        if len(data) > NONE:
+            raise SnapshotError('string data exceeds 4 GiB')
+
+        sections = [
+            _pack_uint32(offsets),
+            bytes(data),
+            _pack(POLICY, self.policies),
+            _pack(CHAIN, chains),
+            _pack_uint32(links),
+            _pack_uint32(order),
+            _pack(INDEX, index),
+            _pack(GROUP, self.groups),
+        ]
+
+        out = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, 0,
+                                    self.generation))
+        table_offset = len(out)
+        out += bytes(SECTION.size * len(sections))
+        for position, section in enumerate(sections):
+            out += bytes(-len(out) % ALIGNMENT)
+            SECTION.pack_into(out, table_offset + position * SECTION.size,
+                              len(out), len(section))
+            out += section
+        return bytes(out)
+
+    def write(self, path):
+        """Write the snapshot, replacing an existing file atomically."""
+        content = self.build()
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.gpsnap-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+                os.fchmod(f.fileno(), 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return len(content)
+
+
+class Snapshot:
+    """
+    Read-only view of a snapshot file.
+
+    Records are decoded on access straight from the mapping; nothing is
+    loaded up front, so opening is constant time and the pages are shared
+    by every process mapping the same file.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise SnapshotError('file is empty')
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse_header()
+        except Exception:
+            self._mm.close()
+            raise
+
+    def _parse_header(self):
+        if len(self._mm) < HEADER.size + SECTION.size * len(SECTIONS):
+            raise SnapshotError('file is too short')
+        magic, version, _flags, self.generation = HEADER.unpack_from(
+            self._mm, 0)
+        if magic != MAGIC:
+            raise SnapshotError('not a Group Policy snapshot')
+        if version != FORMAT_VERSION:
+            raise SnapshotError(
+                'unsupported snapshot version {}'.format(version))
+
+        self._sections = {}
+        for position, name in enumerate(SECTIONS):
+            offset, length = SECTION.unpack_from(
+                self._mm, HEADER.size + position * SECTION.size)
+            if offset + length > len(self._mm):
+                raise SnapshotError('section {} is truncated'.format(name))
+            self._sections[name] = (offset, length)
+
+        for name, record_struct in (('strings', OFFSET), ('policies', POLICY),
+                                    ('chains', CHAIN), ('links', OFFSET),
+                                    ('order', OFFSET), ('index', INDEX),
+                                    ('groups', GROUP)):
+            if self._sections[name][1] % record_struct.size:
+                raise SnapshotError('section {} is corrupt'.format(name))
+
+        self.string_count = self._sections['strings'][1] // OFFSET.size - 1
+        self.policy_count = self._sections['policies'][1] // POLICY.size
+        self.chain_count = self._sections['chains'][1] // CHAIN.size
+        self._order_count = self._sections['order'][1] // OFFSET.size
+        self._index_size = self._sections['index'][1] // INDEX.size
+        self.group_count = self._sections['groups'][1] // GROUP.size
+        if self.string_count < 0 or \
+                self._index_size & (self._index_size - 1):
+            raise SnapshotError('snapshot is corrupt')
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _string_bytes(self, sid):
+        base = self._sections['strings'][0] + sid * OFFSET.size
+        start, end = struct.unpack_from('<II', self._mm, base)
+        data, length = self._sections['data']
+        if not start <= end <= length:
+            raise SnapshotError('string {} is corrupt'.format(sid))
+        return self._mm[data + start:data + end]
+
+    def string(self, sid):
+        """Return the string with the given ID, or None for NONE."""
+        if sid == NONE:
+            return None
+        if not 0 <= sid < self.string_count:
+            raise IndexError(sid)
+        return self._string_bytes(sid).decode('utf-8')
+
+    def _uint32s(self, section, start, count):
+        return struct.unpack_from('<{}I'.format(count), self._mm,
+                                  self._sections[section][0] +
+                                  start * OFFSET.size)
+
+    def policy(self, index):
+        if not 0 <= index < self.policy_count:
+            raise IndexError(index)
+        dn, guid, name, path, version, flags = POLICY.unpack_from(
+            self._mm, self._sections['policies'][0] + index * POLICY.size)
+        return Policy(self.string(dn), self.string(guid), self.string(name),
+                      self.string(path), version, flags)
+
+    def chain_links(self, index):
+        """Return the policy indexes linked by a chain, in gpLink order."""
+        _record, start, count = self._chain_record(index)
+        return self._uint32s('links', start, count)
+
+    def _chain_record(self, index):
+        if not 0 <= index < self.chain_count:
+            raise IndexError(index)
+        record = CHAIN.unpack_from(
+            self._mm, self._sections['chains'][0] + index * CHAIN.size)
+        if record[4] + record[5] > self._sections['links'][1] // OFFSET.size:
+            raise SnapshotError('chain {} is corrupt'.format(index))
+        return record[:4], record[4], record[5]
+
+    def chain(self, index):
+        (dn, name, usergroup, computergroup), start, count = \
+            self._chain_record(index)
+        return Chain(self.string(dn), self.string(name),
+                     self.string(usergroup), self.string(computergroup),
+                     self._uint32s('links', start, count))
+
+    def group(self, index):
+        if not 0 <= index < self.group_count:
+            raise IndexError(index)
+        dn, name, kind = GROUP.unpack_from(
+            self._mm, self._sections['groups'][0] + index * GROUP.size)
+        return Group(self.string(dn), self.string(name), kind)
+
+    def chain_order(self):
+        """Return chain indexes in chainList order."""
+        return self._uint32s('order', 0, self._order_count)
+
+    def _lookup(self, kind, key):
+        if not self._index_size:
+            return None
+        data = key.encode('utf-8')
+        key_hash = _key_hash(kind, data)
+        mask = self._index_size - 1
+        slot = key_hash & mask
+        base = self._sections['index'][0]
+        # The writer always leaves a free slot, a full index is corrupt
+        for _probe in range(self._index_size):
+            slot_hash, sid, value = INDEX.unpack_from(
+                self._mm, base + slot * INDEX.size)
+            if sid == NONE:
+                return None
+            if (slot_hash == key_hash and value >> KIND_SHIFT == kind and
+                    self._string_bytes(sid) == data):
+                return value & RECORD_MASK
+            slot = (slot + 1) & mask
+        raise SnapshotError('index is corrupt')
+
+    def find_policy(self, dn=None, guid=None, name=None):
+        """Return the index of a policy by DN, GUID or name, or None."""
+        if dn is not None:
+            return self._lookup(KEY_POLICY_DN, dn_key(dn))
+        if guid is not None:
+            return self._lookup(KEY_POLICY_GUID, guid.lower())
+        if name is not None:
+            return self._lookup(KEY_POLICY_NAME, name.lower())
+        raise ValueError('dn, guid or name is required')
+
+    def find_chain(self, dn=None, name=None):
+        """Return the index of a chain by DN or name, or None."""
+        if dn is not None:
+            return self._lookup(KEY_CHAIN_DN, dn_key(dn))
+        if name is not None:
+            return self._lookup(KEY_CHAIN_NAME, name.lower())
+        raise ValueError('dn or name is required')
+
+    def find_group(self, dn=None, name=None, kind=GROUP_USER):
+        """Return the index of a group by DN, or name and kind, or None."""
+        if dn is not None:
+            return self._lookup(KEY_GROUP_DN, dn_key(dn))
+        if name is not None:
+            return self._lookup(GROUP_NAME_KEYS[kind], name.lower())
+        raise ValueError('dn or name is required')
+
+
+def build_snapshot(api, ldap, content=True):
+    """
+    Return a SnapshotWriter filled from the directory.
+
+    With content=False, the SYSVOL path and version of policies, which
+    only Group Policy administrators may read, are left out.
+    """
+    writer = SnapshotWriter(api.Object.gpmaster.get_generation(ldap))
+
+    attrs = ['cn', 'displayName', 'flags']
+    if content:
+        attrs += ['gPCFileSysPath', 'versionNumber']
+    for entry in api.Object.grouppolicy.get_all_entries(ldap, attrs):
+        guid = entry.get('cn', [''])[0]
+        writer.add_policy(entry.dn, guid,
+                          entry.get('displayName', [guid])[0],
+                          entry.get('gPCFileSysPath', [''])[0],
+                          entry.get('versionNumber', [0])[0],
+                          entry.get('flags', [0])[0])
+
+    for entry in api.Object.chain.get_all_entries(ldap):
+        links = RankedList(entry.get('gpLink', []),
+                           entry.get('gpLinkOrder', []), key=dn_key)
+        writer.add_chain(entry.dn, entry.get('cn', [''])[0],
+                         entry.get('userGroup', [None])[0],
+                         entry.get('computerGroup', [None])[0],
+                         list(links))
+
+    for obj_name, kind in (('group', GROUP_USER), ('hostgroup', GROUP_HOST)):
+        obj = api.Object[obj_name]
+        try:
+            entries = ldap.get_entries(
+                DN(obj.container_dn, api.env.basedn), ldap.SCOPE_ONELEVEL,
+                ldap.make_filter_from_attr(
+                    'objectclass', obj.permission_filter_objectclasses[0]),
+                ['cn'], paged_search=True)
+        except errors.NotFound:
+            entries = []
+        for entry in entries:
+            writer.add_group(entry.dn, entry.get('cn', [''])[0], kind)
+
+    try:
+        writer.set_chain_order(api.Object.gpmaster.get_chain_list(ldap))
+    except errors.NotFound:
+        pass
+    return writer
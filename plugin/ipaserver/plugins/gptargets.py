@@ -0,0 +1,284 @@
+"""
+Chains applying to a group, stored on the group entry.
+
+A chain applies to the members of the group in its userGroup or
+computerGroup. Clients know their groups, but finding their chains means
+searching all chains on those attributes and ordering the result by the
+chainList of the master. Instead, every user group and host group named
+by a chain carries gpEffectiveChain: the DNs of the chains naming it
+which are in the master, with their master order kept in
+gpEffectiveChainOrder as for gpLink (see gporder). A client reads them
+with the entry of each of its groups; chains without a group and group
+nesting are still resolved by the client.
+
+The lists live in the auxiliary class groupPolicyTarget. Group Policy
+administrators may write the lists but not the object classes of groups,
+so the class is given to new groups by group-add and hostgroup-add and
+to existing ones by ipa-gpo-install.
+
+The lists are derived data. Chain and master commands refresh the lists
+of the groups they touched after their own change: the group entries are
+read first, then the chains naming them and the master, and each list is
+replaced asserting the entryUSN of its group, so that of two concurrent
+refreshes the one which read older chains fails and reads again. A
+refresh which keeps failing is logged and left to chain-fsck, which
+compares every list with the chains and the master and rewrites the
+ones which differ.
+"""
+import logging
+
+from ipalib import errors
+from ipalib import _
+from ipapython.dn import DN
+from .gpclosure import GROUP_FILTER
+from .gporder import RankedList, edit_backoff, entry_usn, modify_values
+from .gpresolve import dn_key
+from .group import group, group_add
+from .hostgroup import hostgroup, hostgroup_add
+
+logger = logging.getLogger(__name__)
+
+TARGET_OBJECTCLASS = 'groupPolicyTarget'
+EFFECTIVE_ATTR = 'gpEffectiveChain'
+EFFECTIVE_ORDER_ATTR = 'gpEffectiveChainOrder'
+TARGET_ATTRS = ['objectClass', EFFECTIVE_ATTR, EFFECTIVE_ORDER_ATTR,
+                'entryUSN']
+
+# Chain attributes naming the group a chain applies to
+CHAIN_GROUP_ATTRS = ('userGroup', 'computerGroup')
+
+# Objects whose entries carry the lists
+TARGET_OBJECTS = ('group', 'hostgroup')
+
+# Number of times a list is refreshed when its group changed concurrently
+REFRESH_RETRIES = 5
+
+# Maximum number of values combined into one OR filter
+FILTER_CHUNK = 500
+
+
+def _target_permissions(label):
+    return {
+        'System: Read {} Effective Group Policy Chains'.format(label): {
+            'ipapermbindruletype': 'all',
+            'ipapermright': {'read', 'search', 'compare'},
+            'ipapermdefaultattr': {
+                'gpeffectivechain', 'gpeffectivechainorder',
+            },
+        },
+        'System: Modify {} Effective Group Policy Chains'.format(label): {
+            'ipapermright': {'write'},
+            'ipapermdefaultattr': {
+                'gpeffectivechain', 'gpeffectivechainorder',
+            },
+            'default_privileges': {'Group Policy Administrators'},
+        },
+    }
+
+
+group.managed_permissions.update(_target_permissions('Group'))
+hostgroup.managed_permissions.update(_target_permissions('Host Group'))
+
+
+def add_target_objectclass(self, ldap, dn, entry_attrs, attrs_list, *keys,
+                           **options):
+    """Create groups with the class holding their chain list."""
+    objectclasses = list(entry_attrs.get('objectclass', []))
+    if TARGET_OBJECTCLASS.lower() not in {str(value).lower()
+                                          for value in objectclasses}:
+        entry_attrs['objectclass'] = objectclasses + [TARGET_OBJECTCLASS]
+    return dn
+
+
+group_add.register_pre_callback(add_target_objectclass)
+hostgroup_add.register_pre_callback(add_target_objectclass)
+
+
+def chain_groups(entry):
+    """Return the DNs of the groups a chain entry names."""
+    return [DN(value) for attr in CHAIN_GROUP_ATTRS
+            for value in entry.get(attr, [])]
+
+
+def effective_chains(chains, chain_list):
+    """
+    Return {group key: chain DNs in master order} for chain entries.
+
+    Chains which are not in chain_list do not apply to anybody and are
+    left out.
+    """
+    by_key = {dn_key(entry.dn): entry for entry in chains}
+    result = {}
+    for chain_dn in chain_list:
+        entry = by_key.get(dn_key(chain_dn))
+        if entry is None:
+            continue
+        for group_dn in chain_groups(entry):
+            chain_dns = result.setdefault(dn_key(group_dn), [])
+            if entry.dn not in chain_dns:
+                chain_dns.append(entry.dn)
+    return result
+
+
+def target_changes(entry, chain_dns):
+    """
+    Return the changes making the list of a group entry chain_dns.
+
+    None means the list is current. The whole list is replaced with
+    evenly spread ranks.
+    """
+    ranked = RankedList(entry.get(EFFECTIVE_ATTR, []),
+                        entry.get(EFFECTIVE_ORDER_ATTR, []), key=DN)
+    if not ranked.stale and not ranked.unranked and \
+            [dn_key(dn) for dn in ranked] == [dn_key(dn) for dn in chain_dns]:
+        return None
+
+    ranked.replace([DN(dn) for dn in chain_dns])
+    changes = []
+    objectclasses = {str(value).lower()
+                     for value in entry.get('objectClass', [])}
+    if chain_dns and TARGET_OBJECTCLASS.lower() not in objectclasses:
+        changes.append(('add', 'objectClass', [TARGET_OBJECTCLASS]))
+    changes.append(('replace', EFFECTIVE_ATTR, list(ranked)))
+    changes.append(('replace', EFFECTIVE_ORDER_ATTR, ranked.order_values()))
+    return changes
+
+
+def _containers(api):
+    return [DN(api.Object[name].container_dn, api.env.basedn)
+            for name in TARGET_OBJECTS]
+
+
+def _search(ldap, base_dn, search_filter, attrs_list):
+    try:
+        return ldap.get_entries(base_dn, ldap.SCOPE_ONELEVEL, search_filter,
+                                attrs_list, paged_search=True)
+    except errors.NotFound:
+        return []
+
+
+def get_chain_list(api, ldap):
+    try:
+        return list(api.Object.gpmaster.get_chain_list(ldap))
+    except errors.NotFound:
+        return []
+
+
+def listing_groups(api, ldap, chain_dns):
+    """Return the DNs of the groups whose list holds one of chain_dns."""
+    filters = []
+    for chain_dn in chain_dns:
+        filters.append(ldap.make_filter_from_attr(EFFECTIVE_ATTR, chain_dn))
+        # Referential integrity removes a deleted or renamed chain from
+        # gpEffectiveChain, its rank stays until the list is refreshed
+        filters.append(ldap.make_filter_from_attr(
+            EFFECTIVE_ORDER_ATTR, ':{}'.format(chain_dn), exact=False,
+            trailing_wildcard=False))
+    found = []
+    for start in range(0, len(filters), FILTER_CHUNK):
+        search_filter = ldap.combine_filters(
+            filters[start:start + FILTER_CHUNK], rules=ldap.MATCH_ANY)
+        for base_dn in _containers(api):
+            found.extend(entry.dn for entry in _search(
+                ldap, base_dn, search_filter, ['1.1']))
+    return found
+
+
+def naming_chains(api, ldap, group_dns):
+    """Return the chain entries naming one of group_dns."""
+    chain = api.Object.chain
+    found = {}
+    for start in range(0, len(group_dns), FILTER_CHUNK):
+        chunk = group_dns[start:start + FILTER_CHUNK]
+        search_filter = ldap.combine_filters(
+            [ldap.make_filter_from_attr(attr, chunk, rules=ldap.MATCH_ANY)
+             for attr in CHAIN_GROUP_ATTRS],
+            rules=ldap.MATCH_ANY)
+        for entry in _search(ldap, DN(chain.container_dn, api.env.basedn),
+                             search_filter, ['cn'] + list(CHAIN_GROUP_ATTRS)):
+            found[dn_key(entry.dn)] = entry
+    return list(found.values())
+
+
+def refresh_groups(api, ldap, group_dns):
+    """Rewrite the lists of groups from the chains and the master."""
+    pending = {dn_key(dn): DN(dn) for dn in group_dns}
+    for attempt in range(REFRESH_RETRIES):
+        if not pending:
+            return
+        if attempt:
+            edit_backoff(attempt)
+
+        # Groups before chains: a list written from chains read before a
+        # concurrent change fails on the entryUSN the other refresh bumped
+        entries = []
+        for dn in pending.values():
+            try:
+                entries.append(ldap.get_entry(dn, TARGET_ATTRS))
+            except errors.NotFound:
+                continue
+        expected = effective_chains(
+            naming_chains(api, ldap, [entry.dn for entry in entries]),
+            get_chain_list(api, ldap))
+
+        pending = {}
+        for entry in entries:
+            changes = target_changes(entry,
+                                     expected.get(dn_key(entry.dn), []))
+            if changes is None:
+                continue
+            try:
+                modify_values(ldap, entry.dn, changes, entry_usn(entry))
+            except errors.MidairCollision:
+                logger.debug("Group %s changed concurrently, retrying "
+                             "(attempt %d)", entry.dn, attempt + 1)
+                pending[dn_key(entry.dn)] = entry.dn
+
+    if not pending:
+        return
+    raise errors.MidairCollision(
+        message=_('Chain lists of groups were modified concurrently')
+    )
+
+
+def refresh_targets(api, ldap, chain_dns):
+    """
+    Refresh the lists of the groups affected by changes of chains.
+
+    chain_dns are the DNs of the chains added, deleted, renamed (old and
+    new DN), moved in the master or whose groups changed. A failure is
+    logged and not raised: the change of the chains is done and the
+    lists are repaired by chain-fsck.
+    """
+    chain_dns = [DN(dn) for dn in chain_dns]
+    if not chain_dns:
+        return
+    try:
+        group_dns = listing_groups(api, ldap, chain_dns)
+        for chain_dn in chain_dns:
+            try:
+                entry = ldap.get_entry(chain_dn, list(CHAIN_GROUP_ATTRS))
+            except errors.NotFound:
+                continue
+            group_dns.extend(chain_groups(entry))
+        refresh_groups(api, ldap, group_dns)
+    except errors.PublicError as e:
+        logger.warning("Failed to refresh the chains of groups, run "
+                       "chain-fsck --fix: %s", e)
+
+
+def check_targets(api, ldap, chains, chain_list):
+    """
+    Compare the lists of all groups with chains and chain_list.
+
+    Returns (entry, changes) of the groups whose list differs.
+    """
+    expected = effective_chains(chains, chain_list)
+    problems = []
+    for base_dn in _containers(api):
+        for entry in _search(ldap, base_dn, GROUP_FILTER, TARGET_ATTRS):
+            changes = target_changes(entry,
+                                     expected.get(dn_key(entry.dn), []))
+            if changes is not None:
+                problems.append((entry, changes))
+    return problems
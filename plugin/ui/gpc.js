@@ -0,0 +1,501 @@
+/*  Authors:
+ *    Danila Skachedubov <skachedubov@altlinux.org>
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+define([
+        'freeipa/ipa',
+        'freeipa/jquery',
+        'freeipa/menu',
+        'freeipa/phases',
+        'freeipa/reg',
+        'freeipa/rpc',
+        'freeipa/details',
+        'freeipa/search',
+        'freeipa/entity'
+       ],
+       function(IPA, $, menu, phases, reg, rpc) {
+
+/**
+ * Group Policy module
+ *
+ * Group Policy Objects and Chains use paged search facets: only primary
+ * keys are searched and the visible page is loaded with one batch of
+ * `*_show` calls, so chains resolve their DNs only for rows on screen.
+ * Ordered lists (gpLink of a chain, chainList of the master) are drawn
+ * with a virtualised list widget which renders only the visible rows and
+ * commits a drag-and-drop reorder as a single command.
+ *
+ * @class
+ * @singleton
+ */
+var gpc = IPA.gpc = {};
+
+/**
+ * Number of rows rendered above and below the visible part of a list
+ */
+gpc.overscan = 5;
+
+/**
+ * Compute the rows of a virtualised list which need to be rendered.
+ *
+ * @param {number} scroll_top Scroll offset of the viewport in pixels
+ * @param {number} viewport_height Height of the viewport in pixels
+ * @param {number} row_height Height of one row in pixels
+ * @param {number} total Number of rows in the list
+ * @param {number} [overscan] Extra rows rendered on each side
+ * @return {Object} `start` (inclusive) and `end` (exclusive) row indexes
+ */
+gpc.visible_range = function(scroll_top, viewport_height, row_height,
+                             total, overscan) {
+    if (overscan === undefined) overscan = gpc.overscan;
+    var first = Math.floor(Math.max(scroll_top, 0) / row_height);
+    var count = Math.ceil(viewport_height / row_height);
+    return {
+        start: Math.max(first - overscan, 0),
+        end: Math.min(first + count + overscan, total)
+    };
+};
+
+/**
+ * Return a copy of a list with one item moved to another position.
+ *
+ * @param {Array} list
+ * @param {number} from Current index of the item
+ * @param {number} to New index of the item
+ * @return {Array}
+ */
+gpc.reorder = function(list, from, to) {
+    var result = list.slice(0);
+    var item = result.splice(from, 1)[0];
+    result.splice(to, 0, item);
+    return result;
+};
+
+/**
+ * Describe a move of one item as a number of single step moves.
+ *
+ * @param {number} from Current index of the item
+ * @param {number} to New index of the item
+ * @return {Object|null} `direction` ('up' or 'down') and `steps`
+ */
+gpc.move_steps = function(from, to) {
+    if (from === to) return null;
+    return {
+        direction: to < from ? 'up' : 'down',
+        steps: Math.abs(to - from)
+    };
+};
+
+/**
+ * Build the commands of a reorder for an ordered list attribute.
+ *
+ * The whole move is one command, so that the server applies it with a
+ * single modify.
+ *
+ * @param {Object} spec
+ * @param {string} spec.entity Entity of the edited object
+ * @param {Function} spec.method Returns method name for a direction
+ * @param {Function} spec.args Returns args for the moved item
+ * @param {Function} spec.options Returns options for the moved item,
+ *                   a direction and a number of steps
+ * @param {string} spec.item Moved item
+ * @param {number} spec.from Current index of the item
+ * @param {number} spec.to New index of the item
+ * @return {Array} list of command specs
+ */
+gpc.reorder_commands = function(spec) {
+    var move = gpc.move_steps(spec.from, spec.to);
+    if (!move) return [];
+    return [{
+        entity: spec.entity,
+        method: spec.method(move.direction),
+        args: spec.args(spec.item),
+        options: spec.options(spec.item, move.direction, move.steps)
+    }];
+};
+
+/**
+ * Virtualised, reorderable list widget
+ *
+ * Renders only the visible rows of a long ordered list. Rows can be
+ * dragged to a new position; the reorder is sent to the server as one
+ * batch command and the facet is refreshed afterwards.
+ *
+ * @class
+ * @extends IPA.input_widget
+ */
+gpc.ordered_list_widget = function(spec) {
+
+    spec = spec || {};
+
+    var that = IPA.input_widget(spec);
+
+    /**
+     * Height of one row in pixels
+     * @property {number}
+     */
+    that.row_height = spec.row_height || 28;
+
+    /**
+     * Number of rows visible without scrolling
+     * @property {number}
+     */
+    that.visible_rows = spec.visible_rows || 12;
+
+    /**
+     * Builds the command specs of a reorder, see gpc.reorder_commands
+     * @property {Function}
+     */
+    that.reorder_commands = spec.reorder_commands;
+
+    that.values = [];
+    that.rendered = {};
+    that.drag_index = null;
+
+    that.create = function(container) {
+
+        that.widget_create(container);
+        container.addClass('gpc-ordered-list');
+
+        that.viewport = $('<div/>', {
+            'class': 'gpc-ordered-list-viewport',
+            css: {
+                position: 'relative',
+                overflowY: 'auto',
+                height: that.row_height * that.visible_rows
+            },
+            scroll: function() {
+                that.render_rows();
+            },
+            dragover: function(e) {
+                e.preventDefault();
+            },
+            drop: function(e) {
+                e.preventDefault();
+                that.on_drop(e);
+            }
+        }).appendTo(container);
+
+        that.spacer = $('<div/>', {
+            'class': 'gpc-ordered-list-spacer',
+            css: { position: 'relative', height: 0 }
+        }).appendTo(that.viewport);
+    };
+
+    that.update = function(values) {
+        that.values = values || [];
+        that.rendered = {};
+        that.spacer.empty();
+        that.spacer.css('height', that.values.length * that.row_height);
+        that.render_rows();
+    };
+
+    that.save = function() {
+        return that.values;
+    };
+
+    that.clear = function() {
+        that.update([]);
+    };
+
+    /**
+     * Add rows which scrolled into view and drop those which left it.
+     */
+    that.render_rows = function() {
+        if (!that.viewport) return;
+
+        var range = gpc.visible_range(
+            that.viewport.scrollTop(), that.viewport.height(),
+            that.row_height, that.values.length);
+
+        for (var index in that.rendered) {
+            if (!that.rendered.hasOwnProperty(index)) continue;
+            var i = parseInt(index, 10);
+            if (i < range.start || i >= range.end) {
+                that.rendered[index].remove();
+                delete that.rendered[index];
+            }
+        }
+
+        for (var j = range.start; j < range.end; j++) {
+            if (!that.rendered[j]) {
+                that.rendered[j] = that.create_row(j);
+            }
+        }
+    };
+
+    that.create_row = function(index) {
+        return $('<div/>', {
+            'class': 'gpc-ordered-list-row',
+            draggable: that.enabled && !that.read_only,
+            text: (index + 1) + '. ' + that.values[index],
+            css: {
+                position: 'absolute',
+                left: 0,
+                right: 0,
+                top: index * that.row_height,
+                height: that.row_height,
+                lineHeight: that.row_height + 'px',
+                cursor: 'move'
+            },
+            dragstart: function(e) {
+                that.drag_index = index;
+                e.originalEvent.dataTransfer.setData('text/plain', String(index));
+            }
+        }).appendTo(that.spacer);
+    };
+
+    that.target_index = function(e) {
+        var offset = e.originalEvent.pageY - that.viewport.offset().top +
+            that.viewport.scrollTop();
+        var index = Math.floor(offset / that.row_height);
+        return Math.min(Math.max(index, 0), that.values.length - 1);
+    };
+
+    that.on_drop = function(e) {
+        if (that.drag_index === null) return;
+
+        var from = that.drag_index;
+        var to = that.target_index(e);
+        that.drag_index = null;
+        if (from === to) return;
+
+        var item = that.values[from];
+        var commands = that.reorder_commands(item, from, to);
+        if (!commands.length) return;
+
+        var batch = rpc.batch_command({
+            name: that.entity.name + '_reorder',
+            on_success: function() {
+                that.facet.refresh();
+            },
+            on_error: function() {
+                that.facet.refresh();
+            }
+        });
+        for (var i = 0; i < commands.length; i++) {
+            batch.add_command(rpc.command(commands[i]));
+        }
+
+        that.update(gpc.reorder(that.values, from, to));
+        batch.execute();
+    };
+
+    return that;
+};
+
+/**
+ * Reorder commands of the gpLink list of a chain
+ */
+gpc.chain_gplink_commands = function(widget) {
+    return function(item, from, to) {
+        return gpc.reorder_commands({
+            entity: 'chain',
+            item: item,
+            from: from,
+            to: to,
+            method: function() { return 'mod'; },
+            args: function() { return [widget.facet.get_pkey()]; },
+            options: function(name, direction, steps) {
+                // chain-mod moves a policy once per repetition
+                var names = [];
+                for (var i = 0; i < steps; i++) names.push(name);
+                var options = {};
+                options['move' + direction + '_gpc'] = names;
+                return options;
+            }
+        });
+    };
+};
+
+/**
+ * Reorder commands of the chainList of the master
+ */
+gpc.gpmaster_chainlist_commands = function() {
+    return function(item, from, to) {
+        return gpc.reorder_commands({
+            entity: 'gpmaster',
+            item: item,
+            from: from,
+            to: to,
+            method: function(direction) {
+                return 'move' + direction + '_chain';
+            },
+            args: function(name) { return [name]; },
+            options: function(name, direction, steps) {
+                return { count: steps };
+            }
+        });
+    };
+};
+
+gpc.chain_gplink_widget = function(spec) {
+    var that = gpc.ordered_list_widget(spec);
+    that.reorder_commands = gpc.chain_gplink_commands(that);
+    return that;
+};
+
+gpc.gpmaster_chainlist_widget = function(spec) {
+    var that = gpc.ordered_list_widget(spec);
+    that.reorder_commands = gpc.gpmaster_chainlist_commands();
+    return that;
+};
+
+var make_grouppolicy_spec = function() {
+return {
+    name: 'grouppolicy',
+    facets: [
+        {
+            $type: 'search',
+            pagination: true,
+            columns: [
+                'displayname',
+                'cn',
+                'flags',
+                'versionnumber'
+            ]
+        },
+        {
+            $type: 'details',
+            sections: [
+                {
+                    name: 'details',
+                    fields: [
+                        'displayname',
+                        'cn',
+                        'distinguishedname',
+                        'flags',
+                        'gpcfilesyspath',
+                        'versionnumber'
+                    ]
+                }
+            ]
+        }
+    ],
+    adder_dialog: {
+        fields: ['displayname']
+    }
+};};
+
+var make_chain_spec = function() {
+return {
+    name: 'chain',
+    facets: [
+        {
+            $type: 'search',
+            pagination: true,
+            columns: [
+                'cn',
+                'displayname'
+            ]
+        },
+        {
+            $type: 'details',
+            sections: [
+                {
+                    name: 'details',
+                    fields: [
+                        'cn',
+                        'displayname',
+                        'usergroup',
+                        'computergroup'
+                    ]
+                },
+                {
+                    name: 'gplink',
+                    label: '@mo-param:chain:gplink:label',
+                    fields: [
+                        {
+                            $type: 'gpc_chain_gplink',
+                            name: 'gplink',
+                            read_only: true
+                        }
+                    ]
+                }
+            ]
+        }
+    ],
+    adder_dialog: {
+        fields: [
+            'cn',
+            'displayname',
+            'usergroup',
+            'computergroup'
+        ]
+    }
+};};
+
+var make_gpmaster_spec = function() {
+return {
+    name: 'gpmaster',
+    defines_key: false,
+    facets: [
+        {
+            $type: 'details',
+            sections: [
+                {
+                    name: 'details',
+                    fields: [
+                        'cn',
+                        'pdcemulator'
+                    ]
+                },
+                {
+                    name: 'chainlist',
+                    label: '@mo-param:gpmaster:chainlist:label',
+                    fields: [
+                        {
+                            $type: 'gpc_gpmaster_chainlist',
+                            name: 'chainlist',
+                            read_only: true
+                        }
+                    ]
+                }
+            ]
+        }
+    ]
+};};
+
+gpc.grouppolicy_spec = make_grouppolicy_spec();
+gpc.chain_spec = make_chain_spec();
+gpc.gpmaster_spec = make_gpmaster_spec();
+
+gpc.register = function() {
+    var e = reg.entity;
+    var w = reg.widget;
+    var f = reg.field;
+
+    w.register('gpc_chain_gplink', gpc.chain_gplink_widget);
+    f.register('gpc_chain_gplink', IPA.field);
+    w.register('gpc_gpmaster_chainlist', gpc.gpmaster_chainlist_widget);
+    f.register('gpc_gpmaster_chainlist', IPA.field);
+
+    e.register({type: 'grouppolicy', spec: gpc.grouppolicy_spec});
+    e.register({type: 'chain', spec: gpc.chain_spec});
+    e.register({type: 'gpmaster', spec: gpc.gpmaster_spec});
+};
+
+gpc.add_menu_items = function() {
+    menu.add_item({ name: 'grouppolicy', entity: 'grouppolicy' }, 'policy');
+    menu.add_item({ name: 'chain', entity: 'chain' }, 'policy');
+    menu.add_item({ name: 'gpmaster', entity: 'gpmaster' }, 'policy');
+};
+
+phases.on('registration', gpc.register);
+phases.on('profile', gpc.add_menu_items, 20);
+
+return gpc;
+});
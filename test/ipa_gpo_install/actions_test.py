@@ -0,0 +1,76 @@
+import logging
+import re
+from types import SimpleNamespace
+
+from ipalib import errors
+from ipa_gpo_install.actions import IPAActions
+from ipaserver.plugins.gporder import RankedList
+
+BASE = 'dc=example,dc=test'
+
+
+class LDAP:
+    SCOPE_SUBTREE = 2
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.searches = []
+        self.updated = []
+
+    def get_entries(self, base_dn, scope, search_filter, attrs_list,
+                    paged_search=False):
+        self.searches.append(search_filter)
+        object_class, list_attr, order_attr = re.match(
+            r'\(&\(objectClass=(\w+)\)\((\w+)=\*\)\(!\((\w+)=\*\)\)\)',
+            search_filter).groups()
+        found = [entry for entry in self.entries
+                 if entry['objectClass'] == object_class and
+                 entry.get(list_attr) and order_attr not in entry]
+        if not found:
+            raise errors.NotFound()
+        return found
+
+    def update_entry(self, entry):
+        self.updated.append(entry)
+
+
+def make_actions(entries):
+    ldap2 = LDAP(entries)
+    api = SimpleNamespace(env=SimpleNamespace(basedn=BASE),
+                          Backend=SimpleNamespace(ldap2=ldap2))
+    return IPAActions(logging.getLogger('test'), api), ldap2
+
+
+def test_migrate_ordering_keeps_value_order():
+    links = ['cn={{{}}},cn=Policies,cn=System,{}'.format(n, BASE)
+             for n in ('b', 'a', 'c')]
+    chain = {'objectClass': 'groupPolicyChain', 'gpLink': links}
+    done = {'objectClass': 'groupPolicyChain', 'gpLink': links[:1],
+            'gpLinkOrder': ['1:' + links[0]]}
+    master = {'objectClass': 'groupPolicyMaster',
+              'chainList': ['cn=x,' + BASE, 'cn=y,' + BASE]}
+    actions, ldap2 = make_actions([chain, done, master])
+
+    assert actions.migrate_ordering()
+    # One search per list attribute, entries with ranks are left alone
+    assert len(ldap2.searches) == 2
+    assert ldap2.updated == [chain, master]
+    assert list(RankedList(chain['gpLink'][::-1],
+                           chain['gpLinkOrder'])) == links
+    assert list(RankedList(master['chainList'][::-1],
+                           master['chainListOrder'])) == master['chainList']
+
+    # Nothing left to migrate
+    ldap2.updated = []
+    assert actions.migrate_ordering()
+    assert ldap2.updated == []
+
+
+def test_migrate_ordering_reports_errors():
+    actions, ldap2 = make_actions([{'objectClass': 'groupPolicyChain',
+                                    'gpLink': ['cn=a,' + BASE]}])
+
+    def fail(entry):
+        raise errors.DatabaseError()
+    ldap2.update_entry = fail
+    assert not actions.migrate_ordering()
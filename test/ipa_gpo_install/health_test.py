@@ -0,0 +1,115 @@
+import json
+import time
+from types import SimpleNamespace
+
+from ipalib import errors
+
+from ipa_gpo_install.health import HealthCheck, HealthMonitor
+
+CHECKS = (
+    HealthCheck('kerberos_ticket', 'check_kerberos_ticket', (), 60),
+    HealthCheck('schema_complete', 'check_schema_current', ('a.ldif',), 3600),
+)
+
+
+class Checker:
+    def __init__(self):
+        self.calls = []
+        self.ticket = True
+        self.delay = 0
+
+    def check_kerberos_ticket(self):
+        self.calls.append('kerberos_ticket')
+        return self.ticket
+
+    def check_schema_current(self, path):
+        self.calls.append('schema_complete')
+        time.sleep(self.delay)
+        return True
+
+
+class Connection:
+    def __init__(self):
+        self.connected = False
+        self.connects = 0
+        self.error = None
+
+    def isconnected(self):
+        return self.connected
+
+    def connect(self):
+        if self.error is not None:
+            raise self.error
+        self.connected = True
+        self.connects += 1
+
+    def disconnect(self):
+        self.connected = False
+
+    def get_entry(self, dn, attrs_list):
+        if self.error is not None:
+            raise self.error
+        return {}
+
+
+def make_monitor(tmp_path, checker=None):
+    ldap2 = Connection()
+    api = SimpleNamespace(Backend=SimpleNamespace(ldap2=ldap2),
+                          env=SimpleNamespace(basedn='dc=example,dc=test'))
+    monitor = HealthMonitor(checker or Checker(), api, CHECKS,
+                            str(tmp_path / 'health.json'))
+    return monitor, ldap2
+
+
+def test_only_due_checks_run(tmp_path):
+    checker = Checker()
+    monitor, ldap2 = make_monitor(tmp_path, checker)
+
+    assert monitor.run_cycle(now=0) == ['kerberos_ticket', 'schema_complete']
+    assert monitor.run_cycle(now=30) == []
+    assert monitor.run_cycle(now=61) == ['kerberos_ticket']
+    assert checker.calls == ['kerberos_ticket', 'schema_complete',
+                             'kerberos_ticket']
+    assert ldap2.connects == 1
+
+    monitor.publish()
+    with open(monitor.status_path) as f:
+        status = json.load(f)
+    assert status['healthy'] and status['cycles'] == 2
+    assert sorted(status['checks']) == ['kerberos_ticket', 'schema_complete']
+
+
+def test_slow_checks_back_off(tmp_path):
+    checker = Checker()
+    checker.delay = 0.05
+    monitor, _ldap2 = make_monitor(tmp_path, checker)
+    monitor.checks = (HealthCheck('schema_complete', 'check_schema_current',
+                                  ('a.ldif',), 1),)
+    monitor.next_run = {'schema_complete': 0}
+
+    monitor.run_cycle(now=0)
+    # At least 0.05 s times COST_RATIO instead of the 1 s base interval
+    assert monitor.next_run['schema_complete'] >= 5
+
+
+def test_reconnects(tmp_path):
+    checker = Checker()
+    monitor, ldap2 = make_monitor(tmp_path, checker)
+    monitor.run_cycle(now=0)
+
+    # The ticket expired: bind again with the new credentials
+    checker.ticket = False
+    monitor.run_cycle(now=61)
+    assert ldap2.connects == 2
+    assert not monitor.status()['healthy']
+
+    # The server went away
+    ldap2.error = errors.NetworkError()
+    assert monitor.run_cycle(now=200) is None
+    assert not monitor.status()['connected']
+
+    ldap2.error = None
+    checker.ticket = True
+    assert monitor.run_cycle(now=201) == ['kerberos_ticket']
+    assert ldap2.connects == 4
+    assert monitor.status()['healthy']
@@ -0,0 +1,159 @@
+import os
+import tempfile
+import threading
+
+import ldap
+import pytest
+from ldap.controls.psearch import EntryChangeNotificationControl
+
+from ipa_gpo_install import resolverd
+
+BASEDN = 'dc=example,dc=test'
+POLICIES = 'cn=policies,cn=system,' + BASEDN
+CHAINS = 'cn=system,' + BASEDN
+MASTERS = 'cn=etc,' + BASEDN
+GROUPS = 'cn=groups,cn=accounts,' + BASEDN
+
+SEARCHES = [
+    (POLICIES, ldap.SCOPE_ONELEVEL, '(objectClass=groupPolicyContainer)', []),
+    (CHAINS, ldap.SCOPE_ONELEVEL, '(objectClass=groupPolicyChain)', []),
+    (MASTERS, ldap.SCOPE_ONELEVEL, '(objectClass=groupPolicyMaster)', []),
+]
+
+
+def policy(guid, name):
+    return ('cn={},{}'.format(guid, POLICIES), {
+        'objectClass': [b'groupPolicyContainer'],
+        'cn': [guid.encode()],
+        'displayName': [name.encode()],
+    })
+
+
+def chain(name, *guids):
+    return ('cn={},{}'.format(name, CHAINS), {
+        'objectClass': [b'groupPolicyChain'],
+        'cn': [name.encode()],
+        'gpLink': ['cn={},{}'.format(g, POLICIES).encode() for g in guids],
+    })
+
+
+def master(*chains):
+    return ('cn=grouppolicymaster,' + MASTERS, {
+        'objectClass': [b'groupPolicyMaster'],
+        'chainList': ['cn={},{}'.format(c, CHAINS).encode() for c in chains],
+    })
+
+
+def notification(entry, change_type=4, previous_dn=None):
+    control = EntryChangeNotificationControl()
+    control.changeType = change_type
+    control.previousDN = previous_dn
+    control.changeNumber = None
+    return (entry[0], entry[1], [control])
+
+
+class FakeConnection:
+    """Stand-in for a python-ldap connection with persistent searches."""
+
+    def __init__(self, entries, changes, on_idle):
+        self.entries = entries
+        self.changes = list(changes)
+        self.on_idle = on_idle
+        self.psearches = []
+
+    def search_ext(self, base, scope, search_filter, attrs, serverctrls):
+        self.psearches.append(base)
+        return len(self.psearches)
+
+    def search_s(self, base, scope, search_filter, attrs):
+        return [e for e in self.entries if e[0].endswith(',' + base)
+                and e[0].count(',') == base.count(',') + 1]
+
+    def result4(self, msgid, all, timeout, add_ctrls, resp_ctrl_classes):
+        if not self.changes:
+            self.on_idle()
+            raise ldap.TIMEOUT()
+        return (ldap.RES_SEARCH_ENTRY, [self.changes.pop(0)], 1, [])
+
+    def unbind_s(self):
+        pass
+
+
+def run_watcher(entries, changes=()):
+    service = resolverd.ResolverService()
+    watcher = None
+
+    def connect():
+        return FakeConnection(entries, changes, watcher.stop)
+
+    watcher = resolverd.GraphWatcher(service, SEARCHES, connect)
+    watcher.run()
+    return service
+
+
+def resolve(service):
+    response = service.handle_request({'user': 'john', 'host': 'ws001'})
+    return [p['name'] for p in response['policies']]
+
+
+INITIAL = [
+    policy('{GUID-1}', 'policy-1'),
+    policy('{GUID-2}', 'policy-2'),
+    chain('all', '{GUID-1}', '{GUID-2}'),
+    master('all'),
+]
+
+
+class TestGraphWatcher:
+
+    def test_initial_load(self):
+        service = run_watcher(INITIAL)
+        assert resolve(service) == ['policy-1', 'policy-2']
+        assert service.handle_request({'op': 'status'})['ready']
+
+    def test_modify_and_delete_notifications(self):
+        service = run_watcher(INITIAL, [
+            notification(policy('{GUID-1}', 'renamed')),
+            notification(policy('{GUID-2}', 'policy-2'), change_type=2),
+        ])
+        assert resolve(service) == ['renamed']
+
+    def test_moddn_notification(self):
+        new_chain = chain('renamed', '{GUID-2}')
+        service = run_watcher(INITIAL, [
+            notification(new_chain, change_type=8,
+                         previous_dn='cn=all,' + CHAINS),
+            notification(master('renamed')),
+        ])
+        assert resolve(service) == ['policy-2']
+
+    def test_not_ready_before_load(self):
+        service = resolverd.ResolverService()
+        assert service.handle_request({'user': 'john'}) == {
+            'error': 'not ready'}
+
+    def test_unknown_op(self):
+        service = resolverd.ResolverService()
+        with pytest.raises(ValueError):
+            service.handle_request({'op': 'unknown'})
+
+
+class TestResolverServer:
+
+    def test_query_over_socket(self):
+        service = run_watcher(INITIAL)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'resolver.sock')
+            server = resolverd.ResolverServer(path, service)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                response = resolverd.query({'user': 'john', 'host': 'ws001'},
+                                           path=path)
+                assert [p['guid'] for p in response['policies']] == [
+                    '{GUID-1}', '{GUID-2}']
+                assert 'error' in resolverd.query(['bad'], path=path)
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
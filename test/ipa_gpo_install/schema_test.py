@@ -0,0 +1,93 @@
+import os
+
+import ldap
+
+from ipa_gpo_install import schema
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+FILES = [os.path.join(ROOT, 'data', '74alt-group-policy.ldif')] + [
+    os.path.join(ROOT, 'plugin', 'schema.d', name)
+    for name in ('75-gpc.ldif', '75-chain.ldif', '75-gpmaster.ldif')
+]
+
+CN = b"( 2.5.4.3 NAME ( 'cn' 'commonName' ) SUP name X-ORIGIN 'RFC 4519' )"
+
+
+class FakeConnection:
+    """cn=schema entry applying modifies the way 389-ds does."""
+
+    def __init__(self):
+        self.entry = {'attributeTypes': [CN], 'objectClasses': []}
+        self.modifies = []
+
+    def search_s(self, base, scope, attrlist=None):
+        return [(base, self.entry)]
+
+    def modify_s(self, dn, mods):
+        self.modifies.append(mods)
+        names = {'attributetypes': 'attributeTypes',
+                 'objectclasses': 'objectClasses'}
+        for op, attr, values in mods:
+            current = self.entry[names[attr]]
+            for value in values:
+                if op == ldap.MOD_DELETE:
+                    current.remove(value)
+                else:
+                    current.append(
+                        value[:-1] + b"X-ORIGIN 'user defined' )")
+
+
+def test_read_ldif_content_and_modify_records():
+    content = schema.read_ldif(FILES[0])
+    modify = schema.read_ldif(FILES[2])
+    assert [attr for attr, _value in content].count('objectclasses') == 2
+    assert all(value.startswith('(') and value.endswith(')')
+               for _attr, value in content + modify)
+    assert "NAME 'groupPolicyChain'" in ' '.join(
+        value for _attr, value in modify)
+
+
+def test_fresh_server_gets_one_modify():
+    conn = FakeConnection()
+    diff = schema.diff_schema(conn, FILES)
+    assert not diff.current and not diff.changed and not diff.conflicts
+    assert ('objectclasses', 'grouppolicymaster') in {
+        (attr, name) for attr, name, _element in diff.added}
+
+    schema.apply_schema(conn, diff)
+    assert len(conn.modifies) == 1
+    # attribute types are added before the object classes using them
+    assert [attr for _op, attr, _values in conn.modifies[0]] == [
+        'attributetypes', 'objectclasses']
+
+    diff = schema.diff_schema(conn, FILES)
+    assert diff.current and diff.lines() == []
+    assert schema.apply_schema(conn, diff) == 0
+    assert len(conn.modifies) == 1
+
+
+def test_changed_definition_is_replaced():
+    conn = FakeConnection()
+    schema.apply_schema(conn, schema.diff_schema(conn, FILES))
+    conn.entry['attributeTypes'] = [
+        value.replace(b"DESC '", b"DESC 'Old ") if b"'gpGeneration'" in value
+        else value for value in conn.entry['attributeTypes']]
+
+    diff = schema.diff_schema(conn, FILES)
+    assert diff.lines() == ['change attributetypes gpgeneration']
+    schema.apply_schema(conn, diff)
+    assert [op for op, _attr, _values in conn.modifies[-1]] == [
+        ldap.MOD_DELETE, ldap.MOD_ADD]
+    assert schema.diff_schema(conn, FILES).current
+
+
+def test_name_under_another_oid_is_a_conflict():
+    conn = FakeConnection()
+    schema.apply_schema(conn, schema.diff_schema(conn, FILES[:1]))
+
+    diff = schema.diff_schema(conn, FILES)
+    conflicts = {name for _attr, name, _old, _new in diff.conflicts}
+    assert {'versionnumber', 'grouppolicycontainer'} <= conflicts
+    assert not diff.changed
+    assert 'grouppolicycontainer' not in {
+        name for _attr, name, _element in diff.added}
@@ -0,0 +1,70 @@
+import shutil
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from ipa_gpo_install import system
+
+UNITS = ['dirsrv@EXAMPLE-TEST', 'krb5kdc', 'ipa', 'sssd']
+
+
+def fake_run(output, returncode=0):
+    calls = []
+
+    def run(args, **kwargs):
+        calls.append(args)
+        return SimpleNamespace(output=output, error_output='',
+                               returncode=returncode)
+    return run, calls
+
+
+def test_unit_states_fall_back_to_one_systemctl(monkeypatch):
+    def no_dbus(names):
+        raise ImportError('dbus')
+
+    run, calls = fake_run('active\nactive\nfailed\nactive\n', returncode=3)
+    monkeypatch.setattr(system, '_dbus_unit_states', no_dbus)
+    monkeypatch.setattr(system.ipautil, 'run', run, raising=False)
+
+    states = system.unit_states(UNITS)
+    assert states == {'dirsrv@EXAMPLE-TEST': 'active', 'krb5kdc': 'active',
+                      'ipa': 'failed', 'sssd': 'active'}
+    assert calls == [['systemctl', 'is-active', 'dirsrv@EXAMPLE-TEST.service',
+                      'krb5kdc.service', 'ipa.service', 'sssd.service']]
+
+
+def test_share_exists_matches_whole_names(monkeypatch):
+    run, _calls = fake_run('global\nsysvol-old\nnetlogon\n')
+    monkeypatch.setattr(system.ipautil, 'run', run, raising=False)
+    config = system.SambaConfig.__new__(system.SambaConfig)
+    config.conf = None
+
+    assert not config.share_exists('sysvol')
+    assert config.share_exists('NETLOGON')
+
+
+def test_benchmark_unit_states():
+    """Compare the D-Bus query with the systemctl calls it replaces."""
+    pytest.importorskip('dbus')
+    if shutil.which('systemctl') is None:
+        pytest.skip('systemd is not available')
+    names = [system._unit_name(unit) for unit in UNITS]
+    try:
+        system._dbus_unit_states(names)
+    except Exception as e:
+        pytest.skip('systemd is not reachable over D-Bus: {}'.format(e))
+
+    start = time.perf_counter()
+    for unit in names:
+        system.ipautil.run(['systemctl', 'is-active', unit],
+                           raiseonerr=False)
+    forked = time.perf_counter() - start
+
+    start = time.perf_counter()
+    states = system.unit_states(UNITS)
+    in_process = time.perf_counter() - start
+
+    print('systemctl: {:.1f} ms, D-Bus: {:.1f} ms'.format(
+        forked * 1000, in_process * 1000))
+    assert set(states) == set(UNITS)
@@ -0,0 +1,46 @@
+import errno
+import os
+
+import pytest
+
+from ipa_gpo_install.sysvol_acl import (
+    ACCESS_ACL,
+    DEFAULT_ACL,
+    SysvolPermissions,
+)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    try:
+        os.getxattr(str(tmp_path), ACCESS_ACL)
+    except OSError as e:
+        if e.errno == errno.EOPNOTSUPP:
+            pytest.skip('file system without POSIX ACLs')
+    for guid in ('{A}', '{B}'):
+        machine = tmp_path / 'example.test' / 'Policies' / guid / 'Machine'
+        machine.mkdir(parents=True)
+        (machine.parent / 'GPT.INI').write_text('[General]\n')
+        (machine / 'Registry.pol').write_bytes(b'PReg\x01\x00\x00\x00')
+    os.symlink('/etc', str(tmp_path / 'example.test' / 'link'))
+    return tmp_path
+
+
+def test_dry_run_reports_without_changes(tree):
+    stats = SysvolPermissions(str(tree), gid=os.getgid(),
+                              dry_run=True).repair()
+    # root, domain, Policies, 2 x (GPO, Machine, GPT.INI, Registry.pol)
+    assert stats['checked'] == stats['repaired'] == 11
+    with pytest.raises(OSError):
+        os.getxattr(str(tree), DEFAULT_ACL)
+
+
+def test_repair_then_skip(tree):
+    repair = SysvolPermissions(str(tree), gid=os.getgid())
+    assert repair.repair()['repaired'] == 11
+    gpt_ini = tree / 'example.test' / 'Policies' / '{A}' / 'GPT.INI'
+    assert oct(os.stat(str(gpt_ini)).st_mode & 0o777) == '0o664'
+
+    os.chmod(str(gpt_ini), 0o600)
+    stats = SysvolPermissions(str(tree), gid=os.getgid()).repair()
+    assert (stats['checked'], stats['repaired'], stats['errors']) == (11, 1, 0)
@@ -0,0 +1,150 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from ipalib import errors
+from ipa_gpo_install import sysvol_gc
+from ipa_gpo_install.sysvol_gc import (
+    RateLimiter,
+    SysvolCollector,
+    find_orphans,
+)
+
+DOMAIN = 'example.test'
+KEPT = '{11111111-1111-1111-1111-111111111111}'
+ORPHAN = '{22222222-2222-2222-2222-222222222222}'
+RECENT = '{33333333-3333-3333-3333-333333333333}'
+ADDED = '{44444444-4444-4444-4444-444444444444}'
+LINK = '{55555555-5555-5555-5555-555555555555}'
+
+
+class LDAP:
+    SCOPE_ONELEVEL = 1
+
+    def __init__(self, guids, added=()):
+        self.guids = list(guids)
+        # Entries created after the bulk search
+        self.added = list(added)
+
+    def get_entries(self, base_dn, scope, search_filter, attrs_list,
+                    paged_search=False):
+        if not self.guids:
+            raise errors.NotFound(reason='no entries')
+        return [{'cn': [guid]} for guid in self.guids]
+
+    def get_entry(self, dn, attrs_list):
+        guid = str(dn[0].value)
+        if guid not in self.guids + self.added:
+            raise errors.NotFound(reason='{} not found'.format(dn))
+        return {'cn': [guid]}
+
+
+def make_collector(ldap, **options):
+    api = SimpleNamespace(env=SimpleNamespace(domain=DOMAIN,
+                                              basedn='dc=example,dc=test'),
+                          Backend=SimpleNamespace(ldap2=ldap))
+    options.setdefault('rate', 0)
+    return SysvolCollector(api, **options)
+
+
+@pytest.fixture
+def sysvol(tmp_path, monkeypatch):
+    monkeypatch.setattr(sysvol_gc, 'SYSVOL_ROOT', str(tmp_path / 'sysvol'))
+    monkeypatch.setattr(sysvol_gc, 'QUARANTINE_ROOT',
+                        str(tmp_path / 'quarantine'))
+    policies = tmp_path / 'sysvol' / DOMAIN / 'Policies'
+    old = time.time() - 2 * sysvol_gc.DEFAULT_MIN_AGE
+    for guid in (KEPT, ORPHAN, RECENT, ADDED):
+        (policies / guid / 'Machine').mkdir(parents=True)
+        if guid != RECENT:
+            os.utime(str(policies / guid), (old, old))
+    # Not policy directories
+    (policies / 'PolicyDefinitions').mkdir()
+    os.symlink(str(policies / KEPT), str(policies / LINK))
+    return policies
+
+
+def test_find_orphans(sysvol):
+    orphans = dict(find_orphans(str(sysvol), {KEPT.lower()},
+                                sysvol_gc.DEFAULT_MIN_AGE))
+    # Recent directories, links and other names are left alone
+    assert sorted(orphans) == [ORPHAN, ADDED]
+    assert orphans[ORPHAN] == str(sysvol / ORPHAN)
+    assert sorted(dict(find_orphans(str(sysvol), {KEPT.lower()}, 0))) == \
+        [ORPHAN, RECENT, ADDED]
+
+
+def test_quarantine(sysvol, tmp_path):
+    collector = make_collector(LDAP([KEPT], added=[ADDED]))
+    stats = collector.collect()
+
+    assert stats == {'orphans': 2, 'quarantined': 1, 'deleted': 0,
+                     'skipped': 1, 'purged': 0, 'remaining': 0}
+    assert not (sysvol / ORPHAN).exists()
+    assert (sysvol / ADDED).is_dir()
+    moved = [name for name in os.listdir(str(tmp_path / 'quarantine' /
+                                             DOMAIN))
+             if name != '.lock']
+    assert [name.rpartition('.')[0] for name in moved] == [ORPHAN]
+    assert (tmp_path / 'quarantine' / DOMAIN / moved[0] / 'Machine').is_dir()
+
+
+def test_dry_run_and_delete(sysvol, tmp_path):
+    stats = make_collector(LDAP([KEPT, ADDED]), dry_run=True).collect()
+    assert stats['orphans'] == 1 and stats['quarantined'] == 0
+    assert (sysvol / ORPHAN).is_dir()
+    assert not (tmp_path / 'quarantine').exists()
+
+    stats = make_collector(LDAP([KEPT, ADDED]), delete=True).collect()
+    assert stats['deleted'] == 1
+    assert not (sysvol / ORPHAN).exists()
+    assert os.listdir(str(tmp_path / 'quarantine' / DOMAIN)) == ['.lock']
+
+
+def test_limit_and_purge(sysvol, tmp_path):
+    waits = []
+    collector = make_collector(LDAP([KEPT]), limit=1)
+    collector.limiter = SimpleNamespace(wait=lambda: waits.append(1))
+    stats = collector.collect()
+    # One orphan is left for the next run, each move waits for the limiter
+    assert stats['quarantined'] == 1 and stats['remaining'] == 1
+    assert len(waits) == 1
+    quarantine = tmp_path / 'quarantine' / DOMAIN
+    moved = set(os.listdir(str(quarantine)))
+    expired = time.time() - 31 * 86400
+    (quarantine / '{}.{}'.format(RECENT, int(expired)) / 'User').mkdir(
+        parents=True)
+    (quarantine / 'notes.{}'.format(int(expired))).mkdir()
+    collector = make_collector(LDAP([KEPT]), min_age=10 ** 9)
+    collector.limiter = SimpleNamespace(wait=lambda: waits.append(1))
+    stats = collector.collect()
+    # Only expired policy directories are purged, at the same rate
+    assert stats['purged'] == 1
+    assert len(waits) == 2
+    assert set(os.listdir(str(quarantine))) == \
+        moved | {'notes.{}'.format(int(expired))}
+
+
+def test_rate_limiter():
+    now = [100.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+    limiter = RateLimiter(4, clock=lambda: now[0], sleep=sleep)
+    for _ in range(3):
+        limiter.wait()
+    assert sleeps == [0.25, 0.25]
+
+    # Time spent between calls counts towards the interval
+    now[0] += 0.1
+    limiter.wait()
+    assert sleeps[-1] == pytest.approx(0.15)
+
+    unlimited = RateLimiter(0, clock=lambda: now[0], sleep=sleep)
+    unlimited.wait()
+    unlimited.wait()
+    assert len(sleeps) == 3
@@ -0,0 +1,205 @@
+import os
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import ldap as _ldap
+from ipaserver.plugins.gpprovision import ProvisioningQueue
+
+from ipa_gpo_install.sysvol_watch import (
+    Inotify, SysvolWatcher, VersionUpdater, classify,
+)
+
+GUID1 = '{11111111-1111-1111-1111-111111111111}'
+GUID2 = '{22222222-2222-2222-2222-222222222222}'
+GUID3 = '{33333333-3333-3333-3333-333333333333}'
+
+
+class FakeInotify:
+    def __init__(self):
+        self.paths = {}
+
+    def add_watch(self, path, mask):
+        self.paths[len(self.paths) + 1] = path
+        return len(self.paths)
+
+    def rm_watch(self, wd):
+        pass
+
+
+def make_policies(tmp_path, *guids):
+    for guid in guids:
+        for side in ('Machine', 'User'):
+            os.makedirs(str(tmp_path / guid / side))
+    return str(tmp_path)
+
+
+def test_classify():
+    assert classify(os.path.join(GUID1, 'Machine', 'Registry.pol')) == \
+        (GUID1, ('Machine',))
+    assert classify(os.path.join(GUID1, 'USER', 'Scripts', 'a.sh')) == \
+        (GUID1, ('User',))
+    assert classify(os.path.join(GUID1, 'notes.txt')) == \
+        (GUID1, ('Machine', 'User'))
+    assert classify(os.path.join(GUID1, 'GPT.INI')) is None
+    assert classify(os.path.join(GUID1, '.GPT.INI-x1y2')) is None
+    assert classify('notes.txt') is None
+    assert classify(os.path.join('other', 'Machine', 'a')) is None
+
+
+def test_debounce_and_max_delay(tmp_path):
+    watcher = SysvolWatcher(make_policies(tmp_path, GUID1, GUID2),
+                            inotify=FakeInotify(), debounce=2, max_delay=10)
+    watcher.watch('', now=0)
+    machine = next(wd for wd, path in watcher.watches.items()
+                   if path == os.path.join(GUID1, 'Machine'))
+    user = next(wd for wd, path in watcher.watches.items()
+                if path == os.path.join(GUID2, 'User'))
+
+    watcher.handle(machine, 0x8, 'Registry.pol', now=0)
+    watcher.handle(machine, 0x8, 'Registry.pol', now=1)
+    assert watcher.timeout(1) == 2
+    assert watcher.due(2.5) == {}
+    assert watcher.due(3) == {GUID1: {'Machine'}}
+
+    # A GPO written to continuously is flushed after max_delay
+    for now in range(0, 11):
+        watcher.handle(user, 0x8, 'a.sh', now=now)
+    watcher.handle(machine, 0x8, 'Registry.pol', now=10)
+    assert watcher.due(10) == {GUID2: {'User'}}
+    assert list(watcher.pending) == [GUID1]
+
+
+def test_kernel_events(tmp_path):
+    policies = make_policies(tmp_path, GUID1)
+    watcher = SysvolWatcher(policies, inotify=Inotify())
+    try:
+        watcher.watch('', now=0)
+        with open(os.path.join(policies, GUID1, 'GPT.INI'), 'w') as f:
+            f.write('[General]\nVersion=0\n')
+        with open(os.path.join(policies, GUID1, 'User', 'a.sh'), 'w') as f:
+            f.write('true\n')
+        # A new directory, with a file written before it could be watched
+        os.makedirs(os.path.join(policies, GUID1, 'User', 'Scripts', 'x'))
+        with open(os.path.join(policies, GUID1, 'User', 'Scripts', 'x',
+                               'b.sh'), 'w'):
+            pass
+        # A new policy, which is not a change
+        os.makedirs(os.path.join(policies, GUID2, 'Machine'))
+        with open(os.path.join(policies, GUID2, 'Machine', 'x.pol'), 'w'):
+            pass
+
+        for wd, mask, name in watcher.inotify.read(1):
+            watcher.handle(wd, mask, name, now=0)
+        assert watcher.pending[GUID1][0] == {'User'}
+        assert GUID2 not in watcher.pending
+
+        # Watching the new directories picked up later writes
+        with open(os.path.join(policies, GUID2, 'Machine', 'y.pol'), 'w'):
+            pass
+        watcher.pending.clear()
+        for wd, mask, name in watcher.inotify.read(1):
+            watcher.handle(wd, mask, name, now=0)
+        assert list(watcher.pending) == [GUID2]
+    finally:
+        watcher.inotify.close()
+
+
+def test_queued_policy_is_not_bumped(tmp_path):
+    os.makedirs(str(tmp_path / 'queue'))
+    queue = ProvisioningQueue(str(tmp_path / 'queue'), str(tmp_path))
+    watcher = SysvolWatcher(make_policies(tmp_path / 'policies', GUID1, GUID2),
+                            inotify=FakeInotify(), queue=queue)
+    watcher.watch('', now=0)
+    machine = {path.split(os.sep)[0]: wd
+               for wd, path in watcher.watches.items()
+               if path.endswith('Machine')}
+
+    # The helper writes the structure of a queued GPO
+    queue.enqueue(GUID1, 'example.test')
+    watcher.handle(machine[GUID1], 0x8, 'Registry.pol', now=0)
+    watcher.handle(machine[GUID2], 0x8, 'Registry.pol', now=0)
+    assert list(watcher.pending) == [GUID2]
+
+    # Once provisioned, edits bump the version again
+    queue.discard(GUID1)
+    watcher.handle(machine[GUID1], 0x8, 'Registry.pol', now=1)
+    assert sorted(watcher.pending) == [GUID1, GUID2]
+
+
+class Entry(dict):
+    def __init__(self, dn, **attrs):
+        super().__init__(attrs)
+        self.dn = dn
+
+
+class LDAP:
+    MATCH_ANY = '|'
+    MATCH_ALL = '&'
+    SCOPE_ONELEVEL = 1
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.searches = 0
+        self.conn = self
+        # Entries modified by another writer after the search
+        self.concurrent = set()
+
+    def make_filter_from_attr(self, attr, values, rules):
+        return '({}{})'.format(rules, ''.join(
+            '({}={})'.format(attr, value) for value in values))
+
+    def combine_filters(self, filters, rules):
+        return '({}{})'.format(rules, ''.join(filters))
+
+    def get_entries(self, base, scope, search_filter, attrs_list):
+        self.searches += 1
+        return [Entry(entry.dn, **entry) for entry in self.entries
+                if '(cn={})'.format(entry['cn'][0]) in search_filter]
+
+    @staticmethod
+    def encode(value):
+        return str(value).encode('utf-8')
+
+    @contextmanager
+    def error_handler(self):
+        yield
+
+    def modify_ext_s(self, dn, modlist, serverctrls=None):
+        entry = next(entry for entry in self.entries if entry.dn == dn)
+        if dn in self.concurrent:
+            self.concurrent.discard(dn)
+            entry['entryUSN'] = [entry['entryUSN'][0] + 1]
+        if serverctrls[0].filterstr != \
+                '(entryUSN={})'.format(entry['entryUSN'][0]):
+            raise _ldap.ASSERTION_FAILED()
+        (_op, attr, values), = modlist
+        entry[attr] = [int(values[0])]
+        entry['entryUSN'] = [entry['entryUSN'][0] + 1]
+
+
+def test_updater_bumps_in_batches(tmp_path):
+    policies = make_policies(tmp_path, GUID1, GUID2, GUID3)
+    entries = [
+        Entry('cn={},cn=Policies'.format(GUID1), cn=[GUID1],
+              versionNumber=[(1 << 16) | 4], entryUSN=[10]),
+        Entry('cn={},cn=Policies'.format(GUID2), cn=[GUID2], entryUSN=[20]),
+    ]
+    ldap2 = LDAP(entries)
+    ldap2.concurrent.add(entries[1].dn)
+    updater = VersionUpdater(SimpleNamespace(
+        Backend=SimpleNamespace(ldap2=ldap2),
+        env=SimpleNamespace(basedn='dc=example,dc=test')), policies)
+
+    # GUID3 has no entry and is dropped
+    retry = updater.apply({GUID1: {'Machine'}, GUID2: {'User', 'Machine'},
+                           GUID3: {'User'}})
+    assert ldap2.searches == 1
+    assert entries[0]['versionNumber'] == [(1 << 16) | 5]
+    with open(os.path.join(policies, GUID1, 'GPT.INI')) as f:
+        assert f.read() == '[General]\nVersion=65541\n'
+
+    # GUID2 was modified after it was read and is retried
+    assert retry == {GUID2: {'User', 'Machine'}}
+    assert not os.path.exists(os.path.join(policies, GUID2, 'GPT.INI'))
+    assert updater.apply(retry) == {}
+    assert entries[1]['versionNumber'] == [(1 << 16) | 1]
@@ -0,0 +1,162 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from ipalib import errors
+from ipaclient.plugins import gpc
+from ipaclient.plugins.gpc import GPNameCache, chain_mod, format_chain_entry
+
+BASE = 'cn=Policies,cn=System,dc=example,dc=test'
+OFFICE = '{11111111-1111-1111-1111-111111111111}'
+BASELINE = '{22222222-2222-2222-2222-222222222222}'
+
+
+def gp_dn(guid):
+    return 'cn={},{}'.format(guid, BASE)
+
+
+class Server:
+    """Names and generation of the master, as gpmaster_cache returns them."""
+
+    def __init__(self):
+        self.generation = 1
+        self.policies = {OFFICE: 'office', BASELINE: 'baseline'}
+        self.calls = []
+        self.forwarded = []
+
+    def rename(self, guid, name):
+        self.policies[guid] = name
+        self.generation += 1
+
+    def gpmaster_cache(self, generation=None):
+        self.calls.append(generation)
+        if generation == self.generation:
+            return dict(result={'generation': generation, 'changed': False})
+        return dict(result={
+            'generation': self.generation,
+            'changed': True,
+            'grouppolicy': [[gp_dn(guid), guid, name]
+                            for guid, name in self.policies.items()],
+            'chain': [['office', 'Office']],
+        })
+
+    # chain_mod on the server
+    def forward(self, *keys, **options):
+        self.forwarded.append(options)
+        generation = options.get('gp_generation')
+        if generation is not None and generation != self.generation:
+            raise errors.MidairCollision()
+        return dict(result={'cn': list(keys)})
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpc, 'USER_CACHE_PATH', str(tmp_path))
+    monkeypatch.setattr(gpc, '_caches', {})
+    return Server()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(gpc.time, 'time', lambda: now[0])
+    return now
+
+
+class Commands(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+def make_cache(server):
+    api = SimpleNamespace(
+        env=SimpleNamespace(realm='EXAMPLE.TEST'),
+        Command=Commands(gpmaster_cache=server.gpmaster_cache))
+    return GPNameCache(api)
+
+
+def test_miss_fills_the_cache(server, tmp_path):
+    cache = make_cache(server)
+    assert cache.load()
+    # Nothing on disk: all names are fetched
+    assert server.calls == [None]
+    assert cache.generation == 1
+    assert cache.gp_dn('Office') == gp_dn(OFFICE)
+    assert cache.gp_name(gp_dn(BASELINE).upper()) == 'baseline'
+    assert cache.gp_name('not a dn') is None
+    assert cache.chain_names() == ['office']
+
+    with open(str(tmp_path / 'ipa' / 'gpc' / 'EXAMPLE.TEST.json')) as f:
+        assert json.load(f)['generation'] == 1
+
+
+def test_hit_reads_the_disk(server, clock):
+    make_cache(server).load()
+    server.calls = []
+
+    cache = make_cache(server)
+    # Within CACHE_TTL neither writes nor display ask the server
+    assert cache.load() and cache.refresh()
+    assert server.calls == []
+    assert cache.gp_dn('baseline') == gp_dn(BASELINE)
+
+    # After it only the generation is compared
+    clock[0] += gpc.CACHE_TTL
+    assert cache.refresh()
+    assert server.calls == [1]
+    assert cache.gp_names() == ['office', 'baseline']
+
+
+def test_generation_change_invalidates(server, clock):
+    cache = make_cache(server)
+    cache.load()
+    server.rename(OFFICE, 'workstations')
+
+    # Still within CACHE_TTL: the old names are shown
+    cache.refresh()
+    assert cache.gp_dn('office') == gp_dn(OFFICE)
+
+    clock[0] += gpc.CACHE_TTL
+    cache.refresh()
+    assert server.calls == [None, 1]
+    assert cache.generation == 2
+    assert cache.gp_dn('office') is None
+    assert cache.gp_dn('workstations') == gp_dn(OFFICE)
+
+    # An unknown DN forces a refresh whatever the cache age
+    server.policies['{33333333-3333-3333-3333-333333333333}'] = 'lab'
+    server.generation += 1
+    entry = {'gplink': [gp_dn('{33333333-3333-3333-3333-333333333333}'),
+                        gp_dn(BASELINE)]}
+    format_chain_entry(cache, entry)
+    assert entry['gplink'] == ['lab', 'baseline']
+    assert server.calls[-1] == 2
+
+
+def test_stale_generation_is_rejected(server, clock):
+    cache = make_cache(server)
+    gpc._caches[id(cache.api)] = cache
+    command = chain_mod.__new__(chain_mod)
+    command.api = cache.api
+    command.next = server
+    command.params = {'gp_generation': None}
+
+    # Names are sent as DNs along with the generation they came from
+    chain_mod.forward(command, 'office', add_gpc=('office', gp_dn(BASELINE)))
+    assert server.forwarded[-1] == {
+        'add_gpc': (gp_dn(OFFICE), gp_dn(BASELINE)), 'gp_generation': 1}
+
+    # The server rejects names of an older generation: the names are sent
+    # instead and the next use of the cache revalidates it
+    server.rename(OFFICE, 'workstations')
+    server.policies[BASELINE] = 'office'
+    chain_mod.forward(command, 'office', add_gpc='office')
+    assert server.forwarded[-2:] == [
+        {'add_gpc': (gp_dn(OFFICE),), 'gp_generation': 1},
+        {'add_gpc': 'office'},
+    ]
+    server.calls = []
+    cache.refresh()
+    assert server.calls == [1]
+    assert cache.gp_dn('office') == gp_dn(BASELINE)
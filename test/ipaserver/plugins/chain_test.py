@@ -0,0 +1,423 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import ldap as _ldap
+import pytest
+
+from ipalib import errors
+from ipapython.dn import DN
+from ipaserver.plugins import chain as chain_plugin
+from ipaserver.plugins.chain import _parse_import_data, chain, chain_import
+from ipaserver.plugins.gpnames import SharedNameCache
+from ipaserver.plugins.gpsnapshot import SnapshotWriter
+
+BASE = 'dc=example,dc=test'
+
+
+class Entry(dict):
+    def __init__(self, dn, **attrs):
+        super().__init__(attrs)
+        self.dn = DN(dn)
+
+
+class LDAP:
+    def __init__(self):
+        self.added = []
+
+    def make_entry(self, dn, attrs):
+        return Entry(dn, **attrs)
+
+    def add_entry(self, entry):
+        self.added.append(entry)
+
+
+class ChainObject:
+    object_class = ['groupPolicyChain']
+
+    def __init__(self, existing, names):
+        self.existing = existing
+        self.names = names
+        self.master = []
+
+    def get_dn(self, name):
+        return DN('cn={},cn=System,{}'.format(name, BASE))
+
+    def get_all_entries(self, ldap, attrs_list=None):
+        return [Entry(self.get_dn(name), cn=[name]) for name in self.existing]
+
+    def resolve_names_bulk(self, ldap, usergroups=(), computergroups=(),
+                           gp_names=()):
+        return {
+            attr: {name.lower(): self.names[name] for name in requested
+                   if name in self.names}
+            for attr, requested in (('usergroup', usergroups),
+                                    ('computergroup', computergroups),
+                                    ('gplink', gp_names))
+        }
+
+    def initial_gp_link_order(self, gp_dns):
+        return ['{}:{}'.format(rank, dn) for rank, dn in enumerate(gp_dns)]
+
+    def add_chains_to_gpmaster(self, ldap, chain_dns):
+        self.master.extend(chain_dns)
+
+
+def run_import(monkeypatch, data, existing=(), names=None):
+    refreshed = []
+    monkeypatch.setattr(chain_plugin, 'refresh_targets',
+                        lambda api, ldap, dns: refreshed.extend(dns))
+    ldap2 = LDAP()
+    command = SimpleNamespace(
+        api=SimpleNamespace(
+            Backend=SimpleNamespace(ldap2=ldap2),
+            Object=SimpleNamespace(gpmaster=SimpleNamespace(
+                bump_generation=lambda ldap: None))),
+        obj=ChainObject(existing, names or {}))
+    result = chain_import.execute(command, data)['result']
+    return result, ldap2.added, command.obj.master
+
+
+def gp_dn(name):
+    return DN('cn={{{}}},cn=Policies,cn=System,{}'.format(name, BASE))
+
+
+def test_import_csv(monkeypatch):
+    names = {'admins': DN('cn=admins,cn=groups,cn=accounts,' + BASE),
+             'base': gp_dn('base'), 'office': gp_dn('office')}
+    data = ('name,user_group,gplink\n'
+            'office,admins,office;base\n'
+            'empty,,\n')
+    result, added, master = run_import(monkeypatch, data, names=names)
+
+    assert result == {'added': ['office', 'empty'], 'skipped': []}
+    office, empty = added
+    assert office['objectclass'] == ['top', 'groupPolicyChain']
+    assert office['usergroup'] == names['admins']
+    assert office['gplink'] == [gp_dn('office'), gp_dn('base')]
+    assert len(office['gplinkorder']) == 2
+    assert 'gplink' not in empty
+    assert master == [entry.dn for entry in added]
+
+
+def test_import_skips_duplicate_rows(monkeypatch):
+    names = {'base': gp_dn('base')}
+    data = ('[{"name": "office", "gplink": ["base", "Base", "base"]},'
+            ' {"name": "Office"}, {"name": "existing"}]')
+    result, added, _master = run_import(monkeypatch, data,
+                                        existing=['existing'], names=names)
+
+    assert result == {'added': ['office'], 'skipped': ['Office', 'existing']}
+    assert added[0]['gplink'] == [gp_dn('base')]
+
+
+def test_import_rejects_bad_rows(monkeypatch):
+    with pytest.raises(errors.ValidationError):
+        _parse_import_data('name,gplink\n,base\n')
+    with pytest.raises(errors.ValidationError):
+        _parse_import_data('[1]')
+    with pytest.raises(errors.ValidationError):
+        _parse_import_data('[{"name": "a"', 'json')
+
+    # Nothing is created when a row names a missing object
+    with pytest.raises(errors.NotFound):
+        run_import(monkeypatch, 'name,gplink\na,base\nb,missing\n',
+                   names={'base': gp_dn('base')})
+
+
+def test_policy_missing_from_snapshot_is_read_from_ldap(tmp_path,
+                                                        monkeypatch):
+    writer = SnapshotWriter(1)
+    writer.add_policy(gp_dn('base'), '{base}', 'base')
+    writer.write(str(tmp_path / 'names.snap'))
+    cache = SharedNameCache(str(tmp_path))
+    snapshot = cache.get(1, None)
+    monkeypatch.setattr(chain_plugin, 'get_name_cache', lambda: cache)
+    monkeypatch.setattr(chain_plugin, 'api',
+                        SimpleNamespace(env=SimpleNamespace(basedn=BASE)))
+
+    def find_entry_by_attr(attr, value, object_class, base_dn):
+        # Added after the snapshot was built
+        if value == 'new':
+            return Entry(gp_dn('new'))
+        raise errors.NotFound(reason='not found')
+    obj = SimpleNamespace(api=SimpleNamespace(Backend=SimpleNamespace(
+        ldap2=SimpleNamespace(find_entry_by_attr=find_entry_by_attr))))
+
+    assert chain.find_gp_by_displayname(obj, 'base', snapshot) == \
+        gp_dn('base')
+    assert chain.find_gp_by_displayname(obj, 'new', snapshot) == gp_dn('new')
+    with pytest.raises(errors.NotFound):
+        chain.find_gp_by_displayname(obj, 'missing', snapshot)
+
+
+class LinkDirectory:
+    """A chain entry whose gpLink modifies are recorded."""
+
+    def __init__(self, links):
+        self.conn = self
+        self.entry = Entry('cn=office,cn=System,' + BASE,
+                           gpLink=list(links), gpLinkOrder=[], entryUSN=[1])
+        self.modifies = []
+
+    def get_entry(self, dn, attrs_list):
+        return Entry(dn, **{attr: list(self.entry[attr])
+                            for attr in attrs_list})
+
+    @staticmethod
+    def encode(value):
+        return str(value).encode('utf-8')
+
+    @contextmanager
+    def error_handler(self):
+        yield
+
+    def modify_ext_s(self, dn, modlist, serverctrls=None):
+        self.modifies.append(modlist)
+        for op, attr, values in modlist:
+            values = [value.decode('utf-8') for value in values]
+            if op == _ldap.MOD_ADD:
+                self.entry[attr].extend(values)
+            elif op == _ldap.MOD_DELETE:
+                for value in values:
+                    self.entry[attr].remove(value)
+            else:
+                self.entry[attr] = values
+        self.entry['entryUSN'] = [self.entry['entryUSN'][0] + 1]
+
+
+def test_repeated_move_is_one_modify():
+    names = {name: gp_dn(name) for name in 'abcdef'}
+    directory = LinkDirectory(names.values())
+    obj = SimpleNamespace(
+        resolve_names_bulk=lambda ldap, gp_names=(): {
+            'gplink': {name.lower(): names[name] for name in gp_names}},
+        read_gp_links=lambda ldap, dn: chain_plugin.chain.read_gp_links(
+            None, ldap, dn))
+    # Rank all links first, as written by chain-add
+    chain_plugin.chain.edit_gp_links(obj, directory, directory.entry.dn,
+                                     {'movedown_gpc': ['f']})
+    directory.modifies = []
+
+    chain_plugin.chain.edit_gp_links(obj, directory, directory.entry.dn,
+                                     {'moveup_gpc': ['e'] * 3})
+    modlist, = directory.modifies
+    # Only the rank of the moved policy is replaced
+    assert [(op, attr, len(values)) for op, attr, values in modlist] == \
+        [(_ldap.MOD_DELETE, 'gpLinkOrder', 1),
+         (_ldap.MOD_ADD, 'gpLinkOrder', 1)]
+    ranked = chain_plugin.chain.read_gp_links(None, directory,
+                                              directory.entry.dn)[0]
+    assert [DN(dn) for dn in ranked] == \
+        [names[name] for name in 'aebcdf']
+
+
+CHAINS = 'cn=System,' + BASE
+GROUPS = 'cn=groups,cn=accounts,' + BASE
+HOSTGROUPS = 'cn=hostgroups,cn=accounts,' + BASE
+POLICIES = 'cn=Policies,cn=System,' + BASE
+MASTER = 'cn=grouppolicymaster,cn=etc,' + BASE
+
+
+class FsckEntry(Entry):
+    @property
+    def raw(self):
+        return {attr: [str(value).encode('utf-8') for value in values]
+                for attr, values in self.items()}
+
+
+class FsckDirectory:
+    """Chains, policies, groups and the master read and fixed by fsck."""
+
+    SCOPE_ONELEVEL = 1
+
+    def __init__(self):
+        self.conn = self
+        self.entries = {}
+        self.usn = 0
+        # Called before the next modify, to edit an entry concurrently
+        self.concurrent = None
+
+    def add(self, dn, **attrs):
+        self.usn += 1
+        entry = FsckEntry(dn, entryUSN=[self.usn],
+                          **{attr: list(values)
+                             for attr, values in attrs.items()})
+        self.entries[DN(dn)] = entry
+        return entry
+
+    def copy(self, entry):
+        return FsckEntry(entry.dn, **{attr: list(values)
+                                      for attr, values in entry.items()})
+
+    def get_entry(self, dn, attrs_list=None):
+        if DN(dn) not in self.entries:
+            raise errors.NotFound(reason='{} not found'.format(dn))
+        return self.copy(self.entries[DN(dn)])
+
+    def get_entries(self, base_dn, scope, search_filter, attrs_list,
+                    paged_search=False):
+        return [self.copy(entry) for dn, entry in self.entries.items()
+                if dn[1:] == DN(base_dn)]
+
+    @staticmethod
+    def encode(value):
+        return str(value).encode('utf-8')
+
+    @contextmanager
+    def error_handler(self):
+        yield
+
+    def modify_ext_s(self, dn, modlist, serverctrls=None):
+        if self.concurrent is not None:
+            concurrent, self.concurrent = self.concurrent, None
+            concurrent()
+        entry = self.entries[DN(dn)]
+        if serverctrls and serverctrls[0].filterstr != \
+                '(entryUSN={})'.format(entry['entryUSN'][0]):
+            raise _ldap.ASSERTION_FAILED()
+        for op, attr, values in modlist:
+            values = [value.decode('utf-8') for value in values]
+            if op == _ldap.MOD_ADD:
+                entry.setdefault(attr, []).extend(values)
+            else:
+                entry[attr] = values
+        self.usn += 1
+        entry['entryUSN'] = [self.usn]
+
+
+class Fsck(SimpleNamespace):
+    load_targets = chain_plugin.chain_fsck.load_targets
+    _index = staticmethod(chain_plugin.chain_fsck._index)
+    check_values = chain_plugin.chain_fsck.check_values
+    check_list = chain_plugin.chain_fsck.check_list
+    execute = chain_plugin.chain_fsck.execute
+
+
+def make_fsck(directory):
+    def container(dn):
+        return SimpleNamespace(container_dn=DN(dn)[:-2])
+
+    def get_all_entries(base):
+        return lambda ldap, attrs_list=None: directory.get_entries(
+            base, directory.SCOPE_ONELEVEL, None, attrs_list)
+
+    gpmaster = SimpleNamespace(
+        get_dn=lambda: DN(MASTER),
+        get_chain_list=lambda ldap: chain_plugin.RankedList(
+            *(directory.get_entry(MASTER).get(attr, [])
+              for attr in ('chainList', 'chainListOrder')), key=DN))
+    objects = {
+        'group': container(GROUPS),
+        'hostgroup': container(HOSTGROUPS),
+        'grouppolicy': SimpleNamespace(
+            get_all_entries=get_all_entries(POLICIES)),
+        'gpmaster': gpmaster,
+    }
+    api = SimpleNamespace(
+        env=SimpleNamespace(basedn=BASE),
+        Backend=SimpleNamespace(ldap2=directory),
+        Object=type('Objects', (SimpleNamespace,), {
+            '__getitem__': lambda self, name: getattr(self, name)})(
+                **objects))
+    obj = SimpleNamespace(
+        get_all_entries=get_all_entries(CHAINS),
+        initial_gp_link_order=lambda dns: ChainObject.initial_gp_link_order(
+            None, dns))
+    return Fsck(api=api, obj=obj)
+
+
+def fsck_directory():
+    """A directory with each kind of problem chain-fsck reports."""
+    directory = FsckDirectory()
+    admins = 'cn=admins,' + GROUPS
+    directory.add(admins, cn=['admins'], objectClass=['groupOfNames'])
+    directory.add('cn=servers,' + HOSTGROUPS, cn=['servers'],
+                  objectClass=['groupOfNames'])
+    for name in ('base', 'office'):
+        directory.add(gp_dn(name), cn=['{{{}}}'.format(name)],
+                      displayName=[name])
+
+    chains = {
+        # A deleted group and a deleted policy
+        'dangling': {'userGroup': ['cn=gone,' + GROUPS],
+                     'gpLink': [gp_dn('office'), gp_dn('gone')]},
+        # A policy named instead of referenced, and one that is neither
+        'invalid': {'userGroup': [admins], 'gpLink': ['office', 'nonsense']},
+        # The same policy twice, with different case
+        'duplicate': {'gpLink': [str(gp_dn('base')),
+                                 str(gp_dn('base')).upper()]},
+        'orphan': {'computerGroup': ['cn=servers,' + HOSTGROUPS]},
+    }
+    for name, attrs in chains.items():
+        directory.add('cn={},{}'.format(name, CHAINS), cn=[name], **attrs)
+    listed = [DN('cn={},{}'.format(name, CHAINS))
+              for name in ('dangling', 'invalid', 'duplicate')]
+    directory.add(MASTER, chainList=listed,
+                  chainListOrder=ChainObject.initial_gp_link_order(
+                      None, listed))
+    # Lists chains of admins which no longer apply to it
+    directory.entries[DN(admins)]['gpEffectiveChain'] = [listed[0]]
+    return directory
+
+
+def test_fsck_reports_each_problem():
+    directory = fsck_directory()
+    usn = directory.usn
+    result = make_fsck(directory).execute()['result']
+
+    assert sorted(result['dangling']) == [
+        'dangling: gpLink: ' + str(gp_dn('gone')),
+        'dangling: userGroup: cn=gone,' + GROUPS]
+    assert sorted(result['invalid']) == [
+        'invalid: gpLink: nonsense', 'invalid: gpLink: office']
+    assert result['duplicate'] == [
+        'duplicate: gpLink: ' + str(gp_dn('base')).upper()]
+    assert result['not_in_master'] == ['orphan']
+    # orphan applies to servers only once it is in the master
+    assert result['effective_chain'] == ['admins: gpEffectiveChain']
+    assert 'fixed' not in result
+    # Nothing is written without --fix
+    assert directory.usn == usn
+
+
+def test_fsck_fix():
+    directory = fsck_directory()
+    result = make_fsck(directory).execute(fix=True)['result']
+    assert sorted(result['fixed']) == [
+        'admins', 'dangling', 'duplicate', 'grouppolicymaster', 'invalid',
+        'servers']
+
+    def chain(name, attr):
+        return [str(value) for value in directory.entries[
+            DN('cn={},{}'.format(name, CHAINS))].get(attr, [])]
+    assert chain('dangling', 'userGroup') == []
+    assert chain('dangling', 'gpLink') == [str(gp_dn('office'))]
+    assert chain('invalid', 'gpLink') == [str(gp_dn('office'))]
+    assert len(chain('duplicate', 'gpLink')) == 1
+    assert len(chain('duplicate', 'gpLinkOrder')) == 1
+    master = directory.entries[DN(MASTER)]
+    assert DN(master['chainList'][-1]) == DN('cn=orphan,' + CHAINS)
+    assert [DN(dn) for dn in directory.entries[
+        DN('cn=admins,' + GROUPS)]['gpEffectiveChain']] == \
+        [DN('cn=invalid,' + CHAINS)]
+    assert [DN(dn) for dn in directory.entries[
+        DN('cn=servers,' + HOSTGROUPS)]['gpEffectiveChain']] == \
+        [DN('cn=orphan,' + CHAINS)]
+
+    # Everything found was fixed
+    assert make_fsck(directory).execute()['result'] == {}
+
+
+def test_fsck_fix_skips_entries_edited_meanwhile():
+    directory = fsck_directory()
+
+    def edit_dangling():
+        # chain-mod between the check and the repair
+        entry = directory.entries[DN('cn=dangling,' + CHAINS)]
+        entry['entryUSN'] = [entry['entryUSN'][0] + 100]
+    directory.concurrent = edit_dangling
+
+    result = make_fsck(directory).execute(fix=True)['result']
+    assert 'dangling' not in result['fixed']
+    assert directory.entries[DN('cn=dangling,' + CHAINS)]['userGroup'] == \
+        ['cn=gone,' + GROUPS]
@@ -0,0 +1,136 @@
+import re
+
+from ipapython.dn import DN
+from ipaserver.plugins import gpclosure
+from ipaserver.plugins.gpclosure import DirectoryGroupClosure, GroupClosure
+
+BASE = 'cn=groups,cn=accounts,dc=example,dc=test'
+
+
+def group_dn(name):
+    return 'cn={},{}'.format(name, BASE)
+
+
+class Entry(dict):
+    def __init__(self, dn, **attrs):
+        super().__init__(attrs)
+        self.dn = DN(dn)
+
+
+class LDAP:
+    """Groups of one container, answering the closure searches."""
+
+    MATCH_ALL = '&'
+    SCOPE_ONELEVEL = 1
+
+    def __init__(self):
+        self.groups = {}
+        self.usn = 0
+        self.searches = []
+
+    def set_group(self, name, *members):
+        self.usn += 1
+        self.groups[name] = Entry(group_dn(name),
+                                  member=[group_dn(m) for m in members],
+                                  entryUSN=[self.usn])
+
+    def make_filter_from_attr(self, attr, value):
+        return '({}={})'.format(attr, value)
+
+    def combine_filters(self, filters, rules):
+        return '({}{})'.format(rules, ''.join(filters))
+
+    def get_entries(self, base_dn, scope, search_filter, attrs_list,
+                    paged_search=False):
+        self.searches.append(search_filter)
+        entries = list(self.groups.values())
+        usn = re.search(r'\(entryUSN>=(\d+)\)', search_filter)
+        if usn:
+            entries = [e for e in entries
+                       if e['entryUSN'][0] >= int(usn.group(1))]
+        member = re.search(r'\(member=([^)]*)\)', search_filter)
+        if member:
+            entries = [e for e in entries if member.group(1) in e['member']]
+        return entries
+
+
+def test_incremental_set_members():
+    closure = GroupClosure()
+    closure.set_members('all', ['staff'])
+    closure.set_members('staff', ['admins'])
+
+    assert closure.ancestors(['admins']) == {'admins', 'staff', 'all'}
+    assert closure.ancestors(['staff']) == {'staff', 'all'}
+    # A group nobody nests is its own closure
+    assert closure.ancestors(['other']) == {'other'}
+
+    # Nesting added above an existing tree reaches its leaves
+    closure.set_members('everyone', ['all'])
+    assert closure.ancestors(['admins']) == {'admins', 'staff', 'all',
+                                             'everyone'}
+
+
+def test_member_removal():
+    closure = GroupClosure()
+    closure.set_members('all', ['staff', 'admins'])
+    closure.set_members('staff', ['admins'])
+
+    closure.set_members('staff', [])
+    # Still a direct member of all
+    assert closure.ancestors(['admins']) == {'admins', 'all'}
+    closure.set_members('all', ['staff'])
+    assert closure.ancestors(['admins']) == {'admins'}
+    assert closure.ancestors(['staff']) == {'staff', 'all'}
+
+
+def test_cycles():
+    closure = GroupClosure()
+    closure.set_members('a', ['b'])
+    closure.set_members('b', ['c'])
+    closure.set_members('c', ['a'])
+
+    for group in 'abc':
+        assert closure.ancestors([group]) == {'a', 'b', 'c'}
+
+    # Breaking the cycle leaves a chain
+    closure.set_members('c', [])
+    assert closure.ancestors(['c']) == {'a', 'b', 'c'}
+    assert closure.ancestors(['a']) == {'a'}
+    assert closure.ancestors(['b']) == {'a', 'b'}
+
+
+def test_refresh_reads_changed_groups(monkeypatch):
+    ldap2 = LDAP()
+    ldap2.set_group('all', 'staff')
+    ldap2.set_group('staff')
+    closure = DirectoryGroupClosure(BASE)
+    closure.refresh(ldap2)
+    assert closure.usn == 2
+    assert closure.member_of(ldap2, group_dn('staff')) == {
+        group_dn('all').lower()}
+
+    ldap2.set_group('staff', 'admins')
+    ldap2.searches = []
+    closure.refresh(ldap2)
+    # Only entries changed since the last refresh are read
+    assert ldap2.searches == ['(&{}(entryUSN>=3))'.format(
+        gpclosure.GROUP_FILTER)]
+    assert closure.usn == 3
+    assert closure.ancestors([group_dn('admins').lower()]) == {
+        group_dn(name).lower() for name in ('admins', 'staff', 'all')}
+
+    # Members outside the container are not groups of the closure
+    ldap2.set_group('staff', 'admins')
+    ldap2.groups['staff']['member'].append(
+        'uid=admin,cn=users,cn=accounts,dc=example,dc=test')
+    closure.refresh(ldap2)
+    assert closure.children[group_dn('staff').lower()] == {
+        group_dn('admins').lower()}
+
+    # A full reload drops groups which are gone
+    del ldap2.groups['all']
+    monkeypatch.setattr(gpclosure, 'RELOAD_INTERVAL', -1)
+    closure.refresh(ldap2)
+    assert ldap2.searches[-1] == gpclosure.GROUP_FILTER
+    assert closure.ancestors([group_dn('admins').lower()]) == {
+        group_dn(name).lower() for name in ('admins', 'staff')}
@@ -0,0 +1,252 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from ipalib import errors
+from ipapython.dn import DN
+from ipaserver.plugins import gpconfig
+from ipaserver.plugins.gpconfig import gpconfig_export, gpconfig_import
+from ipaserver.plugins.gporder import RankedList
+
+BASE = 'dc=example,dc=test'
+POLICIES = 'cn=Policies,cn=System'
+CHAINS = 'cn=chains,cn=System,' + BASE
+MASTER = 'cn=grouppolicymaster,cn=etc,' + BASE
+GROUPS = {
+    'usergroup': {'admins': DN('cn=admins,cn=groups,cn=accounts,' + BASE)},
+    'computergroup': {
+        'servers': DN('cn=servers,cn=hostgroups,cn=accounts,' + BASE)},
+}
+OFFICE = '{11111111-1111-1111-1111-111111111111}'
+BASELINE = '{22222222-2222-2222-2222-222222222222}'
+
+
+class Entry(dict):
+    """Entry with case-insensitive attribute names, as in ldap2."""
+
+    def __init__(self, dn, **attrs):
+        super().__init__((key.lower(), value) for key, value in attrs.items())
+        self.dn = DN(dn)
+
+    def __getitem__(self, key):
+        return super().__getitem__(key.lower())
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key.lower(), value)
+
+    def __contains__(self, key):
+        return super().__contains__(key.lower())
+
+    def get(self, key, default=None):
+        return super().get(key.lower(), default)
+
+
+class Directory:
+    """Policies, chains and the master of one server."""
+
+    def __init__(self):
+        self.entries = {}
+        self.generation = 0
+        self.refreshed = []
+        self.sysvol = []
+        # Number of adds after which add_entry fails
+        self.fail_after = None
+        self.master = Entry(MASTER, chainList=[], chainListOrder=[])
+
+    # ldap2
+    def make_entry(self, dn, attrs):
+        return Entry(dn, **{key: value if isinstance(value, list)
+                            else [value] for key, value in attrs.items()})
+
+    def add_entry(self, entry):
+        if self.fail_after is not None and \
+                len(self.entries) >= self.fail_after:
+            raise errors.DatabaseError(desc='server is unwilling',
+                                       info='')
+        if entry.dn in self.entries:
+            raise errors.DuplicateEntry()
+        self.entries[entry.dn] = entry
+
+    def get_entry(self, dn, attrs_list=None):
+        if DN(dn) != DN(MASTER):
+            raise errors.NotFound(reason='{} not found'.format(dn))
+        return self.master
+
+    def entries_of(self, object_class):
+        return [entry for entry in self.entries.values()
+                if object_class in entry['objectclass']]
+
+    # grouppolicy, chain and gpmaster objects
+    def add_policy(self, guid, name, **attrs):
+        self.add_entry(self.make_entry(
+            'cn={},{},{}'.format(guid, POLICIES, BASE),
+            dict(attrs, objectclass=['top', 'groupPolicyContainer'],
+                 cn=guid, displayName=name)))
+
+    def add_chain(self, name, gplink=(), **attrs):
+        links = [DN('cn={},{},{}'.format(guid, POLICIES, BASE))
+                 for guid in gplink]
+        self.add_entry(self.make_entry(
+            self.chain_dn(name),
+            dict(attrs, objectclass=['top', 'groupPolicyChain'], cn=name,
+                 gpLink=links, gpLinkOrder=self.order(links))))
+
+    def chain_dn(self, name):
+        return DN('cn={},{}'.format(name, CHAINS))
+
+    @staticmethod
+    def order(dns):
+        return RankedList([]).replace([DN(dn) for dn in dns])[0]
+
+    def add_chains(self, ldap, chain_dns):
+        chain_list = list(RankedList(self.master['chainList'],
+                                     self.master['chainListOrder'], key=DN))
+        chain_list.extend(chain_dns)
+        self.master['chainList'] = chain_list
+        self.master['chainListOrder'] = self.order(chain_list)
+
+    def resolve_names_bulk(self, ldap, usergroups=(), computergroups=()):
+        return {attr: {name.lower(): GROUPS[attr][name] for name in names
+                       if name in GROUPS[attr]}
+                for attr, names in (('usergroup', usergroups),
+                                    ('computergroup', computergroups))}
+
+
+def make_command(cls, directory):
+    api = SimpleNamespace(
+        env=SimpleNamespace(basedn=BASE, domain='example.test',
+                            container_grouppolicy=DN(POLICIES)),
+        Backend=SimpleNamespace(ldap2=directory),
+        Object=SimpleNamespace(
+            grouppolicy=SimpleNamespace(
+                get_all_entries=lambda ldap, attrs_list=None:
+                    directory.entries_of('groupPolicyContainer'),
+                create_gpo_structure=directory.sysvol.append),
+            chain=SimpleNamespace(
+                get_all_entries=lambda ldap, attrs_list=None:
+                    directory.entries_of('groupPolicyChain'),
+                get_dn=directory.chain_dn,
+                resolve_names_bulk=directory.resolve_names_bulk,
+                initial_gp_link_order=directory.order,
+                add_chains_to_gpmaster=directory.add_chains),
+            gpmaster=SimpleNamespace(bump_generation=lambda ldap: setattr(
+                directory, 'generation', directory.generation + 1))))
+    command = SimpleNamespace(api=api)
+    if cls is gpconfig_import:
+        command._update_chain_list = \
+            lambda ldap, chain_dns: gpconfig_import._update_chain_list(
+                command, ldap, chain_dns)
+    return command
+
+
+@pytest.fixture
+def source(monkeypatch):
+    def refresh_targets(api, ldap, chain_dns):
+        api.Backend.ldap2.refreshed.extend(chain_dns)
+    monkeypatch.setattr(gpconfig, 'refresh_targets', refresh_targets)
+    monkeypatch.setattr(gpconfig, 'get_gpmaster_dn', lambda env: DN(MASTER))
+
+    source = Directory()
+    source.add_policy(OFFICE, 'office', flags=[0], versionNumber=[65538],
+                      gPCMachineExtensionNames=['[{35378EAC}{D02B1F72}]'])
+    source.add_policy(BASELINE, 'baseline', flags=[1], versionNumber=[0])
+    source.add_chain('office', gplink=[BASELINE, OFFICE],
+                     displayName=['Office'],
+                     userGroup=[GROUPS['usergroup']['admins']])
+    source.add_chain('servers', gplink=[BASELINE],
+                     computerGroup=[GROUPS['computergroup']['servers']])
+    source.add_chains(source, [source.chain_dn('servers'),
+                               source.chain_dn('office')])
+    return source
+
+
+def export(directory):
+    records = gpconfig_export.execute(
+        make_command(gpconfig_export, directory))['result']
+    return '\n'.join(json.dumps(record, sort_keys=True)
+                     for record in records) + '\n'
+
+
+def run_import(directory, data, **options):
+    return gpconfig_import.execute(
+        make_command(gpconfig_import, directory), data, **options)
+
+
+def test_round_trip(source):
+    data = export(source)
+    target = Directory()
+    result = run_import(target, data)['result']
+
+    assert result == {'grouppolicy': ['office', 'baseline'],
+                      'chain': ['office', 'servers'], 'sysvol_failed': []}
+    assert export(target) == data
+    assert target.sysvol == [OFFICE, BASELINE]
+    assert target.generation == 1
+    # Chains appended to the master have their groups refreshed
+    assert target.refreshed == [target.chain_dn('servers'),
+                                target.chain_dn('office')]
+
+    # A second import finds everything in place
+    result = run_import(target, data, no_sysvol=True)['result']
+    assert result == {'grouppolicy': [], 'chain': [], 'sysvol_failed': []}
+    assert export(target) == data
+    assert target.generation == 1
+
+
+def test_records_are_checked_before_writing(source):
+    header, *lines = export(source).splitlines()
+    bad = [
+        {'type': 'grouppolicy', 'cn': OFFICE},
+        {'type': 'grouppolicy', 'displayname': 'x', 'cn': '../../etc'},
+        {'type': 'grouppolicy', 'displayname': 'x', 'flags': '0'},
+        {'type': 'chain', 'cn': ''},
+        {'type': 'chain', 'cn': 'x', 'gplink': 'office'},
+        {'type': 'gpmaster', 'chainlist': [None]},
+        ['not', 'a', 'record'],
+    ]
+    for record in bad:
+        target = Directory()
+        data = '\n'.join([header] + lines + [json.dumps(record)])
+        with pytest.raises(errors.ValidationError):
+            run_import(target, data)
+        assert target.entries == {}
+
+
+def test_repeated_records_are_imported_once(source):
+    header, *lines = export(source).splitlines()
+    repeated = [
+        {'type': 'chain', 'cn': 'Office', 'gplink': ['baseline']},
+        {'type': 'chain', 'cn': 'lab',
+         'gplink': ['office', 'Office', 'baseline']},
+        {'type': 'grouppolicy', 'displayname': 'OFFICE'},
+    ]
+    data = '\n'.join([header] + lines +
+                     [json.dumps(record) for record in repeated])
+    target = Directory()
+    result = run_import(target, data, no_sysvol=True)['result']
+
+    assert result['chain'] == ['office', 'servers', 'lab']
+    assert result['grouppolicy'] == ['office', 'baseline']
+    lab = target.entries[target.chain_dn('lab')]
+    assert len(lab['gpLink']) == len(lab['gpLinkOrder']) == 2
+
+
+def test_failure_reports_created_entries(source):
+    data = export(source)
+    target = Directory()
+    target.fail_after = 3
+    with pytest.raises(errors.ExecutionError) as e:
+        run_import(target, data)
+    message = str(e.value)
+    assert 'office, baseline' in message
+    assert 'Chains: office' in message
+    # Names of the entries created are visible to the name caches
+    assert target.generation == 1
+
+    # Nothing was created: the original error is raised
+    target = Directory()
+    target.fail_after = 0
+    with pytest.raises(errors.DatabaseError):
+        run_import(target, data)
+    assert target.generation == 0
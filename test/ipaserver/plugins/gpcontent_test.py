@@ -0,0 +1,101 @@
+import os
+
+from ipaserver.plugins.gpcontent import PolicyContentCache
+
+GUID = '{11111111-1111-1111-1111-111111111111}'
+PART = 'Machine/Registry.pol'
+
+
+class Codec:
+    @staticmethod
+    def size(value):
+        return len(value)
+
+    @staticmethod
+    def dump(value):
+        return value
+
+    @staticmethod
+    def load(obj):
+        return obj
+
+
+class Parser:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, path):
+        self.calls += 1
+        with open(path) as f:
+            return f.read()
+
+
+def make_file(tmp_path, content='abc', name='Registry.pol'):
+    path = tmp_path / name
+    path.write_text(content)
+    return str(path)
+
+
+def test_hit_and_version_miss(tmp_path):
+    path = make_file(tmp_path)
+    cache = PolicyContentCache(directory=None)
+    parse = Parser()
+
+    assert cache.get(GUID, PART, 1, path, parse, Codec) == 'abc'
+    assert cache.get(GUID.upper(), PART, 1, path, parse, Codec) == 'abc'
+    assert parse.calls == 1
+
+    assert cache.get(GUID, PART, 2, path, parse, Codec) == 'abc'
+    assert parse.calls == 2
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 1)
+
+
+def test_mtime_change_misses(tmp_path):
+    path = make_file(tmp_path)
+    cache = PolicyContentCache(directory=None)
+    parse = Parser()
+
+    cache.get(GUID, PART, 1, path, parse, Codec)
+    make_file(tmp_path, 'changed')
+    os.utime(path, ns=(0, 10 ** 9))
+    assert cache.get(GUID, PART, 1, path, parse, Codec) == 'changed'
+    assert parse.calls == 2
+
+
+def test_byte_budget_evicts_least_recently_used(tmp_path):
+    path = make_file(tmp_path, 'x' * 40)
+    cache = PolicyContentCache(budget=100, directory=None)
+    parse = Parser()
+
+    for part in ('a', 'b', 'c'):
+        cache.get(GUID, part, 1, path, parse, Codec)
+        cache.get(GUID, 'a', 1, path, parse, Codec)
+
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['bytes'] == 80
+    cache.get(GUID, 'b', 1, path, parse, Codec)
+    assert parse.calls == 4
+
+
+def test_disk_tier(tmp_path):
+    directory = tmp_path / 'cache'
+    directory.mkdir()
+    path = make_file(tmp_path)
+    parse = Parser()
+
+    PolicyContentCache(directory=str(directory)).get(
+        GUID, PART, 1, path, parse, Codec)
+    cache = PolicyContentCache(directory=str(directory))
+    assert cache.get(GUID, PART, 1, path, parse, Codec) == 'abc'
+    assert parse.calls == 1
+    assert cache.stats()['disk_hits'] == 1
+
+    cache.get(GUID, PART, 2, path, parse, Codec)
+    assert parse.calls == 2
+    assert len(os.listdir(str(directory))) == 1
+
+    cache.invalidate(GUID)
+    assert os.listdir(str(directory)) == []
+    assert cache.stats()['entries'] == 0
@@ -0,0 +1,178 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from ipaserver.plugins.gpnames import REBUILD_RETRY, SharedNameCache
+from ipaserver.plugins.gpsnapshot import GROUP_HOST, GROUP_USER, SnapshotWriter
+
+BASE = 'dc=example,dc=test'
+POLICY_DN = 'cn={31B2F340-016D-11D2-945F-00C04FB984F9},cn=Policies,cn=System,' + BASE
+GROUP_DN = 'cn=admins,cn=groups,cn=accounts,' + BASE
+HOSTGROUP_DN = 'cn=servers,cn=hostgroups,cn=accounts,' + BASE
+
+
+def make_writer(generation, name='Default Domain Policy'):
+    writer = SnapshotWriter(generation)
+    writer.add_policy(POLICY_DN, '{31B2F340-016D-11D2-945F-00C04FB984F9}',
+                      name)
+    writer.add_group(GROUP_DN, 'admins', GROUP_USER)
+    writer.add_group(HOSTGROUP_DN, 'servers', GROUP_HOST)
+    return writer
+
+
+class Builder:
+    """Records builds in a file so they are counted across processes."""
+
+    def __init__(self, directory, generation, name='Default Domain Policy',
+                 delay=0):
+        self.log = os.path.join(str(directory), 'builds.log')
+        self.generation = generation
+        self.name = name
+        self.delay = delay
+
+    def __call__(self):
+        with open(self.log, 'a') as f:
+            f.write('{}\n'.format(os.getpid()))
+        time.sleep(self.delay)
+        return make_writer(self.generation, self.name)
+
+    @property
+    def count(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as f:
+            return len(f.readlines())
+
+
+class Requests:
+    """Counts the rebuilds a cache asks for."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+
+
+def _worker(directory, generation, barrier, results):
+    cache = SharedNameCache(str(directory))
+    barrier.wait()
+    results.put(cache.rebuild(generation,
+                              Builder(directory, generation, delay=0.3)))
+
+
+def test_group_records(tmp_path):
+    path = str(tmp_path / 'names.snap')
+    make_writer(3).write(path)
+    cache = SharedNameCache(str(tmp_path))
+    snapshot = cache.get(3, None)
+
+    assert snapshot.group(snapshot.find_group(name='ADMINS')).dn == GROUP_DN
+    assert snapshot.find_group(name='admins', kind=GROUP_HOST) is None
+    assert cache.group_name(snapshot, HOSTGROUP_DN.upper()) == 'servers'
+    assert cache.group_name(snapshot, 'cn=other,' + BASE) is None
+    assert cache.policy_dn(snapshot, 'Other Policy') is None
+    assert cache.stats()['misses'] == 2
+
+
+def test_single_writer_across_processes(tmp_path):
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(6)
+    results = context.Queue()
+    workers = [context.Process(target=_worker,
+                               args=(tmp_path, 7, barrier, results))
+               for _ in range(6)]
+    for worker in workers:
+        worker.start()
+    sizes = [results.get(timeout=30) for _ in workers]
+    for worker in workers:
+        worker.join(timeout=30)
+
+    # The processes which lost the lock, or found the file current, left it
+    assert Builder(tmp_path, 7).count == 1
+    assert len([size for size in sizes if size is not None]) == 1
+
+    # Every later process maps the file without asking for a rebuild
+    cache = SharedNameCache(str(tmp_path))
+    requests = Requests()
+    snapshot = cache.get(7, requests)
+    assert cache.policy_dn(snapshot, 'Default Domain Policy') == POLICY_DN
+    assert requests.count == 0
+    assert cache.rebuild(7, Builder(tmp_path, 7)) is None
+    assert Builder(tmp_path, 7).count == 1
+
+
+def _rebuild(directory, generation, name):
+    SharedNameCache(str(directory)).rebuild(
+        generation, Builder(directory, generation, name=name))
+
+
+def test_reader_follows_generation(tmp_path):
+    reader = SharedNameCache(str(tmp_path))
+    reader.rebuild(1, Builder(tmp_path, 1))
+    old = reader.get(1, None)
+    assert reader.policy_dn(old, 'Default Domain Policy') == POLICY_DN
+
+    # The helper renames the policy and rebuilds the file
+    context = multiprocessing.get_context('fork')
+    process = context.Process(target=_rebuild,
+                              args=(tmp_path, 2, 'Renamed'))
+    process.start()
+    process.join(timeout=30)
+
+    requests = Requests()
+    new = reader.get(2, requests)
+    assert requests.count == 0
+    assert reader.policy_dn(new, 'Renamed') == POLICY_DN
+    assert reader.policy_dn(new, 'Default Domain Policy') is None
+    # The old mapping stays readable for threads still using it
+    assert reader.policy_name(old, POLICY_DN) == 'Default Domain Policy'
+
+
+def test_aged_snapshot_is_rebuilt(tmp_path):
+    cache = SharedNameCache(str(tmp_path), max_age=60)
+    requests = Requests()
+    now = time.time()
+    assert cache.get(4, requests, now=now) is None
+    assert requests.count == 1
+    cache.rebuild(4, Builder(tmp_path, 4), now=now)
+    assert cache.get(4, requests, now=now + 30) is not None
+    assert requests.count == 1
+
+    # The aged snapshot is served while it is rebuilt
+    assert cache.get(4, requests, now=now + 120) is not None
+    assert requests.count == 2
+    assert cache.rebuild(4, Builder(tmp_path, 4), now=now + 120) is not None
+    assert cache.stats()['rebuilds'] == 2
+
+
+def test_rebuild_is_asked_for_once(tmp_path):
+    cache = SharedNameCache(str(tmp_path))
+    cache.rebuild(1, Builder(tmp_path, 1))
+    old = cache.get(1, None)
+
+    requests = Requests()
+    now = time.time()
+    assert cache.get(2, requests, now=now) is None
+    # Display may use the previous snapshot until the new one is written
+    assert cache.get(2, requests, now=now + 1, stale=True) is old
+    assert requests.count == 1
+    # A rebuild which did not happen is asked for again
+    assert cache.get(2, requests, now=now + REBUILD_RETRY) is None
+    assert requests.count == 2
+    assert cache.stats()['requests'] == 2
+
+
+def test_lock_is_not_followed(tmp_path):
+    target = tmp_path / 'target'
+    target.write_text('')
+    directory = tmp_path / 'names'
+    directory.mkdir()
+    os.symlink(str(target), str(directory / '.lock'))
+    cache = SharedNameCache(str(directory))
+
+    with pytest.raises(OSError):
+        cache.rebuild(1, Builder(tmp_path, 1))
+    assert Builder(tmp_path, 1).count == 0
@@ -0,0 +1,181 @@
+import random
+from contextlib import contextmanager
+
+import ldap as _ldap
+import pytest
+
+from ipalib import errors
+from ipaserver.plugins import gporder
+from ipaserver.plugins.gporder import (
+    DIGITS,
+    RankedList,
+    edit_backoff,
+    entry_usn,
+    modify_values,
+    net_changes,
+    order_changes,
+    rank_after,
+    rank_between,
+)
+
+DN = 'cn=chain1,cn=chains,dc=example,dc=test'
+
+
+class Conn:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+
+    def modify_ext_s(self, dn, modlist, serverctrls=None):
+        self.calls.append((dn, modlist, serverctrls))
+        if self.error is not None:
+            raise self.error
+
+
+class LDAP:
+    def __init__(self, error=None):
+        self.conn = Conn(error)
+
+    @staticmethod
+    def encode(value):
+        return str(value).encode('utf-8')
+
+    @contextmanager
+    def error_handler(self):
+        yield
+
+
+def test_modify_asserts_entry_usn():
+    ldap = LDAP()
+    modify_values(ldap, DN, [('add', 'gpLink', ['cn=a']),
+                             ('delete', 'gpLinkOrder', [])], usn=42)
+
+    (dn, modlist, controls), = ldap.conn.calls
+    assert dn == DN
+    assert modlist == [(_ldap.MOD_ADD, 'gpLink', [b'cn=a'])]
+    assert controls[0].criticality
+    assert controls[0].filterstr == '(entryUSN=42)'
+
+    # No change, no modify; no USN, no control
+    modify_values(ldap, DN, [('add', 'gpLink', [])], usn=42)
+    modify_values(ldap, DN, [('replace', 'gpLinkOrder', [])])
+    assert len(ldap.conn.calls) == 2
+    assert ldap.conn.calls[1][2] is None
+
+
+def test_changed_entry_is_a_collision():
+    with pytest.raises(errors.MidairCollision):
+        modify_values(LDAP(_ldap.ASSERTION_FAILED()), DN,
+                      [('add', 'gpLink', ['cn=a'])], usn=42)
+    with pytest.raises(errors.DuplicateEntry):
+        modify_values(LDAP(_ldap.TYPE_OR_VALUE_EXISTS()), DN,
+                      [('add', 'gpLink', ['cn=a'])], usn=42)
+
+
+def test_backoff_is_bounded(monkeypatch):
+    delays = []
+    monkeypatch.setattr(gporder.time, 'sleep', delays.append)
+    for attempt in range(1, 10):
+        edit_backoff(attempt)
+    assert all(0 <= delay <= gporder.EDIT_BACKOFF_MAX for delay in delays)
+    assert delays[0] <= gporder.EDIT_BACKOFF * 2
+
+    assert entry_usn({'entryUSN': ['17']}) == 17
+    assert entry_usn({}) is None
+
+
+def apply(order_values, changes):
+    """Apply planned companion value edits as the directory would."""
+    added, deleted = changes
+    assert not set(deleted) - set(order_values)
+    return [v for v in order_values if v not in deleted] + added
+
+
+def test_rank_between():
+    rng = random.Random(4)
+
+    def random_rank():
+        # Ranks never end with the lowest digit
+        return ''.join(rng.choice(DIGITS) for _ in range(
+            rng.randint(0, 4))) + rng.choice(DIGITS[1:])
+
+    for _ in range(500):
+        lower, upper = sorted((random_rank(), random_rank()))
+        if lower == upper:
+            continue
+        rank = rank_between(lower, upper)
+        assert lower < rank < upper
+        assert not rank.endswith(DIGITS[0])
+    assert rank_between(None, '1') < '1'
+    assert rank_between('zz', None) > 'zz'
+
+    # Inserting again and again at the same place grows ranks slowly
+    lower, upper = rank_after(None), rank_after(rank_after(None))
+    for _ in range(100):
+        upper = rank_between(lower, upper)
+        assert lower < upper
+    assert len(upper) < 30
+
+
+def test_ranked_list_reads_order():
+    values = ['a', 'b', 'c', 'd']
+    ranked = RankedList(values, ['2:a', '1:c', '3:gone', '4:a'])
+    # Ranked values first, then the others in directory order
+    assert list(ranked) == ['c', 'a', 'b', 'd']
+    assert ranked.stale == ['3:gone', '4:a']
+
+    added, deleted = ranked.migrate()
+    assert deleted == ['3:gone', '4:a']
+    order = apply(['2:a', '1:c', '3:gone', '4:a'], (added, deleted))
+    assert list(RankedList(values, order)) == ['c', 'a', 'b', 'd']
+
+
+def test_ranked_list_edits():
+    values = ['a', 'b', 'c']
+    ranked = RankedList(values)
+    order = apply([], ranked.migrate())
+
+    rng = random.Random(7)
+    for step in range(200):
+        ranked = RankedList(values, order)
+        if step % 10 == 0:
+            value = 'v{}'.format(step)
+            changes = ranked.append([value])
+            values.append(value)
+        elif step % 10 == 5 and len(values) > 3:
+            value = rng.choice(values)
+            changes = ranked.remove([value])
+            values.remove(value)
+        else:
+            changes = ranked.move(rng.choice(values), rng.randint(-3, 3))
+        expected = list(ranked)
+        if ranked.rebalanced:
+            (_op, _attr, order), = order_changes('gpLinkOrder', ranked,
+                                                 *changes)
+        else:
+            # Only the moved value changes
+            assert len(changes[0]) <= 1 and len(changes[1]) <= 1
+            order = apply(order, changes)
+        assert list(RankedList(values, order)) == expected
+
+    assert sorted(ranked) == sorted(values)
+
+
+def test_move_rebalances_long_ranks():
+    values = ['a', 'b', 'c']
+    ranked = RankedList(values)
+    order = apply([], ranked.migrate())
+    for _ in range(200):
+        ranked = RankedList(values, order)
+        # Swap the last two values, always between the same neighbours
+        changes = ranked.move(list(ranked)[-1], -1)
+        if ranked.rebalanced:
+            break
+        order = apply(order, changes)
+    else:
+        pytest.fail('ranks never rebalanced')
+    changes = order_changes('gpLinkOrder', ranked, *changes)
+    assert changes == [('replace', 'gpLinkOrder', ranked.order_values())]
+    assert max(len(v.partition(':')[0]) for v in ranked.order_values()) == 1
+
+    assert net_changes(['1:a', '2:b'], ['2:b', '3:c']) == (['1:a'], ['3:c'])
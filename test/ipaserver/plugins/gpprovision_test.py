@@ -0,0 +1,245 @@
+import errno
+import json
+import os
+
+import pytest
+
+from ipaserver.plugins import gpprovision
+from ipaserver.plugins.gpprovision import (
+    COPY_RANGE,
+    COPY_STREAM,
+    MAX_ATTEMPTS,
+    STATE_FAILED,
+    STATE_MISSING,
+    STATE_PENDING,
+    STATE_PROVISIONED,
+    STATE_RETRYING,
+    ProvisioningQueue,
+    copy_file,
+    copy_policy_tree,
+    policy_path,
+    set_gpt_version,
+)
+
+GUID = '{11111111-1111-1111-1111-111111111111}'
+COPY = '{22222222-2222-2222-2222-222222222222}'
+OTHER = '{33333333-3333-3333-3333-333333333333}'
+DOMAIN = 'example.test'
+
+
+def make_queue(tmp_path):
+    directory = tmp_path / 'queue'
+    directory.mkdir()
+    return ProvisioningQueue(str(directory), str(tmp_path / 'sysvol'))
+
+
+def test_drain_creates_structure(tmp_path):
+    queue = make_queue(tmp_path)
+    assert queue.state(GUID, DOMAIN)[0] == STATE_MISSING
+
+    queue.enqueue(GUID.lower(), DOMAIN)
+    assert queue.state(GUID, DOMAIN)[0] == STATE_PENDING
+
+    assert queue.drain()['provisioned'] == 1
+    path = policy_path(queue.root, DOMAIN, GUID)
+    assert sorted(os.listdir(path)) == ['GPT.INI', 'Machine', 'User']
+    assert queue.state(GUID, DOMAIN) == (STATE_PROVISIONED, None)
+    assert list(queue.jobs()) == []
+
+
+def test_existing_gpt_ini_is_kept(tmp_path):
+    queue = make_queue(tmp_path)
+    path = policy_path(queue.root, DOMAIN, GUID)
+    os.makedirs(path)
+    with open(os.path.join(path, 'GPT.INI'), 'w') as f:
+        f.write('[General]\nVersion=7\n')
+
+    queue.enqueue(GUID, DOMAIN)
+    queue.drain()
+    with open(os.path.join(path, 'GPT.INI')) as f:
+        assert 'Version=7' in f.read()
+
+
+def test_set_gpt_version(tmp_path):
+    with open(str(tmp_path / 'GPT.INI'), 'w', newline='') as f:
+        f.write('[General]\r\ndisplayName=Test\r\nVersion=7\r\n')
+    set_gpt_version(str(tmp_path), 65544)
+    with open(str(tmp_path / 'GPT.INI'), newline='') as f:
+        assert f.read() == \
+            '[General]\r\ndisplayName=Test\r\nVersion=65544\r\n'
+
+    # A file without a Version line gets one under [General]
+    with open(str(tmp_path / 'GPT.INI'), 'w') as f:
+        f.write('[General]\ndisplayName=Test\n')
+    set_gpt_version(str(tmp_path), 2)
+    with open(str(tmp_path / 'GPT.INI')) as f:
+        assert f.read() == '[General]\nVersion=2\ndisplayName=Test\n'
+    assert os.listdir(str(tmp_path)) == ['GPT.INI']
+
+
+def test_failed_job_is_retried_with_backoff(tmp_path, monkeypatch):
+    queue = make_queue(tmp_path)
+    queue.enqueue(GUID, DOMAIN)
+
+    def fail(path):
+        raise PermissionError('denied')
+
+    monkeypatch.setattr(gpprovision, 'create_policy_structure', fail)
+    assert queue.drain(now=1000)['failed'] == 1
+    assert queue.state(GUID, DOMAIN) == (STATE_RETRYING, 'denied')
+
+    job = queue.load(GUID)
+    assert job['next_attempt'] == 1000 + gpprovision.RETRY_DELAY
+    assert queue.drain(now=1001)['deferred'] == 1
+
+    for attempt in range(2, MAX_ATTEMPTS + 1):
+        queue.drain(now=queue.load(GUID)['next_attempt'])
+    assert queue.load(GUID)['attempts'] == MAX_ATTEMPTS
+    assert queue.state(GUID, DOMAIN)[0] == STATE_FAILED
+
+    monkeypatch.undo()
+    queue.drain(now=queue.load(GUID)['next_attempt'])
+    assert queue.state(GUID, DOMAIN)[0] == STATE_PROVISIONED
+
+
+def test_discard(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.enqueue(GUID, DOMAIN)
+    queue.discard(GUID)
+    queue.discard(GUID)
+    assert queue.drain()['provisioned'] == 0
+
+
+def test_copy_job(tmp_path):
+    queue = make_queue(tmp_path)
+    source = policy_path(queue.root, DOMAIN, GUID)
+    os.makedirs(os.path.join(source, 'Machine', 'Scripts'))
+    with open(os.path.join(source, 'GPT.INI'), 'w') as f:
+        f.write('[General]\nVersion=7\n')
+    with open(os.path.join(source, 'Machine', 'Registry.pol'), 'wb') as f:
+        f.write(os.urandom(3 * gpprovision.COPY_CHUNK // 2))
+    os.chmod(os.path.join(source, 'Machine', 'Registry.pol'), 0o640)
+    # Leftovers of an interrupted GPT.INI write are not copied
+    open(os.path.join(source, '.GPT.INI-tmp'), 'w').close()
+    os.symlink('/etc/passwd', os.path.join(source, 'Machine', 'link'))
+
+    queue.enqueue(COPY.lower(), DOMAIN, source=GUID.lower())
+    assert queue.drain()['provisioned'] == 1
+    target = policy_path(queue.root, DOMAIN, COPY)
+    assert sorted(os.listdir(target)) == ['GPT.INI', 'Machine', 'User']
+    assert sorted(os.listdir(os.path.join(target, 'Machine'))) == \
+        ['Registry.pol', 'Scripts']
+    with open(os.path.join(target, 'GPT.INI')) as f:
+        assert f.read() == '[General]\nVersion=7\n'
+    contents = []
+    for path in (source, target):
+        with open(os.path.join(path, 'Machine', 'Registry.pol'), 'rb') as f:
+            contents.append(f.read())
+    assert contents[0] == contents[1]
+    assert os.stat(os.path.join(target, 'Machine', 'Registry.pol')).st_mode \
+        & 0o777 == 0o640
+    # No temporary directory is left in Policies/
+    assert sorted(os.listdir(os.path.dirname(target))) == [GUID, COPY]
+
+
+def test_copy_source_must_be_a_directory(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'Machine').mkdir(parents=True)
+    (source / 'GPT.INI').write_text('[General]\nVersion=1\n')
+    os.symlink(str(tmp_path / 'elsewhere'), str(source / 'Machine' / 'link'))
+    os.mkfifo(str(source / 'Machine' / 'fifo'))
+    os.symlink(str(source), str(tmp_path / 'link'))
+    (tmp_path / 'file').write_text('')
+
+    with pytest.raises(OSError) as e:
+        copy_policy_tree(str(tmp_path / 'link'), str(tmp_path / 'a'))
+    assert e.value.errno == errno.ELOOP
+    with pytest.raises(NotADirectoryError):
+        copy_policy_tree(str(tmp_path / 'file'), str(tmp_path / 'b'))
+    with pytest.raises(FileNotFoundError):
+        copy_policy_tree(str(tmp_path / 'missing'), str(tmp_path / 'c'))
+    assert not any(name in os.listdir(str(tmp_path)) for name in 'abc')
+
+    # Links and special files inside the tree are skipped
+    stats = copy_policy_tree(str(source), str(tmp_path / 'target'))
+    assert stats['bytes'] == len('[General]\nVersion=1\n')
+    assert os.listdir(str(tmp_path / 'target' / 'Machine')) == []
+
+
+def test_copy_file_falls_back_to_streaming(tmp_path, monkeypatch):
+    source = str(tmp_path / 'source')
+    with open(source, 'wb') as f:
+        f.write(os.urandom(gpprovision.COPY_CHUNK + 10))
+
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+    monkeypatch.setattr(gpprovision.fcntl, 'ioctl', unsupported)
+    if hasattr(os, 'copy_file_range'):
+        assert copy_file(source, str(tmp_path / 'range')) == COPY_RANGE
+        monkeypatch.setattr(os, 'copy_file_range', unsupported)
+    assert copy_file(source, str(tmp_path / 'stream')) == COPY_STREAM
+
+    with open(source, 'rb') as f:
+        data = f.read()
+    for name in os.listdir(str(tmp_path)):
+        with open(str(tmp_path / name), 'rb') as f:
+            assert f.read() == data
+
+
+def test_invalid_jobs_are_discarded(tmp_path):
+    queue = make_queue(tmp_path)
+    outside = tmp_path / 'outside'
+    forged = {
+        'A.json': {'guid': '../../../outside', 'domain': DOMAIN},
+        'B.json': {'guid': GUID, 'domain': str(outside)},
+        'C.json': {'guid': GUID, 'domain': '..'},
+        # The GUID must be the one the job file is named after
+        GUID.upper() + '.json': {'guid': COPY, 'domain': DOMAIN},
+        'D.json': {'domain': DOMAIN},
+        # The source of a copy names a directory under Policies too
+        OTHER + '.json': {'guid': OTHER, 'domain': DOMAIN,
+                          'source': '../../../outside'},
+        'E.json': ['not', 'a', 'job'],
+    }
+    for name, job in forged.items():
+        if isinstance(job, dict):
+            job = dict(job, attempts=0, next_attempt=0, error=None)
+        with open(str(tmp_path / 'queue' / name), 'w') as f:
+            json.dump(job, f)
+    with open(str(tmp_path / 'queue' / 'F.json'), 'w') as f:
+        f.write('{')
+    queue.enqueue(COPY, DOMAIN)
+
+    # Invalid jobs do not stop the valid one
+    assert queue.drain() == {'provisioned': 1, 'failed': 0, 'deferred': 0}
+    assert os.listdir(str(tmp_path / 'queue')) == ['.lock']
+    assert not outside.exists()
+    assert os.listdir(os.path.join(queue.root, DOMAIN, 'Policies')) == [COPY]
+
+
+def test_special_job_files_are_not_read(tmp_path):
+    queue = make_queue(tmp_path)
+    directory = tmp_path / 'queue'
+    outside = tmp_path / 'outside.json'
+    with open(str(outside), 'w') as f:
+        json.dump({'guid': GUID, 'domain': DOMAIN, 'attempts': 0,
+                   'next_attempt': 0, 'error': None}, f)
+    os.symlink(str(outside), str(directory / (GUID + '.json')))
+    # A FIFO would block the reader, a large file exhaust its memory
+    os.mkfifo(str(directory / (OTHER + '.json')))
+    with open(str(directory / (COPY + '.json')), 'w') as f:
+        f.write(' ' * (gpprovision.MAX_JOB_SIZE + 1))
+
+    assert queue.load(GUID) is None
+    assert queue.drain() == {'provisioned': 0, 'failed': 0, 'deferred': 0}
+    assert os.listdir(str(directory)) == ['.lock']
+    assert outside.exists()
+
+
+def test_lock_is_not_followed(tmp_path):
+    queue = make_queue(tmp_path)
+    target = tmp_path / 'created-by-root'
+    os.symlink(str(target), str(tmp_path / 'queue' / '.lock'))
+    with pytest.raises(OSError):
+        queue.drain()
+    assert not target.exists()
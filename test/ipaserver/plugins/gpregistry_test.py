@@ -0,0 +1,149 @@
+import io
+import time
+import tracemalloc
+
+import pytest
+
+from ipaserver.plugins.gpregistry import (
+    REG_BINARY,
+    REG_DWORD,
+    REG_DWORD_BIG_ENDIAN,
+    REG_EXPAND_SZ,
+    REG_MULTI_SZ,
+    REG_QWORD,
+    REG_SZ,
+    RegistryPolError,
+    RegistryPolReader,
+    RegistryPolWriter,
+    RegistryRecord,
+    iter_records,
+    read_records,
+    write_file,
+)
+
+KEY = 'Software\\Policies\\Example'
+
+VALUES = [
+    (KEY, 'Text', REG_SZ, 'hello'),
+    (KEY, 'Path', REG_EXPAND_SZ, '%SystemRoot%\\example'),
+    (KEY, 'Number', REG_DWORD, 42),
+    (KEY, 'BigEndian', REG_DWORD_BIG_ENDIAN, 7),
+    (KEY, 'Wide', REG_QWORD, 2 ** 40),
+    (KEY, 'List', REG_MULTI_SZ, ['one', 'two']),
+    # an odd data size shifts every later record off 2-byte alignment
+    (KEY, 'Odd', REG_BINARY, b'\x01\x02\x03'),
+    (KEY + '\\Sub', '**del.Text', REG_SZ, ' '),
+]
+
+
+def make_image(values):
+    stream = io.BytesIO()
+    writer = RegistryPolWriter(stream)
+    for key, name, value_type, value in values:
+        writer.write_value(key, name, value_type, value)
+    return stream.getvalue()
+
+
+def test_round_trip():
+    records = list(iter_records(make_image(VALUES)))
+    assert [(r.key, r.name, r.type, r.value) for r in records] == VALUES
+
+
+def test_data_is_not_copied():
+    image = bytearray(make_image(VALUES))
+    record = next(iter_records(image))
+    assert isinstance(record.data, memoryview)
+    assert record.data.obj is image
+
+
+def test_empty_file():
+    assert list(iter_records(make_image([]))) == []
+
+
+@pytest.mark.parametrize('image', [
+    b'',
+    b'PReg',
+    b'XReg\x01\x00\x00\x00',
+    b'PReg\x02\x00\x00\x00',
+])
+def test_bad_header(image):
+    with pytest.raises(RegistryPolError):
+        list(iter_records(image))
+
+
+def test_truncated_record():
+    image = make_image(VALUES)
+    with pytest.raises(RegistryPolError):
+        list(iter_records(image[:-3]))
+
+
+def test_file_round_trip(tmp_path):
+    source = tmp_path / 'source.pol'
+    source.write_bytes(make_image(VALUES))
+    target = tmp_path / 'target.pol'
+
+    with RegistryPolReader(str(source)) as reader:
+        write_file(str(target), (r for r in reader if r.type != REG_BINARY))
+
+    records = read_records(str(target))
+    assert [r.name for r in records] == [
+        name for _key, name, value_type, _value in VALUES
+        if value_type != REG_BINARY
+    ]
+    assert all(isinstance(r.data, bytes) for r in records)
+
+
+def test_close_with_records_in_use(tmp_path):
+    path = tmp_path / 'Registry.pol'
+    path.write_bytes(make_image(VALUES))
+
+    reader = RegistryPolReader(str(path))
+    record = next(iter(reader))
+    with pytest.raises(RegistryPolError):
+        reader.close()
+    del record
+    reader.close()
+
+
+def test_record_value():
+    record = RegistryRecord(KEY, 'Number', REG_DWORD, b'\x2a\x00\x00\x00')
+    assert record.value == 42
+    with pytest.raises(RegistryPolError):
+        RegistryRecord(KEY, 'Number', REG_DWORD, b'\x2a').value
+
+
+def test_benchmark_large_file(tmp_path):
+    """Parse a synthetic 20 MB file in bounded memory."""
+    count = 100000
+    path = tmp_path / 'Registry.pol'
+    with open(str(path), 'wb') as f:
+        writer = RegistryPolWriter(f)
+        for i in range(count):
+            writer.write_value('{}\\Key{}'.format(KEY, i % 1000),
+                               'Value{}'.format(i), REG_SZ, 'x' * 50)
+    size = path.stat().st_size
+    assert size > 20 * 10 ** 6
+
+    def parse():
+        parsed = 0
+        with RegistryPolReader(str(path)) as reader:
+            for record in reader:
+                parsed += len(record.data)
+            del record
+        return parsed
+
+    start = time.perf_counter()
+    parsed = parse()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    parse()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('parsed {} records, {:.1f} MB in {:.2f} s ({:.0f} MB/s), '
+          'peak Python allocations {:.0f} KB'.format(
+              count, size / 10 ** 6, elapsed, size / 10 ** 6 / elapsed,
+              peak / 1024))
+    assert parsed == count * 102
+    assert peak < 1024 * 1024
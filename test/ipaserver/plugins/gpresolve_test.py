@@ -0,0 +1,211 @@
+import pytest
+
+from ipaserver.plugins.gpresolve import PolicyGraph, dn_key
+
+BASEDN = 'dc=example,dc=test'
+POLICIES = 'cn=policies,cn=system,' + BASEDN
+CHAINS = 'cn=system,' + BASEDN
+GROUPS = 'cn=groups,cn=accounts,' + BASEDN
+HOSTGROUPS = 'cn=hostgroups,cn=accounts,' + BASEDN
+
+
+def policy_dn(guid):
+    return 'cn={},{}'.format(guid, POLICIES)
+
+
+def chain_dn(name):
+    return 'cn={},{}'.format(name, CHAINS)
+
+
+def policy(guid, name):
+    return {
+        'objectClass': [b'top', b'groupPolicyContainer'],
+        'cn': [guid.encode()],
+        'displayName': [name.encode()],
+        'versionNumber': [b'3'],
+    }
+
+
+def chain(name, usergroup=None, computergroup=None, links=()):
+    attrs = {
+        'objectClass': [b'top', b'groupPolicyChain'],
+        'cn': [name.encode()],
+        'gpLink': [policy_dn(guid).encode() for guid in links],
+        'gpLinkOrder': [
+            '{}:{}'.format(rank, policy_dn(guid)).encode()
+            for rank, guid in zip('abcdefgh', links)
+        ],
+    }
+    if usergroup:
+        attrs['userGroup'] = ['cn={},{}'.format(usergroup, GROUPS).encode()]
+    if computergroup:
+        attrs['computerGroup'] = [
+            'cn={},{}'.format(computergroup, HOSTGROUPS).encode()]
+    return attrs
+
+
+def master(*chains):
+    return {
+        'objectClass': [b'top', b'groupPolicyMaster'],
+        'chainList': [chain_dn(name).encode() for name in chains],
+        'chainListOrder': [
+            '{}:{}'.format(rank, chain_dn(name)).encode()
+            for rank, name in zip('abcdefgh', chains)
+        ],
+    }
+
+
+def user(uid, *groups):
+    return {
+        'objectClass': [b'top', b'person', b'posixAccount'],
+        'uid': [uid.encode()],
+        'memberOf': ['cn={},{}'.format(g, GROUPS).encode() for g in groups],
+    }
+
+
+def host(fqdn, *hostgroups):
+    return {
+        'objectClass': [b'top', b'ipaHost'],
+        'fqdn': [fqdn.encode()],
+        'memberOf': ['cn={},{}'.format(g, HOSTGROUPS).encode()
+                     for g in hostgroups],
+    }
+
+
+def names(policies):
+    return [p['name'] for p in policies]
+
+
+@pytest.fixture
+def graph():
+    graph = PolicyGraph()
+    for index in range(1, 5):
+        guid = '{{GUID-{}}}'.format(index)
+        graph.update(policy_dn(guid), policy(guid, 'policy-{}'.format(index)))
+    graph.update(chain_dn('dev-chain'), chain(
+        'dev-chain', 'developers', 'dev-workstations',
+        ['{GUID-1}', '{GUID-2}']))
+    graph.update(chain_dn('office-chain'), chain(
+        'office-chain', 'office-users', 'office-computers',
+        ['{GUID-3}', '{GUID-4}']))
+    graph.update('cn=grouppolicymaster,cn=etc,' + BASEDN,
+                 master('dev-chain', 'office-chain'))
+    graph.update('uid=john,cn=users,cn=accounts,' + BASEDN,
+                 user('john', 'developers', 'office-users'))
+    graph.update('fqdn=ws001.example.test,cn=computers,cn=accounts,' + BASEDN,
+                 host('ws001.example.test', 'dev-workstations',
+                      'office-computers'))
+    return graph
+
+
+class TestPolicyGraph:
+
+    def test_resolve_in_chain_and_link_order(self, graph):
+        result = graph.resolve('john', 'ws001.example.test')
+        assert names(result) == ['policy-1', 'policy-2', 'policy-3',
+                                 'policy-4']
+        assert result[0]['guid'] == '{GUID-1}'
+        assert result[0]['version'] == 3
+
+    def test_resolve_is_case_insensitive(self, graph):
+        assert len(graph.resolve('JOHN', 'WS001.Example.Test')) == 4
+
+    def test_chain_needs_both_groups(self, graph):
+        graph.update('uid=john,cn=users,cn=accounts,' + BASEDN,
+                     user('john', 'developers'))
+        assert names(graph.resolve('john', 'ws001.example.test')) == [
+            'policy-1', 'policy-2']
+        assert graph.resolve('nobody', 'ws001.example.test') == []
+        assert graph.resolve('john', 'unknown.example.test') == []
+
+    def test_chain_without_groups_applies_to_everyone(self, graph):
+        graph.update(chain_dn('all'), chain('all', links=['{GUID-4}']))
+        graph.update('cn=grouppolicymaster,cn=etc,' + BASEDN,
+                     master('all', 'dev-chain'))
+        assert names(graph.resolve('nobody', None)) == ['policy-4']
+
+    def test_master_order_change(self, graph):
+        graph.update('cn=grouppolicymaster,cn=etc,' + BASEDN,
+                     master('office-chain', 'dev-chain'))
+        assert names(graph.resolve('john', 'ws001.example.test')) == [
+            'policy-3', 'policy-4', 'policy-1', 'policy-2']
+
+    def test_policy_rename_and_delete(self, graph):
+        graph.update(policy_dn('{GUID-1}'), policy('{GUID-1}', 'renamed'))
+        assert graph.remove(policy_dn('{GUID-2}'))
+        assert names(graph.resolve('john', 'ws001.example.test')) == [
+            'renamed', 'policy-3', 'policy-4']
+
+    def test_chain_delete(self, graph):
+        assert graph.remove(chain_dn('dev-chain'))
+        assert names(graph.resolve('john', 'ws001.example.test')) == [
+            'policy-3', 'policy-4']
+
+    def test_user_rename(self, graph):
+        graph.rename('uid=john,cn=users,cn=accounts,' + BASEDN,
+                     'uid=jdoe,cn=users,cn=accounts,' + BASEDN,
+                     user('jdoe', 'developers', 'office-users'))
+        assert graph.resolve('john', 'ws001.example.test') == []
+        assert len(graph.resolve('jdoe', 'ws001.example.test')) == 4
+
+    def test_unknown_entries_are_ignored(self, graph):
+        generation = graph.generation
+        assert not graph.update('cn=other,' + BASEDN,
+                                {'objectClass': [b'nsContainer']})
+        assert not graph.remove('cn=other,' + BASEDN)
+        assert graph.generation == generation
+
+    def test_dn_key_normalizes(self):
+        assert dn_key('CN=Test, DC=Example,DC=TEST') == \
+            dn_key('cn=test,dc=example,dc=test')
+
+    def test_stats(self, graph):
+        stats = graph.stats()
+        assert stats['policies'] == 4
+        assert stats['chains'] == 2
+        assert stats['users'] == 1
+        assert stats['hosts'] == 1
+
+    def test_same_memberships_share_one_resolution(self, graph):
+        for index in range(100):
+            graph.update(
+                'uid=user{},cn=users,cn=accounts,{}'.format(index, BASEDN),
+                # groups no chain refers to do not split the memo
+                user('user{}'.format(index), 'developers',
+                     'team-{}'.format(index)))
+        for index in range(100):
+            assert names(graph.resolve('user{}'.format(index),
+                                       'ws001.example.test')) == [
+                'policy-1', 'policy-2']
+        assert graph.resolution_misses == 1
+        assert graph.resolution_hits == 99
+
+    def test_resolution_memo_invalidation(self, graph):
+        graph.resolve('john', 'ws001.example.test')
+        graph.update(policy_dn('{GUID-1}'), policy('{GUID-1}', 'renamed'))
+        assert names(graph.resolve('john', 'ws001.example.test'))[0] == \
+            'renamed'
+        graph.update(chain_dn('dev-chain'), chain(
+            'dev-chain', 'developers', 'dev-workstations', ['{GUID-2}']))
+        assert names(graph.resolve('john', 'ws001.example.test'))[0] == \
+            'policy-2'
+        # a membership change moves the user to another memo entry
+        graph.update('uid=john,cn=users,cn=accounts,' + BASEDN,
+                     user('john', 'office-users'))
+        assert names(graph.resolve('john', 'ws001.example.test')) == [
+            'policy-3', 'policy-4']
+        assert graph.resolution_hits == 0
+
+    def test_resolution_memo_is_bounded(self):
+        graph = PolicyGraph(cache_size=2)
+        graph.update(chain_dn('all'), chain('all', 'g1'))
+        graph.update('cn=grouppolicymaster,cn=etc,' + BASEDN, master('all'))
+        graph.update(chain_dn('other'), chain('other', 'g2'))
+        graph.update('cn=grouppolicymaster,cn=etc,' + BASEDN,
+                     master('all', 'other'))
+        for uid, groups in (('a', ()), ('b', ('g1',)), ('c', ('g2',))):
+            graph.update('uid={},{}'.format(uid, BASEDN), user(uid, *groups))
+            graph.resolve(uid, None)
+        assert graph.stats()['resolutions'] == 2
+        graph.resolve('a', None)
+        assert graph.resolution_misses == 4
@@ -0,0 +1,158 @@
+import os
+
+from ipaserver.plugins.gpcontent import PolicyContentCache
+from ipaserver.plugins.gpregistry import (
+    REG_DWORD,
+    REG_SZ,
+    RegistryPolWriter,
+)
+from ipaserver.plugins.gprsop import (
+    Contribution,
+    RSoPEngine,
+    ResultantSet,
+    bump_version,
+    side_version,
+)
+
+KEY = 'Software\\Policies\\Example'
+GUID1 = '{11111111-1111-1111-1111-111111111111}'
+GUID2 = '{22222222-2222-2222-2222-222222222222}'
+GUID3 = '{33333333-3333-3333-3333-333333333333}'
+
+
+class Record:
+    def __init__(self, key, name, value_type, data):
+        self.key, self.name, self.type, self.data = key, name, value_type, data
+
+
+def dword(value):
+    return value.to_bytes(4, 'little')
+
+
+def contribution(guid, version, *records):
+    result = Contribution(guid, version)
+    for record in records:
+        result.add(Record(*record))
+    return result
+
+
+def merged(resultant):
+    return {(v.key, v.name): (int.from_bytes(v.data, 'little'), v.guid)
+            for v in resultant.values()}
+
+
+def test_last_wins_with_provenance():
+    resultant = ResultantSet()
+    resultant.update([
+        contribution(GUID1, 1, (KEY, 'A', REG_DWORD, dword(1)),
+                     (KEY, 'B', REG_DWORD, dword(1))),
+        contribution(GUID2, 1, (KEY, 'A', REG_DWORD, dword(2))),
+    ])
+    assert merged(resultant) == {
+        (KEY, 'A'): (2, GUID2),
+        (KEY, 'B'): (1, GUID1),
+    }
+
+
+def test_delete_soft_and_delvals():
+    resultant = ResultantSet()
+    resultant.update([
+        contribution(GUID1, 1, (KEY, 'A', REG_DWORD, dword(1)),
+                     (KEY, 'B', REG_DWORD, dword(1)),
+                     (KEY, 'C', REG_DWORD, dword(1))),
+        contribution(GUID2, 1, (KEY, '**del.A', REG_SZ, b' \x00'),
+                     (KEY, '**soft.B', REG_DWORD, dword(2)),
+                     (KEY, '**soft.D', REG_DWORD, dword(2))),
+    ])
+    assert merged(resultant) == {
+        (KEY, 'B'): (1, GUID1),
+        (KEY, 'C'): (1, GUID1),
+        (KEY, 'D'): (2, GUID2),
+    }
+
+    resultant.update([
+        contribution(GUID1, 1, (KEY, 'A', REG_DWORD, dword(1))),
+        contribution(GUID2, 2, (KEY, '**delvals.', REG_SZ, b' \x00')),
+    ])
+    assert merged(resultant) == {}
+
+
+def test_gpo_linked_twice_applies_at_last_position():
+    # Linked from two chains: the later link is the one which wins
+    first = contribution(GUID1, 1, (KEY, '**soft.A', REG_DWORD, dword(1)))
+    second = contribution(GUID2, 1, (KEY, '**soft.A', REG_DWORD, dword(2)),
+                          (KEY, 'B', REG_DWORD, dword(2)))
+    resultant = ResultantSet()
+    resultant.update([second, first, second])
+
+    assert resultant.order == [GUID1, GUID2]
+    assert merged(resultant) == {
+        (KEY, 'A'): (1, GUID1),
+        (KEY, 'B'): (2, GUID2),
+    }
+
+
+def test_only_changed_contribution_is_refolded():
+    first = contribution(GUID1, 1, (KEY, 'A', REG_DWORD, dword(1)),
+                         (KEY, 'B', REG_DWORD, dword(1)))
+    third = contribution(GUID3, 1, (KEY, 'C', REG_DWORD, dword(3)))
+    resultant = ResultantSet()
+    resultant.update([first,
+                      contribution(GUID2, 1, (KEY, 'A', REG_DWORD, dword(2))),
+                      third])
+
+    touched = resultant.update([
+        first,
+        contribution(GUID2, 2, (KEY, 'B', REG_DWORD, dword(2))),
+        third,
+    ])
+    assert touched == {(KEY.lower(), 'a'), (KEY.lower(), 'b')}
+    assert merged(resultant) == {
+        (KEY, 'A'): (1, GUID1),
+        (KEY, 'B'): (2, GUID2),
+        (KEY, 'C'): (3, GUID3),
+    }
+
+
+def test_side_version():
+    version = (3 << 16) | 5
+    assert side_version(version, 'Machine') == 5
+    assert side_version(version, 'User') == 3
+
+
+def test_bump_version():
+    version = (3 << 16) | 0xFFFF
+    assert bump_version(version, ('User',)) == (4 << 16) | 0xFFFF
+    # The machine part wraps to 1 and leaves the user part alone
+    assert bump_version(version, ('Machine',)) == (3 << 16) | 1
+    assert bump_version(None, ('Machine', 'User')) == (1 << 16) | 1
+
+
+def write_policy(root, guid, side, values):
+    directory = os.path.join(root, 'example.test', 'Policies', guid, side)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'Registry.pol'), 'wb') as f:
+        writer = RegistryPolWriter(f)
+        for name, value in values:
+            writer.write_value(KEY, name, REG_DWORD, value)
+
+
+def test_engine_reparses_only_changed_versions(tmp_path):
+    root = str(tmp_path)
+    write_policy(root, GUID1, 'Machine', [('A', 1)])
+    write_policy(root, GUID2, 'Machine', [('A', 2)])
+    content = PolicyContentCache(directory=None)
+    engine = RSoPEngine('example.test', root=root, content=content)
+
+    result = engine.resolve([(GUID1, 1), (GUID2, 1)])
+    assert [(v.name, v.guid) for v in result['Machine']] == [('A', GUID2)]
+    assert result['User'] == []
+    unchanged = engine.contribution(GUID1, 'Machine', 1)
+
+    write_policy(root, GUID2, 'Machine', [('B', 2)])
+    result = engine.resolve([(GUID1, 1), (GUID2, 2)])
+    assert [(v.name, v.guid) for v in result['Machine']] == [
+        ('A', GUID1), ('B', GUID2)]
+    assert engine.contribution(GUID1, 'Machine', 1) is unchanged
+    # both parts of both policies parsed once, the changed part twice
+    assert content.stats()['misses'] == 5
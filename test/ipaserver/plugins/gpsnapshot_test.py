@@ -0,0 +1,161 @@
+import struct
+
+import pytest
+
+from ipaserver.plugins import gpsnapshot
+from ipaserver.plugins.gpsnapshot import (
+    GROUP_HOST,
+    GROUP_USER,
+    HEADER,
+    SECTION,
+    Snapshot,
+    SnapshotError,
+    SnapshotWriter,
+)
+
+BASE = 'dc=example,dc=test'
+GUIDS = ['{{{:08d}-0000-0000-0000-000000000000}}'.format(number)
+         for number in range(3)]
+
+
+def policy_dn(guid):
+    return 'cn={},cn=Policies,cn=System,{}'.format(guid, BASE)
+
+
+def chain_dn(name):
+    return 'cn={},cn=System,{}'.format(name, BASE)
+
+
+def group_dn(name, container='groups'):
+    return 'cn={},cn={},cn=accounts,{}'.format(name, container, BASE)
+
+
+def make_writer():
+    writer = SnapshotWriter(generation=42)
+    for number, guid in enumerate(GUIDS):
+        writer.add_policy(policy_dn(guid), guid, 'Policy {}'.format(number),
+                          '\\\\example.test\\SysVol\\' + guid, number, 1)
+    writer.add_chain(chain_dn('office'), 'office', group_dn('staff'), None,
+                     [policy_dn(GUIDS[2]), policy_dn('{gone}'),
+                      policy_dn(GUIDS[0])])
+    writer.add_chain(chain_dn('empty'), 'empty')
+    writer.add_group(group_dn('staff'), 'staff', GROUP_USER)
+    writer.add_group(group_dn('staff', 'hostgroups'), 'staff', GROUP_HOST)
+    writer.set_chain_order([chain_dn('empty'), chain_dn('missing'),
+                            chain_dn('office')])
+    return writer
+
+
+def write(tmp_path, writer=None):
+    path = str(tmp_path / 'gp.snap')
+    (writer or make_writer()).write(path)
+    return path
+
+
+def test_round_trip(tmp_path):
+    with Snapshot(write(tmp_path)) as snapshot:
+        assert snapshot.generation == 42
+        assert snapshot.policy_count == 3
+        policy = snapshot.policy(1)
+        assert policy.dn == policy_dn(GUIDS[1])
+        assert policy.name == 'Policy 1'
+        assert (policy.version, policy.flags) == (1, 1)
+
+        office = snapshot.chain(snapshot.find_chain(name='office'))
+        assert office.usergroup == group_dn('staff')
+        assert office.computergroup is None
+        # Links to policies which do not exist are dropped
+        assert [snapshot.policy(index).guid for index in office.links] == \
+            [GUIDS[2], GUIDS[0]]
+        assert snapshot.chain(snapshot.find_chain(name='empty')).links == ()
+        assert [snapshot.chain(index).name
+                for index in snapshot.chain_order()] == ['empty', 'office']
+
+
+def test_lookups(tmp_path):
+    with Snapshot(write(tmp_path)) as snapshot:
+        assert snapshot.find_policy(dn=policy_dn(GUIDS[2]).upper()) == 2
+        assert snapshot.find_policy(guid=GUIDS[1].lower()) == 1
+        assert snapshot.find_policy(name='POLICY 0') == 0
+        assert snapshot.find_policy(name='Policy 9') is None
+        assert snapshot.find_chain(dn=chain_dn('office')) == 0
+        assert snapshot.find_chain(name='missing') is None
+
+        # Keys of different kinds with the same text do not clash
+        user = snapshot.find_group(name='staff', kind=GROUP_USER)
+        host = snapshot.find_group(name='staff', kind=GROUP_HOST)
+        assert snapshot.group(user).kind == GROUP_USER
+        assert snapshot.group(host).dn == group_dn('staff', 'hostgroups')
+        assert snapshot.find_policy(name='staff') is None
+
+
+def test_hash_collisions(tmp_path, monkeypatch):
+    # Every key hashes to the same slot and is found by probing
+    monkeypatch.setattr(gpsnapshot, '_key_hash', lambda kind, data: 7)
+    with Snapshot(write(tmp_path)) as snapshot:
+        for number, guid in enumerate(GUIDS):
+            assert snapshot.find_policy(guid=guid) == number
+            assert snapshot.find_policy(name='Policy {}'.format(number)) == \
+                number
+        assert snapshot.find_chain(name='empty') == 1
+        assert snapshot.find_policy(guid='{unknown}') is None
+
+
+def test_empty_snapshot(tmp_path):
+    with Snapshot(write(tmp_path, SnapshotWriter())) as snapshot:
+        assert snapshot.policy_count == snapshot.chain_count == 0
+        assert snapshot.find_policy(name='any') is None
+        assert snapshot.chain_order() == ()
+
+
+def corrupt(path, offset, data):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+
+@pytest.mark.parametrize('length', [0, 4, HEADER.size + 3, -1])
+def test_truncated_file(tmp_path, length):
+    path = write(tmp_path)
+    with open(path, 'r+b') as f:
+        f.truncate(length if length >= 0 else f.seek(0, 2) + length)
+    with pytest.raises(SnapshotError):
+        Snapshot(path)
+
+
+def test_corrupt_file(tmp_path):
+    path = write(tmp_path)
+    corrupt(path, 0, b'NOTASNAP')
+    with pytest.raises(SnapshotError):
+        Snapshot(path)
+
+    path = write(tmp_path)
+    corrupt(path, 8, struct.pack('<I', 99))
+    with pytest.raises(SnapshotError, match='version'):
+        Snapshot(path)
+
+    # An index without a free slot would make a lookup probe forever
+    path = write(tmp_path)
+    with Snapshot(path) as snapshot:
+        offset, length = snapshot._sections['index']
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        slots = bytearray(f.read(length))
+    for start in range(0, length, gpsnapshot.INDEX.size):
+        if slots[start + 8:start + 12] == b'\xff' * 4:
+            slots[start + 8:start + 12] = struct.pack('<I', 0)
+    corrupt(path, offset, bytes(slots))
+    with Snapshot(path) as snapshot:
+        with pytest.raises(SnapshotError):
+            snapshot.find_policy(name='Policy 9')
+
+    # A section length which is not a whole number of records
+    path = write(tmp_path)
+    position = gpsnapshot.SECTIONS.index('policies')
+    table = HEADER.size + position * SECTION.size
+    with open(path, 'rb') as f:
+        f.seek(table)
+        offset, length = SECTION.unpack(f.read(SECTION.size))
+    corrupt(path, table, SECTION.pack(offset, length - 1))
+    with pytest.raises(SnapshotError):
+        Snapshot(path)
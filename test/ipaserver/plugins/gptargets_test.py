@@ -0,0 +1,233 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import ldap as _ldap
+
+from ipalib import errors
+from ipapython.dn import DN
+from ipaserver.plugins import gptargets
+from ipaserver.plugins.gptargets import (
+    add_target_objectclass,
+    effective_chains,
+    listing_groups,
+    refresh_groups,
+    refresh_targets,
+    target_changes,
+)
+
+BASE = 'dc=example,dc=test'
+CHAINS = 'cn=System,' + BASE
+GROUP = 'cn=admins,cn=groups,cn=accounts,' + BASE
+OTHER_GROUP = 'cn=editors,cn=groups,cn=accounts,' + BASE
+HOSTGROUP = 'cn=servers,cn=hostgroups,cn=accounts,' + BASE
+
+
+def chain_dn(name):
+    return DN('cn={},{}'.format(name, CHAINS))
+
+
+class Entry(dict):
+    def __init__(self, dn, **attrs):
+        super().__init__(attrs)
+        self.dn = DN(dn)
+
+
+def make_chain(name, user_group=None, computer_group=None):
+    entry = Entry(chain_dn(name), cn=[name])
+    if user_group:
+        entry['userGroup'] = [user_group]
+    if computer_group:
+        entry['computerGroup'] = [computer_group]
+    return entry
+
+
+def test_effective_chains_follow_master_order():
+    chains = [make_chain('a', GROUP, HOSTGROUP), make_chain('b', GROUP),
+              make_chain('c', HOSTGROUP)]
+    # c is not in the master and applies to nobody
+    expected = effective_chains(chains, [chain_dn('b'), chain_dn('a')])
+
+    assert expected[GROUP.lower()] == [chain_dn('b'), chain_dn('a')]
+    assert expected[HOSTGROUP.lower()] == [chain_dn('a')]
+
+
+def test_target_changes():
+    group = Entry(GROUP, objectClass=['top', 'groupOfNames'])
+    assert target_changes(group, []) is None
+
+    changes = target_changes(group, [chain_dn('b'), chain_dn('a')])
+    assert changes[0] == ('add', 'objectClass', ['groupPolicyTarget'])
+    assert changes[1] == ('replace', 'gpEffectiveChain',
+                          [chain_dn('b'), chain_dn('a')])
+
+    # Written back, the list reads in the same order and is current
+    group['objectClass'].append('groupPolicyTarget')
+    group['gpEffectiveChain'] = list(reversed(changes[1][2]))
+    group['gpEffectiveChainOrder'] = changes[2][2]
+    assert target_changes(group, [chain_dn('b'), chain_dn('a')]) is None
+    assert len(target_changes(group, [chain_dn('a'), chain_dn('b')])) == 2
+
+    # A deleted chain leaves its rank behind, which is dropped
+    group['gpEffectiveChain'] = [chain_dn('b')]
+    (_op, attr, values), = target_changes(group, [chain_dn('b')])[1:]
+    assert attr == 'gpEffectiveChainOrder'
+    assert [value.partition(':')[2] for value in values] == \
+        [str(chain_dn('b'))]
+
+
+def test_new_groups_get_the_target_class():
+    entry_attrs = {'objectclass': ['top', 'groupOfNames', 'ipaUserGroup']}
+    add_target_objectclass(None, None, DN(GROUP), entry_attrs, [], 'admins')
+    assert entry_attrs['objectclass'][-1] == 'groupPolicyTarget'
+    add_target_objectclass(None, None, DN(GROUP), entry_attrs, [], 'admins')
+    assert entry_attrs['objectclass'].count('groupPolicyTarget') == 1
+
+    # Administrators may not add the class themselves
+    for name, permission in gptargets.group.managed_permissions.items():
+        if name.startswith('System: Modify'):
+            assert 'objectclass' not in permission['ipapermdefaultattr']
+
+
+class LDAP:
+    MATCH_ANY = '|'
+    SCOPE_ONELEVEL = 1
+
+    def __init__(self, chains, groups):
+        self.chains = chains
+        self.groups = {DN(entry.dn): entry for entry in groups}
+        self.conn = self
+        # Called between the read of a group and its write
+        self.concurrent = None
+
+    def make_filter_from_attr(self, attr, values, rules=None, exact=True,
+                              trailing_wildcard=True):
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        prefix = '' if exact else '*'
+        return '({}{})'.format(rules or '', ''.join(
+            '({}={}{})'.format(attr, prefix, value) for value in values))
+
+    def combine_filters(self, filters, rules):
+        return '({}{})'.format(rules, ''.join(filters))
+
+    def get_entry(self, dn, attrs_list):
+        entries = {DN(entry.dn): entry for entry in self.chains}
+        entries.update(self.groups)
+        if DN(dn) not in entries:
+            raise errors.NotFound(reason='{} not found'.format(dn))
+        entry = entries[DN(dn)]
+        return Entry(entry.dn, **{k: list(v) for k, v in entry.items()})
+
+    def get_entries(self, base, scope, search_filter, attrs_list,
+                    paged_search=False):
+        if DN(base) == DN(CHAINS):
+            return [entry for entry in self.chains
+                    if any('={})'.format(value) in search_filter
+                           for attr in ('userGroup', 'computerGroup')
+                           for value in entry.get(attr, []))]
+        # Groups of the container listing a chain, or keeping its rank
+        return [entry for entry in self.groups.values()
+                if str(entry.dn).lower().endswith(str(base).lower()) and (
+                    any('(gpEffectiveChain={})'.format(value) in search_filter
+                        for value in entry.get('gpEffectiveChain', [])) or
+                    any('(gpEffectiveChainOrder=*:{})'.format(
+                        value.partition(':')[2]) in search_filter
+                        for value in entry.get('gpEffectiveChainOrder', [])))]
+
+    @staticmethod
+    def encode(value):
+        return str(value).encode('utf-8')
+
+    @contextmanager
+    def error_handler(self):
+        yield
+
+    def modify_ext_s(self, dn, modlist, serverctrls=None):
+        if self.concurrent is not None:
+            concurrent, self.concurrent = self.concurrent, None
+            concurrent()
+        entry = self.groups[DN(dn)]
+        if serverctrls[0].filterstr != \
+                '(entryUSN={})'.format(entry['entryUSN'][0]):
+            raise _ldap.ASSERTION_FAILED()
+        for op, attr, values in modlist:
+            values = [value.decode('utf-8') for value in values]
+            if op == _ldap.MOD_ADD:
+                entry.setdefault(attr, []).extend(values)
+            else:
+                entry[attr] = values
+        entry['entryUSN'] = [entry['entryUSN'][0] + 1]
+
+
+class Objects(SimpleNamespace):
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+def make_api(master):
+    return SimpleNamespace(
+        env=SimpleNamespace(basedn=BASE),
+        Object=Objects(
+            chain=SimpleNamespace(container_dn='cn=System'),
+            group=SimpleNamespace(container_dn='cn=groups,cn=accounts'),
+            hostgroup=SimpleNamespace(
+                container_dn='cn=hostgroups,cn=accounts'),
+            gpmaster=SimpleNamespace(get_chain_list=lambda ldap: master)))
+
+
+def listed(group):
+    return [str(dn) for dn in group.get('gpEffectiveChain', [])]
+
+
+def test_refresh_rereads_chains_after_collision(monkeypatch):
+    monkeypatch.setattr(gptargets, 'edit_backoff', lambda attempt: None)
+    chains = [make_chain('a', GROUP)]
+    group = Entry(GROUP, objectClass=['groupOfNames'], entryUSN=[5])
+    ldap2 = LDAP(chains, [group])
+    api = make_api([chain_dn('a'), chain_dn('b')])
+
+    def add_chain_b():
+        # Another refresh wrote the group after this one read the chains
+        chains.append(make_chain('b', GROUP))
+        group['entryUSN'] = [6]
+    ldap2.concurrent = add_chain_b
+
+    refresh_groups(api, ldap2, [GROUP])
+    assert [str(dn) for dn in group['gpEffectiveChain']] == \
+        [str(chain_dn('a')), str(chain_dn('b'))]
+    assert 'groupPolicyTarget' in group['objectClass']
+    assert group['entryUSN'] == [7]
+
+
+def test_listing_groups():
+    group = Entry(GROUP, objectClass=['groupOfNames'], entryUSN=[1])
+    hostgroup = Entry(HOSTGROUP, objectClass=['groupOfNames'], entryUSN=[1])
+    ldap2 = LDAP([make_chain('a', GROUP), make_chain('b', None, HOSTGROUP)],
+                 [group, hostgroup])
+    api = make_api([chain_dn('a'), chain_dn('b')])
+    refresh_groups(api, ldap2, [GROUP, HOSTGROUP])
+
+    assert listing_groups(api, ldap2, [chain_dn('a')]) == [DN(GROUP)]
+    assert listing_groups(api, ldap2, [chain_dn('c')]) == []
+    # Referential integrity removed b, its rank still finds the group
+    hostgroup['gpEffectiveChain'] = []
+    assert listing_groups(api, ldap2, [chain_dn('a'), chain_dn('b')]) == \
+        [DN(GROUP), DN(HOSTGROUP)]
+
+
+def test_chain_moved_to_another_group():
+    chains = [make_chain('a', GROUP), make_chain('b', GROUP)]
+    group = Entry(GROUP, objectClass=['groupOfNames'], entryUSN=[1])
+    other = Entry(OTHER_GROUP, objectClass=['groupOfNames'], entryUSN=[1])
+    ldap2 = LDAP(chains, [group, other])
+    api = make_api([chain_dn('b'), chain_dn('a')])
+    refresh_targets(api, ldap2, [chain_dn('a'), chain_dn('b')])
+    assert listed(group) == [str(chain_dn('b')), str(chain_dn('a'))]
+    assert listed(other) == []
+
+    # chain-mod a --usergroup=editors
+    chains[0]['userGroup'] = [OTHER_GROUP]
+    refresh_targets(api, ldap2, [chain_dn('a')])
+    assert listed(group) == [str(chain_dn('b'))]
+    assert listed(other) == [str(chain_dn('a'))]
+    assert 'groupPolicyTarget' in other['objectClass']
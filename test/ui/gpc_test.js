@@ -0,0 +1,98 @@
+/*  Authors:
+ *    Danila Skachedubov <skachedubov@altlinux.org>
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+define([
+    'freeipa/ipa',
+    'gpc/gpc'
+], function(IPA, gpc) {
+    return function() {
+
+QUnit.module('gpc');
+
+QUnit.test('visible_range() renders the viewport with overscan', function(assert) {
+
+    var range = gpc.visible_range(0, 280, 28, 1000, 5);
+    assert.deepEqual(range, { start: 0, end: 15 }, 'top of the list');
+
+    range = gpc.visible_range(2800, 280, 28, 1000, 5);
+    assert.deepEqual(range, { start: 95, end: 115 }, 'middle of the list');
+
+    range = gpc.visible_range(27720, 280, 28, 1000, 5);
+    assert.deepEqual(range, { start: 985, end: 1000 }, 'end of the list');
+});
+
+QUnit.test('visible_range() handles short and empty lists', function(assert) {
+
+    assert.deepEqual(gpc.visible_range(0, 280, 28, 3, 5),
+                     { start: 0, end: 3 }, 'shorter than the viewport');
+    assert.deepEqual(gpc.visible_range(0, 280, 28, 0, 5),
+                     { start: 0, end: 0 }, 'empty list');
+    assert.deepEqual(gpc.visible_range(-50, 280, 28, 100, 0),
+                     { start: 0, end: 10 }, 'negative scroll offset');
+});
+
+QUnit.test('reorder() moves one item and keeps the input', function(assert) {
+
+    var list = ['a', 'b', 'c', 'd'];
+
+    assert.deepEqual(gpc.reorder(list, 3, 0), ['d', 'a', 'b', 'c'], 'up');
+    assert.deepEqual(gpc.reorder(list, 0, 2), ['b', 'c', 'a', 'd'], 'down');
+    assert.deepEqual(gpc.reorder(list, 1, 1), list, 'same position');
+    assert.deepEqual(list, ['a', 'b', 'c', 'd'], 'input not modified');
+});
+
+QUnit.test('move_steps() counts single step moves', function(assert) {
+
+    assert.deepEqual(gpc.move_steps(5, 2), { direction: 'up', steps: 3 });
+    assert.deepEqual(gpc.move_steps(0, 4), { direction: 'down', steps: 4 });
+    assert.strictEqual(gpc.move_steps(2, 2), null);
+});
+
+QUnit.test('reorder_commands() builds chain gpLink moves', function(assert) {
+
+    var widget = { facet: { get_pkey: function() { return 'chain1'; } } };
+    var build = gpc.chain_gplink_commands(widget);
+    var commands = build('Policy', 3, 1);
+
+    assert.strictEqual(commands.length, 1, 'one command per move');
+    assert.deepEqual(commands[0], {
+        entity: 'chain',
+        method: 'mod',
+        args: ['chain1'],
+        options: { moveup_gpc: ['Policy', 'Policy'] }
+    });
+
+    commands = build('Policy', 1, 2);
+    assert.deepEqual(commands[0].options, { movedown_gpc: ['Policy'] });
+    assert.deepEqual(build('Policy', 1, 1), [], 'no move');
+});
+
+QUnit.test('reorder_commands() builds master chainList moves', function(assert) {
+
+    var build = gpc.gpmaster_chainlist_commands();
+    var commands = build('chain2', 0, 2);
+
+    assert.strictEqual(commands.length, 1, 'one command per move');
+    assert.deepEqual(commands[0], {
+        entity: 'gpmaster',
+        method: 'movedown_chain',
+        args: ['chain2'],
+        options: { count: 2 }
+    });
+});
+
+};});